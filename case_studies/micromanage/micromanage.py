@@ -13,7 +13,6 @@
 # limitations under the License.
 
 import collections
-import json
 import os
 import shutil
 import subprocess
@@ -100,48 +99,18 @@ search_paths = [  # Where we look for imported jsonnet files
 ]
 debug = False
 
-#  Returns content if worked, None if file not found, or throws an exception
-def jsonnet_try_path(dir, rel):
-    if not rel:
-        raise RuntimeError('Got invalid filename (empty string).')
-    if rel[0] == '/':
-        full_path = rel
-    else:
-        full_path = dir + rel
-    if full_path[-1] == '/':
-        raise RuntimeError('Attempted to import a directory')
-
-    if not os.path.isfile(full_path):
-        return full_path, None
-    with open(full_path) as f:
-        return full_path, f.read()
-
-    
-def jsonnet_import_callback(dir, rel):
-    full_path, content = jsonnet_try_path(dir, rel)
-    if content:
-        return full_path, content
-    for path in search_paths:
-        full_path, content = jsonnet_try_path(path, rel)
-        if content:
-            return full_path, content
-    raise RuntimeError('File not found')
-
 
 def config_load(filename, ext_vars):
     try:
-        text = _jsonnet.evaluate_file(
-            filename,
-            max_trace=100,
-            ext_vars=ext_vars,
-            import_callback=jsonnet_import_callback)
+        # The library search path is searched last to first.
+        vm = _jsonnet.Vm(max_trace=100, jpathdir=search_paths[::-1], import_path_cache=True)
+        config = vm.evaluate_file_value(filename, ext_vars=ext_vars)
     except RuntimeError as e:
         # Error from Jsonnet
         sys.stderr.write(e.message)
         sys.stderr.write('\n')
         sys.exit(1)
 
-    config = json.loads(text)
     try:
         config_check(config)
     except validate.ConfigError as e:
@@ -14,7 +14,12 @@ See the License for the specific language governing permissions and
 limitations under the License.
 */
 
+#include <algorithm>
+#include <atomic>
 #include <cassert>
+#include <cerrno>
+#include <chrono>
+#include <cstdio>
 #include <cstdlib>
 #include <cstring>
 
@@ -25,8 +30,16 @@ limitations under the License.
 #include <map>
 #include <sstream>
 #include <string>
+#include <thread>
+#include <utility>
 #include <vector>
 
+#include <sys/stat.h>
+#ifndef _WIN32
+#include <fcntl.h>
+#include <unistd.h>
+#endif
+
 #include "utils.h"
 
 extern "C" {
@@ -58,10 +71,13 @@ void usage(std::ostream &o)
     o << "  -m / --multi <dir>      Write multiple files to the directory, list files on stdout\n";
     o << "  -y / --yaml-stream      Write output as a YAML stream of JSON documents\n";
     o << "  -S / --string           Expect a string, manifest as plain text\n";
+    o << "  --select <path>         Evaluate only the value at a path such as a.b.0 (repeatable)\n";
     o << "  -s / --max-stack <n>    Number of allowed stack frames\n";
     o << "  -t / --max-trace <n>    Max length of stack trace before cropping\n";
     o << "  --gc-min-objects <n>    Do not run garbage collector until this many\n";
     o << "  --gc-growth-trigger <n> Run garbage collector after this amount of object growth\n";
+    o << "  --gc-stats              Print garbage collector statistics to stderr\n";
+    o << "  --timings               Print the time taken to evaluate and to write to stderr\n";
     o << "  --version               Print version\n";
     o << "Available options for specifying values of 'external' variables:\n";
     o << "Provide the value as a string:\n";
@@ -98,6 +114,8 @@ struct JsonnetConfig {
     std::vector<std::string> inputFiles;
     std::string outputFile;
     bool filenameIsCode;
+    bool gcStats;
+    bool timings;
 
     // EVAL flags
     bool evalMulti;
@@ -106,6 +124,8 @@ struct JsonnetConfig {
 
     JsonnetConfig()
         : filenameIsCode(false),
+          gcStats(false),
+          timings(false),
           evalMulti(false),
           evalStream(false)
     {
@@ -308,6 +328,12 @@ static ArgStatus process_args(int argc, const char **argv, JsonnetConfig *config
                 return ARG_FAILURE;
             }
             jsonnet_gc_growth_trigger(vm, v);
+        } else if (arg == "--gc-stats") {
+            config->gcStats = true;
+        } else if (arg == "--timings") {
+            config->timings = true;
+        } else if (arg == "--select") {
+            jsonnet_select_add(vm, next_arg(i, args).c_str());
         } else if (arg == "-m" || arg == "--multi") {
             config->evalMulti = true;
             std::string output_dir = next_arg(i, args);
@@ -347,6 +373,139 @@ static ArgStatus process_args(int argc, const char **argv, JsonnetConfig *config
     return ARG_CONTINUE;
 }
 
+/** The most output files written at once, which mostly means waiting for the file system. */
+static const size_t MAX_WRITE_THREADS = 16;
+
+/** Whether the file already has the content, without reading it if the size differs. */
+static bool file_has_content(const std::string &filename, const char *content, size_t length)
+{
+    struct stat st;
+    if (stat(filename.c_str(), &st) != 0 || size_t(st.st_size) != length)
+        return false;
+    std::ifstream f(filename.c_str(), std::ios::binary);
+    char buf[65536];
+    size_t done = 0;
+    while (done < length) {
+        f.read(buf, std::min(sizeof(buf), length - done));
+        size_t n = f.gcount();
+        if (n == 0 || std::memcmp(buf, content + done, n) != 0)
+            return false;
+        done += n;
+    }
+    return true;
+}
+
+/** Write the file in place, through a symbolic link if it is one.
+ *
+ * \returns An error message, or the empty string.
+ */
+static std::string write_output_file(const std::string &filename, const char *content,
+                                     size_t length)
+{
+    std::ofstream f;
+    f.open(filename.c_str(), std::ios::binary);
+    if (!f.good())
+        return "Opening output file: " + filename + ": " + strerror(errno);
+    f.write(content, length);
+    f.close();
+    if (!f.good())
+        return "Writing to output file: " + filename + ": " + strerror(errno);
+    return "";
+}
+
+#ifndef _WIN32
+/** The permissions that files get when they are created. */
+static mode_t created_file_mode(void)
+{
+    // The umask can only be read by changing it, so the first call must come before any file is
+    // created by another thread.
+    static const mode_t mode = [] {
+        mode_t mask = umask(0);
+        umask(mask);
+        return 0666 & ~mask;
+    }();
+    return mode;
+}
+#endif
+
+/** Write the file unless it already has the content.
+ *
+ * The content goes to a new temporary file next to the file, which is then renamed over it, so
+ * that the file is never seen half written.  The temporary file takes the permissions and owner
+ * of the file it replaces, and a symbolic link is replaced at its target.  A file that has other
+ * hard links, is not a regular file or whose owner cannot be kept is written in place instead.
+ *
+ * \returns An error message, or the empty string.
+ */
+static std::string write_output_file_atomically(const std::string &filename, const char *content,
+                                                size_t length)
+{
+#ifdef _WIN32
+    // Renaming does not replace existing files here.
+    if (file_has_content(filename, content, length))
+        return "";
+    return write_output_file(filename, content, length);
+#else
+    mode_t mode = created_file_mode();
+
+    // Do not bump the timestamp on the file if its content is the same. This may trigger other
+    // tools (e.g. make) to do unnecessary work.
+    if (file_has_content(filename, content, length))
+        return "";
+
+    std::string path = filename;
+    struct stat st;
+    if (lstat(filename.c_str(), &st) == 0 && S_ISLNK(st.st_mode)) {
+        char *target = realpath(filename.c_str(), nullptr);
+        if (target == nullptr)
+            return write_output_file(filename, content, length);
+        path = target;
+        free(target);
+    }
+    bool exists = stat(path.c_str(), &st) == 0;
+    if (exists && (!S_ISREG(st.st_mode) || st.st_nlink > 1))
+        return write_output_file(filename, content, length);
+
+    size_t slash = path.rfind('/');
+    std::string tmp = slash == std::string::npos ? "" : path.substr(0, slash + 1);
+    tmp += "." + path.substr(slash == std::string::npos ? 0 : slash + 1) + ".XXXXXX";
+    std::vector<char> tmp_buf(tmp.begin(), tmp.end());
+    tmp_buf.push_back('\0');
+    int fd = mkstemp(tmp_buf.data());
+    if (fd < 0)
+        return "Opening output file: " + filename + ": " + strerror(errno);
+    tmp = tmp_buf.data();
+
+    std::string msg;
+    struct stat tmp_st;
+    if (exists) {
+        mode = st.st_mode & 07777;
+        if (fstat(fd, &tmp_st) == 0 && (tmp_st.st_uid != st.st_uid || tmp_st.st_gid != st.st_gid)
+            && fchown(fd, st.st_uid, st.st_gid) != 0) {
+            close(fd);
+            unlink(tmp.c_str());
+            return write_output_file(filename, content, length);
+        }
+    }
+    if (fchmod(fd, mode) != 0)
+        msg = "Writing to output file: " + filename + ": " + strerror(errno);
+    for (size_t done = 0; msg.empty() && done < length;) {
+        ssize_t n = write(fd, content + done, length - done);
+        if (n < 0 && errno != EINTR)
+            msg = "Writing to output file: " + filename + ": " + strerror(errno);
+        else if (n > 0)
+            done += n;
+    }
+    if (close(fd) != 0 && msg.empty())
+        msg = "Writing to output file: " + filename + ": " + strerror(errno);
+    if (msg.empty() && std::rename(tmp.c_str(), path.c_str()) != 0)
+        msg = "Writing to output file: " + filename + ": " + strerror(errno);
+    if (!msg.empty())
+        unlink(tmp.c_str());
+    return msg;
+#endif
+}
+
 /** Writes output files for multiple file output */
 static bool write_multi_output_files(JsonnetVm *vm, char *output, const std::string &output_dir,
                                      const std::string &output_file)
@@ -354,7 +513,9 @@ static bool write_multi_output_files(JsonnetVm *vm, char *output, const std::str
     // If multiple file output is used, then iterate over each string from
     // the sequence of strings returned by jsonnet_evaluate_snippet_multi,
     // construct pairs of filename and content, and write each output file.
-    std::map<std::string, std::string> r;
+    // The content is written straight from the output buffer.
+    typedef std::pair<const char *, size_t> Content;
+    std::vector<std::pair<std::string, Content>> r;
     for (const char *c = output; *c != '\0';) {
         const char *filename = c;
         const char *c2 = c;
@@ -364,11 +525,11 @@ static bool write_multi_output_files(JsonnetVm *vm, char *output, const std::str
         const char *json = c2;
         while (*c2 != '\0')
             ++c2;
+        r.emplace_back(output_dir + filename, Content(json, c2 - json));
         ++c2;
         c = c2;
-        r[filename] = json;
     }
-    jsonnet_realloc(vm, output, 0);
+    std::sort(r.begin(), r.end());
 
     std::ostream *o;
     std::ofstream f;
@@ -380,41 +541,40 @@ static bool write_multi_output_files(JsonnetVm *vm, char *output, const std::str
         if (!f.good()) {
             std::string msg = "Writing to output file: " + output_file;
             perror(msg.c_str());
+            jsonnet_realloc(vm, output, 0);
             return false;
         }
         o = &f;
     }
 
-    for (const auto &pair : r) {
-        const std::string &new_content = pair.second;
-        const std::string &filename = output_dir + pair.first;
-        (*o) << filename << std::endl;
-        {
-            std::ifstream exists(filename.c_str());
-            if (exists.good()) {
-                std::string existing_content;
-                existing_content.assign(std::istreambuf_iterator<char>(exists),
-                                        std::istreambuf_iterator<char>());
-                if (existing_content == new_content) {
-                    // Do not bump the timestamp on the file if its content is
-                    // the same. This may trigger other tools (e.g. make) to do
-                    // unnecessary work.
-                    continue;
-                }
-            }
+    for (const auto &pair : r)
+        (*o) << pair.first << std::endl;
+
+    // The files are written by a few threads, since each mostly waits for the file system.
+    std::vector<std::string> errors(r.size());
+    std::atomic<size_t> next(0);
+    std::atomic<bool> failed(false);
+    auto write_files = [&]() {
+        for (size_t i; !failed && (i = next++) < r.size();) {
+            const auto &pair = r[i];
+            errors[i] = write_output_file_atomically(
+                pair.first, pair.second.first, pair.second.second);
+            if (!errors[i].empty())
+                failed = true;
         }
-        std::ofstream f;
-        f.open(filename.c_str());
-        if (!f.good()) {
-            std::string msg = "Opening output file: " + filename;
-            perror(msg.c_str());
-            return false;
-        }
-        f << new_content;
-        f.close();
-        if (!f.good()) {
-            std::string msg = "Writing to output file: " + filename;
-            perror(msg.c_str());
+    };
+    std::vector<std::thread> threads;
+    size_t num_threads = std::min(MAX_WRITE_THREADS, r.size());
+    for (size_t i = 1; i < num_threads; ++i)
+        threads.emplace_back(write_files);
+    write_files();
+    for (auto &thread : threads)
+        thread.join();
+    jsonnet_realloc(vm, output, 0);
+
+    for (const auto &error : errors) {
+        if (!error.empty()) {
+            std::cerr << error << std::endl;
             return false;
         }
     }
@@ -518,6 +678,7 @@ int main(int argc, const char **argv)
             return EXIT_FAILURE;
         }
 
+        auto start = std::chrono::steady_clock::now();
         if (config.evalMulti) {
             output = jsonnet_evaluate_snippet_multi(
                 vm, config.inputFiles[0].c_str(), input.c_str(), &error);
@@ -529,6 +690,17 @@ int main(int argc, const char **argv)
                 vm, config.inputFiles[0].c_str(), input.c_str(), &error);
         }
 
+        auto evaluated = std::chrono::steady_clock::now();
+
+        if (config.gcStats) {
+            JsonnetGcStats stats;
+            jsonnet_gc_stats(vm, &stats);
+            std::cerr << "GC: " << stats.cycles << " cycles in " << stats.steps << " steps, "
+                      << stats.freed << " objects freed, peak " << stats.peak_entities
+                      << " objects, " << stats.pause_ms << " ms total, " << stats.max_pause_ms
+                      << " ms longest" << std::endl;
+        }
+
         if (error) {
             std::cerr << output;
             jsonnet_realloc(vm, output, 0);
@@ -557,6 +729,14 @@ int main(int argc, const char **argv)
             }
         }
 
+        if (config.timings) {
+            typedef std::chrono::duration<double, std::milli> Millis;
+            Millis evaluation = evaluated - start;
+            Millis writing = std::chrono::steady_clock::now() - evaluated;
+            std::cerr << "Timings: evaluation " << evaluation.count() << " ms, writing "
+                      << writing.count() << " ms" << std::endl;
+        }
+
         jsonnet_destroy(vm);
         return EXIT_SUCCESS;
 
@@ -21,6 +21,7 @@ limitations under the License.
 #include <cstdlib>
 
 #include <iostream>
+#include <iterator>
 #include <list>
 #include <map>
 #include <string>
@@ -115,6 +116,22 @@ static inline std::ostream &operator<<(std::ostream &o, const Identifier *id)
 
 typedef std::vector<const Identifier *> Identifiers;
 
+/** Where a variable is bound, as resolved by static analysis.
+ *
+ * The interpreter keeps bindings in scopes: the call that evaluates a function, thunk or field
+ * body, and within it one scope per enclosing local and object comprehension.  Each scope's
+ * bindings are sorted by identifier.  depth is the number of scopes to skip from the innermost
+ * one, and index the position of the binding within that scope.
+ */
+struct VarSlot {
+    /** The depth of variables that were not resolved. */
+    static const unsigned UNRESOLVED = ~0u;
+    unsigned depth;
+    unsigned index;
+    VarSlot(void) : depth(UNRESOLVED), index(0) {}
+    VarSlot(unsigned depth, unsigned index) : depth(depth), index(index) {}
+};
+
 /** All AST nodes are subtypes of this class.
  */
 struct AST {
@@ -122,8 +139,18 @@ struct AST {
     ASTType type;
     Fodder openFodder;
     Identifiers freeVariables;
+    /** For functions and objects, where each of freeVariables is bound at the point where they
+     * are captured, or empty if that was not resolved. */
+    std::vector<VarSlot> freeVariableSlots;
+    /** For ASTs that are evaluated by thunks (local bindings, arguments and array elements),
+     * where each of freeVariables is bound at the point where the thunk is made, or empty if
+     * that was not resolved. */
+    std::vector<VarSlot> thunkSlots;
+    /** Whether static analysis has filled in freeVariables.  Lets subtrees that are shared
+     * between programs (e.g. the standard library) be analysed only once. */
+    bool analysed;
     AST(const LocationRange &location, ASTType type, const Fodder &open_fodder)
-        : location(location), type(type), openFodder(open_fodder)
+        : location(location), type(type), openFodder(open_fodder), analysed(false)
     {
     }
     virtual ~AST(void) {}
@@ -932,6 +959,8 @@ struct Unary : public AST {
 /** Represents variables. */
 struct Var : public AST {
     const Identifier *id;
+    /** Where id is bound, filled in by static analysis. */
+    VarSlot slot;
     Var(const LocationRange &lr, const Fodder &open_fodder, const Identifier *id)
         : AST(lr, AST_VAR, open_fodder), id(id)
     {
@@ -943,8 +972,15 @@ struct Var : public AST {
 class Allocator {
     std::map<UString, const Identifier *> internedIdentifiers;
     ASTs allocated;
+    const Allocator *base;
 
    public:
+    /** \param base If not null, identifiers already interned by base are returned instead of
+     * being interned again, so that ASTs from both allocators can be used in the same program.
+     * It must outlive this allocator.
+     */
+    Allocator(const Allocator *base = nullptr) : base(base) {}
+
     template <class T, class... Args>
     T *make(Args &&... args)
     {
@@ -965,14 +1001,56 @@ class Allocator {
      * The location used in the Identifier AST is that of the first one parsed.
      */
     const Identifier *makeIdentifier(const UString &name)
+    {
+        const Identifier *r = findIdentifier(name);
+        if (r != nullptr) {
+            return r;
+        }
+        r = new Identifier(name);
+        internedIdentifiers[name] = r;
+        return r;
+    }
+    /** The number of ASTs made so far, to be given to moveASTsTo. */
+    size_t numASTs(void) const
+    {
+        return allocated.size();
+    }
+    /** Hand over the ASTs made since numASTs returned first to another allocator, which will then
+     * free them instead of this one.
+     */
+    void moveASTsTo(Allocator &dest, size_t first)
+    {
+        auto it = allocated.end();
+        std::advance(it, -static_cast<std::ptrdiff_t>(allocated.size() - first));
+        dest.allocated.splice(dest.allocated.end(), allocated, it, allocated.end());
+    }
+    /** Hand over all the identifiers interned by this allocator (but not its base) to another
+     * allocator, so that they outlive this one.  They must not already be interned there.
+     */
+    void moveIdentifiersTo(Allocator &dest)
+    {
+        for (const auto &x : internedIdentifiers) {
+            assert(dest.internedIdentifiers.find(x.first) == dest.internedIdentifiers.end());
+            dest.internedIdentifiers[x.first] = x.second;
+        }
+        internedIdentifiers.clear();
+    }
+    /** Returns the interned identifier, or nullptr if there is none yet.
+     *
+     * Identifiers interned by this allocator take precedence over those of its base.  The base
+     * may intern the same name later (when identifiers of another allocator are moved to it), and
+     * the ASTs of this allocator must keep getting the identifier they were made with.
+     */
+    const Identifier *findIdentifier(const UString &name) const
     {
         auto it = internedIdentifiers.find(name);
         if (it != internedIdentifiers.end()) {
             return it->second;
         }
-        auto r = new Identifier(name);
-        internedIdentifiers[name] = r;
-        return r;
+        if (base != nullptr) {
+            return base->findIdentifier(name);
+        }
+        return nullptr;
     }
     ~Allocator()
     {
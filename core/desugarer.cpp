@@ -34,7 +34,7 @@ struct BuiltinDecl {
     std::vector<UString> params;
 };
 
-static unsigned long max_builtin = 37;
+static unsigned long max_builtin = 54;
 BuiltinDecl jsonnet_builtin_decl(unsigned long builtin)
 {
     switch (builtin) {
@@ -76,6 +76,23 @@ BuiltinDecl jsonnet_builtin_decl(unsigned long builtin)
         case 35: return {U"parseJson", {U"str"}};
         case 36: return {U"encodeUTF8", {U"str"}};
         case 37: return {U"decodeUTF8", {U"arr"}};
+        case 38: return {U"slice", {U"indexable", U"index", U"end", U"step"}};
+        case 39: return {U"stringChars", {U"str"}};
+        case 40: return {U"foldl", {U"func", U"arr", U"init"}};
+        case 41: return {U"foldr", {U"func", U"arr", U"init"}};
+        case 42: return {U"flattenArrays", {U"arrs"}};
+        case 43: return {U"equals", {U"a", U"b"}};
+        case 44: return {U"sortImpl", {U"arr", U"keyF"}};
+        case 45: return {U"uniqImpl", {U"arr", U"keyF"}};
+        case 46: return {U"setInterImpl", {U"a", U"b", U"keyF"}};
+        case 47: return {U"setUnionImpl", {U"a", U"b", U"keyF"}};
+        case 48: return {U"setDiffImpl", {U"a", U"b", U"keyF"}};
+        case 49: return {U"format", {U"str", U"vals"}};
+        case 50: return {U"escapeStringJson", {U"str_"}};
+        case 51: return {U"manifestJsonEx", {U"value", U"indent"}};
+        case 52: return {U"manifestYamlDocImpl", {U"value", U"indent_array_in_object"}};
+        case 53: return {U"base64", {U"input"}};
+        case 54: return {U"mapImpl", {U"func", U"arr"}};
         default:
             std::cerr << "INTERNAL ERROR: Unrecognized builtin function: " << builtin << std::endl;
             std::abort();
@@ -901,11 +918,8 @@ class Desugarer {
         }
     }
 
-    void desugarFile(AST *&ast, std::map<std::string, VmExt> *tlas)
+    DesugaredObject *stdlib(void)
     {
-        desugar(ast, 0);
-
-        // Now, implement the std library by wrapping in a local construct.
         Tokens tokens = jsonnet_lex("std.jsonnet", STD_CODE);
         AST *std_ast = jsonnet_parse(alloc, tokens);
         desugar(std_ast, 0);
@@ -934,9 +948,39 @@ class Desugarer {
                 fields.emplace_back(ObjectField::HIDDEN, name, fn);
             }
         }
+        return std_obj;
+    }
+
+    void desugarFile(AST *&ast, std::map<std::string, VmExt> *tlas,
+                     const DesugaredObject *shared_std)
+    {
+        desugar(ast, 0);
+
+        // Now, implement the std library by wrapping in a local construct.
+        DesugaredObject *std_obj;
+        if (shared_std == nullptr) {
+            std_obj = stdlib();
+        } else {
+            // Only the thisFile field differs between files, so copy the list of fields but share
+            // their (already analysed) bodies.
+            std_obj = make<DesugaredObject>(*shared_std);
+            std_obj->freeVariables.clear();
+            std_obj->analysed = false;
+        }
+        DesugaredObject::Fields &fields = std_obj->fields;
         fields.emplace_back(
             ObjectField::HIDDEN, str(U"thisFile"), str(decode_utf8(ast->location.file)));
 
+        if (tlas != nullptr)
+            ast = bindTlas(ast, *tlas);
+
+        // local std = (std.jsonnet stuff); ast
+        ast = make<Local>(ast->location, EF, singleBind(id(U"std"), std_obj), ast);
+    }
+
+    /** Wrap ast so that, if it is a function, it is called with the top-level arguments. */
+    AST *bindTlas(AST *ast, const std::map<std::string, VmExt> &tlas)
+    {
         std::vector<std::string> empty;
         auto line_end_blank = Fodder{{FodderElement::LINE_END, 1, 0, empty}};
         auto line_end = Fodder{{FodderElement::LINE_END, 0, 0, empty}};
@@ -946,52 +990,92 @@ class Desugarer {
         //     body(tlas...)
         // else
         //     body
-        if (tlas != nullptr) {
-            LocationRange tla_loc("Top-level function");
-            ArgParams args;
-            for (const auto &pair : *tlas) {
-                AST *expr;
-                if (pair.second.isCode) {
-                    // Now, implement the std library by wrapping in a local construct.
-                    Tokens tokens = jsonnet_lex("tla:" + pair.first, pair.second.data.c_str());
-                    expr = jsonnet_parse(alloc, tokens);
-                    desugar(expr, 0);
-                } else {
-                    expr = str(decode_utf8(pair.second.data));
-                }
-                // Add them as named arguments, so order does not matter.
-                args.emplace_back(EF, id(decode_utf8(pair.first)), EF, expr, EF);
+        LocationRange tla_loc("Top-level function");
+        ArgParams args;
+        for (const auto &pair : tlas) {
+            AST *expr;
+            if (pair.second.isCode) {
+                // Now, implement the std library by wrapping in a local construct.
+                Tokens tokens = jsonnet_lex("tla:" + pair.first, pair.second.data.c_str());
+                expr = jsonnet_parse(alloc, tokens);
+                desugar(expr, 0);
+            } else if (pair.second.value != nullptr) {
+                // The interpreter converts the value when it is needed.
+                auto *fn = make<BuiltinFunction>(tla_loc, "tlaValue", Identifiers{id(U"name")});
+                expr = make<Apply>(tla_loc,
+                                   EF,
+                                   fn,
+                                   EF,
+                                   ArgParams{{str(decode_utf8(pair.first)), EF}},
+                                   false,  // trailing comma
+                                   EF,
+                                   EF,
+                                   true  // tailstrict
+                                   );
+            } else {
+                expr = str(decode_utf8(pair.second.data));
             }
-            const Identifier *body = id(U"top_level");
-            ast =
-                make<Local>(ast->location,
-                            line_end_blank,
-                            singleBind(body, ast),
-                            make<Conditional>(E,
-                                              line_end,
-                                              primitiveEquals(E, type(var(body)), str(U"function")),
-                                              EF,
-                                              make<Apply>(tla_loc,
-                                                          EF,
-                                                          make<Var>(E, line_end, body),
-                                                          EF,
-                                                          args,
-                                                          false,  // trailing comma
-                                                          EF,
-                                                          EF,
-                                                          false  // tailstrict
-                                                          ),
-                                              line_end,
-                                              make<Var>(E, line_end, body)));
+            // Add them as named arguments, so order does not matter.
+            args.emplace_back(EF, id(decode_utf8(pair.first)), EF, expr, EF);
         }
+        const Identifier *body = id(U"top_level");
+        return make<Local>(ast->location,
+                           line_end_blank,
+                           singleBind(body, ast),
+                           make<Conditional>(E,
+                                             line_end,
+                                             primitiveEquals(E, type(var(body)), str(U"function")),
+                                             EF,
+                                             make<Apply>(tla_loc,
+                                                         EF,
+                                                         make<Var>(E, line_end, body),
+                                                         EF,
+                                                         args,
+                                                         false,  // trailing comma
+                                                         EF,
+                                                         EF,
+                                                         false  // tailstrict
+                                                         ),
+                                             line_end,
+                                             make<Var>(E, line_end, body)));
+    }
 
-        // local std = (std.jsonnet stuff); ast
-        ast = make<Local>(ast->location, EF, singleBind(id(U"std"), std_obj), ast);
+    /** Rebuild the wrapping added by desugarFile around a program, with new top-level arguments.
+     *
+     * The program body and the std object are shared with the original.
+     */
+    AST *rebindTlas(const AST *program, const std::map<std::string, VmExt> &tlas)
+    {
+        auto *std_local = dynamic_cast<const Local *>(program);
+        auto *tla_local =
+            std_local == nullptr ? nullptr : dynamic_cast<const Local *>(std_local->body);
+        if (tla_local == nullptr || tla_local->binds.size() != 1 ||
+            tla_local->binds[0].var != id(U"top_level")) {
+            std::cerr << "INTERNAL ERROR: program was not desugared with top-level arguments."
+                      << std::endl;
+            std::abort();
+        }
+        AST *ast = bindTlas(tla_local->binds[0].body, tlas);
+        return make<Local>(ast->location, EF, singleBind(id(U"std"), std_local->binds[0].body), ast);
     }
 };
 
-void jsonnet_desugar(Allocator *alloc, AST *&ast, std::map<std::string, VmExt> *tlas)
+DesugaredObject *jsonnet_desugar_stdlib(Allocator *alloc)
+{
+    Desugarer desugarer(alloc);
+    return desugarer.stdlib();
+}
+
+void jsonnet_desugar(Allocator *alloc, AST *&ast, std::map<std::string, VmExt> *tlas,
+                     const DesugaredObject *stdlib)
+{
+    Desugarer desugarer(alloc);
+    desugarer.desugarFile(ast, tlas, stdlib);
+}
+
+AST *jsonnet_desugar_rebind_tla(Allocator *alloc, const AST *program,
+                                const std::map<std::string, VmExt> &tla)
 {
     Desugarer desugarer(alloc);
-    desugarer.desugarFile(ast, tlas);
+    return desugarer.rebindTlas(program, tla);
 }
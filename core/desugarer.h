@@ -23,12 +23,37 @@ limitations under the License.
 #include "ast.h"
 #include "vm.h"
 
+/** Build the desugared standard library object, with the native builtins bound.
+ *
+ * The result can be passed to jsonnet_desugar to avoid building the standard library for every
+ * file.  Allocators used with it must share its identifiers, see Allocator::Allocator.
+ *
+ * \param alloc Allocator for making new identifiers / ASTs.
+ */
+DesugaredObject *jsonnet_desugar_stdlib(Allocator *alloc);
+
 /** Translate the AST to remove syntax sugar.
  * \param alloc Allocator for making new identifiers / ASTs.
  * \param ast The AST to change.
  * \param tla the top level arguments.  If null then do not try to process
  * top-level functions.
+ * \param stdlib The result of jsonnet_desugar_stdlib, shared read-only with the new AST.  If null
+ * then the standard library is built from scratch.
+ */
+void jsonnet_desugar(Allocator *alloc, AST *&ast, std::map<std::string, VmExt> *tla,
+                     const DesugaredObject *stdlib = nullptr);
+
+/** Give different top-level arguments to a program.
+ *
+ * Only the code that binds the arguments is created again, the rest is shared with the given
+ * program, so it is not desugared or analysed again.
+ *
+ * \param alloc Allocator for making new identifiers / ASTs.
+ * \param program The result of jsonnet_desugar with a non-null tla.
+ * \param tla The new top level arguments.
+ * \returns The new program, which needs static analysis.
  */
-void jsonnet_desugar(Allocator *alloc, AST *&ast, std::map<std::string, VmExt> *tla);
+AST *jsonnet_desugar_rebind_tla(Allocator *alloc, const AST *program,
+                                const std::map<std::string, VmExt> &tla);
 
 #endif
@@ -19,6 +19,7 @@ limitations under the License.
 
 #include <memory>
 #include <string>
+#include <utility>
 #include <vector>
 
 #include <libjsonnet.h>
@@ -46,7 +47,8 @@ struct JsonnetJsonValue {
     std::string string;
     double number;  // Also used for bool (0.0 and 1.0)
     std::vector<std::unique_ptr<JsonnetJsonValue>> elements;
-    std::map<std::string, std::unique_ptr<JsonnetJsonValue>> fields;
+    /** In order of insertion.  If a field occurs more than once, the last one counts. */
+    std::vector<std::pair<std::string, std::unique_ptr<JsonnetJsonValue>>> fields;
 };
 
 #endif
@@ -20,7 +20,10 @@ limitations under the License.
 
 #include <exception>
 #include <fstream>
+#include <functional>
 #include <iostream>
+#include <list>
+#include <memory>
 #include <sstream>
 #include <string>
 
@@ -32,6 +35,7 @@ extern "C" {
 #include "desugarer.h"
 #include "formatter.h"
 #include "json.h"
+#include "md5.h"
 #include "parser.h"
 #include "static_analysis.h"
 #include "vm.h"
@@ -50,7 +54,8 @@ static char *from_string(JsonnetVm *vm, const std::string &v)
 }
 
 static char *default_import_callback(void *ctx, const char *dir, const char *file,
-                                     char **found_here_cptr, int *success);
+                                     char **found_here_cptr, JsonnetImportBuffer *buffer,
+                                     int *success);
 
 const char *jsonnet_json_extract_string(JsonnetVm *vm, const struct JsonnetJsonValue *v)
 {
@@ -83,6 +88,43 @@ int jsonnet_json_extract_null(struct JsonnetVm *vm, const struct JsonnetJsonValu
     return v->kind == JsonnetJsonValue::NULL_KIND;
 }
 
+int jsonnet_json_extract_array(struct JsonnetVm *vm, const struct JsonnetJsonValue *v,
+                               size_t *out)
+{
+    (void)vm;
+    if (v->kind != JsonnetJsonValue::ARRAY)
+        return 0;
+    *out = v->elements.size();
+    return 1;
+}
+
+const JsonnetJsonValue *jsonnet_json_array_element(struct JsonnetVm *vm,
+                                                   const struct JsonnetJsonValue *arr, size_t i)
+{
+    (void)vm;
+    assert(arr->kind == JsonnetJsonValue::ARRAY);
+    return arr->elements[i].get();
+}
+
+int jsonnet_json_extract_object(struct JsonnetVm *vm, const struct JsonnetJsonValue *v,
+                                size_t *out)
+{
+    (void)vm;
+    if (v->kind != JsonnetJsonValue::OBJECT)
+        return 0;
+    *out = v->fields.size();
+    return 1;
+}
+
+const char *jsonnet_json_object_field(struct JsonnetVm *vm, const struct JsonnetJsonValue *obj,
+                                      size_t i, const struct JsonnetJsonValue **v)
+{
+    (void)vm;
+    assert(obj->kind == JsonnetJsonValue::OBJECT);
+    *v = obj->fields[i].second.get();
+    return obj->fields[i].first.c_str();
+}
+
 JsonnetJsonValue *jsonnet_json_make_string(JsonnetVm *vm, const char *v)
 {
     (void)vm;
@@ -146,7 +188,7 @@ void jsonnet_json_object_append(JsonnetVm *vm, JsonnetJsonValue *obj, const char
 {
     (void)vm;
     assert(obj->kind == JsonnetJsonValue::OBJECT);
-    obj->fields[std::string(f)] = std::unique_ptr<JsonnetJsonValue>(v);
+    obj->fields.emplace_back(std::string(f), std::unique_ptr<JsonnetJsonValue>(v));
 }
 
 void jsonnet_json_destroy(JsonnetVm *vm, JsonnetJsonValue *v)
@@ -155,32 +197,99 @@ void jsonnet_json_destroy(JsonnetVm *vm, JsonnetJsonValue *v)
     delete v;
 }
 
+/** A program that has been parsed, desugared and analysed, see jsonnet_compile_snippet. */
+struct CompiledProgram {
+    /** Owns the ASTs of the program.  Based on the allocator of the VM that compiled it. */
+    Allocator alloc;
+    /** Desugared with no top-level arguments, see jsonnet_desugar_rebind_tla. */
+    AST *ast;
+    CompiledProgram(const Allocator *base) : alloc(base), ast(nullptr) {}
+};
+
+/** Compiled programs are shared between the user and the VM's program cache. */
+struct JsonnetProgram {
+    std::shared_ptr<CompiledProgram> program;
+};
+
+struct JsonnetMulti {
+    /** Keeps the program alive while the evaluation goes on. */
+    std::shared_ptr<CompiledProgram> program;
+    /** Owns the ASTs made during the evaluation.  Based on the allocator of the program. */
+    Allocator alloc;
+    std::unique_ptr<VmMultiResult> result;
+    JsonnetMulti(const std::shared_ptr<CompiledProgram> &program)
+        : program(program), alloc(&program->alloc)
+    {
+    }
+};
+
+/** Programs are cached by filename and the md5 of their code. */
+typedef std::pair<std::string, std::string> ProgramCacheKey;
+typedef std::list<std::pair<ProgramCacheKey, std::shared_ptr<CompiledProgram>>> ProgramCache;
+
 struct JsonnetVm {
+    /** Owns the standard library, and the identifiers it uses.  Allocators used for individual
+     * evaluations are based on this one. */
+    Allocator alloc;
+    /** Built on first use and shared read-only by every evaluation on this VM. */
+    DesugaredObject *stdlib;
     double gcGrowthTrigger;
     unsigned maxStack;
     unsigned gcMinObjects;
     unsigned maxTrace;
     std::map<std::string, VmExt> ext;
     std::map<std::string, VmExt> tla;
+    /** Given to the VM, either default_import_callback or one given by the user. */
+    JsonnetImportBufferCallback *importBufferCallback;
+    void *importBufferCallbackContext;
+    /** The callback given to jsonnet_import_callback, see classic_import_callback. */
     JsonnetImportCallback *importCallback;
     VmNativeCallbackMap nativeCallbacks;
     void *importCallbackContext;
+    /** Called by default_import_callback with the files it cannot find, or null. */
+    JsonnetImportBufferCallback *importFallback;
+    void *importFallbackContext;
+    /** See jsonnet_import_path_cache. */
+    bool importPathCache;
+    /** Where default_import_callback found each path by directory, or "" if not there. */
+    std::map<std::string, std::map<std::string, std::string>> importPaths;
     bool stringOutput;
     std::vector<std::string> jpaths;
+    /** Most recently used first. */
+    ProgramCache programCache;
+    std::map<ProgramCacheKey, ProgramCache::iterator> programCacheIndex;
+    unsigned programCacheMax;
+    ImportCache importCache;
+    /** Set by jsonnet_cancel, possibly from another thread. */
+    std::atomic<bool> cancelled;
+    /** Added to by every evaluation, see jsonnet_gc_stats. */
+    JsonnetGcStats gcStats;
+    /** The paths to evaluate instead of the whole value, see jsonnet_select_add. */
+    std::vector<std::string> select;
 
     FmtOpts fmtOpts;
     bool fmtDebugDesugaring;
 
     JsonnetVm(void)
-        : gcGrowthTrigger(2.0),
+        : stdlib(nullptr),
+          gcGrowthTrigger(2.0),
           maxStack(500),
           gcMinObjects(1000),
           maxTrace(20),
-          importCallback(default_import_callback),
-          importCallbackContext(this),
+          importBufferCallback(default_import_callback),
+          importBufferCallbackContext(this),
+          importCallback(nullptr),
+          importCallbackContext(nullptr),
+          importFallback(nullptr),
+          importFallbackContext(nullptr),
+          importPathCache(false),
           stringOutput(false),
+          programCacheMax(0),
+          cancelled(false),
+          gcStats(),
           fmtDebugDesugaring(false)
     {
+        importCache.checkFileStats = true;
         jpaths.emplace_back("/usr/share/jsonnet-" + std::string(jsonnet_version()) + "/");
         jpaths.emplace_back("/usr/local/share/jsonnet-" + std::string(jsonnet_version()) + "/");
     }
@@ -189,8 +298,7 @@ struct JsonnetVm {
 enum ImportStatus { IMPORT_STATUS_OK, IMPORT_STATUS_FILE_NOT_FOUND, IMPORT_STATUS_IO_ERROR };
 
 static enum ImportStatus try_path(const std::string &dir, const std::string &rel,
-                                  std::string &content, std::string &found_here,
-                                  std::string &err_msg)
+                                  std::string &found_here, std::string &err_msg)
 {
     std::string abs_path;
     if (rel.length() == 0) {
@@ -209,47 +317,65 @@ static enum ImportStatus try_path(const std::string &dir, const std::string &rel
         return IMPORT_STATUS_IO_ERROR;
     }
 
+    // The content is loaded by the VM, see jsonnet_vm_load_file.
     std::ifstream f;
     f.open(abs_path.c_str());
     if (!f.good())
         return IMPORT_STATUS_FILE_NOT_FOUND;
-    try {
-        content.assign(std::istreambuf_iterator<char>(f), std::istreambuf_iterator<char>());
-    } catch (const std::ios_base::failure &io_err) {
-        err_msg = io_err.what();
-        return IMPORT_STATUS_IO_ERROR;
-    }
-    if (!f.good()) {
-        err_msg = strerror(errno);
-        return IMPORT_STATUS_IO_ERROR;
-    }
 
     found_here = abs_path;
 
     return IMPORT_STATUS_OK;
 }
 
+/** Like try_path, but remembers the files found and not found if importPathCache is set. */
+static enum ImportStatus try_path_cached(JsonnetVm *vm, const std::string &dir,
+                                         const std::string &rel, std::string &found_here,
+                                         std::string &err_msg)
+{
+    if (!vm->importPathCache)
+        return try_path(dir, rel, found_here, err_msg);
+    std::map<std::string, std::string> &paths = vm->importPaths[dir];
+    auto it = paths.find(rel);
+    if (it != paths.end()) {
+        if (it->second.empty())
+            return IMPORT_STATUS_FILE_NOT_FOUND;
+        found_here = it->second;
+        return IMPORT_STATUS_OK;
+    }
+    ImportStatus status = try_path(dir, rel, found_here, err_msg);
+    if (status == IMPORT_STATUS_OK)
+        paths[rel] = found_here;
+    else if (status == IMPORT_STATUS_FILE_NOT_FOUND)
+        paths[rel] = "";
+    return status;
+}
+
 static char *default_import_callback(void *ctx, const char *dir, const char *file,
-                                     char **found_here_cptr, int *success)
+                                     char **found_here_cptr, JsonnetImportBuffer *buffer,
+                                     int *success)
 {
     auto *vm = static_cast<JsonnetVm *>(ctx);
 
-    std::string input, found_here, err_msg;
+    std::string found_here, err_msg;
 
-    ImportStatus status = try_path(dir, file, input, found_here, err_msg);
+    ImportStatus status = try_path_cached(vm, dir, file, found_here, err_msg);
 
     std::vector<std::string> jpaths(vm->jpaths);
 
     // If not found, try library search path.
     while (status == IMPORT_STATUS_FILE_NOT_FOUND) {
         if (jpaths.size() == 0) {
+            if (vm->importFallback != nullptr)
+                return vm->importFallback(
+                    vm->importFallbackContext, dir, file, found_here_cptr, buffer, success);
             *success = 0;
             const char *err = "no match locally or in the Jsonnet library paths.";
             char *r = jsonnet_realloc(vm, nullptr, std::strlen(err) + 1);
             std::strcpy(r, err);
             return r;
         }
-        status = try_path(jpaths.back(), file, input, found_here, err_msg);
+        status = try_path_cached(vm, jpaths.back(), file, found_here, err_msg);
         jpaths.pop_back();
     }
 
@@ -260,10 +386,29 @@ static char *default_import_callback(void *ctx, const char *dir, const char *fil
         assert(status == IMPORT_STATUS_OK);
         *success = 1;
         *found_here_cptr = from_string(vm, found_here);
-        return from_string(vm, input);
+        buffer->content = nullptr;
+        return nullptr;
     }
 }
 
+/** Calls the callback given to jsonnet_import_callback, and hands its result to the VM. */
+static char *classic_import_callback(void *ctx, const char *dir, const char *file,
+                                     char **found_here_cptr, JsonnetImportBuffer *buffer,
+                                     int *success)
+{
+    auto *vm = static_cast<JsonnetVm *>(ctx);
+    char *content =
+        vm->importCallback(vm->importCallbackContext, dir, file, found_here_cptr, success);
+    if (!*success)
+        return content;
+    // Allocated by jsonnet_realloc, so it can be released with free.
+    buffer->content = content;
+    buffer->length = std::strlen(content);
+    buffer->release = ::free;
+    buffer->owner = content;
+    return nullptr;
+}
+
 #define TRY try {
 #define CATCH(func)                                                                           \
     }                                                                                         \
@@ -313,6 +458,26 @@ void jsonnet_gc_growth_trigger(JsonnetVm *vm, double v)
     vm->gcGrowthTrigger = v;
 }
 
+void jsonnet_gc_stats(JsonnetVm *vm, JsonnetGcStats *stats)
+{
+    *stats = vm->gcStats;
+}
+
+void jsonnet_gc_stats_reset(JsonnetVm *vm)
+{
+    vm->gcStats = JsonnetGcStats();
+}
+
+void jsonnet_select_add(struct JsonnetVm *vm, const char *path)
+{
+    vm->select.emplace_back(path);
+}
+
+void jsonnet_select_clear(struct JsonnetVm *vm)
+{
+    vm->select.clear();
+}
+
 void jsonnet_string_output(struct JsonnetVm *vm, int v)
 {
     vm->stringOutput = bool(v);
@@ -322,6 +487,41 @@ void jsonnet_import_callback(struct JsonnetVm *vm, JsonnetImportCallback *cb, vo
 {
     vm->importCallback = cb;
     vm->importCallbackContext = ctx;
+    jsonnet_import_buffer_callback(vm, classic_import_callback, vm);
+}
+
+void jsonnet_import_buffer_callback(struct JsonnetVm *vm, JsonnetImportBufferCallback *cb,
+                                    void *ctx)
+{
+    vm->importBufferCallback = cb;
+    vm->importBufferCallbackContext = ctx;
+    // Files found by a different callback cannot be trusted.
+    vm->importCache.clear();
+    vm->importCache.checkFileStats = cb == default_import_callback;
+}
+
+void jsonnet_import_cache_max(struct JsonnetVm *vm, size_t v)
+{
+    vm->importCache.setMaxBytes(v);
+}
+
+void jsonnet_import_path_cache(struct JsonnetVm *vm, int v)
+{
+    vm->importPathCache = bool(v);
+    vm->importPaths.clear();
+}
+
+void jsonnet_import_fallback(struct JsonnetVm *vm, JsonnetImportBufferCallback *cb, void *ctx)
+{
+    vm->importFallback = cb;
+    vm->importFallbackContext = ctx;
+    // Files the fallback gave before cannot be trusted.
+    vm->importCache.clear();
+}
+
+void jsonnet_cancel(struct JsonnetVm *vm, int v)
+{
+    vm->cancelled = v != 0;
 }
 
 void jsonnet_native_callback(struct JsonnetVm *vm, const char *name, JsonnetNativeCallback *cb,
@@ -330,7 +530,26 @@ void jsonnet_native_callback(struct JsonnetVm *vm, const char *name, JsonnetNati
     std::vector<std::string> params2;
     for (; *params != nullptr; params++)
         params2.push_back(*params);
-    vm->nativeCallbacks[name] = VmNativeCallback{cb, ctx, params2};
+    vm->nativeCallbacks[name] = VmNativeCallback{cb, ctx, params2, false, nullptr};
+}
+
+void jsonnet_native_callback_vectorized(struct JsonnetVm *vm, const char *name,
+                                        JsonnetNativeCallback *cb, void *ctx,
+                                        const char *const *params)
+{
+    jsonnet_native_callback(vm, name, cb, ctx, params);
+    vm->nativeCallbacks[name].vectorized = true;
+}
+
+void jsonnet_native_callback_memo(struct JsonnetVm *vm, const char *name, int v)
+{
+    auto it = vm->nativeCallbacks.find(name);
+    if (it == vm->nativeCallbacks.end())
+        return;
+    if (!v)
+        it->second.memo = nullptr;
+    else if (it->second.memo == nullptr)
+        it->second.memo = std::make_shared<VmNativeMemo>();
 }
 
 void jsonnet_ext_var(JsonnetVm *vm, const char *key, const char *val)
@@ -353,6 +572,35 @@ void jsonnet_tla_code(JsonnetVm *vm, const char *key, const char *val)
     vm->tla[key] = VmExt(val, true);
 }
 
+void jsonnet_ext_value(JsonnetVm *vm, const char *key, JsonnetJsonValue *v)
+{
+    vm->ext[key] = VmExt(v);
+}
+
+void jsonnet_tla_value(JsonnetVm *vm, const char *key, JsonnetJsonValue *v)
+{
+    vm->tla[key] = VmExt(v);
+}
+
+void jsonnet_ext_clear(JsonnetVm *vm)
+{
+    vm->ext.clear();
+}
+
+void jsonnet_tla_clear(JsonnetVm *vm)
+{
+    vm->tla.clear();
+}
+
+void jsonnet_program_cache_max(JsonnetVm *vm, unsigned v)
+{
+    vm->programCacheMax = v;
+    while (vm->programCache.size() > v) {
+        vm->programCacheIndex.erase(vm->programCache.back().first);
+        vm->programCache.pop_back();
+    }
+}
+
 void jsonnet_fmt_debug_desugaring(JsonnetVm *vm, int v)
 {
     vm->fmtDebugDesugaring = v;
@@ -411,6 +659,8 @@ void jsonnet_jpath_add(JsonnetVm *vm, const char *path_)
 {
     if (std::strlen(path_) == 0)
         return;
+    // Files may now be found elsewhere.
+    vm->importCache.clear();
     std::string path = path_;
     if (path[path.length() - 1] != '/')
         path += '/';
@@ -481,17 +731,116 @@ namespace {
 enum EvalKind { REGULAR, MULTI, STREAM };
 }  // namespace
 
-static char *jsonnet_evaluate_snippet_aux(JsonnetVm *vm, const char *filename, const char *snippet,
-                                          int *error, EvalKind kind)
+static char *static_error_message(JsonnetVm *vm, const StaticError &e)
 {
-    try {
-        Allocator alloc;
-        AST *expr;
-        Tokens tokens = jsonnet_lex(filename, snippet);
+    std::stringstream ss;
+    ss << "STATIC ERROR: " << e << std::endl;
+    return from_string(vm, ss.str());
+}
 
-        expr = jsonnet_parse(&alloc, tokens);
+static char *runtime_error_message(JsonnetVm *vm, const RuntimeError &e)
+{
+    std::stringstream ss;
+    ss << "RUNTIME ERROR: " << e.msg << std::endl;
+    const long max_above = vm->maxTrace / 2;
+    const long max_below = vm->maxTrace - max_above;
+    const long sz = e.stackTrace.size();
+    for (long i = 0; i < sz; ++i) {
+        const auto &f = e.stackTrace[i];
+        if (vm->maxTrace > 0 && i >= max_above && i < sz - max_below) {
+            if (i == max_above)
+                ss << "\t..." << std::endl;
+        } else {
+            ss << "\t" << f.location << "\t" << f.name << std::endl;
+        }
+    }
+    return from_string(vm, ss.str());
+}
+
+/** Read a whole file, or return false and set err_msg. */
+static bool read_input_file(const char *filename, std::string &input, std::string &err_msg)
+{
+    std::ifstream f;
+    f.open(filename);
+    if (!f.good()) {
+        std::stringstream ss;
+        ss << "Opening input file: " << filename << ": " << strerror(errno);
+        err_msg = ss.str();
+        return false;
+    }
+    input.assign(std::istreambuf_iterator<char>(f), std::istreambuf_iterator<char>());
+    return true;
+}
+
+/** Parse, desugar and analyse a program, or take it from the program cache.
+ *
+ * \param persistent Whether the program may outlive the current evaluation.
+ * \throws StaticError
+ */
+static std::shared_ptr<CompiledProgram> compile_program(JsonnetVm *vm, const char *filename,
+                                                        const char *snippet, bool persistent)
+{
+    if (vm->stdlib == nullptr)
+        vm->stdlib = jsonnet_desugar_stdlib(&vm->alloc);
+
+    ProgramCacheKey key;
+    if (vm->programCacheMax > 0) {
+        key = ProgramCacheKey(filename, md5(snippet));
+        auto it = vm->programCacheIndex.find(key);
+        if (it != vm->programCacheIndex.end()) {
+            vm->programCache.splice(vm->programCache.begin(), vm->programCache, it->second);
+            return it->second->second;
+        }
+        persistent = true;
+    }
+
+    auto program = std::make_shared<CompiledProgram>(&vm->alloc);
+    Tokens tokens = jsonnet_lex(filename, snippet);
+    program->ast = jsonnet_parse(&program->alloc, tokens);
+    std::map<std::string, VmExt> no_tlas;
+    jsonnet_desugar(&program->alloc, program->ast, &no_tlas, vm->stdlib);
+    jsonnet_static_analysis(program->ast);
+
+    // Identifiers are compared by address, so any that are new must be known to the VM for
+    // as long as the program is in use.  Programs that are only evaluated once keep their own.
+    if (persistent)
+        program->alloc.moveIdentifiersTo(vm->alloc);
+
+    if (vm->programCacheMax > 0) {
+        vm->programCache.emplace_front(key, program);
+        vm->programCacheIndex[key] = vm->programCache.begin();
+        jsonnet_program_cache_max(vm, vm->programCacheMax);
+    }
+    return program;
+}
+
+/** Called at the end of each evaluation of program using alloc, see ImportCache. */
+static void keep_cached_imports(JsonnetVm *vm, CompiledProgram &program, Allocator &alloc)
+{
+    if (vm->importCache.takeInserted()) {
+        alloc.moveIdentifiersTo(vm->alloc);
+        program.alloc.moveIdentifiersTo(vm->alloc);
+    }
+}
 
-        jsonnet_desugar(&alloc, expr, &vm->tla);
+/** Evaluate a compiled program with the VM's ext vars and top-level arguments.
+ *
+ * \param run Executes the given AST with the given allocator, stack limit and import cache.
+ * \throws StaticError, RuntimeError
+ */
+template <class T>
+static T execute_program(
+    JsonnetVm *vm, CompiledProgram &program,
+    const std::function<T(Allocator *, const AST *, unsigned, ImportCache *)> &run)
+{
+    Allocator alloc(&program.alloc);
+    try {
+        const AST *expr = program.ast;
+        if (!vm->tla.empty()) {
+            AST *bound = jsonnet_desugar_rebind_tla(&alloc, program.ast, vm->tla);
+            jsonnet_static_analysis(bound);
+            expr = bound;
+        }
 
         unsigned max_stack = vm->maxStack;
 
@@ -501,18 +850,39 @@ static char *jsonnet_evaluate_snippet_aux(JsonnetVm *vm, const char *filename, c
         // For the TLA desugaring.
         max_stack++;
 
-        jsonnet_static_analysis(expr);
+        T r = run(&alloc,
+                  expr,
+                  max_stack,
+                  vm->importCache.enabled() ? &vm->importCache : nullptr);
+        keep_cached_imports(vm, program, alloc);
+        return r;
+    } catch (...) {
+        keep_cached_imports(vm, program, alloc);
+        throw;
+    }
+}
+
+static char *execute_program(JsonnetVm *vm, CompiledProgram &program, int *error, EvalKind kind)
+{
+    auto run = [&](Allocator *alloc, const AST *expr, unsigned max_stack,
+                   ImportCache *cache) -> char * {
         switch (kind) {
             case REGULAR: {
-                std::string json_str = jsonnet_vm_execute(&alloc,
+                std::string json_str = jsonnet_vm_execute(alloc,
+                                                          vm->stdlib,
                                                           expr,
                                                           vm->ext,
+                                                          vm->tla,
                                                           max_stack,
                                                           vm->gcMinObjects,
                                                           vm->gcGrowthTrigger,
                                                           vm->nativeCallbacks,
-                                                          vm->importCallback,
-                                                          vm->importCallbackContext,
+                                                          vm->importBufferCallback,
+                                                          vm->importBufferCallbackContext,
+                                                          cache,
+                                                          &vm->cancelled,
+                                                          &vm->gcStats,
+                                                          vm->select,
                                                           vm->stringOutput);
                 json_str += "\n";
                 *error = false;
@@ -521,15 +891,21 @@ static char *jsonnet_evaluate_snippet_aux(JsonnetVm *vm, const char *filename, c
 
             case MULTI: {
                 std::map<std::string, std::string> files =
-                    jsonnet_vm_execute_multi(&alloc,
+                    jsonnet_vm_execute_multi(alloc,
+                                             vm->stdlib,
                                              expr,
                                              vm->ext,
+                                             vm->tla,
                                              max_stack,
                                              vm->gcMinObjects,
                                              vm->gcGrowthTrigger,
                                              vm->nativeCallbacks,
-                                             vm->importCallback,
-                                             vm->importCallbackContext,
+                                             vm->importBufferCallback,
+                                             vm->importBufferCallbackContext,
+                                             cache,
+                                             &vm->cancelled,
+                                             &vm->gcStats,
+                                             vm->select,
                                              vm->stringOutput);
                 size_t sz = 1;  // final sentinel
                 for (const auto &pair : files) {
@@ -557,15 +933,21 @@ static char *jsonnet_evaluate_snippet_aux(JsonnetVm *vm, const char *filename, c
 
             case STREAM: {
                 std::vector<std::string> documents =
-                    jsonnet_vm_execute_stream(&alloc,
+                    jsonnet_vm_execute_stream(alloc,
+                                              vm->stdlib,
                                               expr,
                                               vm->ext,
+                                              vm->tla,
                                               max_stack,
                                               vm->gcMinObjects,
                                               vm->gcGrowthTrigger,
                                               vm->nativeCallbacks,
-                                              vm->importCallback,
-                                              vm->importCallbackContext);
+                                              vm->importBufferCallback,
+                                              vm->importBufferCallbackContext,
+                                              cache,
+                                              &vm->cancelled,
+                                              &vm->gcStats,
+                                              vm->select);
                 size_t sz = 1;  // final sentinel
                 for (const auto &doc : documents) {
                     sz += doc.length() + 2;  // Add a '\n' as well as sentinel
@@ -591,48 +973,341 @@ static char *jsonnet_evaluate_snippet_aux(JsonnetVm *vm, const char *filename, c
                 fputs("INTERNAL ERROR: bad value of 'kind', probably memory corruption.\n", stderr);
                 abort();
         }
+        return nullptr;  // Quiet, compiler.
+    };
+    return execute_program<char *>(vm, program, run);
+}
+
+/** Evaluate a compiled program with the VM's ext vars and top-level arguments, to a JSON value.
+ *
+ * \throws StaticError, RuntimeError
+ */
+static JsonnetJsonValue *execute_program_json(JsonnetVm *vm, CompiledProgram &program)
+{
+    auto run = [&](Allocator *alloc, const AST *expr, unsigned max_stack,
+                   ImportCache *cache) -> JsonnetJsonValue * {
+        return jsonnet_vm_execute_json(alloc,
+                                       vm->stdlib,
+                                       expr,
+                                       vm->ext,
+                                       vm->tla,
+                                       max_stack,
+                                       vm->gcMinObjects,
+                                       vm->gcGrowthTrigger,
+                                       vm->nativeCallbacks,
+                                       vm->importBufferCallback,
+                                       vm->importBufferCallbackContext,
+                                       cache,
+                                       &vm->cancelled,
+                                       &vm->gcStats,
+                                       vm->select,
+                                       vm->stringOutput)
+            .release();
+    };
+    return execute_program<JsonnetJsonValue *>(vm, program, run);
+}
+
+/** Evaluate a compiled program with the VM's ext vars and top-level arguments, passing the output
+ * to sink as it is produced.
+ *
+ * \throws StaticError, RuntimeError
+ */
+static void execute_program_sink(JsonnetVm *vm, CompiledProgram &program,
+                                 JsonnetSinkCallback *sink, void *ctx)
+{
+    std::function<bool(const std::string &)> write = [&](const std::string &chunk) {
+        return sink(ctx, chunk.data(), chunk.length()) == 0;
+    };
+    auto run = [&](Allocator *alloc, const AST *expr, unsigned max_stack,
+                   ImportCache *cache) -> bool {
+        jsonnet_vm_execute_sink(alloc,
+                                vm->stdlib,
+                                expr,
+                                vm->ext,
+                                vm->tla,
+                                max_stack,
+                                vm->gcMinObjects,
+                                vm->gcGrowthTrigger,
+                                vm->nativeCallbacks,
+                                vm->importBufferCallback,
+                                vm->importBufferCallbackContext,
+                                cache,
+                                &vm->cancelled,
+                                &vm->gcStats,
+                                vm->select,
+                                write,
+                                vm->stringOutput);
+        return true;
+    };
+    execute_program<bool>(vm, program, run);
+    if (!write("\n"))
+        throw RuntimeError({}, "output callback failed.");
+}
+
+/** The number of events, or the bytes of their text, from which a ValueEventWriter passes them
+ * on to its callback. */
+static const size_t VALUE_EVENT_BATCH_SIZE = 4096;
+static const size_t VALUE_EVENT_BATCH_TEXT = 64 * 1024;
+
+/** A ManifestVisitor that passes the value on to a JsonnetValueCallback in batches of events. */
+class ValueEventWriter : public ManifestVisitor {
+    JsonnetValueCallback *cb;
+    void *ctx;
+    std::vector<JsonnetValueEvent> events;
+    /** The strings of the events not yet passed on, one after the other. */
+    std::string text;
+
+    void add(JsonnetValueEventKind kind, double number, size_t size)
+    {
+        events.push_back(JsonnetValueEvent{kind, number, nullptr, size});
+    }
+
+    void addString(JsonnetValueEventKind kind, const UString &v)
+    {
+        size_t offset = text.length();
+        encode_utf8(v, text);
+        add(kind, 0, text.length() - offset);
+    }
+
+   public:
+    ValueEventWriter(JsonnetValueCallback *cb, void *ctx) : cb(cb), ctx(ctx)
+    {
+        events.reserve(VALUE_EVENT_BATCH_SIZE);
+    }
+
+    void null(void)
+    {
+        add(JSONNET_VALUE_NULL, 0, 0);
+    }
+
+    void boolean(bool v)
+    {
+        add(JSONNET_VALUE_BOOL, v ? 1 : 0, 0);
+    }
+
+    void number(double v)
+    {
+        add(JSONNET_VALUE_NUMBER, v, 0);
+    }
+
+    void string(const UString &v)
+    {
+        addString(JSONNET_VALUE_STRING, v);
+    }
+
+    void beginArray(size_t size)
+    {
+        add(JSONNET_VALUE_ARRAY, 0, size);
+    }
+
+    void endArray(void) {}
+
+    void beginObject(size_t size)
+    {
+        add(JSONNET_VALUE_OBJECT, 0, size);
+    }
+
+    void field(const UString &name)
+    {
+        addString(JSONNET_VALUE_FIELD, name);
+    }
+
+    void endObject(void) {}
+
+    bool done(void)
+    {
+        if (events.size() < VALUE_EVENT_BATCH_SIZE && text.length() < VALUE_EVENT_BATCH_TEXT)
+            return true;
+        return flush();
+    }
+
+    /** Pass the events on to the callback.  Returns false if it failed. */
+    bool flush(void)
+    {
+        if (events.empty())
+            return true;
+        const char *next = text.data();
+        for (auto &e : events) {
+            if (e.kind == JSONNET_VALUE_STRING || e.kind == JSONNET_VALUE_FIELD) {
+                e.string = next;
+                next += e.size;
+            }
+        }
+        bool ok = cb(ctx, events.data(), events.size()) == 0;
+        events.clear();
+        text.clear();
+        return ok;
+    }
+};
+
+/** Evaluate a compiled program with the VM's ext vars and top-level arguments, passing the value
+ * to cb as it is manifested.
+ *
+ * \throws StaticError, RuntimeError
+ */
+static void execute_program_value(JsonnetVm *vm, CompiledProgram &program,
+                                  JsonnetValueCallback *cb, void *ctx)
+{
+    ValueEventWriter writer(cb, ctx);
+    auto run = [&](Allocator *alloc, const AST *expr, unsigned max_stack,
+                   ImportCache *cache) -> bool {
+        jsonnet_vm_execute_visit(alloc,
+                                 vm->stdlib,
+                                 expr,
+                                 vm->ext,
+                                 vm->tla,
+                                 max_stack,
+                                 vm->gcMinObjects,
+                                 vm->gcGrowthTrigger,
+                                 vm->nativeCallbacks,
+                                 vm->importBufferCallback,
+                                 vm->importBufferCallbackContext,
+                                 cache,
+                                 &vm->cancelled,
+                                 &vm->gcStats,
+                                 vm->select,
+                                 writer,
+                                 vm->stringOutput);
+        return true;
+    };
+    execute_program<bool>(vm, program, run);
+    if (!writer.flush())
+        throw RuntimeError({}, "output callback failed.");
+}
+
+/** Evaluate a compiled program with the VM's ext vars and top-level arguments, up to the object
+ * of files of multi mode.
+ *
+ * \throws StaticError, RuntimeError
+ */
+static JsonnetMulti *execute_program_multi_lazy(JsonnetVm *vm,
+                                                const std::shared_ptr<CompiledProgram> &program)
+{
+    std::unique_ptr<JsonnetMulti> r(new JsonnetMulti(program));
+    const AST *expr = program->ast;
+    if (!vm->tla.empty()) {
+        AST *bound = jsonnet_desugar_rebind_tla(&r->alloc, program->ast, vm->tla);
+        jsonnet_static_analysis(bound);
+        expr = bound;
+    }
+
+    // For the stdlib and TLA desugaring, as in execute_program.
+    unsigned max_stack = vm->maxStack + 2;
+
+    r->result = jsonnet_vm_execute_multi_lazy(&r->alloc,
+                                              vm->stdlib,
+                                              expr,
+                                              vm->ext,
+                                              vm->tla,
+                                              max_stack,
+                                              vm->gcMinObjects,
+                                              vm->gcGrowthTrigger,
+                                              vm->nativeCallbacks,
+                                              vm->importBufferCallback,
+                                              vm->importBufferCallbackContext,
+                                              &vm->cancelled,
+                                              &vm->gcStats,
+                                              vm->select,
+                                              vm->stringOutput);
+    return r.release();
+}
+
+static JsonnetMulti *jsonnet_evaluate_snippet_multi_lazy_aux(JsonnetVm *vm, const char *filename,
+                                                             const char *snippet, char **error)
+{
+    try {
+        return execute_program_multi_lazy(vm, compile_program(vm, filename, snippet, false));
+
+    } catch (StaticError &e) {
+        *error = static_error_message(vm, e);
+        return nullptr;
+
+    } catch (RuntimeError &e) {
+        *error = runtime_error_message(vm, e);
+        return nullptr;
+    }
+}
+
+static int jsonnet_evaluate_snippet_sink_aux(JsonnetVm *vm, const char *filename,
+                                             const char *snippet, JsonnetSinkCallback *sink,
+                                             void *ctx, char **error)
+{
+    try {
+        std::shared_ptr<CompiledProgram> program = compile_program(vm, filename, snippet, false);
+        execute_program_sink(vm, *program, sink, ctx);
+        return 1;
+
+    } catch (StaticError &e) {
+        *error = static_error_message(vm, e);
+        return 0;
+
+    } catch (RuntimeError &e) {
+        *error = runtime_error_message(vm, e);
+        return 0;
+    }
+}
+
+static int jsonnet_evaluate_snippet_value_aux(JsonnetVm *vm, const char *filename,
+                                              const char *snippet, JsonnetValueCallback *cb,
+                                              void *ctx, char **error)
+{
+    try {
+        std::shared_ptr<CompiledProgram> program = compile_program(vm, filename, snippet, false);
+        execute_program_value(vm, *program, cb, ctx);
+        return 1;
+
+    } catch (StaticError &e) {
+        *error = static_error_message(vm, e);
+        return 0;
+
+    } catch (RuntimeError &e) {
+        *error = runtime_error_message(vm, e);
+        return 0;
+    }
+}
+
+static char *jsonnet_evaluate_snippet_aux(JsonnetVm *vm, const char *filename, const char *snippet,
+                                          int *error, EvalKind kind)
+{
+    try {
+        std::shared_ptr<CompiledProgram> program = compile_program(vm, filename, snippet, false);
+        return execute_program(vm, *program, error, kind);
 
     } catch (StaticError &e) {
-        std::stringstream ss;
-        ss << "STATIC ERROR: " << e << std::endl;
         *error = true;
-        return from_string(vm, ss.str());
+        return static_error_message(vm, e);
 
     } catch (RuntimeError &e) {
-        std::stringstream ss;
-        ss << "RUNTIME ERROR: " << e.msg << std::endl;
-        const long max_above = vm->maxTrace / 2;
-        const long max_below = vm->maxTrace - max_above;
-        const long sz = e.stackTrace.size();
-        for (long i = 0; i < sz; ++i) {
-            const auto &f = e.stackTrace[i];
-            if (vm->maxTrace > 0 && i >= max_above && i < sz - max_below) {
-                if (i == max_above)
-                    ss << "\t..." << std::endl;
-            } else {
-                ss << "\t" << f.location << "\t" << f.name << std::endl;
-            }
-        }
         *error = true;
-        return from_string(vm, ss.str());
+        return runtime_error_message(vm, e);
     }
+}
 
-    return nullptr;  // Quiet, compiler.
+static JsonnetJsonValue *jsonnet_evaluate_snippet_json_aux(JsonnetVm *vm, const char *filename,
+                                                          const char *snippet, char **error)
+{
+    try {
+        std::shared_ptr<CompiledProgram> program = compile_program(vm, filename, snippet, false);
+        return execute_program_json(vm, *program);
+
+    } catch (StaticError &e) {
+        *error = static_error_message(vm, e);
+        return nullptr;
+
+    } catch (RuntimeError &e) {
+        *error = runtime_error_message(vm, e);
+        return nullptr;
+    }
 }
 
 static char *jsonnet_evaluate_file_aux(JsonnetVm *vm, const char *filename, int *error,
                                        EvalKind kind)
 {
-    std::ifstream f;
-    f.open(filename);
-    if (!f.good()) {
-        std::stringstream ss;
-        ss << "Opening input file: " << filename << ": " << strerror(errno);
+    std::string input, err_msg;
+    if (!read_input_file(filename, input, err_msg)) {
         *error = true;
-        return from_string(vm, ss.str());
+        return from_string(vm, err_msg);
     }
-    std::string input;
-    input.assign(std::istreambuf_iterator<char>(f), std::istreambuf_iterator<char>());
 
     return jsonnet_evaluate_snippet_aux(vm, filename, input.c_str(), error, kind);
 }
@@ -661,6 +1336,96 @@ char *jsonnet_evaluate_file_stream(JsonnetVm *vm, const char *filename, int *err
     return nullptr;  // Never happens.
 }
 
+JsonnetJsonValue *jsonnet_evaluate_file_json(JsonnetVm *vm, const char *filename, char **error)
+{
+    TRY
+        std::string input, err_msg;
+        if (!read_input_file(filename, input, err_msg)) {
+            *error = from_string(vm, err_msg);
+            return nullptr;
+        }
+        return jsonnet_evaluate_snippet_json_aux(vm, filename, input.c_str(), error);
+    CATCH("jsonnet_evaluate_file_json")
+    return nullptr;  // Never happens.
+}
+
+JsonnetJsonValue *jsonnet_evaluate_snippet_json(JsonnetVm *vm, const char *filename,
+                                                const char *snippet, char **error)
+{
+    TRY
+        return jsonnet_evaluate_snippet_json_aux(vm, filename, snippet, error);
+    CATCH("jsonnet_evaluate_snippet_json")
+    return nullptr;  // Never happens.
+}
+
+JsonnetMulti *jsonnet_evaluate_file_multi_lazy(JsonnetVm *vm, const char *filename, char **error)
+{
+    TRY
+        std::string input, err_msg;
+        if (!read_input_file(filename, input, err_msg)) {
+            *error = from_string(vm, err_msg);
+            return nullptr;
+        }
+        return jsonnet_evaluate_snippet_multi_lazy_aux(vm, filename, input.c_str(), error);
+    CATCH("jsonnet_evaluate_file_multi_lazy")
+    return nullptr;  // Never happens.
+}
+
+JsonnetMulti *jsonnet_evaluate_snippet_multi_lazy(JsonnetVm *vm, const char *filename,
+                                                  const char *snippet, char **error)
+{
+    TRY
+        return jsonnet_evaluate_snippet_multi_lazy_aux(vm, filename, snippet, error);
+    CATCH("jsonnet_evaluate_snippet_multi_lazy")
+    return nullptr;  // Never happens.
+}
+
+int jsonnet_evaluate_file_sink(JsonnetVm *vm, const char *filename, JsonnetSinkCallback *sink,
+                               void *ctx, char **error)
+{
+    TRY
+        std::string input, err_msg;
+        if (!read_input_file(filename, input, err_msg)) {
+            *error = from_string(vm, err_msg);
+            return 0;
+        }
+        return jsonnet_evaluate_snippet_sink_aux(vm, filename, input.c_str(), sink, ctx, error);
+    CATCH("jsonnet_evaluate_file_sink")
+    return 0;  // Never happens.
+}
+
+int jsonnet_evaluate_snippet_sink(JsonnetVm *vm, const char *filename, const char *snippet,
+                                  JsonnetSinkCallback *sink, void *ctx, char **error)
+{
+    TRY
+        return jsonnet_evaluate_snippet_sink_aux(vm, filename, snippet, sink, ctx, error);
+    CATCH("jsonnet_evaluate_snippet_sink")
+    return 0;  // Never happens.
+}
+
+int jsonnet_evaluate_file_value(JsonnetVm *vm, const char *filename, JsonnetValueCallback *cb,
+                                void *ctx, char **error)
+{
+    TRY
+        std::string input, err_msg;
+        if (!read_input_file(filename, input, err_msg)) {
+            *error = from_string(vm, err_msg);
+            return 0;
+        }
+        return jsonnet_evaluate_snippet_value_aux(vm, filename, input.c_str(), cb, ctx, error);
+    CATCH("jsonnet_evaluate_file_value")
+    return 0;  // Never happens.
+}
+
+int jsonnet_evaluate_snippet_value(JsonnetVm *vm, const char *filename, const char *snippet,
+                                   JsonnetValueCallback *cb, void *ctx, char **error)
+{
+    TRY
+        return jsonnet_evaluate_snippet_value_aux(vm, filename, snippet, cb, ctx, error);
+    CATCH("jsonnet_evaluate_snippet_value")
+    return 0;  // Never happens.
+}
+
 char *jsonnet_evaluate_snippet(JsonnetVm *vm, const char *filename, const char *snippet, int *error)
 {
     TRY
@@ -687,6 +1452,205 @@ char *jsonnet_evaluate_snippet_stream(JsonnetVm *vm, const char *filename, const
     return nullptr;  // Never happens.
 }
 
+static JsonnetProgram *jsonnet_compile_snippet_aux(JsonnetVm *vm, const char *filename,
+                                                   const char *snippet, char **error)
+{
+    try {
+        std::shared_ptr<CompiledProgram> program = compile_program(vm, filename, snippet, true);
+        JsonnetProgram *r = new JsonnetProgram();
+        r->program = program;
+        return r;
+    } catch (StaticError &e) {
+        *error = static_error_message(vm, e);
+        return nullptr;
+    }
+}
+
+JsonnetProgram *jsonnet_compile_file(JsonnetVm *vm, const char *filename, char **error)
+{
+    TRY
+        std::string input, err_msg;
+        if (!read_input_file(filename, input, err_msg)) {
+            *error = from_string(vm, err_msg);
+            return nullptr;
+        }
+        return jsonnet_compile_snippet_aux(vm, filename, input.c_str(), error);
+    CATCH("jsonnet_compile_file")
+    return nullptr;  // Never happens.
+}
+
+JsonnetProgram *jsonnet_compile_snippet(JsonnetVm *vm, const char *filename, const char *snippet,
+                                        char **error)
+{
+    TRY
+        return jsonnet_compile_snippet_aux(vm, filename, snippet, error);
+    CATCH("jsonnet_compile_snippet")
+    return nullptr;  // Never happens.
+}
+
+static char *jsonnet_program_evaluate_aux(JsonnetVm *vm, JsonnetProgram *program, int *error,
+                                          EvalKind kind)
+{
+    try {
+        return execute_program(vm, *program->program, error, kind);
+
+    } catch (StaticError &e) {
+        *error = true;
+        return static_error_message(vm, e);
+
+    } catch (RuntimeError &e) {
+        *error = true;
+        return runtime_error_message(vm, e);
+    }
+}
+
+char *jsonnet_program_evaluate(JsonnetVm *vm, JsonnetProgram *program, int *error)
+{
+    TRY
+        return jsonnet_program_evaluate_aux(vm, program, error, REGULAR);
+    CATCH("jsonnet_program_evaluate")
+    return nullptr;  // Never happens.
+}
+
+char *jsonnet_program_evaluate_multi(JsonnetVm *vm, JsonnetProgram *program, int *error)
+{
+    TRY
+        return jsonnet_program_evaluate_aux(vm, program, error, MULTI);
+    CATCH("jsonnet_program_evaluate_multi")
+    return nullptr;  // Never happens.
+}
+
+char *jsonnet_program_evaluate_stream(JsonnetVm *vm, JsonnetProgram *program, int *error)
+{
+    TRY
+        return jsonnet_program_evaluate_aux(vm, program, error, STREAM);
+    CATCH("jsonnet_program_evaluate_stream")
+    return nullptr;  // Never happens.
+}
+
+JsonnetJsonValue *jsonnet_program_evaluate_json(JsonnetVm *vm, JsonnetProgram *program,
+                                                char **error)
+{
+    TRY
+        try {
+            return execute_program_json(vm, *program->program);
+
+        } catch (StaticError &e) {
+            *error = static_error_message(vm, e);
+            return nullptr;
+
+        } catch (RuntimeError &e) {
+            *error = runtime_error_message(vm, e);
+            return nullptr;
+        }
+    CATCH("jsonnet_program_evaluate_json")
+    return nullptr;  // Never happens.
+}
+
+int jsonnet_program_evaluate_sink(JsonnetVm *vm, JsonnetProgram *program,
+                                  JsonnetSinkCallback *sink, void *ctx, char **error)
+{
+    TRY
+        try {
+            execute_program_sink(vm, *program->program, sink, ctx);
+            return 1;
+
+        } catch (StaticError &e) {
+            *error = static_error_message(vm, e);
+            return 0;
+
+        } catch (RuntimeError &e) {
+            *error = runtime_error_message(vm, e);
+            return 0;
+        }
+    CATCH("jsonnet_program_evaluate_sink")
+    return 0;  // Never happens.
+}
+
+int jsonnet_program_evaluate_value(JsonnetVm *vm, JsonnetProgram *program,
+                                   JsonnetValueCallback *cb, void *ctx, char **error)
+{
+    TRY
+        try {
+            execute_program_value(vm, *program->program, cb, ctx);
+            return 1;
+
+        } catch (StaticError &e) {
+            *error = static_error_message(vm, e);
+            return 0;
+
+        } catch (RuntimeError &e) {
+            *error = runtime_error_message(vm, e);
+            return 0;
+        }
+    CATCH("jsonnet_program_evaluate_value")
+    return 0;  // Never happens.
+}
+
+JsonnetMulti *jsonnet_program_evaluate_multi_lazy(JsonnetVm *vm, JsonnetProgram *program,
+                                                  char **error)
+{
+    TRY
+        try {
+            return execute_program_multi_lazy(vm, program->program);
+
+        } catch (StaticError &e) {
+            *error = static_error_message(vm, e);
+            return nullptr;
+
+        } catch (RuntimeError &e) {
+            *error = runtime_error_message(vm, e);
+            return nullptr;
+        }
+    CATCH("jsonnet_program_evaluate_multi_lazy")
+    return nullptr;  // Never happens.
+}
+
+size_t jsonnet_multi_size(JsonnetVm *vm, JsonnetMulti *multi)
+{
+    (void)vm;
+    return multi->result->names().size();
+}
+
+const char *jsonnet_multi_name(JsonnetVm *vm, JsonnetMulti *multi, size_t i)
+{
+    (void)vm;
+    return multi->result->names()[i].c_str();
+}
+
+char *jsonnet_multi_manifest(JsonnetVm *vm, JsonnetMulti *multi, size_t i, int *error)
+{
+    TRY
+        try {
+            std::string json_str = multi->result->manifest(i);
+            json_str += "\n";
+            *error = false;
+            return from_string(vm, json_str);
+
+        } catch (RuntimeError &e) {
+            *error = true;
+            return runtime_error_message(vm, e);
+        }
+    CATCH("jsonnet_multi_manifest")
+    return nullptr;  // Never happens.
+}
+
+void jsonnet_multi_destroy(JsonnetVm *vm, JsonnetMulti *multi)
+{
+    (void)vm;
+    TRY
+        delete multi;
+    CATCH("jsonnet_multi_destroy")
+}
+
+void jsonnet_program_destroy(JsonnetVm *vm, JsonnetProgram *program)
+{
+    (void)vm;
+    TRY
+        delete program;
+    CATCH("jsonnet_program_destroy")
+}
+
 char *jsonnet_realloc(JsonnetVm *vm, char *str, size_t sz)
 {
     (void)vm;
@@ -14,6 +14,12 @@ See the License for the specific language governing permissions and
 limitations under the License.
 */
 
+#include <cstdio>
+#include <cstring>
+#include <fstream>
+#include <string>
+#include <thread>
+
 extern "C" {
 #include "libjsonnet.h"
 }
@@ -31,3 +37,604 @@ TEST(JsonnetTest, TestEvaluateSnippet)
     jsonnet_realloc(vm, output, 0);
     jsonnet_destroy(vm);
 }
+
+TEST(JsonnetTest, TestReuseVm)
+{
+    struct JsonnetVm* vm = jsonnet_make();
+    ASSERT_FALSE(vm == nullptr);
+    int error = 0;
+    jsonnet_ext_var(vm, "x", "a");
+    jsonnet_tla_code(vm, "y", "1");
+    char* output = jsonnet_evaluate_snippet(vm, "snippet", "function(y) [std.extVar('x'), y]", &error);
+    EXPECT_EQ(0, error);
+    EXPECT_STREQ("[\n   \"a\",\n   1\n]\n", output);
+    jsonnet_realloc(vm, output, 0);
+
+    jsonnet_ext_clear(vm);
+    jsonnet_tla_clear(vm);
+    output = jsonnet_evaluate_snippet(vm, "snippet", "function(y=2) y", &error);
+    EXPECT_EQ(0, error);
+    EXPECT_STREQ("2\n", output);
+    jsonnet_realloc(vm, output, 0);
+    output = jsonnet_evaluate_snippet(vm, "snippet", "std.extVar('x')", &error);
+    EXPECT_EQ(1, error);
+    jsonnet_realloc(vm, output, 0);
+    jsonnet_destroy(vm);
+}
+
+TEST(JsonnetTest, TestCompiledProgram)
+{
+    struct JsonnetVm* vm = jsonnet_make();
+    ASSERT_FALSE(vm == nullptr);
+    char* error_msg = nullptr;
+    struct JsonnetProgram* program = jsonnet_compile_snippet(
+        vm, "snippet", "function(y) { x: std.extVar('x'), y: y, z: self.y + 1 }", &error_msg);
+    ASSERT_FALSE(program == nullptr);
+
+    int error = 0;
+    jsonnet_ext_var(vm, "x", "a");
+    jsonnet_tla_code(vm, "y", "1");
+    char* output = jsonnet_program_evaluate(vm, program, &error);
+    EXPECT_EQ(0, error);
+    EXPECT_STREQ("{\n   \"x\": \"a\",\n   \"y\": 1,\n   \"z\": 2\n}\n", output);
+    jsonnet_realloc(vm, output, 0);
+
+    jsonnet_ext_var(vm, "x", "b");
+    jsonnet_tla_code(vm, "y", "10");
+    output = jsonnet_program_evaluate(vm, program, &error);
+    EXPECT_EQ(0, error);
+    EXPECT_STREQ("{\n   \"x\": \"b\",\n   \"y\": 10,\n   \"z\": 11\n}\n", output);
+    jsonnet_realloc(vm, output, 0);
+
+    jsonnet_tla_clear(vm);
+    output = jsonnet_program_evaluate(vm, program, &error);
+    EXPECT_EQ(1, error);
+    jsonnet_realloc(vm, output, 0);
+    jsonnet_program_destroy(vm, program);
+
+    program = jsonnet_compile_snippet(vm, "snippet", "{", &error_msg);
+    EXPECT_TRUE(program == nullptr);
+    EXPECT_EQ(0, strncmp(error_msg, "STATIC ERROR: ", 14));
+    jsonnet_realloc(vm, error_msg, 0);
+    jsonnet_destroy(vm);
+}
+
+TEST(JsonnetTest, TestProgramCache)
+{
+    struct JsonnetVm* vm = jsonnet_make();
+    ASSERT_FALSE(vm == nullptr);
+    jsonnet_program_cache_max(vm, 1);
+    int error = 0;
+    const char* snippets[] = {"local a = 1; { a: a }", "local b = 2; { b: b }"};
+    for (int i = 0; i < 4; ++i) {
+        char* output = jsonnet_evaluate_snippet(vm, "snippet", snippets[i / 2], &error);
+        EXPECT_EQ(0, error);
+        EXPECT_STREQ(i < 2 ? "{\n   \"a\": 1\n}\n" : "{\n   \"b\": 2\n}\n", output);
+        jsonnet_realloc(vm, output, 0);
+    }
+    jsonnet_program_cache_max(vm, 0);
+    char* output = jsonnet_evaluate_snippet(vm, "snippet", snippets[0], &error);
+    EXPECT_EQ(0, error);
+    jsonnet_realloc(vm, output, 0);
+    jsonnet_destroy(vm);
+}
+
+TEST(JsonnetTest, TestImportCache)
+{
+    const std::string lib = ::testing::TempDir() + "libjsonnet_test_import_cache.libsonnet";
+    std::ofstream(lib) << "{ greeting: 'hello', local x = self.greeting, twice: [x, x] }";
+    const std::string main = "local lib = import '" + lib + "'; ";
+
+    struct JsonnetVm* vm = jsonnet_make();
+    ASSERT_FALSE(vm == nullptr);
+    jsonnet_import_cache_max(vm, 1 << 20);
+    int error = 0;
+    char* output = jsonnet_evaluate_snippet(vm, "snippet", (main + "lib.twice").c_str(), &error);
+    EXPECT_EQ(0, error);
+    EXPECT_STREQ("[\n   \"hello\",\n   \"hello\"\n]\n", output);
+    jsonnet_realloc(vm, output, 0);
+
+    // The cached ASTs must still work with identifiers first seen in later evaluations.
+    output = jsonnet_evaluate_snippet(
+        vm, "snippet", (main + "(lib { other: 1 }).greeting + importstr '" + lib + "'").c_str(),
+        &error);
+    EXPECT_EQ(0, error);
+    jsonnet_realloc(vm, output, 0);
+
+    std::ofstream(lib) << "{ greeting: 'goodbye' }";
+    output = jsonnet_evaluate_snippet(vm, "snippet", (main + "lib.greeting").c_str(), &error);
+    EXPECT_EQ(0, error);
+    EXPECT_STREQ("\"goodbye\"\n", output);
+    jsonnet_realloc(vm, output, 0);
+    jsonnet_destroy(vm);
+    std::remove(lib.c_str());
+}
+
+TEST(JsonnetTest, TestEvaluateJson)
+{
+    struct JsonnetVm* vm = jsonnet_make();
+    ASSERT_FALSE(vm == nullptr);
+    char* error = nullptr;
+    struct JsonnetJsonValue* v =
+        jsonnet_evaluate_snippet_json(vm, "snippet", "{ b: [1, 'x'], a: null }", &error);
+    ASSERT_FALSE(v == nullptr);
+    size_t len = 0;
+    ASSERT_EQ(1, jsonnet_json_extract_object(vm, v, &len));
+    ASSERT_EQ(2u, len);
+    const struct JsonnetJsonValue* field;
+    EXPECT_STREQ("a", jsonnet_json_object_field(vm, v, 0, &field));
+    EXPECT_EQ(1, jsonnet_json_extract_null(vm, field));
+    EXPECT_STREQ("b", jsonnet_json_object_field(vm, v, 1, &field));
+    ASSERT_EQ(1, jsonnet_json_extract_array(vm, field, &len));
+    ASSERT_EQ(2u, len);
+    double number = 0;
+    EXPECT_EQ(1, jsonnet_json_extract_number(vm, jsonnet_json_array_element(vm, field, 0), &number));
+    EXPECT_EQ(1.0, number);
+    EXPECT_STREQ("x", jsonnet_json_extract_string(vm, jsonnet_json_array_element(vm, field, 1)));
+    jsonnet_json_destroy(vm, v);
+
+    v = jsonnet_evaluate_snippet_json(vm, "snippet", "error 'foo'", &error);
+    EXPECT_TRUE(v == nullptr);
+    EXPECT_EQ(0, strncmp(error, "RUNTIME ERROR: foo", 18));
+    jsonnet_realloc(vm, error, 0);
+    jsonnet_destroy(vm);
+}
+
+TEST(JsonnetTest, TestValueVars)
+{
+    struct JsonnetVm* vm = jsonnet_make();
+    ASSERT_FALSE(vm == nullptr);
+    struct JsonnetJsonValue* arr = jsonnet_json_make_array(vm);
+    jsonnet_json_array_append(vm, arr, jsonnet_json_make_number(vm, 1));
+    jsonnet_json_array_append(vm, arr, jsonnet_json_make_string(vm, "x"));
+    jsonnet_ext_value(vm, "e", arr);
+    jsonnet_tla_value(vm, "t", jsonnet_json_make_bool(vm, 1));
+    int error = 0;
+    char* output = jsonnet_evaluate_snippet(
+        vm, "snippet", "function(t) [std.extVar('e'), std.extVar('e')[0], t]", &error);
+    EXPECT_EQ(0, error);
+    EXPECT_STREQ("[\n   [\n      1,\n      \"x\"\n   ],\n   1,\n   true\n]\n", output);
+    jsonnet_realloc(vm, output, 0);
+    jsonnet_destroy(vm);
+}
+
+TEST(JsonnetTest, TestCancel)
+{
+    // Runs far longer than the test if not cancelled.
+    const char* snippet = "local f(n) = if n == 0 then 0 else f(n - 1); std.length([f(100) for i in std.range(1, 1e9)])";
+    struct JsonnetVm* vm = jsonnet_make();
+    ASSERT_FALSE(vm == nullptr);
+    int error = 0;
+    char* output = nullptr;
+    std::thread evaluation(
+        [&] { output = jsonnet_evaluate_snippet(vm, "snippet", snippet, &error); });
+    std::this_thread::sleep_for(std::chrono::milliseconds(50));
+    jsonnet_cancel(vm, 1);
+    evaluation.join();
+    EXPECT_EQ(1, error);
+    EXPECT_TRUE(strstr(output, "evaluation cancelled") != nullptr) << output;
+    jsonnet_realloc(vm, output, 0);
+
+    jsonnet_cancel(vm, 0);
+    output = jsonnet_evaluate_snippet(vm, "snippet", "1", &error);
+    EXPECT_EQ(0, error);
+    jsonnet_realloc(vm, output, 0);
+    jsonnet_destroy(vm);
+}
+
+static int append_output(void* ctx, const char* buf, size_t len)
+{
+    static_cast<std::string*>(ctx)->append(buf, len);
+    return 0;
+}
+
+static int refuse_output(void* ctx, const char* buf, size_t len)
+{
+    (void)ctx;
+    (void)buf;
+    (void)len;
+    return 1;
+}
+
+TEST(JsonnetTest, TestEvaluateSink)
+{
+    // Large enough to be written in several chunks.
+    const char* snippet = "{ ['f' + i]: { a: [i, 'xxxxxxxxxx'], b: null } for i in std.range(1, 5000) }";
+    struct JsonnetVm* vm = jsonnet_make();
+    ASSERT_FALSE(vm == nullptr);
+    int error = 0;
+    char* expected = jsonnet_evaluate_snippet(vm, "snippet", snippet, &error);
+    ASSERT_EQ(0, error);
+
+    std::string output;
+    char* err = nullptr;
+    EXPECT_EQ(1, jsonnet_evaluate_snippet_sink(vm, "snippet", snippet, append_output, &output, &err));
+    EXPECT_EQ(std::string(expected), output);
+    jsonnet_realloc(vm, expected, 0);
+
+    EXPECT_EQ(0, jsonnet_evaluate_snippet_sink(vm, "snippet", snippet, refuse_output, nullptr, &err));
+    ASSERT_FALSE(err == nullptr);
+    EXPECT_TRUE(strstr(err, "output callback failed") != nullptr) << err;
+    jsonnet_realloc(vm, err, 0);
+    jsonnet_destroy(vm);
+}
+
+static int append_events(void* ctx, const struct JsonnetValueEvent* events, size_t n)
+{
+    std::string* out = static_cast<std::string*>(ctx);
+    for (size_t i = 0; i < n; ++i) {
+        const struct JsonnetValueEvent& e = events[i];
+        switch (e.kind) {
+            case JSONNET_VALUE_NULL: *out += "null "; break;
+            case JSONNET_VALUE_BOOL: *out += e.number != 0 ? "true " : "false "; break;
+            case JSONNET_VALUE_NUMBER: *out += std::to_string(int(e.number)) + " "; break;
+            case JSONNET_VALUE_STRING: *out += "'" + std::string(e.string, e.size) + "' "; break;
+            case JSONNET_VALUE_ARRAY: *out += "[" + std::to_string(e.size) + " "; break;
+            case JSONNET_VALUE_OBJECT: *out += "{" + std::to_string(e.size) + " "; break;
+            case JSONNET_VALUE_FIELD: *out += std::string(e.string, e.size) + ": "; break;
+        }
+    }
+    return 0;
+}
+
+static int refuse_events(void* ctx, const struct JsonnetValueEvent* events, size_t n)
+{
+    (void)ctx;
+    (void)events;
+    (void)n;
+    return 1;
+}
+
+TEST(JsonnetTest, TestEvaluateValue)
+{
+    struct JsonnetVm* vm = jsonnet_make();
+    ASSERT_FALSE(vm == nullptr);
+    std::string output;
+    char* err = nullptr;
+    EXPECT_EQ(1, jsonnet_evaluate_snippet_value(vm, "snippet", "{ b: [1, 'x', {}], a: { c: true } }",
+                                                append_events, &output, &err));
+    EXPECT_EQ("{2 a: {1 c: true b: [3 1 'x' {0 ", output);
+
+    // Large enough to be passed on in several batches.
+    const char* snippet = "[{ a: i } for i in std.range(1, 5000)]";
+    output.clear();
+    EXPECT_EQ(1, jsonnet_evaluate_snippet_value(vm, "snippet", snippet, append_events, &output, &err));
+    EXPECT_EQ(0u, output.find("[5000 {1 a: 1 {1 a: 2 "));
+    EXPECT_EQ(output.length() - 8, output.rfind("a: 5000 "));
+
+    EXPECT_EQ(0, jsonnet_evaluate_snippet_value(vm, "snippet", snippet, refuse_events, nullptr, &err));
+    ASSERT_FALSE(err == nullptr);
+    EXPECT_TRUE(strstr(err, "output callback failed") != nullptr) << err;
+    jsonnet_realloc(vm, err, 0);
+    jsonnet_destroy(vm);
+}
+
+TEST(JsonnetTest, TestMultiLazy)
+{
+    const std::string lib = ::testing::TempDir() + "libjsonnet_test_multi_lazy.libsonnet";
+    std::ofstream(lib) << "function(o) o.unusualName";
+    const std::string snippet = "local obj = { unusualName: 42 }; { 'a.json': (import '" + lib +
+                                "')(obj), 'b.json': error 'b' }";
+
+    struct JsonnetVm* vm = jsonnet_make();
+    ASSERT_FALSE(vm == nullptr);
+    char* err = nullptr;
+    struct JsonnetMulti* multi =
+        jsonnet_evaluate_snippet_multi_lazy(vm, "snippet", snippet.c_str(), &err);
+    ASSERT_FALSE(multi == nullptr) << err;
+    ASSERT_EQ(2u, jsonnet_multi_size(vm, multi));
+    EXPECT_STREQ("a.json", jsonnet_multi_name(vm, multi, 0));
+    EXPECT_STREQ("b.json", jsonnet_multi_name(vm, multi, 1));
+
+    int error = 0;
+    char* output = jsonnet_multi_manifest(vm, multi, 1, &error);
+    EXPECT_EQ(1, error);
+    EXPECT_TRUE(strstr(output, "RUNTIME ERROR: b") != nullptr) << output;
+    jsonnet_realloc(vm, output, 0);
+
+    // Compiling interns unusualName in the VM, which the import must not pick up.
+    struct JsonnetProgram* program = jsonnet_compile_snippet(vm, "other", "{ unusualName: 1 }", &err);
+    ASSERT_FALSE(program == nullptr);
+    output = jsonnet_multi_manifest(vm, multi, 0, &error);
+    EXPECT_EQ(0, error);
+    EXPECT_STREQ("42\n", output);
+    jsonnet_realloc(vm, output, 0);
+
+    jsonnet_program_destroy(vm, program);
+    jsonnet_multi_destroy(vm, multi);
+    jsonnet_destroy(vm);
+    std::remove(lib.c_str());
+}
+
+TEST(JsonnetTest, TestGcStats)
+{
+    const char* snippet = "std.length([{ x: [i] } for i in std.range(1, 10000)])";
+    struct JsonnetVm* vm = jsonnet_make();
+    ASSERT_FALSE(vm == nullptr);
+    struct JsonnetGcStats stats;
+    jsonnet_gc_stats(vm, &stats);
+    EXPECT_EQ(0u, stats.cycles);
+
+    int error = 0;
+    char* output = jsonnet_evaluate_snippet(vm, "snippet", snippet, &error);
+    EXPECT_EQ(0, error);
+    jsonnet_realloc(vm, output, 0);
+    jsonnet_gc_stats(vm, &stats);
+    EXPECT_GT(stats.cycles, 0u);
+    EXPECT_GT(stats.steps, stats.cycles);
+    EXPECT_GT(stats.freed, 0u);
+    EXPECT_GE(stats.peak_entities, 1000u);
+    EXPECT_GE(stats.pause_ms, stats.max_pause_ms);
+
+    jsonnet_gc_stats_reset(vm);
+    jsonnet_gc_stats(vm, &stats);
+    EXPECT_EQ(0u, stats.cycles);
+    EXPECT_EQ(0u, stats.freed);
+    jsonnet_destroy(vm);
+}
+
+TEST(JsonnetTest, TestGcIncremental)
+{
+    // Cached fields, filled thunks, local bindings, default arguments and appended arrays are
+    // all stored into entities that may have been marked already.
+    const char* snippet =
+        "local xs = std.foldl(function(acc, i) acc + [{ v: i, s: std.toString(i) }],\n"
+        "                     std.range(1, 3000), []);\n"
+        "local f(x, d=x.v) = local n = std.length(x.s); d + n;\n"
+        "std.foldl(function(a, x) a + f(x), xs, 0)\n";
+    struct JsonnetVm* vm = jsonnet_make();
+    ASSERT_FALSE(vm == nullptr);
+    jsonnet_gc_min_objects(vm, 10);
+    int error = 0;
+    char* output = jsonnet_evaluate_snippet(vm, "snippet", snippet, &error);
+    EXPECT_EQ(0, error);
+    EXPECT_STREQ("4512393\n", output);
+    jsonnet_realloc(vm, output, 0);
+    struct JsonnetGcStats stats;
+    jsonnet_gc_stats(vm, &stats);
+    EXPECT_GT(stats.cycles, 1u);
+    jsonnet_destroy(vm);
+}
+
+TEST(JsonnetTest, TestSelect)
+{
+    const char* snippet = "{ a: { b: [1, { c: 'x' }] }, d: error 'not selected' }";
+    struct JsonnetVm* vm = jsonnet_make();
+    ASSERT_FALSE(vm == nullptr);
+    int error = 0;
+
+    jsonnet_select_add(vm, "a.b.1.c");
+    char* output = jsonnet_evaluate_snippet(vm, "snippet", snippet, &error);
+    EXPECT_EQ(0, error);
+    EXPECT_STREQ("\"x\"\n", output);
+    jsonnet_realloc(vm, output, 0);
+
+    jsonnet_select_clear(vm);
+    jsonnet_select_add(vm, "a.b.0");
+    jsonnet_select_add(vm, "a.b.1");
+    output = jsonnet_evaluate_snippet(vm, "snippet", snippet, &error);
+    EXPECT_EQ(0, error);
+    EXPECT_STREQ("{\n   \"a.b.0\": 1,\n   \"a.b.1\": {\n      \"c\": \"x\"\n   }\n}\n",
+                 output);
+    jsonnet_realloc(vm, output, 0);
+
+    jsonnet_select_clear(vm);
+    jsonnet_select_add(vm, "a.b.2");
+    output = jsonnet_evaluate_snippet(vm, "snippet", snippet, &error);
+    EXPECT_EQ(1, error);
+    EXPECT_TRUE(strstr(output, "array has 2 elements") != nullptr) << output;
+    jsonnet_realloc(vm, output, 0);
+
+    jsonnet_select_clear(vm);
+    output = jsonnet_evaluate_snippet(vm, "snippet", snippet, &error);
+    EXPECT_EQ(1, error);
+    jsonnet_realloc(vm, output, 0);
+    jsonnet_destroy(vm);
+}
+
+static int native_length_calls = 0;
+
+static JsonnetJsonValue* native_length(void* ctx, const JsonnetJsonValue* const* argv,
+                                       int* success)
+{
+    struct JsonnetVm* vm = static_cast<struct JsonnetVm*>(ctx);
+    ++native_length_calls;
+    size_t n = 0;
+    *success = jsonnet_json_extract_array(vm, argv[0], &n)
+               || jsonnet_json_extract_object(vm, argv[0], &n);
+    if (!*success)
+        return jsonnet_json_make_string(vm, "not an array or object");
+    return jsonnet_json_make_number(vm, n);
+}
+
+TEST(JsonnetTest, TestNativeStructuredArgs)
+{
+    const char* snippet =
+        "local len = std.native('len');\n"
+        "[len([1, [2], 3]), len({ a: 1, b: 2 }), len([1, [2], 3]), len([1, [2], 4])]";
+    const char* params[] = {"x", nullptr};
+    struct JsonnetVm* vm = jsonnet_make();
+    ASSERT_FALSE(vm == nullptr);
+    jsonnet_native_callback(vm, "len", native_length, vm, params);
+    jsonnet_native_callback_memo(vm, "len", 1);
+
+    int error = 0;
+    for (int i = 0; i < 2; ++i) {
+        char* output = jsonnet_evaluate_snippet(vm, "snippet", snippet, &error);
+        EXPECT_EQ(0, error);
+        EXPECT_STREQ("[\n   3,\n   2,\n   3,\n   3\n]\n", output);
+        jsonnet_realloc(vm, output, 0);
+    }
+    // Equal arguments, also in the second evaluation, do not call it again.
+    EXPECT_EQ(3, native_length_calls);
+
+    char* output = jsonnet_evaluate_snippet(vm, "snippet", "std.native('len')(1)", &error);
+    EXPECT_EQ(1, error);
+    EXPECT_TRUE(strstr(output, "not an array or object") != nullptr) << output;
+    jsonnet_realloc(vm, output, 0);
+    jsonnet_destroy(vm);
+}
+
+static int native_batches = 0;
+
+static JsonnetJsonValue* native_sum(void* ctx, const JsonnetJsonValue* const* argv, int* success)
+{
+    struct JsonnetVm* vm = static_cast<struct JsonnetVm*>(ctx);
+    size_t num_calls = 0;
+    jsonnet_json_extract_array(vm, argv[0], &num_calls);
+    ++native_batches;
+    JsonnetJsonValue* results = jsonnet_json_make_array(vm);
+    for (size_t i = 0; i < num_calls; ++i) {
+        const JsonnetJsonValue* call = jsonnet_json_array_element(vm, argv[0], i);
+        double a = 0, b = 0;
+        jsonnet_json_extract_number(vm, jsonnet_json_array_element(vm, call, 0), &a);
+        jsonnet_json_extract_number(vm, jsonnet_json_array_element(vm, call, 1), &b);
+        jsonnet_json_array_append(vm, results, jsonnet_json_make_number(vm, a + b));
+    }
+    *success = 1;
+    return results;
+}
+
+static JsonnetJsonValue* native_negate(void* ctx, const JsonnetJsonValue* const* argv,
+                                       int* success)
+{
+    struct JsonnetVm* vm = static_cast<struct JsonnetVm*>(ctx);
+    size_t num_calls = 0;
+    jsonnet_json_extract_array(vm, argv[0], &num_calls);
+    ++native_batches;
+    JsonnetJsonValue* results = jsonnet_json_make_array(vm);
+    for (size_t i = 0; i < num_calls; ++i) {
+        const JsonnetJsonValue* call = jsonnet_json_array_element(vm, argv[0], i);
+        double a = 0;
+        jsonnet_json_extract_number(vm, jsonnet_json_array_element(vm, call, 0), &a);
+        jsonnet_json_array_append(vm, results, jsonnet_json_make_number(vm, -a));
+    }
+    *success = 1;
+    return results;
+}
+
+TEST(JsonnetTest, TestNativeVectorized)
+{
+    const char* snippet =
+        "local sum = std.native('sum'), negate = std.native('negate');\n"
+        "[sum(1, 2), std.foldl(function(a, b) a + b, std.map(negate, std.range(1, 100)), 0)]";
+    const char* sum_params[] = {"a", "b", nullptr};
+    const char* negate_params[] = {"a", nullptr};
+    struct JsonnetVm* vm = jsonnet_make();
+    ASSERT_FALSE(vm == nullptr);
+    jsonnet_native_callback_vectorized(vm, "sum", native_sum, vm, sum_params);
+    jsonnet_native_callback_vectorized(vm, "negate", native_negate, vm, negate_params);
+
+    int error = 0;
+    char* output = jsonnet_evaluate_snippet(vm, "snippet", snippet, &error);
+    EXPECT_EQ(0, error);
+    EXPECT_STREQ("[\n   3,\n   -5050\n]\n", output);
+    jsonnet_realloc(vm, output, 0);
+    // One batch for the call of sum, one for the whole std.map.
+    EXPECT_EQ(2, native_batches);
+    jsonnet_destroy(vm);
+}
+
+static int import_buffers_released = 0;
+
+static void release_import_buffer(void* owner)
+{
+    (void)owner;
+    ++import_buffers_released;
+}
+
+static char* import_buffer(void* ctx, const char* base, const char* rel, char** found_here,
+                           struct JsonnetImportBuffer* buffer, int* success)
+{
+    struct JsonnetVm* vm = static_cast<struct JsonnetVm*>(ctx);
+    (void)base;
+    static const char lib[] = "{ x: 1 }";
+    std::string path = rel;
+    if (path == "lib.libsonnet") {
+        buffer->content = lib;
+        buffer->length = sizeof(lib) - 1;
+        buffer->release = release_import_buffer;
+        buffer->owner = nullptr;
+    } else {
+        // Left to the VM, which maps it into memory.
+        path = ::testing::TempDir() + rel;
+        buffer->content = nullptr;
+    }
+    *found_here = jsonnet_realloc(vm, nullptr, path.length() + 1);
+    std::strcpy(*found_here, path.c_str());
+    *success = 1;
+    return nullptr;
+}
+
+TEST(JsonnetTest, TestImportBuffer)
+{
+    const std::string big = ::testing::TempDir() + "libjsonnet_test_import_buffer.txt";
+    std::ofstream(big) << std::string(100000, 'a') << "b";
+    struct JsonnetVm* vm = jsonnet_make();
+    ASSERT_FALSE(vm == nullptr);
+    jsonnet_import_buffer_callback(vm, import_buffer, vm);
+
+    int error = 0;
+    char* output = jsonnet_evaluate_snippet(
+        vm,
+        "snippet",
+        "local s = importstr 'libjsonnet_test_import_buffer.txt';\n"
+        "[(import 'lib.libsonnet').x, std.length(s), s[100000], importstr 'lib.libsonnet']",
+        &error);
+    EXPECT_EQ(0, error);
+    EXPECT_STREQ("[\n   1,\n   100001,\n   \"b\",\n   \"{ x: 1 }\"\n]\n", output);
+    jsonnet_realloc(vm, output, 0);
+    // Both imports of lib.libsonnet share the buffer.
+    EXPECT_EQ(1, import_buffers_released);
+    jsonnet_destroy(vm);
+    std::remove(big.c_str());
+}
+
+static char* import_generated(void* ctx, const char* base, const char* rel, char** found_here,
+                              struct JsonnetImportBuffer* buffer, int* success)
+{
+    struct JsonnetVm* vm = static_cast<struct JsonnetVm*>(ctx);
+    (void)base;
+    static const char generated[] = "'generated'";
+    *found_here = jsonnet_realloc(vm, nullptr, std::strlen(rel) + 1);
+    std::strcpy(*found_here, rel);
+    buffer->content = generated;
+    buffer->length = sizeof(generated) - 1;
+    buffer->release = nullptr;
+    *success = 1;
+    return nullptr;
+}
+
+TEST(JsonnetTest, TestImportPathCache)
+{
+    const std::string lib = ::testing::TempDir() + "libjsonnet_test_import_path_cache.libsonnet";
+    const std::string snippet = "import 'libjsonnet_test_import_path_cache.libsonnet'";
+    std::remove(lib.c_str());
+    struct JsonnetVm* vm = jsonnet_make();
+    ASSERT_FALSE(vm == nullptr);
+    jsonnet_jpath_add(vm, ::testing::TempDir().c_str());
+    jsonnet_import_path_cache(vm, 1);
+    jsonnet_import_fallback(vm, import_generated, vm);
+
+    // Not found anywhere, so the fallback provides it.
+    int error = 0;
+    char* output = jsonnet_evaluate_snippet(vm, "snippet", snippet.c_str(), &error);
+    EXPECT_EQ(0, error);
+    EXPECT_STREQ("\"generated\"\n", output);
+    jsonnet_realloc(vm, output, 0);
+
+    // The file is not noticed while the misses are remembered.
+    std::ofstream(lib) << "'on disk'";
+    output = jsonnet_evaluate_snippet(vm, "snippet", snippet.c_str(), &error);
+    EXPECT_EQ(0, error);
+    EXPECT_STREQ("\"generated\"\n", output);
+    jsonnet_realloc(vm, output, 0);
+
+    jsonnet_import_path_cache(vm, 0);
+    output = jsonnet_evaluate_snippet(vm, "snippet", snippet.c_str(), &error);
+    EXPECT_EQ(0, error);
+    EXPECT_STREQ("\"on disk\"\n", output);
+    jsonnet_realloc(vm, output, 0);
+    jsonnet_destroy(vm);
+    std::remove(lib.c_str());
+}
@@ -37,6 +37,8 @@ struct HeapEntity {
     };
     GarbageCollectionMark mark;
     Type type;
+    /** Set by Heap::makeEntity, the free list that the memory of the entity returns to. */
+    unsigned char sizeClass;
     HeapEntity(Type type_) : type(type_) {}
     virtual ~HeapEntity() {}
 };
@@ -92,6 +94,125 @@ std::string type_str(const Value &v)
     return type_str(v.t);
 }
 
+/** A map from identifiers to values, stored as a vector sorted by identifier.
+ *
+ * Identifiers are interned, so they are compared by pointer.  The maps in the interpreter are
+ * small, copied often (e.g. on every call) and looked up far more often than they are changed,
+ * so a single contiguous allocation with binary search beats the nodes of a std::map.  Entries
+ * are in the same order as in a std::map.  Inserting invalidates iterators and references.
+ */
+template <class T>
+class IdentifierMap {
+   public:
+    typedef std::pair<const Identifier *, T> value_type;
+    typedef typename std::vector<value_type>::iterator iterator;
+    typedef typename std::vector<value_type>::const_iterator const_iterator;
+
+   private:
+    std::vector<value_type> entries;
+
+    static bool keyLess(const value_type &a, const Identifier *b)
+    {
+        return std::less<const Identifier *>()(a.first, b);
+    }
+
+   public:
+    IdentifierMap(void) {}
+
+    /** Copy a std::map, which is already sorted. */
+    explicit IdentifierMap(const std::map<const Identifier *, T> &m) : entries(m.begin(), m.end())
+    {
+    }
+
+    iterator begin(void)
+    {
+        return entries.begin();
+    }
+    iterator end(void)
+    {
+        return entries.end();
+    }
+    const_iterator begin(void) const
+    {
+        return entries.begin();
+    }
+    const_iterator end(void) const
+    {
+        return entries.end();
+    }
+    size_t size(void) const
+    {
+        return entries.size();
+    }
+    bool empty(void) const
+    {
+        return entries.empty();
+    }
+    void clear(void)
+    {
+        entries.clear();
+    }
+    void reserve(size_t n)
+    {
+        entries.reserve(n);
+    }
+
+    iterator find(const Identifier *k)
+    {
+        auto it = std::lower_bound(entries.begin(), entries.end(), k, keyLess);
+        return it != entries.end() && it->first == k ? it : entries.end();
+    }
+    const_iterator find(const Identifier *k) const
+    {
+        auto it = std::lower_bound(entries.begin(), entries.end(), k, keyLess);
+        return it != entries.end() && it->first == k ? it : entries.end();
+    }
+    size_t count(const Identifier *k) const
+    {
+        return find(k) == end() ? 0 : 1;
+    }
+
+    /** Add the entries of a range sorted by identifier whose identifiers are not in the map yet,
+     * like std::map::insert.
+     */
+    template <class It>
+    void insert(It first, It last)
+    {
+        std::vector<value_type> merged;
+        merged.reserve(entries.size() + std::distance(first, last));
+        auto it = entries.begin();
+        for (; first != last; ++first) {
+            while (it != entries.end() && keyLess(*it, first->first))
+                merged.push_back(*it++);
+            if (it == entries.end() || it->first != first->first)
+                merged.push_back(*first);
+        }
+        merged.insert(merged.end(), it, entries.end());
+        entries.swap(merged);
+    }
+
+    T &operator[](const Identifier *k)
+    {
+        // Appending in order is the common case, e.g. when building from sorted keys.
+        if (entries.empty() || keyLess(entries.back(), k)) {
+            entries.emplace_back(k, T());
+            return entries.back().second;
+        }
+        auto it = std::lower_bound(entries.begin(), entries.end(), k, keyLess);
+        if (it->first != k)
+            it = entries.emplace(it, k, T());
+        return it->second;
+    }
+};
+
+/** Order pairs by their identifier, as in an IdentifierMap. */
+template <class T>
+bool identifierLess(const std::pair<const Identifier *, T> &a,
+                    const std::pair<const Identifier *, T> &b)
+{
+    return std::less<const Identifier *>()(a.first, b.first);
+}
+
 struct HeapThunk;
 
 /** Stores the values bound to variables.
@@ -99,10 +220,17 @@ struct HeapThunk;
  * Each nested local statement, function call, and field access has its own binding frame to
  * give the values for the local variable, function parameters, or upValues.
  */
-typedef std::map<const Identifier *, HeapThunk *> BindingFrame;
+typedef IdentifierMap<HeapThunk *> BindingFrame;
 
 /** Supertype of all objects.  Types of Value::OBJECT will point at these.  */
 struct HeapObject : public HeapEntity {
+    /** The values of the fields that were already evaluated with this object as self.
+     *
+     * Keyed by the field and the "super" level of the leaf object it was found in.  Once self is
+     * fixed, a field always evaluates to the same value, so it only needs to be evaluated once.
+     */
+    std::map<std::pair<const Identifier *, unsigned>, Value> fieldValues;
+
     HeapObject(Type type) : HeapEntity(type) {}
 };
 
@@ -147,15 +275,74 @@ struct HeapThunk : public HeapEntity {
     }
 };
 
+/** An array, whose elements may be stored in the storage of another array.
+ *
+ * The storage of an array is only ever appended to, so the elements of an existing array never
+ * change.  This lets a + b append b to the storage of a when no other array was made from the end
+ * of it, and lets a slice be a view of the storage it was taken from.
+ */
 struct HeapArray : public HeapEntity {
-    // It is convenient for this to not be const, so that we can add elements to it one at a
-    // time after creation.  Thus, elements are not GCed as the array is being
-    // created.
-    std::vector<HeapThunk *> elements;
+    /** The array whose storage holds the elements, this if the array owns its storage. */
+    HeapArray *const base;
+
+    /** The position of the first element in the storage of base. */
+    const size_t offset;
+
     HeapArray(const std::vector<HeapThunk *> &elements)
-        : HeapEntity(ARRAY), elements(elements)
+        : HeapEntity(ARRAY), base(this), offset(0), length(elements.size()), storage(elements)
+    {
+    }
+
+    HeapArray(HeapArray *base, size_t offset, size_t length)
+        : HeapEntity(ARRAY), base(base), offset(offset), length(length)
+    {
+    }
+
+    size_t size(void) const
+    {
+        return length;
+    }
+
+    HeapThunk *operator[](size_t i) const
+    {
+        return base->storage[offset + i];
+    }
+
+    /** Iterators for range-based for loops, which must not append to the same storage. */
+    HeapThunk *const *begin(void) const
+    {
+        return base->storage.data() + offset;
+    }
+
+    HeapThunk *const *end(void) const
+    {
+        return begin() + length;
+    }
+
+    /** Whether no other array has elements after the end of this one in the storage. */
+    bool atEnd(void) const
+    {
+        return offset + length == base->storage.size();
+    }
+
+    /** Add an element.  It is convenient for arrays to not be const, so that we can add
+     * elements to them one at a time after creation.  Thus, elements are not GCed as the array is
+     * being created.  Only allowed if atEnd().
+     */
+    void push_back(HeapThunk *th)
     {
+        assert(atEnd());
+        base->storage.push_back(th);
+        length++;
     }
+
+   private:
+    friend class Heap;
+
+    size_t length;
+
+    /** The elements of this array and of the arrays that share its storage, if base == this. */
+    std::vector<HeapThunk *> storage;
 };
 
 /** Supertype of all objects that are not super objects or extended objects.  */
@@ -180,7 +367,7 @@ struct HeapSimpleObject : public HeapLeafObject {
      * These are evaluated in the captured environment and with self and super bound
      * dynamically.
      */
-    const std::map<const Identifier *, Field> fields;
+    const IdentifierMap<Field> fields;
 
     /** The object's invariants.
      *
@@ -189,7 +376,7 @@ struct HeapSimpleObject : public HeapLeafObject {
     ASTs asserts;
 
     HeapSimpleObject(const BindingFrame &up_values,
-                     const std::map<const Identifier *, Field> fields, ASTs asserts)
+                     const std::map<const Identifier *, Field> &fields, ASTs asserts)
         : HeapLeafObject(SIMPLE_OBJECT), upValues(up_values), fields(fields), asserts(asserts)
     {
     }
@@ -203,8 +390,43 @@ struct HeapExtendedObject : public HeapObject {
     /** The right hand side of the construct. */
     HeapObject *right;
 
+    /** A leaf that has a field. */
+    struct IndexedLeaf {
+        HeapLeafObject *leaf;
+        /** The position of the leaf in the tree, counting from 0 at the leftmost leaf. */
+        unsigned position;
+        /** The visibility of the field in the leaves up to and including this one. */
+        ObjectField::Hide hide;
+    };
+
+    /** The fields of the leaves of a tree, from left to right.
+     *
+     * Like the storage of an array, an index is only ever appended to, and it is shared along a
+     * chain of +: when the left operand of a + is the last object to have added to its index,
+     * the leaves of the right operand are added to it.  Each object sees the leaves at the
+     * positions before its numLeaves, which are the leaves of its own tree.
+     */
+    struct FieldIndex {
+        /** The leaves that have each field, in order of position. */
+        std::map<const Identifier *, std::vector<IndexedLeaf>> fields;
+        /** The number of leaves added. */
+        unsigned numLeaves = 0;
+    };
+
+    /** The index of the fields of the leaves of the tree, or null if it was not built yet.
+     *
+     * Built by the interpreter on first use, so that finding and enumerating fields does not
+     * depend on the depth of the tree.  The tree never changes, so neither does the index.  The
+     * leaves of the tree are reachable through left and right, so the garbage collector can
+     * ignore it.
+     */
+    std::shared_ptr<FieldIndex> fieldIndex;
+
+    /** The number of leaves of the tree, once fieldIndex was built. */
+    unsigned numLeaves;
+
     HeapExtendedObject(HeapObject *left, HeapObject *right)
-        : HeapObject(EXTENDED_OBJECT), left(left), right(right)
+        : HeapObject(EXTENDED_OBJECT), left(left), right(right), numLeaves(0)
     {
     }
 };
@@ -229,10 +451,10 @@ struct HeapComprehensionObject : public HeapLeafObject {
      * It is convenient to make this non-const to allow building up the values one by one, so that
      * the garbage collector can see them at each intermediate point.
      */
-    std::map<const Identifier *, HeapThunk *> compValues;
+    IdentifierMap<HeapThunk *> compValues;
 
     HeapComprehensionObject(const BindingFrame &up_values, const AST *value, const Identifier *id,
-                            const std::map<const Identifier *, HeapThunk *> &comp_values)
+                            const IdentifierMap<HeapThunk *> &comp_values)
         : HeapLeafObject(COMPREHENSION_OBJECT), upValues(up_values), value(value), id(id), compValues(comp_values)
     {
     }
@@ -274,13 +496,96 @@ struct HeapClosure : public HeapEntity {
     }
 };
 
-/** Stores a simple string on the heap. */
+/** Stores a simple string on the heap.
+ *
+ * Long strings concatenated with + are stored as a rope: a HeapString that only points at its
+ * two halves, so that building a string piece by piece (e.g. acc + x in a fold) takes linear
+ * time overall.  The rope is flattened the first time its contents are needed (\see value).
+ */
 struct HeapString : public HeapEntity {
-    const UString value;
-    HeapString(const UString &value) : HeapEntity(STRING), value(value) {}
+    /** The number of characters. */
+    const size_t length;
+
+    /** The halves of a rope that was not flattened yet, otherwise nullptr. */
+    mutable HeapString *left, *right;
+
+    HeapString(const UString &value)
+        : HeapEntity(STRING), length(value.length()), left(nullptr), right(nullptr), flat(value)
+    {
+    }
+
+    HeapString(HeapString *left, HeapString *right)
+        : HeapEntity(STRING), length(left->length + right->length), left(left), right(right)
+    {
+    }
+
+    /** The contents of the string, flattening it first if it is a rope. */
+    const UString &value(void) const
+    {
+        if (left != nullptr)
+            flatten();
+        return flat;
+    }
+
+   private:
+    /** The contents, unless this is a rope that was not flattened yet. */
+    mutable UString flat;
+
+    void flatten(void) const
+    {
+        UString r;
+        r.reserve(length);
+        // Ropes built by folds are deep, so do not recurse.
+        std::vector<const HeapString *> todo{right, left};
+        while (!todo.empty()) {
+            const HeapString *s = todo.back();
+            todo.pop_back();
+            if (s->left == nullptr) {
+                r.append(s->flat);
+            } else {
+                todo.push_back(s->right);
+                todo.push_back(s->left);
+            }
+        }
+        flat.swap(r);
+        // The halves may now be collected.
+        left = right = nullptr;
+    }
 };
 
-/** The heap does memory management, i.e. garbage collection. */
+/** The memory of heap entities is carved out of blocks of this many bytes. */
+static const size_t HEAP_BLOCK_SIZE = 64 * 1024;
+
+/** Heap entity sizes are rounded up to a multiple of this, which is also their alignment. */
+static const size_t HEAP_SIZE_CLASS_BYTES = 8;
+
+/** Heap entities may be at most this many times HEAP_SIZE_CLASS_BYTES large. */
+static const size_t HEAP_NUM_SIZE_CLASSES = 32;
+
+/** While a collection cycle is running, a step of it is done after this many allocations. */
+static const unsigned HEAP_STEP_ALLOCATIONS = 1024;
+
+/** Each step marks or sweeps this many entities per allocation since the last step, so that a
+ * cycle finishes long before the heap has grown by the growth trigger again.
+ */
+static const unsigned HEAP_STEP_WORK = 16;
+
+/** The heap does memory management, i.e. garbage collection.
+ *
+ * The collector is an incremental mark and sweep collector, so that no single pause is
+ * proportional to the size of the heap.  A cycle first marks, in steps, every entity reachable
+ * from the roots, and then sweeps, in steps, the entities that were not marked.  Between steps
+ * the interpreter runs and changes the heap, so:
+ *
+ * - Entities made while marking are marked at once, and their children later.
+ * - Every store of an entity into an existing one must be followed by writeBarrier, else the
+ *   entity stored may be hidden from the marking in a place that it has already passed.
+ * - The roots are marked once more when there is nothing left to mark, and what they reach is
+ *   marked in that same step, since the roots are not guarded by barriers.
+ *
+ * A single entity is always scanned in one go, so a step may take longer than its budget when
+ * it meets an object with very many fields or a very long array.
+ */
 class Heap {
     /** How many objects must exist in the heap before we bother doing garbage collection?
      */
@@ -290,194 +595,449 @@ class Heap {
      */
     double gcTuneGrowthTrigger;
 
+    /** What the collector is doing between steps. */
+    enum Phase {
+        /** No cycle is running. */
+        IDLE,
+        /** Entities are being marked with lastMark + 1. */
+        MARK,
+        /** Entities not marked with lastMark are being deleted. */
+        SWEEP
+    };
+    Phase phase;
+
     /** Value used to mark entities at the last garbage collection cycle. */
     GarbageCollectionMark lastMark;
 
     /** The heap entities (strings, arrays, objects, functions, etc).
      *
-     * Not all may be reachable, all should have o->mark == this->lastMark.  Entities are
-     * removed from the heap via O(1) swap with last element, so the ordering of entities is
-     * arbitrary and changes every garbage collection cycle.
+     * Not all may be reachable, all should have o->mark == this->lastMark when no cycle is
+     * running.  Entities are kept in the order they were made, since sweep removes them by
+     * compacting the vector.
      */
     std::vector<HeapEntity *> entities;
 
+    /** While sweeping, the entities before sweepKept survived and those from sweepNext on were
+     * not looked at yet.
+     */
+    size_t sweepKept, sweepNext;
+
     /** The number of heap entities at the last garbage collection cycle. */
     unsigned long lastNumEntities;
 
     /** The number of heap entities now. */
     unsigned long numEntities;
 
-    /** Add the HeapEntity inside v to vec, if the value exists on the heap.
+    /** The number of heap entities when the running cycle started. */
+    unsigned long cycleNumEntities;
+
+    /** The number of entities made since the last step. */
+    unsigned long numAllocations;
+
+    /** The number of entities deleted by the last cycle that finished. */
+    unsigned long numFreed;
+
+    /** The blocks that the memory of entities is carved out of.  They are only freed, all
+     * together, when the heap is destroyed.
+     */
+    std::vector<char *> blocks;
+
+    /** The part of the last block that was never used. */
+    char *blockNext, *blockEnd;
+
+    /** The memory of deleted entities by size class, linked through its first word. */
+    void *freeLists[HEAP_NUM_SIZE_CLASSES];
+
+    /** Get memory for an entity, preferably from the memory of a deleted one of the same size
+     * class.
+     */
+    void *allocate(unsigned char size_class)
+    {
+        void *r = freeLists[size_class];
+        if (r != nullptr) {
+            freeLists[size_class] = *static_cast<void **>(r);
+            return r;
+        }
+        size_t bytes = size_class * HEAP_SIZE_CLASS_BYTES;
+        if (size_t(blockEnd - blockNext) < bytes) {
+            blocks.push_back(static_cast<char *>(::operator new(HEAP_BLOCK_SIZE)));
+            blockNext = blocks.back();
+            blockEnd = blockNext + HEAP_BLOCK_SIZE;
+        }
+        r = blockNext;
+        blockNext += bytes;
+        return r;
+    }
+
+    /** Put the memory of an entity back on its free list. */
+    void release(void *mem, unsigned char size_class)
+    {
+        *static_cast<void **>(mem) = freeLists[size_class];
+        freeLists[size_class] = mem;
+    }
+
+    /** Run the destructor of the entity and release its memory. */
+    void destroy(HeapEntity *x)
+    {
+        unsigned char size_class = x->sizeClass;
+        x->~HeapEntity();
+        release(x, size_class);
+    }
+
+    /** Entities marked whose children are not marked yet.
+     *
+     * Kept between calls so that its storage is reused by every collection cycle.
      */
-    void addIfHeapEntity(Value v, std::vector<HeapEntity *> &vec)
+    std::vector<HeapEntity *> markStack;
+
+    /** Mark the HeapEntity inside v and push it on markStack, if the value exists on the heap and
+     * the entity is not marked yet.
+     */
+    void markLater(Value v)
     {
         if (v.isHeap())
-            vec.push_back(v.v.h);
+            markLater(v.v.h);
+    }
+
+    /** Mark the HeapEntity and push it on markStack, if it is not marked yet.
+     */
+    void markLater(HeapEntity *v)
+    {
+        const GarbageCollectionMark thisMark = lastMark + 1;
+        if (v->mark != thisMark) {
+            v->mark = thisMark;
+            markStack.push_back(v);
+        }
     }
 
-    /** Add the HeapEntity inside v to vec, if the value exists on the heap.
+    /** Mark the children of an entity.
+     *
+     * \returns The work done, i.e. one for the entity and one for each child.
      */
-    void addIfHeapEntity(HeapEntity *v, std::vector<HeapEntity *> &vec)
+    size_t markChildren(HeapEntity *curr)
     {
-        vec.push_back(v);
+        switch (curr->type) {
+            case HeapEntity::SIMPLE_OBJECT: {
+                assert(dynamic_cast<HeapSimpleObject *>(curr));
+                auto *obj = static_cast<HeapSimpleObject *>(curr);
+                for (const auto &upv : obj->upValues)
+                    markLater(upv.second);
+                for (const auto &fv : obj->fieldValues)
+                    markLater(fv.second);
+                return 1 + obj->upValues.size() + obj->fieldValues.size();
+            }
+            case HeapEntity::EXTENDED_OBJECT: {
+                assert(dynamic_cast<HeapExtendedObject *>(curr));
+                auto *obj = static_cast<HeapExtendedObject *>(curr);
+                markLater(obj->left);
+                markLater(obj->right);
+                for (const auto &fv : obj->fieldValues)
+                    markLater(fv.second);
+                return 3 + obj->fieldValues.size();
+            }
+            case HeapEntity::COMPREHENSION_OBJECT: {
+                assert(dynamic_cast<HeapComprehensionObject *>(curr));
+                auto *obj = static_cast<HeapComprehensionObject *>(curr);
+                for (const auto &upv : obj->upValues)
+                    markLater(upv.second);
+                for (const auto &upv : obj->compValues)
+                    markLater(upv.second);
+                for (const auto &fv : obj->fieldValues)
+                    markLater(fv.second);
+                return 1 + obj->upValues.size() + obj->compValues.size() +
+                       obj->fieldValues.size();
+            }
+            case HeapEntity::ARRAY: {
+                assert(dynamic_cast<HeapArray *>(curr));
+                auto *arr = static_cast<HeapArray *>(curr);
+                // The base keeps all of the storage alive, so that marking arrays that share it
+                // does not mark the same elements over and over.
+                if (arr->base != arr) {
+                    markLater(arr->base);
+                    return 2;
+                }
+                for (auto el : arr->storage)
+                    markLater(el);
+                return 1 + arr->storage.size();
+            }
+            case HeapEntity::CLOSURE: {
+                assert(dynamic_cast<HeapClosure *>(curr));
+                auto *func = static_cast<HeapClosure *>(curr);
+                for (const auto &upv : func->upValues)
+                    markLater(upv.second);
+                if (func->self)
+                    markLater(func->self);
+                return 2 + func->upValues.size();
+            }
+            case HeapEntity::THUNK: {
+                assert(dynamic_cast<HeapThunk *>(curr));
+                auto *thunk = static_cast<HeapThunk *>(curr);
+                if (thunk->filled) {
+                    markLater(thunk->content);
+                    return 2;
+                }
+                for (const auto &upv : thunk->upValues)
+                    markLater(upv.second);
+                if (thunk->self)
+                    markLater(thunk->self);
+                return 2 + thunk->upValues.size();
+            }
+            case HeapEntity::STRING: {
+                assert(dynamic_cast<HeapString *>(curr));
+                auto *str = static_cast<HeapString *>(curr);
+                if (str->left != nullptr) {
+                    markLater(str->left);
+                    markLater(str->right);
+                }
+                return 3;
+            }
+            default:
+                assert(false);
+                return 1;
+        }
     }
 
    public:
     Heap(unsigned gc_tune_min_objects, double gc_tune_growth_trigger)
         : gcTuneMinObjects(gc_tune_min_objects),
           gcTuneGrowthTrigger(gc_tune_growth_trigger),
+          phase(IDLE),
           lastMark(0),
+          sweepKept(0),
+          sweepNext(0),
           lastNumEntities(0),
-          numEntities(0)
+          numEntities(0),
+          cycleNumEntities(0),
+          numAllocations(0),
+          numFreed(0),
+          blockNext(nullptr),
+          blockEnd(nullptr),
+          freeLists()
     {
     }
 
     ~Heap(void)
     {
-        // Nothing is marked, everything will be collected.
-        sweep();
+        // The entities between sweepKept and sweepNext were deleted or moved down already.
+        if (phase == SWEEP)
+            entities.erase(entities.begin() + sweepKept, entities.begin() + sweepNext);
+        // Everything is collected.  The memory is not put on the free lists, since the blocks are
+        // freed as a whole.
+        for (HeapEntity *x : entities)
+            x->~HeapEntity();
+        for (char *block : blocks)
+            ::operator delete(block);
     }
 
-    /** Garbage collection: Mark v, and entities reachable from v. */
+    /** The number of heap entities now. */
+    unsigned long size(void) const
+    {
+        return numEntities;
+    }
+
+    /** The number of entities deleted by the last collection cycle that finished. */
+    unsigned long freed(void) const
+    {
+        return numFreed;
+    }
+
+    /** Whether a collection cycle is running, i.e. whether startCycle was called and the step
+     * that finished the cycle was not done yet.
+     */
+    bool collecting(void) const
+    {
+        return phase != IDLE;
+    }
+
+    /** Whether the running cycle is marking, i.e. whether the next step is markStep. */
+    bool marking(void) const
+    {
+        return phase == MARK;
+    }
+
+    /** Garbage collection: Start a cycle, after which the roots must be given to markFrom. */
+    void startCycle(void)
+    {
+        assert(phase == IDLE);
+        phase = MARK;
+        cycleNumEntities = numEntities;
+        numAllocations = 0;
+    }
+
+    /** Garbage collection: Mark v, whose children are then marked by later steps. */
     void markFrom(Value v)
     {
         if (v.isHeap())
             markFrom(v.v.h);
     }
 
-    /** Garbage collection: Mark heap entities reachable from the given heap entity. */
+    /** Garbage collection: Mark the given heap entity, whose children are then marked by later
+     * steps.
+     *
+     * Entities are marked when they are first found, so each one is pushed on markStack at most
+     * once per cycle, and the traversal stops at entities already marked from earlier roots.
+     */
     void markFrom(HeapEntity *from)
     {
         assert(from != nullptr);
-        const GarbageCollectionMark thisMark = lastMark + 1;
-        struct State {
-            HeapEntity *ent;
-            std::vector<HeapEntity *> children;
-            State(HeapEntity *ent) : ent(ent) {}
-        };
-
-        std::vector<State> stack;
-        stack.emplace_back(from);
-
-        while (stack.size() > 0) {
-            size_t curr_index = stack.size() - 1;
-            State &s = stack[curr_index];
-            HeapEntity *curr = s.ent;
-            if (curr->mark != thisMark) {
-                curr->mark = thisMark;
-
-                switch(curr->type) {
-                    case HeapEntity::SIMPLE_OBJECT: {
-                        assert(dynamic_cast<HeapSimpleObject *>(curr));
-                        auto *obj = static_cast<HeapSimpleObject *>(curr);
-                        for (auto upv : obj->upValues)
-                            addIfHeapEntity(upv.second, s.children);
-                        break;
-                    }
-                    case HeapEntity::EXTENDED_OBJECT: {
-                        assert(dynamic_cast<HeapExtendedObject *>(curr));
-                        auto *obj = static_cast<HeapExtendedObject *>(curr);
-                        addIfHeapEntity(obj->left, s.children);
-                        addIfHeapEntity(obj->right, s.children);
-                        break;
-                    }
-                    case HeapEntity::COMPREHENSION_OBJECT: {
-                        assert(dynamic_cast<HeapComprehensionObject *>(curr));
-                        auto *obj = static_cast<HeapComprehensionObject *>(curr);
-                        for (auto upv : obj->upValues)
-                            addIfHeapEntity(upv.second, s.children);
-                        for (auto upv : obj->compValues)
-                            addIfHeapEntity(upv.second, s.children);
-                        break;
-                    }
-                    case HeapEntity::ARRAY: {
-                        assert(dynamic_cast<HeapArray *>(curr));
-                        auto *arr = static_cast<HeapArray *>(curr);
-                        for (auto el : arr->elements)
-                            addIfHeapEntity(el, s.children);
-                        break;
-                    }
-                    case HeapEntity::CLOSURE: {
-                        assert(dynamic_cast<HeapClosure *>(curr));
-                        auto *func = static_cast<HeapClosure *>(curr);
-                        for (auto upv : func->upValues)
-                            addIfHeapEntity(upv.second, s.children);
-                        if (func->self)
-                            addIfHeapEntity(func->self, s.children);
-                        break;
-                    }
-                    case HeapEntity::THUNK: {
-                        assert(dynamic_cast<HeapThunk *>(curr));
-                        auto *thunk = static_cast<HeapThunk *>(curr);
-                        if (thunk->filled) {
-                            if (thunk->content.isHeap())
-                                addIfHeapEntity(thunk->content.v.h, s.children);
-                        } else {
-                            for (auto upv : thunk->upValues)
-                                addIfHeapEntity(upv.second, s.children);
-                            if (thunk->self)
-                                addIfHeapEntity(thunk->self, s.children);
-                        }
-                        break;
-                    }
-                    case HeapEntity::STRING:
-                        assert(dynamic_cast<HeapString *>(curr));
-                        break;
-                    default:
-                        assert(false);
-                        break;
-                }
-            }
+        assert(phase == MARK);
+        markLater(from);
+    }
 
-            if (s.children.size() > 0) {
-                HeapEntity *next = s.children[s.children.size() - 1];
-                s.children.pop_back();
-                stack.emplace_back(next);  // CAUTION: s invalidated here
-            } else {
-                stack.pop_back();  // CAUTION: s invalidated here
-            }
+    /** Garbage collection: Keep v alive after it was stored in owner.
+     *
+     * If the children of owner were already marked by the running cycle, v is marked now.
+     * This is not needed if nothing was made on the heap between making owner or v and the
+     * store, since no step can have run in between.
+     */
+    void writeBarrier(HeapEntity *owner, Value v)
+    {
+        if (v.isHeap())
+            writeBarrier(owner, v.v.h);
+    }
+
+    /** Garbage collection: Keep v alive after it was stored in owner, \see writeBarrier. */
+    void writeBarrier(HeapEntity *owner, HeapEntity *v)
+    {
+        if (phase == MARK && owner->mark == GarbageCollectionMark(lastMark + 1))
+            markLater(v);
+    }
+
+    /** Garbage collection: Keep the children of owner alive after many were stored at once.
+     *
+     * If the children of owner were already marked by the running cycle, they are marked again
+     * by a later step.
+     */
+    void writeBarrier(HeapEntity *owner)
+    {
+        if (phase == MARK && owner->mark == GarbageCollectionMark(lastMark + 1))
+            markStack.push_back(owner);
+    }
+
+    /** Garbage collection: Mark the children of some marked entities.
+     *
+     * The entities made while marking are marked too, so a program that quickly makes entities
+     * with many children can keep ahead of the steps.  Then, once the heap has grown as much as
+     * would start the next cycle, everything left is marked in this step.
+     *
+     * The entity made last is left for a later step, since whoever made it may still be filling
+     * it in without write barriers.  The roots keep what is stored in it alive if the marking is
+     * finished now.
+     *
+     * \returns Whether nothing else is left to mark, then the roots must be given to markFrom
+     * again and the marking finished with finishMark.
+     */
+    bool markStep(void)
+    {
+        assert(phase == MARK);
+        if (numEntities > gcTuneGrowthTrigger * cycleNumEntities)
+            return true;
+        HeapEntity *newest = nullptr;
+        if (markStack.size() > 0 && markStack.back() == entities.back()) {
+            newest = markStack.back();
+            markStack.pop_back();
+        }
+        size_t budget = numAllocations * HEAP_STEP_WORK;
+        numAllocations = 0;
+        size_t work = 0;
+        while (work < budget && markStack.size() > 0) {
+            HeapEntity *curr = markStack.back();
+            markStack.pop_back();
+            work += markChildren(curr);
         }
+        bool done = markStack.size() == 0;
+        if (newest != nullptr)
+            markStack.push_back(newest);
+        return done;
     }
 
-    /** Delete everything that was not marked since the last collection. */
-    void sweep(void)
+    /** Garbage collection: Mark everything left to mark, and start sweeping. */
+    void finishMark(void)
     {
+        assert(phase == MARK);
+        while (markStack.size() > 0) {
+            HeapEntity *curr = markStack.back();
+            markStack.pop_back();
+            markChildren(curr);
+        }
         lastMark++;
-        // Heap shrinks during this loop.  Do not cache entities.size().
-        for (unsigned long i = 0; i < entities.size(); ++i) {
-            HeapEntity *x = entities[i];
+        phase = SWEEP;
+        sweepKept = sweepNext = 0;
+        numAllocations = 0;
+        numFreed = 0;
+    }
+
+    /** Garbage collection: Delete some of the entities that were not marked by the cycle.
+     *
+     * The surviving entities are moved down over the deleted ones, keeping their order, so the
+     * entities vector is walked once from the front.  Entities made while sweeping are added at
+     * the end and survive.
+     *
+     * \returns Whether the cycle is finished.
+     */
+    bool sweepStep(void)
+    {
+        assert(phase == SWEEP);
+        size_t end = std::min(entities.size(), sweepNext + numAllocations * HEAP_STEP_WORK);
+        numAllocations = 0;
+        for (; sweepNext < end; ++sweepNext) {
+            HeapEntity *x = entities[sweepNext];
             if (x->mark != lastMark) {
-                delete x;
-                if (i != entities.size() - 1) {
-                    // Swap it with the back.
-                    entities[i] = entities[entities.size() - 1];
-                }
-                entities.pop_back();
-                --i;
+                destroy(x);
+                numFreed++;
+            } else {
+                entities[sweepKept++] = x;
             }
         }
-        lastNumEntities = numEntities = entities.size();
+        numEntities = entities.size() - (sweepNext - sweepKept);
+        if (sweepNext < entities.size())
+            return false;
+        entities.resize(sweepKept);
+        lastNumEntities = numEntities;
+        phase = IDLE;
+        return true;
     }
 
-    /** Is it time to initiate a GC cycle? */
+    /** Is it time to start a GC cycle, or to do the next step of the running one? */
     bool checkHeap(void)
     {
+        if (phase != IDLE)
+            return numAllocations >= HEAP_STEP_ALLOCATIONS;
         return numEntities > gcTuneMinObjects &&
                numEntities > gcTuneGrowthTrigger * lastNumEntities;
     }
 
     /** Allocate a heap entity.
+     *
+     * Its memory comes from the free list of its size class, or else from the last block.
      *
      * If the heap is large enough (\see gcTuneMinObjects) and has grown by enough since the
-     * last collection cycle (\see gcTuneGrowthTrigger), a collection cycle is performed.
+     * last collection cycle (\see gcTuneGrowthTrigger), checkHeap says a collection cycle should
+     * be started.  While marking, the entity is marked, and its children are marked later.
      */
     template <class T, class... Args>
     T *makeEntity(Args &&... args)
     {
-        T *r = new T(std::forward<Args>(args)...);
+        static_assert(alignof(T) <= HEAP_SIZE_CLASS_BYTES, "heap entity alignment");
+        static_assert(sizeof(T) < HEAP_NUM_SIZE_CLASSES * HEAP_SIZE_CLASS_BYTES,
+                      "heap entity size");
+        const unsigned char size_class =
+            (sizeof(T) + HEAP_SIZE_CLASS_BYTES - 1) / HEAP_SIZE_CLASS_BYTES;
+        void *mem = allocate(size_class);
+        T *r;
+        try {
+            r = new (mem) T(std::forward<Args>(args)...);
+        } catch (...) {
+            release(mem, size_class);
+            throw;
+        }
         entities.push_back(r);
+        r->sizeClass = size_class;
         r->mark = lastMark;
-        numEntities = entities.size();
+        if (phase == MARK)
+            markLater(r);
+        numEntities++;
+        numAllocations++;
         return r;
     }
 };
@@ -14,6 +14,8 @@ See the License for the specific language governing permissions and
 limitations under the License.
 */
 
+#include <algorithm>
+#include <functional>
 #include <set>
 
 #include "ast.h"
@@ -22,12 +24,181 @@ limitations under the License.
 
 typedef std::set<const Identifier *> IdSet;
 
+/** The identifiers bound by each scope within a call, innermost last (see VarSlot). */
+typedef std::vector<Identifiers> Scopes;
+
 /** Inserts all of s into r. */
 static void append(IdSet &r, const IdSet &s)
 {
     r.insert(s.begin(), s.end());
 }
 
+/** Find where id is bound in the given scopes. */
+static VarSlot resolve_var(const Scopes &scopes, const Identifier *id)
+{
+    for (unsigned depth = 0; depth < scopes.size(); ++depth) {
+        const Identifiers &scope = scopes[scopes.size() - 1 - depth];
+        auto it = std::lower_bound(scope.begin(), scope.end(), id, std::less<const Identifier *>());
+        if (it != scope.end() && *it == id)
+            return VarSlot(depth, it - scope.begin());
+    }
+    return VarSlot();
+}
+
+/** Resolve where the given free variables are bound in the given scopes, into slots. */
+static void resolve_captures(const Identifiers &free_vars, const Scopes &scopes,
+                             std::vector<VarSlot> &slots)
+{
+    // Like freeVariables, this is only done once for shared subtrees.
+    if (slots.size() == free_vars.size())
+        return;
+    slots.clear();
+    for (const Identifier *id : free_vars)
+        slots.push_back(resolve_var(scopes, id));
+}
+
+/** Resolve the free variables that a function or object captures. */
+static void resolve_closure(AST *ast, const Scopes &scopes)
+{
+    resolve_captures(ast->freeVariables, scopes, ast->freeVariableSlots);
+}
+
+/** Resolve the free variables captured by a thunk made to evaluate ast. */
+static void resolve_thunk(AST *ast, const Scopes &scopes)
+{
+    resolve_captures(ast->freeVariables, scopes, ast->thunkSlots);
+}
+
+/** Resolve the variables of ast_ that are evaluated in the same call as ast_.
+ *
+ * Function, thunk and field bodies are evaluated in calls of their own, so they are resolved
+ * separately (see resolve_body) once their free variables are known.
+ *
+ * \param ast_ The AST.
+ * \param scopes The scopes within the current call, in which ast_ is evaluated.
+ */
+static void resolve(AST *ast_, Scopes &scopes)
+{
+    switch (ast_->type) {
+    case AST_APPLY: {
+        auto* ast = static_cast<Apply *>(ast_);
+        resolve(ast->target, scopes);
+        for (const auto &arg : ast->args)
+            resolve_thunk(arg.expr, scopes);
+    } break;
+    case AST_ARRAY: {
+        auto* ast = static_cast<Array *>(ast_);
+        for (auto &el : ast->elements)
+            resolve_thunk(el.expr, scopes);
+    } break;
+    case AST_BINARY: {
+        auto* ast = static_cast<Binary *>(ast_);
+        resolve(ast->left, scopes);
+        resolve(ast->right, scopes);
+    } break;
+    case AST_CONDITIONAL: {
+        auto* ast = static_cast<Conditional *>(ast_);
+        resolve(ast->cond, scopes);
+        resolve(ast->branchTrue, scopes);
+        resolve(ast->branchFalse, scopes);
+    } break;
+    case AST_ERROR: {
+        auto* ast = static_cast<Error *>(ast_);
+        resolve(ast->expr, scopes);
+    } break;
+    case AST_FUNCTION: {
+        resolve_closure(ast_, scopes);
+    } break;
+    case AST_IN_SUPER: {
+        auto* ast = static_cast<InSuper *>(ast_);
+        resolve(ast->element, scopes);
+    } break;
+    case AST_INDEX: {
+        auto* ast = static_cast<Index *>(ast_);
+        resolve(ast->target, scopes);
+        resolve(ast->index, scopes);
+    } break;
+    case AST_LOCAL: {
+        auto* ast = static_cast<Local *>(ast_);
+        IdSet vars;
+        for (const auto &bind : ast->binds)
+            vars.insert(bind.var);
+        scopes.emplace_back(vars.begin(), vars.end());
+        // The thunks capture the new scope too, so they can refer to each other.
+        for (const auto &bind : ast->binds)
+            resolve_thunk(bind.body, scopes);
+        resolve(ast->body, scopes);
+        scopes.pop_back();
+    } break;
+    case AST_DESUGARED_OBJECT: {
+        auto* ast = static_cast<DesugaredObject *>(ast_);
+        for (auto &field : ast->fields)
+            resolve(field.name, scopes);
+        resolve_closure(ast_, scopes);
+    } break;
+    case AST_OBJECT_COMPREHENSION_SIMPLE: {
+        auto* ast = static_cast<ObjectComprehensionSimple *>(ast_);
+        // The frame that binds id is already on the stack while the array is evaluated.
+        scopes.emplace_back();
+        resolve(ast->array, scopes);
+        scopes.back().push_back(ast->id);
+        resolve(ast->field, scopes);
+        resolve_closure(ast_, scopes);
+        scopes.pop_back();
+    } break;
+    case AST_SUPER_INDEX: {
+        auto* ast = static_cast<SuperIndex *>(ast_);
+        resolve(ast->index, scopes);
+    } break;
+    case AST_UNARY: {
+        auto* ast = static_cast<Unary *>(ast_);
+        resolve(ast->expr, scopes);
+    } break;
+    case AST_VAR: {
+        auto* ast = static_cast<Var *>(ast_);
+        if (ast->slot.depth == VarSlot::UNRESOLVED)
+            ast->slot = resolve_var(scopes, ast->id);
+    } break;
+    default:
+        // No variables.
+        break;
+    }
+}
+
+/** Resolve the variables of a function, thunk or field body, which is evaluated in a call that
+ * binds the variables in env.
+ */
+static void resolve_body(AST *ast, const IdSet &env)
+{
+    Scopes scopes{Identifiers(env.begin(), env.end())};
+    resolve(ast, scopes);
+}
+
+static IdSet static_analysis(AST *ast_, bool in_object, const IdSet &vars);
+
+/** Statically analyse a function, thunk or field body.
+ *
+ * \param bodies If ast was not analysed before, it is added to this, to be resolved once the
+ * variables bound by its call are known.
+ */
+static IdSet static_analysis_body(AST *ast, bool in_object, const IdSet &vars,
+                                  std::vector<AST *> &bodies)
+{
+    if (!ast->analysed)
+        bodies.push_back(ast);
+    return static_analysis(ast, in_object, vars);
+}
+
+/** Statically analyse the body of a thunk, and resolve its variables. */
+static IdSet static_analysis_thunk(AST *ast, bool in_object, const IdSet &vars)
+{
+    std::vector<AST *> bodies;
+    IdSet r = static_analysis_body(ast, in_object, vars, bodies);
+    for (AST *body : bodies)
+        resolve_body(body, r);
+    return r;
+}
+
 /** Statically analyse the given ast.
  *
  * \param ast_ The AST.
@@ -37,6 +208,10 @@ static void append(IdSet &r, const IdSet &s)
  */
 static IdSet static_analysis(AST *ast_, bool in_object, const IdSet &vars)
 {
+    // Shared subtrees are always used in the same context, so the result does not change.
+    if (ast_->analysed)
+        return IdSet(ast_->freeVariables.begin(), ast_->freeVariables.end());
+
     IdSet r;
 
     switch (ast_->type) {
@@ -45,7 +220,7 @@ static IdSet static_analysis(AST *ast_, bool in_object, const IdSet &vars)
         auto* ast = static_cast<Apply *>(ast_);
         append(r, static_analysis(ast->target, in_object, vars));
         for (const auto &arg : ast->args)
-            append(r, static_analysis(arg.expr, in_object, vars));
+            append(r, static_analysis_thunk(arg.expr, in_object, vars));
     } break;
     case AST_APPLY_BRACE: {
         assert(dynamic_cast<ApplyBrace *>(ast_));
@@ -55,7 +230,7 @@ static IdSet static_analysis(AST *ast_, bool in_object, const IdSet &vars)
         assert(dynamic_cast<Array *>(ast_));
         auto* ast = static_cast<Array *>(ast_);
         for (auto &el : ast->elements)
-            append(r, static_analysis(el.expr, in_object, vars));
+            append(r, static_analysis_thunk(el.expr, in_object, vars));
     } break;
     case AST_BINARY: {
         assert(dynamic_cast<Binary *>(ast_));
@@ -93,14 +268,22 @@ static IdSet static_analysis(AST *ast_, bool in_object, const IdSet &vars)
             new_vars.insert(p.id);
         }
 
-        auto fv = static_analysis(ast->body, in_object, new_vars);
+        std::vector<AST *> bodies;
+        auto fv = static_analysis_body(ast->body, in_object, new_vars, bodies);
         for (const auto &p : ast->params) {
             if (p.expr != nullptr)
-                append(fv, static_analysis(p.expr, in_object, new_vars));
+                append(fv, static_analysis_body(p.expr, in_object, new_vars, bodies));
         }
         for (const auto &p : ast->params)
             fv.erase(p.id);
         append(r, fv);
+
+        // The body and default arguments are evaluated with the captured variables and the
+        // parameters.
+        IdSet env = r;
+        append(env, params);
+        for (AST *body : bodies)
+            resolve_body(body, env);
     } break;
     case AST_IMPORT: {
         assert(dynamic_cast<Import *>(ast_));
@@ -134,7 +317,7 @@ static IdSet static_analysis(AST *ast_, bool in_object, const IdSet &vars)
         append(new_vars, ast_vars);
         IdSet fvs;
         for (const auto &bind : ast->binds) {
-            append(fvs, static_analysis(bind.body, in_object, new_vars));
+            append(fvs, static_analysis_thunk(bind.body, in_object, new_vars));
         }
 
         append(fvs, static_analysis(ast->body, in_object, new_vars));
@@ -163,23 +346,33 @@ static IdSet static_analysis(AST *ast_, bool in_object, const IdSet &vars)
     case AST_DESUGARED_OBJECT: {
         assert(dynamic_cast<DesugaredObject *>(ast_));
         auto* ast = static_cast<DesugaredObject *>(ast_);
+        std::vector<AST *> bodies;
         for (auto &field : ast->fields) {
             append(r, static_analysis(field.name, in_object, vars));
-            append(r, static_analysis(field.body, true, vars));
+            append(r, static_analysis_body(field.body, true, vars, bodies));
         }
         for (AST *assert : ast->asserts) {
-            append(r, static_analysis(assert, true, vars));
+            append(r, static_analysis_body(assert, true, vars, bodies));
         }
+        // Fields and assertions are evaluated with the variables captured by the object.
+        for (AST *body : bodies)
+            resolve_body(body, r);
     } break;
     case AST_OBJECT_COMPREHENSION_SIMPLE: {
         assert(dynamic_cast<ObjectComprehensionSimple *>(ast_));
         auto* ast = static_cast<ObjectComprehensionSimple *>(ast_);
         auto new_vars = vars;
         new_vars.insert(ast->id);
+        std::vector<AST *> bodies;
         append(r, static_analysis(ast->field, false, new_vars));
-        append(r, static_analysis(ast->value, true, new_vars));
+        append(r, static_analysis_body(ast->value, true, new_vars, bodies));
         r.erase(ast->id);
         append(r, static_analysis(ast->array, in_object, vars));
+        // The value is evaluated with the variables captured by the object, and id.
+        IdSet env = r;
+        env.insert(ast->id);
+        for (AST *body : bodies)
+            resolve_body(body, env);
     } break;
     case AST_SELF: {
         assert(dynamic_cast<const Self *>(ast_));
@@ -214,11 +407,12 @@ static IdSet static_analysis(AST *ast_, bool in_object, const IdSet &vars)
 
     for (auto *id : r)
         ast_->freeVariables.push_back(id);
+    ast_->analysed = true;
 
     return r;
 }
 
 void jsonnet_static_analysis(AST *ast)
 {
-    static_analysis(ast, false, IdSet{});
+    static_analysis_thunk(ast, false, IdSet{});
 }
@@ -20,7 +20,8 @@ limitations under the License.
 #include "ast.h"
 
 /** Check the ast for appropriate use of self, super, and correctly bound variables.  Also
- * initialize the freeVariables member of function and object ASTs.
+ * initialize the freeVariables member of function and object ASTs, and resolve where each
+ * variable is bound (see VarSlot).
  */
 void jsonnet_static_analysis(AST *ast);
 
@@ -0,0 +1,2 @@
+47,42,10,67,111,112,121,114,105,103,104,116,32,50,48,49,53,32,71,111,111,103,108,101,32,73,110,99,46,32,65,108,108,32,114,105,103,104,116,115,32,114,101,115,101,114,118,101,100,46,10,10,76,105,99,101,110,115,101,100,32,117,110,100,101,114,32,116,104,101,32,65,112,97,99,104,101,32,76,105,99,101,110,115,101,44,32,86,101,114,115,105,111,110,32,50,46,48,32,40,116,104,101,32,34,76,105,99,101,110,115,101,34,41,59,10,121,111,117,32,109,97,121,32,110,111,116,32,117,115,101,32,116,104,105,115,32,102,105,108,101,32,101,120,99,101,112,116,32,105,110,32,99,111,109,112,108,105,97,110,99,101,32,119,105,116,104,32,116,104,101,32,76,105,99,101,110,115,101,46,10,89,111,117,32,109,97,121,32,111,98,116,97,105,110,32,97,32,99,111,112,121,32,111,102,32,116,104,101,32,76,105,99,101,110,115,101,32,97,116,10,10,32,32,32,32,104,116,116,112,58,47,47,119,119,119,46,97,112,97,99,104,101,46,111,114,103,47,108,105,99,101,110,115,101,115,47,76,73,67,69,78,83,69,45,50,46,48,10,10,85,110,108,101,115,115,32,114,101,113,117,105,114,101,100,32,98,121,32,97,112,112,108,105,99,97,98,108,101,32,108,97,119,32,111,114,32,97,103,114,101,101,100,32,116,111,32,105,110,32,119,114,105,116,105,110,103,44,32,115,111,102,116,119,97,114,101,10,100,105,115,116,114,105,98,117,116,101,100,32,117,110,100,101,114,32,116,104,101,32,76,105,99,101,110,115,101,32,105,115,32,100,105,115,116,114,105,98,117,116,101,100,32,111,110,32,97,110,32,34,65,83,32,73,83,34,32,66,65,83,73,83,44,10,87,73,84,72,79,85,84,32,87,65,82,82,65,78,84,73,69,83,32,79,82,32,67,79,78,68,73,84,73,79,78,83,32,79,70,32,65,78,89,32,75,73,78,68,44,32,101,105,116,104,101,114,32,101,120,112,114,101,115,115,32,111,114,32,105,109,112,108,105,101,100,46,10,83,101,101,32,116,104,101,32,76,105,99,101,110,115,101,32,102,111,114,32,116,104,101,32,115,112,101,99,105,102,105,99,32,108,97,110,103,117,97,103,101,32,103,111,118,101,114,110,105,110,103,32,112,101,114,109,105,115,115,105,111,110,115,32,97,110,100,10,108,105,109,105,116,97,116,105,111,110,115,32,117,110,100,101,114,32,116,104,101,32,76,105,99,101,110,115,101,46,10,42,47,10,10,47,42,32,84,104,105,115,32,105,115,32,116,104,101,32,74,115,111,110,110,101,116,32,115,116,97,110,100,97,114,100,32,108,105,98,114,97,114,121,44,32,97,116,32,108,101,97,115,116,32,116,104,101,32,112,97,114,116,115,32,111,102,32,105,116,32,116,104,97,116,32,97,114,101,32,119,114,105,116,116,101,110,32,105,110,32,74,115,111,110,110,101,116,46,10,32,42,10,32,42,32,84,104,101,114,101,32,97,114,101,32,115,111,109,101,32,110,97,116,105,118,101,32,109,101,116,104,111,100,115,32,97,115,32,119,101,108,108,44,32,119,104,105,99,104,32,97,114,101,32,100,101,102,105,110,101,100,32,105,110,32,116,104,101,32,105,110,116,101,114,112,114,101,116,101,114,32,97,110,100,32,97,100,100,101,100,32,116,111,32,116,104,105,115,10,32,42,32,102,105,108,101,46,32,32,73,116,32,105,115,32,110,101,118,101,114,32,110,101,99,101,115,115,97,114,121,32,116,111,32,105,109,112,111,114,116,32,115,116,100,46,106,115,111,110,110,101,116,44,32,105,116,32,105,115,32,101,109,98,101,100,100,101,100,32,105,110,116,111,32,116,104,101,32,105,110,116,101,114,112,114,101,116,101,114,32,97,116,10,32,42,32,99,111,109,112,105,108,101,45,116,105,109,101,32,97,110,100,32,97,117,116,111,109,97,116,105,99,97,108,108,121,32,105,109,112,111,114,116,101,100,32,105,110,116,111,32,97,108,108,32,111,116,104,101,114,32,74,115,111,110,110,101,116,32,112,114,111,103,114,97,109,115,46,10,32,42,47,10,123,10,10,32,32,108,111,99,97,108,32,115,116,100,32,61,32,115,101,108,102,44,10,32,32,108,111,99,97,108,32,105,100,32,61,32,102,117,110,99,116,105,111,110,40,120,41,32,120,44,10,10,32,32,105,115,83,116,114,105,110,103,40,118,41,58,58,32,115,116,100,46,116,121,112,101,40,118,41,32,61,61,32,39,115,116,114,105,110,103,39,44,10,32,32,105,115,78,117,109,98,101,114,40,118,41,58,58,32,115,116,100,46,116,121,112,101,40,118,41,32,61,61,32,39,110,117,109,98,101,114,39,44,10,32,32,105,115,66,111,111,108,101,97,110,40,118,41,58,58,32,115,116,100,46,116,121,112,101,40,118,41,32,61,61,32,39,98,111,111,108,101,97,110,39,44,10,32,32,105,115,79,98,106,101,99,116,40,118,41,58,58,32,115,116,100,46,116,121,112,101,40,118,41,32,61,61,32,39,111,98,106,101,99,116,39,44,10,32,32,105,115,65,114,114,97,121,40,118,41,58,58,32,115,116,100,46,116,121,112,101,40,118,41,32,61,61,32,39,97,114,114,97,121,39,44,10,32,32,105,115,70,117,110,99,116,105,111,110,40,118,41,58,58,32,115,116,100,46,116,121,112,101,40,118,41,32,61,61,32,39,102,117,110,99,116,105,111,110,39,44,10,10,32,32,116,111,83,116,114,105,110,103,40,97,41,58,58,10,32,32,32,32,105,102,32,115,116,100,46,116,121,112,101,40,97,41,32,61,61,32,39,115,116,114,105,110,103,39,32,116,104,101,110,32,97,32,101,108,115,101,32,39,39,32,43,32,97,44,10,10,32,32,115,117,98,115,116,114,40,115,116,114,44,32,102,114,111,109,44,32,108,101,110,41,58,58,10,32,32,32,32,97,115,115,101,114,116,32,115,116,100,46,105,115,83,116,114,105,110,103,40,115,116,114,41,32,58,32,39,115,117,98,115,116,114,32,102,105,114,115,116,32,112,97,114,97,109,101,116,101,114,32,115,104,111,117,108,100,32,98,101,32,97,32,115,116,114,105,110,103,44,32,103,111,116,32,39,32,43,32,115,116,100,46,116,121,112,101,40,115,116,114,41,59,10,32,32,32,32,97,115,115,101,114,116,32,115,116,100,46,105,115,78,117,109,98,101,114,40,102,114,111,109,41,32,58,32,39,115,117,98,115,116,114,32,115,101,99,111,110,100,32,112,97,114,97,109,101,116,101,114,32,115,104,111,117,108,100,32,98,101,32,97,32,115,116,114,105,110,103,44,32,103,111,116,32,39,32,43,32,115,116,100,46,116,121,112,101,40,102,114,111,109,41,59,10,32,32,32,32,97,115,115,101,114,116,32,115,116,100,46,105,115,78,117,109,98,101,114,40,108,101,110,41,32,58,32,39,115,117,98,115,116,114,32,116,104,105,114,100,32,112,97,114,97,109,101,116,101,114,32,115,104,111,117,108,100,32,98,101,32,97,32,115,116,114,105,110,103,44,32,103,111,116,32,39,32,43,32,115,116,100,46,116,121,112,101,40,108,101,110,41,59,10,32,32,32,32,97,115,115,101,114,116,32,108,101,110,32,62,61,32,48,32,58,32,39,115,117,98,115,116,114,32,116,104,105,114,100,32,112,97,114,97,109,101,116,101,114,32,115,104,111,117,108,100,32,98,101,32,103,114,101,97,116,101,114,32,116,104,97,110,32,122,101,114,111,44,32,103,111,116,32,39,32,43,32,108,101,110,59,10,32,32,32,32,115,116,100,46,106,111,105,110,40,39,39,44,32,115,116,100,46,109,97,107,101,65,114,114,97,121,40,115,116,100,46,109,97,120,40,48,44,32,115,116,100,46,109,105,110,40,108,101,110,44,32,115,116,100,46,108,101,110,103,116,104,40,115,116,114,41,32,45,32,102,114,111,109,41,41,44,32,102,117,110,99,116,105,111,110,40,105,41,32,115,116,114,91,105,32,43,32,102,114,111,109,93,41,41,44,10,10,32,32,115,116,97,114,116,115,87,105,116,104,40,97,44,32,98,41,58,58,10,32,32,32,32,105,102,32,115,116,100,46,108,101,110,103,116,104,40,97,41,32,60,32,115,116,100,46,108,101,110,103,116,104,40,98,41,32,116,104,101,110,10,32,32,32,32,32,32,102,97,108,115,101,10,32,32,32,32,101,108,115,101,10,32,32,32,32,32,32,115,116,100,46,115,117,98,115,116,114,40,97,44,32,48,44,32,115,116,100,46,108,101,110,103,116,104,40,98,41,41,32,61,61,32,98,44,10,10,32,32,101,110,100,115,87,105,116,104,40,97,44,32,98,41,58,58,10,32,32,32,32,105,102,32,115,116,100,46,108,101,110,103,116,104,40,97,41,32,60,32,115,116,100,46,108,101,110,103,116,104,40,98,41,32,116,104,101,110,10,32,32,32,32,32,32,102,97,108,115,101,10,32,32,32,32,101,108,115,101,10,32,32,32,32,32,32,115,116,100,46,115,117,98,115,116,114,40,97,44,32,115,116,100,46,108,101,110,103,116,104,40,97,41,32,45,32,115,116,100,46,108,101,110,103,116,104,40,98,41,44,32,115,116,100,46,108,101,110,103,116,104,40,98,41,41,32,61,61,32,98,44,10,10,32,32,108,115,116,114,105,112,67,104,97,114,115,40,115,116,114,44,32,99,104,97,114,115,41,58,58,10,32,32,32,32,105,102,32,115,116,100,46,108,101,110,103,116,104,40,115,116,114,41,32,62,32,48,32,38,38,32,115,116,100,46,109,101,109,98,101,114,40,99,104,97,114,115,44,32,115,116,114,91,48,93,41,32,116,104,101,110,10,32,32,32,32,32,32,115,116,100,46,108,115,116,114,105,112,67,104,97,114,115,40,115,116,114,91,49,58,93,44,32,99,104,97,114,115,41,10,32,32,32,32,101,108,115,101,10,32,32,32,32,32,32,115,116,114,44,10,10,32,32,114,115,116,114,105,112,67,104,97,114,115,40,115,116,114,44,32,99,104,97,114,115,41,58,58,10,32,32,32,32,108,111,99,97,108,32,108,101,110,32,61,32,115,116,100,46,108,101,110,103,116,104,40,115,116,114,41,59,10,32,32,32,32,105,102,32,108,101,110,32,62,32,48,32,38,38,32,115,116,100,46,109,101,109,98,101,114,40,99,104,97,114,115,44,32,115,116,114,91,108,101,110,32,45,32,49,93,41,32,116,104,101,110,10,32,32,32,32,32,32,115,116,100,46,114,115,116,114,105,112,67,104,97,114,115,40,115,116,114,91,58,108,101,110,32,45,32,49,93,44,32,99,104,97,114,115,41,10,32,32,32,32,101,108,115,101,10,32,32,32,32,32,32,115,116,114,44,10,10,32,32,115,116,114,105,112,67,104,97,114,115,40,115,116,114,44,32,99,104,97,114,115,41,58,58,10,32,32,32,32,115,116,100,46,108,115,116,114,105,112,67,104,97,114,115,40,115,116,100,46,114,115,116,114,105,112,67,104,97,114,115,40,115,116,114,44,32,99,104,97,114,115,41,44,32,99,104,97,114,115,41,44,10,10,32,32,115,116,114,105,110,103,67,104,97,114,115,40,115,116,114,41,58,58,10,32,32,32,32,115,116,100,46,109,97,107,101,65,114,114,97,121,40,115,116,100,46,108,101,110,103,116,104,40,115,116,114,41,44,32,102,117,110,99,116,105,111,110,40,105,41,32,115,116,114,91,105,93,41,44,10,10,32,32,108,111,99,97,108,32,112,97,114,115,101,95,110,97,116,40,115,116,114,44,32,98,97,115,101,41,32,61,10,32,32,32,32,97,115,115,101,114,116,32,98,97,115,101,32,62,32,48,32,38,38,32,98,97,115,101,32,60,61,32,49,54,32,58,32,39,105,110,116,101,103,101,114,32,98,97,115,101,32,37,100,32,105,110,118,97,108,105,100,39,32,37,32,98,97,115,101,59,10,32,32,32,32,47,47,32,84,104,101,115,101,32,99,111,100,101,112,111,105,110,116,115,32,97,114,101,32,105,110,32,97,115,99,101,110,100,105,110,103,32,111,114,100,101,114,58,10,32,32,32,32,108,111,99,97,108,32,122,101,114,111,95,99,111,100,101,32,61,32,115,116,100,46,99,111,100,101,112,111,105,110,116,40,39,48,39,41,59,10,32,32,32,32,108,111,99,97,108,32,117,112,112,101,114,95,97,95,99,111,100,101,32,61,32,115,116,100,46,99,111,100,101,112,111,105,110,116,40,39,65,39,41,59,10,32,32,32,32,108,111,99,97,108,32,108,111,119,101,114,95,97,95,99,111,100,101,32,61,32,115,116,100,46,99,111,100,101,112,111,105,110,116,40,39,97,39,41,59,10,32,32,32,32,108,111,99,97,108,32,97,100,100,68,105,103,105,116,40,97,103,103,114,101,103,97,116,101,44,32,99,104,97,114,41,32,61,10,32,32,32,32,32,32,108,111,99,97,108,32,99,111,100,101,32,61,32,115,116,100,46,99,111,100,101,112,111,105,110,116,40,99,104,97,114,41,59,10,32,32,32,32,32,32,108,111,99,97,108,32,100,105,103,105,116,32,61,32,105,102,32,99,111,100,101,32,62,61,32,108,111,119,101,114,95,97,95,99,111,100,101,32,116,104,101,110,10,32,32,32,32,32,32,32,32,99,111,100,101,32,45,32,108,111,119,101,114,95,97,95,99,111,100,101,32,43,32,49,48,10,32,32,32,32,32,32,101,108,115,101,32,105,102,32,99,111,100,101,32,62,61,32,117,112,112,101,114,95,97,95,99,111,100,101,32,116,104,101,110,10,32,32,32,32,32,32,32,32,99,111,100,101,32,45,32,117,112,112,101,114,95,97,95,99,111,100,101,32,43,32,49,48,10,32,32,32,32,32,32,101,108,115,101,10,32,32,32,32,32,32,32,32,99,111,100,101,32,45,32,122,101,114,111,95,99,111,100,101,59,10,32,32,32,32,32,32,97,115,115,101,114,116,32,100,105,103,105,116,32,62,61,32,48,32,38,38,32,100,105,103,105,116,32,60,32,98,97,115,101,32,58,32,39,37,115,32,105,115,32,110,111,116,32,97,32,98,97,115,101,32,37,100,32,105,110,116,101,103,101,114,39,32,37,32,91,115,116,114,44,32,98,97,115,101,93,59,10,32,32,32,32,32,32,98,97,115,101,32,42,32,97,103,103,114,101,103,97,116,101,32,43,32,100,105,103,105,116,59,10,32,32,32,32,115,116,100,46,102,111,108,100,108,40,97,100,100,68,105,103,105,116,44,32,115,116,100,46,115,116,114,105,110,103,67,104,97,114,115,40,115,116,114,41,44,32,48,41,44,10,10,32,32,112,97,114,115,101,73,110,116,40,115,116,114,41,58,58,10,32,32,32,32,97,115,115,101,114,116,32,115,116,100,46,105,115,83,116,114,105,110,103,40,115,116,114,41,32,58,32,39,69,120,112,101,99,116,101,100,32,115,116,114,105,110,103,44,32,103,111,116,32,39,32,43,32,115,116,100,46,116,121,112,101,40,115,116,114,41,59,10,32,32,32,32,97,115,115,101,114,116,32,115,116,100,46,108,101,110,103,116,104,40,115,116,114,41,32,62,32,48,32,38,38,32,115,116,114,32,33,61,32,39,45,39,32,58,32,39,78,111,116,32,97,110,32,105,110,116,101,103,101,114,58,32,34,37,115,34,39,32,37,32,91,115,116,114,93,59,10,32,32,32,32,105,102,32,115,116,114,91,48,93,32,61,61,32,39,45,39,32,116,104,101,110,10,32,32,32,32,32,32,45,112,97,114,115,101,95,110,97,116,40,115,116,114,91,49,58,93,44,32,49,48,41,10,32,32,32,32,101,108,115,101,10,32,32,32,32,32,32,112,97,114,115,101,95,110,97,116,40,115,116,114,44,32,49,48,41,44,10,10,32,32,112,97,114,115,101,79,99,116,97,108,40,115,116,114,41,58,58,10,32,32,32,32,97,115,115,101,114,116,32,115,116,100,46,105,115,83,116,114,105,110,103,40,115,116,114,41,32,58,32,39,69,120,112,101,99,116,101,100,32,115,116,114,105,110,103,44,32,103,111,116,32,39,32,43,32,115,116,100,46,116,121,112,101,40,115,116,114,41,59,10,32,32,32,32,97,115,115,101,114,116,32,115,116,100,46,108,101,110,103,116,104,40,115,116,114,41,32,62,32,48,32,58,32,39,78,111,116,32,97,110,32,111,99,116,97,108,32,110,117,109,98,101,114,58,32,34,34,39,59,10,32,32,32,32,112,97,114,115,101,95,110,97,116,40,115,116,114,44,32,56,41,44,10,10,32,32,112,97,114,115,101,72,101,120,40,115,116,114,41,58,58,10,32,32,32,32,97,115,115,101,114,116,32,115,116,100,46,105,115,83,116,114,105,110,103,40,115,116,114,41,32,58,32,39,69,120,112,101,99,116,101,100,32,115,116,114,105,110,103,44,32,103,111,116,32,39,32,43,32,115,116,100,46,116,121,112,101,40,115,116,114,41,59,10,32,32,32,32,97,115,115,101,114,116,32,115,116,100,46,108,101,110,103,116,104,40,115,116,114,41,32,62,32,48,32,58,32,39,78,111,116,32,104,101,120,97,100,101,99,105,109,97,108,58,32,34,34,39,59,10,32,32,32,32,112,97,114,115,101,95,110,97,116,40,115,116,114,44,32,49,54,41,44,10,10,32,32,115,112,108,105,116,40,115,116,114,44,32,99,41,58,58,10,32,32,32,32,97,115,115,101,114,116,32,115,116,100,46,105,115,83,116,114,105,110,103,40,115,116,114,41,32,58,32,39,115,116,100,46,115,112,108,105,116,32,102,105,114,115,116,32,112,97,114,97,109,101,116,101,114,32,115,104,111,117,108,100,32,98,101,32,97,32,115,116,114,105,110,103,44,32,103,111,116,32,39,32,43,32,115,116,100,46,116,121,112,101,40,115,116,114,41,59,10,32,32,32,32,97,115,115,101,114,116,32,115,116,100,46,105,115,83,116,114,105,110,103,40,99,41,32,58,32,39,115,116,100,46,115,112,108,105,116,32,115,101,99,111,110,100,32,112,97,114,97,109,101,116,101,114,32,115,104,111,117,108,100,32,98,101,32,97,32,115,116,114,105,110,103,44,32,103,111,116,32,39,32,43,32,115,116,100,46,116,121,112,101,40,99,41,59,10,32,32,32,32,97,115,115,101,114,116,32,115,116,100,46,108,101,110,103,116,104,40,99,41,32,61,61,32,49,32,58,32,39,115,116,100,46,115,112,108,105,116,32,115,101,99,111,110,100,32,112,97,114,97,109,101,116,101,114,32,115,104,111,117,108,100,32,104,97,118,101,32,108,101,110,103,116,104,32,49,44,32,103,111,116,32,39,32,43,32,115,116,100,46,108,101,110,103,116,104,40,99,41,59,10,32,32,32,32,115,116,100,46,115,112,108,105,116,76,105,109,105,116,40,115,116,114,44,32,99,44,32,45,49,41,44,10,10,32,32,115,112,108,105,116,76,105,109,105,116,40,115,116,114,44,32,99,44,32,109,97,120,115,112,108,105,116,115,41,58,58,10,32,32,32,32,97,115,115,101,114,116,32,115,116,100,46,105,115,83,116,114,105,110,103,40,115,116,114,41,32,58,32,39,115,116,100,46,115,112,108,105,116,76,105,109,105,116,32,102,105,114,115,116,32,112,97,114,97,109,101,116,101,114,32,115,104,111,117,108,100,32,98,101,32,97,32,115,116,114,105,110,103,44,32,103,111,116,32,39,32,43,32,115,116,100,46,116,121,112,101,40,115,116,114,41,59,10,32,32,32,32,97,115,115,101,114,116,32,115,116,100,46,105,115,83,116,114,105,110,103,40,99,41,32,58,32,39,115,116,100,46,115,112,108,105,116,76,105,109,105,116,32,115,101,99,111,110,100,32,112,97,114,97,109,101,116,101,114,32,115,104,111,117,108,100,32,98,101,32,97,32,115,116,114,105,110,103,44,32,103,111,116,32,39,32,43,32,115,116,100,46,116,121,112,101,40,99,41,59,10,32,32,32,32,97,115,115,101,114,116,32,115,116,100,46,108,101,110,103,116,104,40,99,41,32,61,61,32,49,32,58,32,39,115,116,100,46,115,112,108,105,116,76,105,109,105,116,32,115,101,99,111,110,100,32,112,97,114,97,109,101,116,101,114,32,115,104,111,117,108,100,32,104,97,118,101,32,108,101,110,103,116,104,32,49,44,32,103,111,116,32,39,32,43,32,115,116,100,46,108,101,110,103,116,104,40,99,41,59,10,32,32,32,32,97,115,115,101,114,116,32,115,116,100,46,105,115,78,117,109,98,101,114,40,109,97,120,115,112,108,105,116,115,41,32,58,32,39,115,116,100,46,115,112,108,105,116,76,105,109,105,116,32,116,104,105,114,100,32,112,97,114,97,109,101,116,101,114,32,115,104,111,117,108,100,32,98,101,32,97,32,110,117,109,98,101,114,44,32,103,111,116,32,39,32,43,32,115,116,100,46,116,121,112,101,40,109,97,120,115,112,108,105,116,115,41,59,10,32,32,32,32,108,111,99,97,108,32,97,117,120,40,115,116,114,44,32,100,101,108,105,109,44,32,105,44,32,97,114,114,44,32,118,41,32,61,10,32,32,32,32,32,32,108,111,99,97,108,32,99,32,61,32,115,116,114,91,105,93,59,10,32,32,32,32,32,32,108,111,99,97,108,32,105,50,32,61,32,105,32,43,32,49,59,10,32,32,32,32,32,32,105,102,32,105,32,62,61,32,115,116,100,46,108,101,110,103,116,104,40,115,116,114,41,32,116,104,101,110,10,32,32,32,32,32,32,32,32,97,114,114,32,43,32,91,118,93,10,32,32,32,32,32,32,101,108,115,101,32,105,102,32,99,32,61,61,32,100,101,108,105,109,32,38,38,32,40,109,97,120,115,112,108,105,116,115,32,61,61,32,45,49,32,124,124,32,115,116,100,46,108,101,110,103,116,104,40,97,114,114,41,32,60,32,109,97,120,115,112,108,105,116,115,41,32,116,104,101,110,10,32,32,32,32,32,32,32,32,97,117,120,40,115,116,114,44,32,100,101,108,105,109,44,32,105,50,44,32,97,114,114,32,43,32,91,118,93,44,32,39,39,41,32,116,97,105,108,115,116,114,105,99,116,10,32,32,32,32,32,32,101,108,115,101,10,32,32,32,32,32,32,32,32,97,117,120,40,115,116,114,44,32,100,101,108,105,109,44,32,105,50,44,32,97,114,114,44,32,118,32,43,32,99,41,32,116,97,105,108,115,116,114,105,99,116,59,10,32,32,32,32,97,117,120,40,115,116,114,44,32,99,44,32,48,44,32,91,93,44,32,39,39,41,44,10,10,32,32,115,116,114,82,101,112,108,97,99,101,40,115,116,114,44,32,102,114,111,109,44,32,116,111,41,58,58,10,32,32,32,32,97,115,115,101,114,116,32,115,116,100,46,105,115,83,116,114,105,110,103,40,115,116,114,41,59,10,32,32,32,32,97,115,115,101,114,116,32,115,116,100,46,105,115,83,116,114,105,110,103,40,102,114,111,109,41,59,10,32,32,32,32,97,115,115,101,114,116,32,115,116,100,46,105,115,83,116,114,105,110,103,40,116,111,41,59,10,32,32,32,32,97,115,115,101,114,116,32,102,114,111,109,32,33,61,32,39,39,32,58,32,34,39,102,114,111,109,39,32,115,116,114,105,110,103,32,109,117,115,116,32,110,111,116,32,98,101,32,122,101,114,111,32,108,101,110,103,116,104,46,34,59,10,10,32,32,32,32,47,47,32,67,97,99,104,101,32,102,111,114,32,112,101,114,102,111,114,109,97,110,99,101,46,10,32,32,32,32,108,111,99,97,108,32,115,116,114,95,108,101,110,32,61,32,115,116,100,46,108,101,110,103,116,104,40,115,116,114,41,59,10,32,32,32,32,108,111,99,97,108,32,102,114,111,109,95,108,101,110,32,61,32,115,116,100,46,108,101,110,103,116,104,40,102,114,111,109,41,59,10,10,32,32,32,32,47,47,32,84,114,117,101,32,105,102,32,102,114,111,109,32,105,115,32,97,116,32,115,116,114,91,105,93,46,10,32,32,32,32,108,111,99,97,108,32,102,111,117,110,100,95,97,116,40,105,41,32,61,32,115,116,114,91,105,58,105,32,43,32,102,114,111,109,95,108,101,110,93,32,61,61,32,102,114,111,109,59,10,10,32,32,32,32,47,47,32,82,101,116,117,114,110,32,116,104,101,32,114,101,109,97,105,110,100,101,114,32,111,102,32,39,115,116,114,39,32,115,116,97,114,116,105,110,103,32,119,105,116,104,32,39,115,116,97,114,116,95,105,110,100,101,120,39,32,119,104,101,114,101,10,32,32,32,32,47,47,32,97,108,108,32,111,99,99,117,114,114,101,110,99,101,115,32,111,102,32,39,102,114,111,109,39,32,97,102,116,101,114,32,39,99,117,114,114,95,105,110,100,101,120,39,32,97,114,101,32,114,101,112,108,97,99,101,100,32,119,105,116,104,32,39,116,111,39,46,10,32,32,32,32,108,111,99,97,108,32,114,101,112,108,97,99,101,95,97,102,116,101,114,40,115,116,97,114,116,95,105,110,100,101,120,44,32,99,117,114,114,95,105,110,100,101,120,44,32,97,99,99,41,32,61,10,32,32,32,32,32,32,105,102,32,99,117,114,114,95,105,110,100,101,120,32,62,32,115,116,114,95,108,101,110,32,116,104,101,110,10,32,32,32,32,32,32,32,32,97,99,99,32,43,32,115,116,114,91,115,116,97,114,116,95,105,110,100,101,120,58,99,117,114,114,95,105,110,100,101,120,93,10,32,32,32,32,32,32,101,108,115,101,32,105,102,32,102,111,117,110,100,95,97,116,40,99,117,114,114,95,105,110,100,101,120,41,32,116,104,101,110,10,32,32,32,32,32,32,32,32,108,111,99,97,108,32,110,101,119,95,105,110,100,101,120,32,61,32,99,117,114,114,95,105,110,100,101,120,32,43,32,115,116,100,46,108,101,110,103,116,104,40,102,114,111,109,41,59,10,32,32,32,32,32,32,32,32,114,101,112,108,97,99,101,95,97,102,116,101,114,40,110,101,119,95,105,110,100,101,120,44,32,110,101,119,95,105,110,100,101,120,44,32,97,99,99,32,43,32,115,116,114,91,115,116,97,114,116,95,105,110,100,101,120,58,99,117,114,114,95,105,110,100,101,120,93,32,43,32,116,111,41,32,116,97,105,108,115,116,114,105,99,116,10,32,32,32,32,32,32,101,108,115,101,10,32,32,32,32,32,32,32,32,114,101,112,108,97,99,101,95,97,102,116,101,114,40,115,116,97,114,116,95,105,110,100,101,120,44,32,99,117,114,114,95,105,110,100,101,120,32,43,32,49,44,32,97,99,99,41,32,116,97,105,108,115,116,114,105,99,116,59,10,10,32,32,32,32,47,47,32,105,102,32,102,114,111,109,95,108,101,110,61,61,49,44,32,116,104,101,110,32,119,101,32,114,101,112,108,97,99,101,32,98,121,32,115,112,108,105,116,116,105,110,103,32,97,110,100,32,114,101,106,111,105,110,105,110,103,32,116,104,101,10,32,32,32,32,47,47,32,115,116,114,105,110,103,32,119,104,105,99,104,32,105,115,32,109,117,99,104,32,102,97,115,116,101,114,32,116,104,97,110,32,114,101,99,117,114,115,105,110,103,32,111,110,32,114,101,112,108,97,99,101,95,97,102,116,101,114,10,32,32,32,32,105,102,32,102,114,111,109,95,108,101,110,32,61,61,32,49,32,116,104,101,110,10,32,32,32,32,32,32,115,116,100,46,106,111,105,110,40,116,111,44,32,115,116,100,46,115,112,108,105,116,40,115,116,114,44,32,102,114,111,109,41,41,10,32,32,32,32,101,108,115,101,10,32,32,32,32,32,32,114,101,112,108,97,99,101,95,97,102,116,101,114,40,48,44,32,48,44,32,39,39,41,44,10,10,32,32,97,115,99,105,105,85,112,112,101,114,40,115,116,114,41,58,58,10,32,32,32,32,108,111,99,97,108,32,99,112,32,61,32,115,116,100,46,99,111,100,101,112,111,105,110,116,59,10,32,32,32,32,108,111,99,97,108,32,117,112,95,108,101,116,116,101,114,40,99,41,32,61,32,105,102,32,99,112,40,99,41,32,62,61,32,57,55,32,38,38,32,99,112,40,99,41,32,60,32,49,50,51,32,116,104,101,110,10,32,32,32,32,32,32,115,116,100,46,99,104,97,114,40,99,112,40,99,41,32,45,32,51,50,41,10,32,32,32,32,101,108,115,101,10,32,32,32,32,32,32,99,59,10,32,32,32,32,115,116,100,46,106,111,105,110,40,39,39,44,32,115,116,100,46,109,97,112,40,117,112,95,108,101,116,116,101,114,44,32,115,116,100,46,115,116,114,105,110,103,67,104,97,114,115,40,115,116,114,41,41,41,44,10,10,32,32,97,115,99,105,105,76,111,119,101,114,40,115,116,114,41,58,58,10,32,32,32,32,108,111,99,97,108,32,99,112,32,61,32,115,116,100,46,99,111,100,101,112,111,105,110,116,59,10,32,32,32,32,108,111,99,97,108,32,100,111,119,110,95,108,101,116,116,101,114,40,99,41,32,61,32,105,102,32,99,112,40,99,41,32,62,61,32,54,53,32,38,38,32,99,112,40,99,41,32,60,32,57,49,32,116,104,101,110,10,32,32,32,32,32,32,115,116,100,46,99,104,97,114,40,99,112,40,99,41,32,43,32,51,50,41,10,32,32,32,32,101,108,115,101,10,32,32,32,32,32,32,99,59,10,32,32,32,32,115,116,100,46,106,111,105,110,40,39,39,44,32,115,116,100,46,109,97,112,40,100,111,119,110,95,108,101,116,116,101,114,44,32,115,116,100,46,115,116,114,105,110,103,67,104,97,114,115,40,115,116,114,41,41,41,44,10,10,32,32,114,97,110,103,101,40,102,114,111,109,44,32,116,111,41,58,58,10,32,32,32,32,115,116,100,46,109,97,107,101,65,114,114,97,121,40,116,111,32,45,32,102,114,111,109,32,43,32,49,44,32,102,117,110,99,116,105,111,110,40,105,41,32,105,32,43,32,102,114,111,109,41,44,10,10,32,32,114,101,112,101,97,116,40,119,104,97,116,44,32,99,111,117,110,116,41,58,58,10,32,32,32,32,108,111,99,97,108,32,106,111,105,110,101,114,32,61,10,32,32,32,32,32,32,105,102,32,115,116,100,46,105,115,83,116,114,105,110,103,40,119,104,97,116,41,32,116,104,101,110,32,39,39,10,32,32,32,32,32,32,101,108,115,101,32,105,102,32,115,116,100,46,105,115,65,114,114,97,121,40,119,104,97,116,41,32,116,104,101,110,32,91,93,10,32,32,32,32,32,32,101,108,115,101,32,101,114,114,111,114,32,39,115,116,100,46,114,101,112,101,97,116,32,102,105,114,115,116,32,97,114,103,117,109,101,110,116,32,109,117,115,116,32,98,101,32,97,110,32,97,114,114,97,121,32,111,114,32,97,32,115,116,114,105,110,103,39,59,10,32,32,32,32,115,116,100,46,106,111,105,110,40,106,111,105,110,101,114,44,32,115,116,100,46,109,97,107,101,65,114,114,97,121,40,99,111,117,110,116,44,32,102,117,110,99,116,105,111,110,40,105,41,32,119,104,97,116,41,41,44,10,10,32,32,115,108,105,99,101,40,105,110,100,101,120,97,98,108,101,44,32,105,110,100,101,120,44,32,101,110,100,44,32,115,116,101,112,41,58,58,10,32,32,32,32,108,111,99,97,108,32,105,110,118,97,114,32,61,10,32,32,32,32,32,32,47,47,32,108,111,111,112,32,105,110,118,97,114,105,97,110,116,32,119,105,116,104,32,100,101,102,97,117,108,116,115,32,97,112,112,108,105,101,100,10,32,32,32,32,32,32,123,10,32,32,32,32,32,32,32,32,105,110,100,101,120,97,98,108,101,58,32,105,110,100,101,120,97,98,108,101,44,10,32,32,32,32,32,32,32,32,105,110,100,101,120,58,10,32,32,32,32,32,32,32,32,32,32,105,102,32,105,110,100,101,120,32,61,61,32,110,117,108,108,32,116,104,101,110,32,48,10,32,32,32,32,32,32,32,32,32,32,101,108,115,101,32,105,110,100,101,120,44,10,32,32,32,32,32,32,32,32,101,110,100,58,10,32,32,32,32,32,32,32,32,32,32,105,102,32,101,110,100,32,61,61,32,110,117,108,108,32,116,104,101,110,32,115,116,100,46,108,101,110,103,116,104,40,105,110,100,101,120,97,98,108,101,41,10,32,32,32,32,32,32,32,32,32,32,101,108,115,101,32,101,110,100,44,10,32,32,32,32,32,32,32,32,115,116,101,112,58,10,32,32,32,32,32,32,32,32,32,32,105,102,32,115,116,101,112,32,61,61,32,110,117,108,108,32,116,104,101,110,32,49,10,32,32,32,32,32,32,32,32,32,32,101,108,115,101,32,115,116,101,112,44,10,32,32,32,32,32,32,32,32,108,101,110,103,116,104,58,32,115,116,100,46,108,101,110,103,116,104,40,105,110,100,101,120,97,98,108,101,41,44,10,32,32,32,32,32,32,32,32,116,121,112,101,58,32,115,116,100,46,116,121,112,101,40,105,110,100,101,120,97,98,108,101,41,44,10,32,32,32,32,32,32,125,59,10,32,32,32,32,97,115,115,101,114,116,32,105,110,118,97,114,46,105,110,100,101,120,32,62,61,32,48,32,38,38,32,105,110,118,97,114,46,101,110,100,32,62,61,32,48,32,38,38,32,105,110,118,97,114,46,115,116,101,112,32,62,61,32,48,32,58,32,39,103,111,116,32,91,37,115,58,37,115,58,37,115,93,32,98,117,116,32,110,101,103,97,116,105,118,101,32,105,110,100,101,120,44,32,101,110,100,44,32,97,110,100,32,115,116,101,112,115,32,97,114,101,32,110,111,116,32,115,117,112,112,111,114,116,101,100,39,32,37,32,91,105,110,118,97,114,46,105,110,100,101,120,44,32,105,110,118,97,114,46,101,110,100,44,32,105,110,118,97,114,46,115,116,101,112,93,59,10,32,32,32,32,97,115,115,101,114,116,32,115,116,101,112,32,33,61,32,48,32,58,32,39,103,111,116,32,37,115,32,98,117,116,32,115,116,101,112,32,109,117,115,116,32,98,101,32,103,114,101,97,116,101,114,32,116,104,97,110,32,48,39,32,37,32,115,116,101,112,59,10,32,32,32,32,97,115,115,101,114,116,32,115,116,100,46,105,115,83,116,114,105,110,103,40,105,110,100,101,120,97,98,108,101,41,32,124,124,32,115,116,100,46,105,115,65,114,114,97,121,40,105,110,100,101,120,97,98,108,101,41,32,58,32,39,115,116,100,46,115,108,105,99,101,32,97,99,99,101,112,116,115,32,97,32,115,116,114,105,110,103,32,111,114,32,97,110,32,97,114,114,97,121,44,32,98,117,116,32,103,111,116,58,32,37,115,39,32,37,32,115,116,100,46,116,121,112,101,40,105,110,100,101,120,97,98,108,101,41,59,10,32,32,32,32,108,111,99,97,108,32,98,117,105,108,100,40,115,108,105,99,101,44,32,99,117,114,41,32,61,10,32,32,32,32,32,32,105,102,32,99,117,114,32,62,61,32,105,110,118,97,114,46,101,110,100,32,124,124,32,99,117,114,32,62,61,32,105,110,118,97,114,46,108,101,110,103,116,104,32,116,104,101,110,10,32,32,32,32,32,32,32,32,115,108,105,99,101,10,32,32,32,32,32,32,101,108,115,101,10,32,32,32,32,32,32,32,32,98,117,105,108,100,40,10,32,32,32,32,32,32,32,32,32,32,105,102,32,105,110,118,97,114,46,116,121,112,101,32,61,61,32,39,115,116,114,105,110,103,39,32,116,104,101,110,10,32,32,32,32,32,32,32,32,32,32,32,32,115,108,105,99,101,32,43,32,105,110,118,97,114,46,105,110,100,101,120,97,98,108,101,91,99,117,114,93,10,32,32,32,32,32,32,32,32,32,32,101,108,115,101,10,32,32,32,32,32,32,32,32,32,32,32,32,115,108,105,99,101,32,43,32,91,105,110,118,97,114,46,105,110,100,101,120,97,98,108,101,91,99,117,114,93,93,44,10,32,32,32,32,32,32,32,32,32,32,99,117,114,32,43,32,105,110,118,97,114,46,115,116,101,112,10,32,32,32,32,32,32,32,32,41,32,116,97,105,108,115,116,114,105,99,116,59,10,32,32,32,32,98,117,105,108,100,40,105,102,32,105,110,118,97,114,46,116,121,112,101,32,61,61,32,39,115,116,114,105,110,103,39,32,116,104,101,110,32,39,39,32,101,108,115,101,32,91,93,44,32,105,110,118,97,114,46,105,110,100,101,120,41,44,10,10,32,32,109,101,109,98,101,114,40,97,114,114,44,32,120,41,58,58,10,32,32,32,32,105,102,32,115,116,100,46,105,115,65,114,114,97,121,40,97,114,114,41,32,116,104,101,110,10,32,32,32,32,32,32,115,116,100,46,99,111,117,110,116,40,97,114,114,44,32,120,41,32,62,32,48,10,32,32,32,32,101,108,115,101,32,105,102,32,115,116,100,46,105,115,83,116,114,105,110,103,40,97,114,114,41,32,116,104,101,110,10,32,32,32,32,32,32,115,116,100,46,108,101,110,103,116,104,40,115,116,100,46,102,105,110,100,83,117,98,115,116,114,40,120,44,32,97,114,114,41,41,32,62,32,48,10,32,32,32,32,101,108,115,101,32,101,114,114,111,114,32,39,115,116,100,46,109,101,109,98,101,114,32,102,105,114,115,116,32,97,114,103,117,109,101,110,116,32,109,117,115,116,32,98,101,32,97,110,32,97,114,114,97,121,32,111,114,32,97,32,115,116,114,105,110,103,39,44,10,10,32,32,99,111,117,110,116,40,97,114,114,44,32,120,41,58,58,32,115,116,100,46,108,101,110,103,116,104,40,115,116,100,46,102,105,108,116,101,114,40,102,117,110,99,116,105,111,110,40,118,41,32,118,32,61,61,32,120,44,32,97,114,114,41,41,44,10,10,32,32,109,111,100,40,97,44,32,98,41,58,58,10,32,32,32,32,105,102,32,115,116,100,46,105,115,78,117,109,98,101,114,40,97,41,32,38,38,32,115,116,100,46,105,115,78,117,109,98,101,114,40,98,41,32,116,104,101,110,10,32,32,32,32,32,32,115,116,100,46,109,111,100,117,108,111,40,97,44,32,98,41,10,32,32,32,32,101,108,115,101,32,105,102,32,115,116,100,46,105,115,83,116,114,105,110,103,40,97,41,32,116,104,101,110,10,32,32,32,32,32,32,115,116,100,46,102,111,114,109,97,116,40,97,44,32,98,41,10,32,32,32,32,101,108,115,101,10,32,32,32,32,32,32,101,114,114,111,114,32,39,79,112,101,114,97,116,111,114,32,37,32,99,97,110,110,111,116,32,98,101,32,117,115,101,100,32,111,110,32,116,121,112,101,115,32,39,32,43,32,115,116,100,46,116,121,112,101,40,97,41,32,43,32,39,32,97,110,100,32,39,32,43,32,115,116,100,46,116,121,112,101,40,98,41,32,43,32,39,46,39,44,10,10,32,32,109,97,112,40,102,117,110,99,44,32,97,114,114,41,58,58,10,32,32,32,32,105,102,32,33,115,116,100,46,105,115,70,117,110,99,116,105,111,110,40,102,117,110,99,41,32,116,104,101,110,10,32,32,32,32,32,32,101,114,114,111,114,32,40,39,115,116,100,46,109,97,112,32,102,105,114,115,116,32,112,97,114,97,109,32,109,117,115,116,32,98,101,32,102,117,110,99,116,105,111,110,44,32,103,111,116,32,39,32,43,32,115,116,100,46,116,121,112,101,40,102,117,110,99,41,41,10,32,32,32,32,101,108,115,101,32,105,102,32,33,115,116,100,46,105,115,65,114,114,97,121,40,97,114,114,41,32,38,38,32,33,115,116,100,46,105,115,83,116,114,105,110,103,40,97,114,114,41,32,116,104,101,110,10,32,32,32,32,32,32,101,114,114,111,114,32,40,39,115,116,100,46,109,97,112,32,115,101,99,111,110,100,32,112,97,114,97,109,32,109,117,115,116,32,98,101,32,97,114,114,97,121,32,47,32,115,116,114,105,110,103,44,32,103,111,116,32,39,32,43,32,115,116,100,46,116,121,112,101,40,97,114,114,41,41,10,32,32,32,32,101,108,115,101,10,32,32,32,32,32,32,108,111,99,97,108,32,109,97,112,112,101,100,32,61,32,115,116,100,46,109,97,112,73,109,112,108,40,102,117,110,99,44,32,97,114,114,41,59,10,32,32,32,32,32,32,105,102,32,109,97,112,112,101,100,32,33,61,32,110,117,108,108,32,116,104,101,110,32,109,97,112,112,101,100,10,32,32,32,32,32,32,101,108,115,101,32,115,116,100,46,109,97,107,101,65,114,114,97,121,40,115,116,100,46,108,101,110,103,116,104,40,97,114,114,41,44,32,102,117,110,99,116,105,111,110,40,105,41,32,102,117,110,99,40,97,114,114,91,105,93,41,41,44,10,10,32,32,109,97,112,87,105,116,104,73,110,100,101,120,40,102,117,110,99,44,32,97,114,114,41,58,58,10,32,32,32,32,105,102,32,33,115,116,100,46,105,115,70,117,110,99,116,105,111,110,40,102,117,110,99,41,32,116,104,101,110,10,32,32,32,32,32,32,101,114,114,111,114,32,40,39,115,116,100,46,109,97,112,87,105,116,104,73,110,100,101,120,32,102,105,114,115,116,32,112,97,114,97,109,32,109,117,115,116,32,98,101,32,102,117,110,99,116,105,111,110,44,32,103,111,116,32,39,32,43,32,115,116,100,46,116,121,112,101,40,102,117,110,99,41,41,10,32,32,32,32,101,108,115,101,32,105,102,32,33,115,116,100,46,105,115,65,114,114,97,121,40,97,114,114,41,32,38,38,32,33,115,116,100,46,105,115,83,116,114,105,110,103,40,97,114,114,41,32,116,104,101,110,10,32,32,32,32,32,32,101,114,114,111,114,32,40,39,115,116,100,46,109,97,112,87,105,116,104,73,110,100,101,120,32,115,101,99,111,110,100,32,112,97,114,97,109,32,109,117,115,116,32,98,101,32,97,114,114,97,121,44,32,103,111,116,32,39,32,43,32,115,116,100,46,116,121,112,101,40,97,114,114,41,41,10,32,32,32,32,101,108,115,101,10,32,32,32,32,32,32,115,116,100,46,109,97,107,101,65,114,114,97,121,40,115,116,100,46,108,101,110,103,116,104,40,97,114,114,41,44,32,102,117,110,99,116,105,111,110,40,105,41,32,102,117,110,99,40,105,44,32,97,114,114,91,105,93,41,41,44,10,10,32,32,109,97,112,87,105,116,104,75,101,121,40,102,117,110,99,44,32,111,98,106,41,58,58,10,32,32,32,32,105,102,32,33,115,116,100,46,105,115,70,117,110,99,116,105,111,110,40,102,117,110,99,41,32,116,104,101,110,10,32,32,32,32,32,32,101,114,114,111,114,32,40,39,115,116,100,46,109,97,112,87,105,116,104,75,101,121,32,102,105,114,115,116,32,112,97,114,97,109,32,109,117,115,116,32,98,101,32,102,117,110,99,116,105,111,110,44,32,103,111,116,32,39,32,43,32,115,116,100,46,116,121,112,101,40,102,117,110,99,41,41,10,32,32,32,32,101,108,115,101,32,105,102,32,33,115,116,100,46,105,115,79,98,106,101,99,116,40,111,98,106,41,32,116,104,101,110,10,32,32,32,32,32,32,101,114,114,111,114,32,40,39,115,116,100,46,109,97,112,87,105,116,104,75,101,121,32,115,101,99,111,110,100,32,112,97,114,97,109,32,109,117,115,116,32,98,101,32,111,98,106,101,99,116,44,32,103,111,116,32,39,32,43,32,115,116,100,46,116,121,112,101,40,111,98,106,41,41,10,32,32,32,32,101,108,115,101,10,32,32,32,32,32,32,123,32,91,107,93,58,32,102,117,110,99,40,107,44,32,111,98,106,91,107,93,41,32,102,111,114,32,107,32,105,110,32,115,116,100,46,111,98,106,101,99,116,70,105,101,108,100,115,40,111,98,106,41,32,125,44,10,10,32,32,102,108,97,116,77,97,112,40,102,117,110,99,44,32,97,114,114,41,58,58,10,32,32,32,32,105,102,32,33,115,116,100,46,105,115,70,117,110,99,116,105,111,110,40,102,117,110,99,41,32,116,104,101,110,10,32,32,32,32,32,32,101,114,114,111,114,32,40,39,115,116,100,46,102,108,97,116,77,97,112,32,102,105,114,115,116,32,112,97,114,97,109,32,109,117,115,116,32,98,101,32,102,117,110,99,116,105,111,110,44,32,103,111,116,32,39,32,43,32,115,116,100,46,116,121,112,101,40,102,117,110,99,41,41,10,32,32,32,32,101,108,115,101,32,105,102,32,115,116,100,46,105,115,65,114,114,97,121,40,97,114,114,41,32,116,104,101,110,10,32,32,32,32,32,32,115,116,100,46,102,108,97,116,116,101,110,65,114,114,97,121,115,40,115,116,100,46,109,97,107,101,65,114,114,97,121,40,115,116,100,46,108,101,110,103,116,104,40,97,114,114,41,44,32,102,117,110,99,116,105,111,110,40,105,41,32,102,117,110,99,40,97,114,114,91,105,93,41,41,41,10,32,32,32,32,101,108,115,101,32,105,102,32,115,116,100,46,105,115,83,116,114,105,110,103,40,97,114,114,41,32,116,104,101,110,10,32,32,32,32,32,32,115,116,100,46,106,111,105,110,40,39,39,44,32,115,116,100,46,109,97,107,101,65,114,114,97,121,40,115,116,100,46,108,101,110,103,116,104,40,97,114,114,41,44,32,102,117,110,99,116,105,111,110,40,105,41,32,102,117,110,99,40,97,114,114,91,105,93,41,41,41,10,32,32,32,32,101,108,115,101,32,101,114,114,111,114,32,40,39,115,116,100,46,102,108,97,116,77,97,112,32,115,101,99,111,110,100,32,112,97,114,97,109,32,109,117,115,116,32,98,101,32,97,114,114,97,121,32,47,32,115,116,114,105,110,103,44,32,103,111,116,32,39,32,43,32,115,116,100,46,116,121,112,101,40,97,114,114,41,41,44,10,10,32,32,106,111,105,110,40,115,101,112,44,32,97,114,114,41,58,58,10,32,32,32,32,108,111,99,97,108,32,97,117,120,40,97,114,114,44,32,105,44,32,102,105,114,115,116,44,32,114,117,110,110,105,110,103,41,32,61,10,32,32,32,32,32,32,105,102,32,105,32,62,61,32,115,116,100,46,108,101,110,103,116,104,40,97,114,114,41,32,116,104,101,110,10,32,32,32,32,32,32,32,32,114,117,110,110,105,110,103,10,32,32,32,32,32,32,101,108,115,101,32,105,102,32,97,114,114,91,105,93,32,61,61,32,110,117,108,108,32,116,104,101,110,10,32,32,32,32,32,32,32,32,97,117,120,40,97,114,114,44,32,105,32,43,32,49,44,32,102,105,114,115,116,44,32,114,117,110,110,105,110,103,41,32,116,97,105,108,115,116,114,105,99,116,10,32,32,32,32,32,32,101,108,115,101,32,105,102,32,115,116,100,46,116,121,112,101,40,97,114,114,91,105,93,41,32,33,61,32,115,116,100,46,116,121,112,101,40,115,101,112,41,32,116,104,101,110,10,32,32,32,32,32,32,32,32,101,114,114,111,114,32,39,101,120,112,101,99,116,101,100,32,37,115,32,98,117,116,32,97,114,114,91,37,100,93,32,119,97,115,32,37,115,32,39,32,37,32,91,115,116,100,46,116,121,112,101,40,115,101,112,41,44,32,105,44,32,115,116,100,46,116,121,112,101,40,97,114,114,91,105,93,41,93,10,32,32,32,32,32,32,101,108,115,101,32,105,102,32,102,105,114,115,116,32,116,104,101,110,10,32,32,32,32,32,32,32,32,97,117,120,40,97,114,114,44,32,105,32,43,32,49,44,32,102,97,108,115,101,44,32,114,117,110,110,105,110,103,32,43,32,97,114,114,91,105,93,41,32,116,97,105,108,115,116,114,105,99,116,10,32,32,32,32,32,32,101,108,115,101,10,32,32,32,32,32,32,32,32,97,117,120,40,97,114,114,44,32,105,32,43,32,49,44,32,102,97,108,115,101,44,32,114,117,110,110,105,110,103,32,43,32,115,101,112,32,43,32,97,114,114,91,105,93,41,32,116,97,105,108,115,116,114,105,99,116,59,10,32,32,32,32,105,102,32,33,115,116,100,46,105,115,65,114,114,97,121,40,97,114,114,41,32,116,104,101,110,10,32,32,32,32,32,32,101,114,114,111,114,32,39,106,111,105,110,32,115,101,99,111,110,100,32,112,97,114,97,109,101,116,101,114,32,115,104,111,117,108,100,32,98,101,32,97,114,114,97,121,44,32,103,111,116,32,39,32,43,32,115,116,100,46,116,121,112,101,40,97,114,114,41,10,32,32,32,32,101,108,115,101,32,105,102,32,115,116,100,46,105,115,83,116,114,105,110,103,40,115,101,112,41,32,116,104,101,110,10,32,32,32,32,32,32,97,117,120,40,97,114,114,44,32,48,44,32,116,114,117,101,44,32,39,39,41,10,32,32,32,32,101,108,115,101,32,105,102,32,115,116,100,46,105,115,65,114,114,97,121,40,115,101,112,41,32,116,104,101,110,10,32,32,32,32,32,32,97,117,120,40,97,114,114,44,32,48,44,32,116,114,117,101,44,32,91,93,41,10,32,32,32,32,101,108,115,101,10,32,32,32,32,32,32,101,114,114,111,114,32,39,106,111,105,110,32,102,105,114,115,116,32,112,97,114,97,109,101,116,101,114,32,115,104,111,117,108,100,32,98,101,32,115,116,114,105,110,103,32,111,114,32,97,114,114,97,121,44,32,103,111,116,32,39,32,43,32,115,116,100,46,116,121,112,101,40,115,101,112,41,44,10,10,32,32,108,105,110,101,115,40,97,114,114,41,58,58,10,32,32,32,32,115,116,100,46,106,111,105,110,40,39,92,110,39,44,32,97,114,114,32,43,32,91,39,39,93,41,44,10,10,32,32,100,101,101,112,74,111,105,110,40,97,114,114,41,58,58,10,32,32,32,32,105,102,32,115,116,100,46,105,115,83,116,114,105,110,103,40,97,114,114,41,32,116,104,101,110,10,32,32,32,32,32,32,97,114,114,10,32,32,32,32,101,108,115,101,32,105,102,32,115,116,100,46,105,115,65,114,114,97,121,40,97,114,114,41,32,116,104,101,110,10,32,32,32,32,32,32,115,116,100,46,106,111,105,110,40,39,39,44,32,91,115,116,100,46,100,101,101,112,74,111,105,110,40,120,41,32,102,111,114,32,120,32,105,110,32,97,114,114,93,41,10,32,32,32,32,101,108,115,101,10,32,32,32,32,32,32,101,114,114,111,114,32,39,69,120,112,101,99,116,101,100,32,115,116,114,105,110,103,32,111,114,32,97,114,114,97,121,44,32,103,111,116,32,37,115,39,32,37,32,115,116,100,46,116,121,112,101,40,97,114,114,41,44,10,10,10,32,32,102,111,114,109,97,116,40,115,116,114,44,32,118,97,108,115,41,58,58,10,10,32,32,32,32,47,47,47,47,47,47,47,47,47,47,47,47,47,47,47,47,47,47,47,47,47,47,47,47,47,47,47,47,47,10,32,32,32,32,47,47,32,80,97,114,115,101,32,116,104,101,32,109,105,110,105,45,108,97,110,103,117,97,103,101,32,47,47,10,32,32,32,32,47,47,47,47,47,47,47,47,47,47,47,47,47,47,47,47,47,47,47,47,47,47,47,47,47,47,47,47,47,10,10,32,32,32,32,108,111,99,97,108,32,116,114,121,95,112,97,114,115,101,95,109,97,112,112,105,110,103,95,107,101,121,40,115,116,114,44,32,105,41,32,61,10,32,32,32,32,32,32,97,115,115,101,114,116,32,105,32,60,32,115,116,100,46,108,101,110,103,116,104,40,115,116,114,41,32,58,32,39,84,114,117,110,99,97,116,101,100,32,102,111,114,109,97,116,32,99,111,100,101,46,39,59,10,32,32,32,32,32,32,108,111,99,97,108,32,99,32,61,32,115,116,114,91,105,93,59,10,32,32,32,32,32,32,105,102,32,99,32,61,61,32,39,40,39,32,116,104,101,110,10,32,32,32,32,32,32,32,32,108,111,99,97,108,32,99,111,110,115,117,109,101,40,115,116,114,44,32,106,44,32,118,41,32,61,10,32,32,32,32,32,32,32,32,32,32,105,102,32,106,32,62,61,32,115,116,100,46,108,101,110,103,116,104,40,115,116,114,41,32,116,104,101,110,10,32,32,32,32,32,32,32,32,32,32,32,32,101,114,114,111,114,32,39,84,114,117,110,99,97,116,101,100,32,102,111,114,109,97,116,32,99,111,100,101,46,39,10,32,32,32,32,32,32,32,32,32,32,101,108,115,101,10,32,32,32,32,32,32,32,32,32,32,32,32,108,111,99,97,108,32,99,32,61,32,115,116,114,91,106,93,59,10,32,32,32,32,32,32,32,32,32,32,32,32,105,102,32,99,32,33,61,32,39,41,39,32,116,104,101,110,10,32,32,32,32,32,32,32,32,32,32,32,32,32,32,99,111,110,115,117,109,101,40,115,116,114,44,32,106,32,43,32,49,44,32,118,32,43,32,99,41,10,32,32,32,32,32,32,32,32,32,32,32,32,101,108,115,101,10,32,32,32,32,32,32,32,32,32,32,32,32,32,32,123,32,105,58,32,106,32,43,32,49,44,32,118,58,32,118,32,125,59,10,32,32,32,32,32,32,32,32,99,111,110,115,117,109,101,40,115,116,114,44,32,105,32,43,32,49,44,32,39,39,41,10,32,32,32,32,32,32,101,108,115,101,10,32,32,32,32,32,32,32,32,123,32,105,58,32,105,44,32,118,58,32,110,117,108,108,32,125,59,10,10,32,32,32,32,108,111,99,97,108,32,116,114,121,95,112,97,114,115,101,95,99,102,108,97,103,115,40,115,116,114,44,32,105,41,32,61,10,32,32,32,32,32,32,108,111,99,97,108,32,99,111,110,115,117,109,101,40,115,116,114,44,32,106,44,32,118,41,32,61,10,32,32,32,32,32,32,32,32,97,115,115,101,114,116,32,106,32,60,32,115,116,100,46,108,101,110,103,116,104,40,115,116,114,41,32,58,32,39,84,114,117,110,99,97,116,101,100,32,102,111,114,109,97,116,32,99,111,100,101,46,39,59,10,32,32,32,32,32,32,32,32,108,111,99,97,108,32,99,32,61,32,115,116,114,91,106,93,59,10,32,32,32,32,32,32,32,32,105,102,32,99,32,61,61,32,39,35,39,32,116,104,101,110,10,32,32,32,32,32,32,32,32,32,32,99,111,110,115,117,109,101,40,115,116,114,44,32,106,32,43,32,49,44,32,118,32,123,32,97,108,116,58,32,116,114,117,101,32,125,41,10,32,32,32,32,32,32,32,32,101,108,115,101,32,105,102,32,99,32,61,61,32,39,48,39,32,116,104,101,110,10,32,32,32,32,32,32,32,32,32,32,99,111,110,115,117,109,101,40,115,116,114,44,32,106,32,43,32,49,44,32,118,32,123,32,122,101,114,111,58,32,116,114,117,101,32,125,41,10,32,32,32,32,32,32,32,32,101,108,115,101,32,105,102,32,99,32,61,61,32,39,45,39,32,116,104,101,110,10,32,32,32,32,32,32,32,32,32,32,99,111,110,115,117,109,101,40,115,116,114,44,32,106,32,43,32,49,44,32,118,32,123,32,108,101,102,116,58,32,116,114,117,101,32,125,41,10,32,32,32,32,32,32,32,32,101,108,115,101,32,105,102,32,99,32,61,61,32,39,32,39,32,116,104,101,110,10,32,32,32,32,32,32,32,32,32,32,99,111,110,115,117,109,101,40,115,116,114,44,32,106,32,43,32,49,44,32,118,32,123,32,98,108,97,110,107,58,32,116,114,117,101,32,125,41,10,32,32,32,32,32,32,32,32,101,108,115,101,32,105,102,32,99,32,61,61,32,39,43,39,32,116,104,101,110,10,32,32,32,32,32,32,32,32,32,32,99,111,110,115,117,109,101,40,115,116,114,44,32,106,32,43,32,49,44,32,118,32,123,32,112,108,117,115,58,32,116,114,117,101,32,125,41,10,32,32,32,32,32,32,32,32,101,108,115,101,10,32,32,32,32,32,32,32,32,32,32,123,32,105,58,32,106,44,32,118,58,32,118,32,125,59,10,32,32,32,32,32,32,99,111,110,115,117,109,101,40,115,116,114,44,32,105,44,32,123,32,97,108,116,58,32,102,97,108,115,101,44,32,122,101,114,111,58,32,102,97,108,115,101,44,32,108,101,102,116,58,32,102,97,108,115,101,44,32,98,108,97,110,107,58,32,102,97,108,115,101,44,32,112,108,117,115,58,32,102,97,108,115,101,32,125,41,59,10,10,32,32,32,32,108,111,99,97,108,32,116,114,121,95,112,97,114,115,101,95,102,105,101,108,100,95,119,105,100,116,104,40,115,116,114,44,32,105,41,32,61,10,32,32,32,32,32,32,105,102,32,105,32,60,32,115,116,100,46,108,101,110,103,116,104,40,115,116,114,41,32,38,38,32,115,116,114,91,105,93,32,61,61,32,39,42,39,32,116,104,101,110,10,32,32,32,32,32,32,32,32,123,32,105,58,32,105,32,43,32,49,44,32,118,58,32,39,42,39,32,125,10,32,32,32,32,32,32,101,108,115,101,10,32,32,32,32,32,32,32,32,108,111,99,97,108,32,99,111,110,115,117,109,101,40,115,116,114,44,32,106,44,32,118,41,32,61,10,32,32,32,32,32,32,32,32,32,32,97,115,115,101,114,116,32,106,32,60,32,115,116,100,46,108,101,110,103,116,104,40,115,116,114,41,32,58,32,39,84,114,117,110,99,97,116,101,100,32,102,111,114,109,97,116,32,99,111,100,101,46,39,59,10,32,32,32,32,32,32,32,32,32,32,108,111,99,97,108,32,99,32,61,32,115,116,114,91,106,93,59,10,32,32,32,32,32,32,32,32,32,32,105,102,32,99,32,61,61,32,39,48,39,32,116,104,101,110,10,32,32,32,32,32,32,32,32,32,32,32,32,99,111,110,115,117,109,101,40,115,116,114,44,32,106,32,43,32,49,44,32,118,32,42,32,49,48,32,43,32,48,41,10,32,32,32,32,32,32,32,32,32,32,101,108,115,101,32,105,102,32,99,32,61,61,32,39,49,39,32,116,104,101,110,10,32,32,32,32,32,32,32,32,32,32,32,32,99,111,110,115,117,109,101,40,115,116,114,44,32,106,32,43,32,49,44,32,118,32,42,32,49,48,32,43,32,49,41,10,32,32,32,32,32,32,32,32,32,32,101,108,115,101,32,105,102,32,99,32,61,61,32,39,50,39,32,116,104,101,110,10,32,32,32,32,32,32,32,32,32,32,32,32,99,111,110,115,117,109,101,40,115,116,114,44,32,106,32,43,32,49,44,32,118,32,42,32,49,48,32,43,32,50,41,10,32,32,32,32,32,32,32,32,32,32,101,108,115,101,32,105,102,32,99,32,61,61,32,39,51,39,32,116,104,101,110,10,32,32,32,32,32,32,32,32,32,32,32,32,99,111,110,115,117,109,101,40,115,116,114,44,32,106,32,43,32,49,44,32,118,32,42,32,49,48,32,43,32,51,41,10,32,32,32,32,32,32,32,32,32,32,101,108,115,101,32,105,102,32,99,32,61,61,32,39,52,39,32,116,104,101,110,10,32,32,32,32,32,32,32,32,32,32,32,32,99,111,110,115,117,109,101,40,115,116,114,44,32,106,32,43,32,49,44,32,118,32,42,32,49,48,32,43,32,52,41,10,32,32,32,32,32,32,32,32,32,32,101,108,115,101,32,105,102,32,99,32,61,61,32,39,53,39,32,116,104,101,110,10,32,32,32,32,32,32,32,32,32,32,32,32,99,111,110,115,117,109,101,40,115,116,114,44,32,106,32,43,32,49,44,32,118,32,42,32,49,48,32,43,32,53,41,10,32,32,32,32,32,32,32,32,32,32,101,108,115,101,32,105,102,32,99,32,61,61,32,39,54,39,32,116,104,101,110,10,32,32,32,32,32,32,32,32,32,32,32,32,99,111,110,115,117,109,101,40,115,116,114,44,32,106,32,43,32,49,44,32,118,32,42,32,49,48,32,43,32,54,41,10,32,32,32,32,32,32,32,32,32,32,101,108,115,101,32,105,102,32,99,32,61,61,32,39,55,39,32,116,104,101,110,10,32,32,32,32,32,32,32,32,32,32,32,32,99,111,110,115,117,109,101,40,115,116,114,44,32,106,32,43,32,49,44,32,118,32,42,32,49,48,32,43,32,55,41,10,32,32,32,32,32,32,32,32,32,32,101,108,115,101,32,105,102,32,99,32,61,61,32,39,56,39,32,116,104,101,110,10,32,32,32,32,32,32,32,32,32,32,32,32,99,111,110,115,117,109,101,40,115,116,114,44,32,106,32,43,32,49,44,32,118,32,42,32,49,48,32,43,32,56,41,10,32,32,32,32,32,32,32,32,32,32,101,108,115,101,32,105,102,32,99,32,61,61,32,39,57,39,32,116,104,101,110,10,32,32,32,32,32,32,32,32,32,32,32,32,99,111,110,115,117,109,101,40,115,116,114,44,32,106,32,43,32,49,44,32,118,32,42,32,49,48,32,43,32,57,41,10,32,32,32,32,32,32,32,32,32,32,101,108,115,101,10,32,32,32,32,32,32,32,32,32,32,32,32,123,32,105,58,32,106,44,32,118,58,32,118,32,125,59,10,32,32,32,32,32,32,32,32,99,111,110,115,117,109,101,40,115,116,114,44,32,105,44,32,48,41,59,10,10,32,32,32,32,108,111,99,97,108,32,116,114,121,95,112,97,114,115,101,95,112,114,101,99,105,115,105,111,110,40,115,116,114,44,32,105,41,32,61,10,32,32,32,32,32,32,97,115,115,101,114,116,32,105,32,60,32,115,116,100,46,108,101,110,103,116,104,40,115,116,114,41,32,58,32,39,84,114,117,110,99,97,116,101,100,32,102,111,114,109,97,116,32,99,111,100,101,46,39,59,10,32,32,32,32,32,32,108,111,99,97,108,32,99,32,61,32,115,116,114,91,105,93,59,10,32,32,32,32,32,32,105,102,32,99,32,61,61,32,39,46,39,32,116,104,101,110,10,32,32,32,32,32,32,32,32,116,114,121,95,112,97,114,115,101,95,102,105,101,108,100,95,119,105,100,116,104,40,115,116,114,44,32,105,32,43,32,49,41,10,32,32,32,32,32,32,101,108,115,101,10,32,32,32,32,32,32,32,32,123,32,105,58,32,105,44,32,118,58,32,110,117,108,108,32,125,59,10,10,32,32,32,32,47,47,32,73,103,110,111,114,101,100,44,32,105,102,32,105,116,32,101,120,105,115,116,115,46,10,32,32,32,32,108,111,99,97,108,32,116,114,121,95,112,97,114,115,101,95,108,101,110,103,116,104,95,109,111,100,105,102,105,101,114,40,115,116,114,44,32,105,41,32,61,10,32,32,32,32,32,32,97,115,115,101,114,116,32,105,32,60,32,115,116,100,46,108,101,110,103,116,104,40,115,116,114,41,32,58,32,39,84,114,117,110,99,97,116,101,100,32,102,111,114,109,97,116,32,99,111,100,101,46,39,59,10,32,32,32,32,32,32,108,111,99,97,108,32,99,32,61,32,115,116,114,91,105,93,59,10,32,32,32,32,32,32,105,102,32,99,32,61,61,32,39,104,39,32,124,124,32,99,32,61,61,32,39,108,39,32,124,124,32,99,32,61,61,32,39,76,39,32,116,104,101,110,10,32,32,32,32,32,32,32,32,105,32,43,32,49,10,32,32,32,32,32,32,101,108,115,101,10,32,32,32,32,32,32,32,32,105,59,10,10,32,32,32,32,108,111,99,97,108,32,112,97,114,115,101,95,99,111,110,118,95,116,121,112,101,40,115,116,114,44,32,105,41,32,61,10,32,32,32,32,32,32,97,115,115,101,114,116,32,105,32,60,32,115,116,100,46,108,101,110,103,116,104,40,115,116,114,41,32,58,32,39,84,114,117,110,99,97,116,101,100,32,102,111,114,109,97,116,32,99,111,100,101,46,39,59,10,32,32,32,32,32,32,108,111,99,97,108,32,99,32,61,32,115,116,114,91,105,93,59,10,32,32,32,32,32,32,105,102,32,99,32,61,61,32,39,100,39,32,124,124,32,99,32,61,61,32,39,105,39,32,124,124,32,99,32,61,61,32,39,117,39,32,116,104,101,110,10,32,32,32,32,32,32,32,32,123,32,105,58,32,105,32,43,32,49,44,32,118,58,32,39,100,39,44,32,99,97,112,115,58,32,102,97,108,115,101,32,125,10,32,32,32,32,32,32,101,108,115,101,32,105,102,32,99,32,61,61,32,39,111,39,32,116,104,101,110,10,32,32,32,32,32,32,32,32,123,32,105,58,32,105,32,43,32,49,44,32,118,58,32,39,111,39,44,32,99,97,112,115,58,32,102,97,108,115,101,32,125,10,32,32,32,32,32,32,101,108,115,101,32,105,102,32,99,32,61,61,32,39,120,39,32,116,104,101,110,10,32,32,32,32,32,32,32,32,123,32,105,58,32,105,32,43,32,49,44,32,118,58,32,39,120,39,44,32,99,97,112,115,58,32,102,97,108,115,101,32,125,10,32,32,32,32,32,32,101,108,115,101,32,105,102,32,99,32,61,61,32,39,88,39,32,116,104,101,110,10,32,32,32,32,32,32,32,32,123,32,105,58,32,105,32,43,32,49,44,32,118,58,32,39,120,39,44,32,99,97,112,115,58,32,116,114,117,101,32,125,10,32,32,32,32,32,32,101,108,115,101,32,105,102,32,99,32,61,61,32,39,101,39,32,116,104,101,110,10,32,32,32,32,32,32,32,32,123,32,105,58,32,105,32,43,32,49,44,32,118,58,32,39,101,39,44,32,99,97,112,115,58,32,102,97,108,115,101,32,125,10,32,32,32,32,32,32,101,108,115,101,32,105,102,32,99,32,61,61,32,39,69,39,32,116,104,101,110,10,32,32,32,32,32,32,32,32,123,32,105,58,32,105,32,43,32,49,44,32,118,58,32,39,101,39,44,32,99,97,112,115,58,32,116,114,117,101,32,125,10,32,32,32,32,32,32,101,108,115,101,32,105,102,32,99,32,61,61,32,39,102,39,32,116,104,101,110,10,32,32,32,32,32,32,32,32,123,32,105,58,32,105,32,43,32,49,44,32,118,58,32,39,102,39,44,32,99,97,112,115,58,32,102,97,108,115,101,32,125,10,32,32,32,32,32,32,101,108,115,101,32,105,102,32,99,32,61,61,32,39,70,39,32,116,104,101,110,10,32,32,32,32,32,32,32,32,123,32,105,58,32,105,32,43,32,49,44,32,118,58,32,39,102,39,44,32,99,97,112,115,58,32,116,114,117,101,32,125,10,32,32,32,32,32,32,101,108,115,101,32,105,102,32,99,32,61,61,32,39,103,39,32,116,104,101,110,10,32,32,32,32,32,32,32,32,123,32,105,58,32,105,32,43,32,49,44,32,118,58,32,39,103,39,44,32,99,97,112,115,58,32,102,97,108,115,101,32,125,10,32,32,32,32,32,32,101,108,115,101,32,105,102,32,99,32,61,61,32,39,71,39,32,116,104,101,110,10,32,32,32,32,32,32,32,32,123,32,105,58,32,105,32,43,32,49,44,32,118,58,32,39,103,39,44,32,99,97,112,115,58,32,116,114,117,101,32,125,10,32,32,32,32,32,32,101,108,115,101,32,105,102,32,99,32,61,61,32,39,99,39,32,116,104,101,110,10,32,32,32,32,32,32,32,32,123,32,105,58,32,105,32,43,32,49,44,32,118,58,32,39,99,39,44,32,99,97,112,115,58,32,102,97,108,115,101,32,125,10,32,32,32,32,32,32,101,108,115,101,32,105,102,32,99,32,61,61,32,39,115,39,32,116,104,101,110,10,32,32,32,32,32,32,32,32,123,32,105,58,32,105,32,43,32,49,44,32,118,58,32,39,115,39,44,32,99,97,112,115,58,32,102,97,108,115,101,32,125,10,32,32,32,32,32,32,101,108,115,101,32,105,102,32,99,32,61,61,32,39,37,39,32,116,104,101,110,10,32,32,32,32,32,32,32,32,123,32,105,58,32,105,32,43,32,49,44,32,118,58,32,39,37,39,44,32,99,97,112,115,58,32,102,97,108,115,101,32,125,10,32,32,32,32,32,32,101,108,115,101,10,32,32,32,32,32,32,32,32,101,114,114,111,114,32,39,85,110,114,101,99,111,103,110,105,115,101,100,32,99,111,110,118,101,114,115,105,111,110,32,116,121,112,101,58,32,39,32,43,32,99,59,10,10,10,32,32,32,32,47,47,32,80,97,114,115,101,100,32,105,110,105,116,105,97,108,32,37,44,32,110,111,119,32,116,104,101,32,114,101,115,116,46,10,32,32,32,32,108,111,99,97,108,32,112,97,114,115,101,95,99,111,100,101,40,115,116,114,44,32,105,41,32,61,10,32,32,32,32,32,32,97,115,115,101,114,116,32,105,32,60,32,115,116,100,46,108,101,110,103,116,104,40,115,116,114,41,32,58,32,39,84,114,117,110,99,97,116,101,100,32,102,111,114,109,97,116,32,99,111,100,101,46,39,59,10,32,32,32,32,32,32,108,111,99,97,108,32,109,107,101,121,32,61,32,116,114,121,95,112,97,114,115,101,95,109,97,112,112,105,110,103,95,107,101,121,40,115,116,114,44,32,105,41,59,10,32,32,32,32,32,32,108,111,99,97,108,32,99,102,108,97,103,115,32,61,32,116,114,121,95,112,97,114,115,101,95,99,102,108,97,103,115,40,115,116,114,44,32,109,107,101,121,46,105,41,59,10,32,32,32,32,32,32,108,111,99,97,108,32,102,119,32,61,32,116,114,121,95,112,97,114,115,101,95,102,105,101,108,100,95,119,105,100,116,104,40,115,116,114,44,32,99,102,108,97,103,115,46,105,41,59,10,32,32,32,32,32,32,108,111,99,97,108,32,112,114,101,99,32,61,32,116,114,121,95,112,97,114,115,101,95,112,114,101,99,105,115,105,111,110,40,115,116,114,44,32,102,119,46,105,41,59,10,32,32,32,32,32,32,108,111,99,97,108,32,108,101,110,95,109,111,100,32,61,32,116,114,121,95,112,97,114,115,101,95,108,101,110,103,116,104,95,109,111,100,105,102,105,101,114,40,115,116,114,44,32,112,114,101,99,46,105,41,59,10,32,32,32,32,32,32,108,111,99,97,108,32,99,116,121,112,101,32,61,32,112,97,114,115,101,95,99,111,110,118,95,116,121,112,101,40,115,116,114,44,32,108,101,110,95,109,111,100,41,59,10,32,32,32,32,32,32,123,10,32,32,32,32,32,32,32,32,105,58,32,99,116,121,112,101,46,105,44,10,32,32,32,32,32,32,32,32,99,111,100,101,58,32,123,10,32,32,32,32,32,32,32,32,32,32,109,107,101,121,58,32,109,107,101,121,46,118,44,10,32,32,32,32,32,32,32,32,32,32,99,102,108,97,103,115,58,32,99,102,108,97,103,115,46,118,44,10,32,32,32,32,32,32,32,32,32,32,102,119,58,32,102,119,46,118,44,10,32,32,32,32,32,32,32,32,32,32,112,114,101,99,58,32,112,114,101,99,46,118,44,10,32,32,32,32,32,32,32,32,32,32,99,116,121,112,101,58,32,99,116,121,112,101,46,118,44,10,32,32,32,32,32,32,32,32,32,32,99,97,112,115,58,32,99,116,121,112,101,46,99,97,112,115,44,10,32,32,32,32,32,32,32,32,125,44,10,32,32,32,32,32,32,125,59,10,10,32,32,32,32,47,47,32,80,97,114,115,101,32,97,32,102,111,114,109,97,116,32,115,116,114,105,110,103,32,40,99,111,110,116,97,105,110,105,110,103,32,110,111,110,101,32,111,114,32,109,111,114,101,32,37,32,102,111,114,109,97,116,32,116,97,103,115,41,46,10,32,32,32,32,108,111,99,97,108,32,112,97,114,115,101,95,99,111,100,101,115,40,115,116,114,44,32,105,44,32,111,117,116,44,32,99,117,114,41,32,61,10,32,32,32,32,32,32,105,102,32,105,32,62,61,32,115,116,100,46,108,101,110,103,116,104,40,115,116,114,41,32,116,104,101,110,10,32,32,32,32,32,32,32,32,111,117,116,32,43,32,91,99,117,114,93,10,32,32,32,32,32,32,101,108,115,101,10,32,32,32,32,32,32,32,32,108,111,99,97,108,32,99,32,61,32,115,116,114,91,105,93,59,10,32,32,32,32,32,32,32,32,105,102,32,99,32,61,61,32,39,37,39,32,116,104,101,110,10,32,32,32,32,32,32,32,32,32,32,108,111,99,97,108,32,114,32,61,32,112,97,114,115,101,95,99,111,100,101,40,115,116,114,44,32,105,32,43,32,49,41,59,10,32,32,32,32,32,32,32,32,32,32,112,97,114,115,101,95,99,111,100,101,115,40,115,116,114,44,32,114,46,105,44,32,111,117,116,32,43,32,91,99,117,114,44,32,114,46,99,111,100,101,93,44,32,39,39,41,32,116,97,105,108,115,116,114,105,99,116,10,32,32,32,32,32,32,32,32,101,108,115,101,10,32,32,32,32,32,32,32,32,32,32,112,97,114,115,101,95,99,111,100,101,115,40,115,116,114,44,32,105,32,43,32,49,44,32,111,117,116,44,32,99,117,114,32,43,32,99,41,32,116,97,105,108,115,116,114,105,99,116,59,10,10,32,32,32,32,108,111,99,97,108,32,99,111,100,101,115,32,61,32,112,97,114,115,101,95,99,111,100,101,115,40,115,116,114,44,32,48,44,32,91,93,44,32,39,39,41,59,10,10,10,32,32,32,32,47,47,47,47,47,47,47,47,47,47,47,47,47,47,47,47,47,47,47,47,47,47,47,10,32,32,32,32,47,47,32,70,111,114,109,97,116,32,116,104,101,32,118,97,108,117,101,115,32,47,47,10,32,32,32,32,47,47,47,47,47,47,47,47,47,47,47,47,47,47,47,47,47,47,47,47,47,47,47,10,10,32,32,32,32,47,47,32,85,115,101,102,117,108,32,117,116,105,108,105,116,105,101,115,10,32,32,32,32,108,111,99,97,108,32,112,97,100,100,105,110,103,40,119,44,32,115,41,32,61,10,32,32,32,32,32,32,108,111,99,97,108,32,97,117,120,40,119,44,32,118,41,32,61,10,32,32,32,32,32,32,32,32,105,102,32,119,32,60,61,32,48,32,116,104,101,110,10,32,32,32,32,32,32,32,32,32,32,118,10,32,32,32,32,32,32,32,32,101,108,115,101,10,32,32,32,32,32,32,32,32,32,32,97,117,120,40,119,32,45,32,49,44,32,118,32,43,32,115,41,59,10,32,32,32,32,32,32,97,117,120,40,119,44,32,39,39,41,59,10,10,32,32,32,32,47,47,32,65,100,100,32,115,32,116,111,32,116,104,101,32,108,101,102,116,32,111,102,32,115,116,114,32,115,111,32,116,104,97,116,32,105,116,115,32,108,101,110,103,116,104,32,105,115,32,97,116,32,108,101,97,115,116,32,119,46,10,32,32,32,32,108,111,99,97,108,32,112,97,100,95,108,101,102,116,40,115,116,114,44,32,119,44,32,115,41,32,61,10,32,32,32,32,32,32,112,97,100,100,105,110,103,40,119,32,45,32,115,116,100,46,108,101,110,103,116,104,40,115,116,114,41,44,32,115,41,32,43,32,115,116,114,59,10,10,32,32,32,32,47,47,32,65,100,100,32,115,32,116,111,32,116,104,101,32,114,105,103,104,116,32,111,102,32,115,116,114,32,115,111,32,116,104,97,116,32,105,116,115,32,108,101,110,103,116,104,32,105,115,32,97,116,32,108,101,97,115,116,32,119,46,10,32,32,32,32,108,111,99,97,108,32,112,97,100,95,114,105,103,104,116,40,115,116,114,44,32,119,44,32,115,41,32,61,10,32,32,32,32,32,32,115,116,114,32,43,32,112,97,100,100,105,110,103,40,119,32,45,32,115,116,100,46,108,101,110,103,116,104,40,115,116,114,41,44,32,115,41,59,10,10,32,32,32,32,47,47,32,82,101,110,100,101,114,32,97,32,115,105,103,110,32,38,32,109,97,103,110,105,116,117,100,101,32,105,110,116,101,103,101,114,32,40,114,97,100,105,120,32,114,97,110,103,101,115,32,102,114,111,109,32,100,101,99,105,109,97,108,32,116,111,32,98,105,110,97,114,121,41,46,10,32,32,32,32,47,47,32,110,101,103,32,115,104,111,117,108,100,32,98,101,32,97,32,98,111,111,108,101,97,110,44,32,97,110,100,32,119,104,101,110,32,116,114,117,101,32,105,110,100,105,99,97,116,101,115,32,116,104,97,116,32,119,101,32,115,104,111,117,108,100,32,114,101,110,100,101,114,32,97,32,110,101,103,97,116,105,118,101,32,110,117,109,98,101,114,46,10,32,32,32,32,47,47,32,109,97,103,32,109,117,115,116,32,97,108,119,97,121,115,32,98,101,32,97,32,119,104,111,108,101,32,110,117,109,98,101,114,32,62,61,32,48,44,32,105,116,39,115,32,116,104,101,32,109,97,103,110,105,116,117,100,101,32,111,102,32,116,104,101,32,105,110,116,101,103,101,114,32,116,111,32,114,101,110,100,101,114,10,32,32,32,32,47,47,32,109,105,110,95,99,104,97,114,115,32,109,117,115,116,32,98,101,32,97,32,119,104,111,108,101,32,110,117,109,98,101,114,32,62,61,32,48,10,32,32,32,32,47,47,32,32,32,73,116,32,105,115,32,116,104,101,32,102,105,101,108,100,32,119,105,100,116,104,44,32,105,46,101,46,32,115,116,100,46,108,101,110,103,116,104,40,41,32,111,102,32,116,104,101,32,114,101,115,117,108,116,32,115,104,111,117,108,100,32,98,101,32,62,61,32,109,105,110,95,99,104,97,114,115,10,32,32,32,32,47,47,32,109,105,110,95,100,105,103,105,116,115,32,109,117,115,116,32,98,101,32,97,32,119,104,111,108,101,32,110,117,109,98,101,114,32,62,61,32,48,46,32,73,116,39,115,32,116,104,101,32,110,117,109,98,101,114,32,111,102,32,122,101,114,111,101,115,32,116,111,32,112,97,100,32,119,105,116,104,46,10,32,32,32,32,47,47,32,98,108,97,110,107,32,109,117,115,116,32,98,101,32,97,32,98,111,111,108,101,97,110,44,32,105,102,32,116,114,117,101,32,97,100,100,115,32,97,110,32,97,100,100,105,116,105,111,110,97,108,32,39,32,39,32,105,110,32,102,114,111,110,116,32,111,102,32,97,32,112,111,115,105,116,105,118,101,32,110,117,109,98,101,114,44,32,115,111,10,32,32,32,32,47,47,32,116,104,97,116,32,105,116,32,105,115,32,97,108,105,103,110,101,100,32,119,105,116,104,32,110,101,103,97,116,105,118,101,32,110,117,109,98,101,114,115,32,119,105,116,104,32,116,104,101,32,115,97,109,101,32,110,117,109,98,101,114,32,111,102,32,100,105,103,105,116,115,46,10,32,32,32,32,47,47,32,112,108,117,115,32,109,117,115,116,32,98,101,32,97,32,98,111,111,108,101,97,110,44,32,105,102,32,116,114,117,101,32,97,100,100,115,32,97,32,39,43,39,32,105,110,32,102,114,111,110,116,32,111,102,32,97,32,112,111,115,116,105,118,101,32,110,117,109,98,101,114,44,32,115,111,32,116,104,97,116,32,105,116,32,105,115,10,32,32,32,32,47,47,32,97,108,105,103,110,101,100,32,119,105,116,104,32,110,101,103,97,116,105,118,101,32,110,117,109,98,101,114,115,32,119,105,116,104,32,116,104,101,32,115,97,109,101,32,110,117,109,98,101,114,32,111,102,32,100,105,103,105,116,115,46,32,32,84,104,105,115,32,116,97,107,101,115,32,112,114,101,99,101,100,101,110,99,101,32,111,118,101,114,10,32,32,32,32,47,47,32,98,108,97,110,107,44,32,105,102,32,98,111,116,104,32,97,114,101,32,116,114,117,101,46,10,32,32,32,32,47,47,32,114,97,100,105,120,32,109,117,115,116,32,98,101,32,97,32,119,104,111,108,101,32,110,117,109,98,101,114,32,62,49,32,97,110,100,32,60,61,32,49,48,46,32,32,73,116,32,105,115,32,116,104,101,32,98,97,115,101,32,111,102,32,116,104,101,32,115,121,115,116,101,109,32,111,102,32,110,117,109,101,114,97,108,115,46,10,32,32,32,32,47,47,32,122,101,114,111,95,112,114,101,102,105,120,32,105,115,32,97,32,115,116,114,105,110,103,32,112,114,101,102,105,120,101,100,32,98,101,102,111,114,101,32,116,104,101,32,115,105,103,110,32,116,111,32,97,108,108,32,110,117,109,98,101,114,115,32,116,104,97,116,32,97,114,101,32,110,111,116,32,48,46,10,32,32,32,32,108,111,99,97,108,32,114,101,110,100,101,114,95,105,110,116,40,110,101,103,44,32,109,97,103,44,32,109,105,110,95,99,104,97,114,115,44,32,109,105,110,95,100,105,103,105,116,115,44,32,98,108,97,110,107,44,32,112,108,117,115,44,32,114,97,100,105,120,44,32,122,101,114,111,95,112,114,101,102,105,120,41,32,61,10,32,32,32,32,32,32,47,47,32,100,101,99,32,105,115,32,116,104,101,32,109,105,110,105,109,97,108,32,115,116,114,105,110,103,32,110,101,101,100,101,100,32,116,111,32,114,101,112,114,101,115,101,110,116,32,116,104,101,32,110,117,109,98,101,114,32,97,115,32,116,101,120,116,46,10,32,32,32,32,32,32,108,111,99,97,108,32,100,101,99,32,61,10,32,32,32,32,32,32,32,32,105,102,32,109,97,103,32,61,61,32,48,32,116,104,101,110,10,32,32,32,32,32,32,32,32,32,32,39,48,39,10,32,32,32,32,32,32,32,32,101,108,115,101,10,32,32,32,32,32,32,32,32,32,32,108,111,99,97,108,32,97,117,120,40,110,41,32,61,10,32,32,32,32,32,32,32,32,32,32,32,32,105,102,32,110,32,61,61,32,48,32,116,104,101,110,10,32,32,32,32,32,32,32,32,32,32,32,32,32,32,122,101,114,111,95,112,114,101,102,105,120,10,32,32,32,32,32,32,32,32,32,32,32,32,101,108,115,101,10,32,32,32,32,32,32,32,32,32,32,32,32,32,32,97,117,120,40,115,116,100,46,102,108,111,111,114,40,110,32,47,32,114,97,100,105,120,41,41,32,43,32,40,110,32,37,32,114,97,100,105,120,41,59,10,32,32,32,32,32,32,32,32,32,32,97,117,120,40,109,97,103,41,59,10,32,32,32,32,32,32,108,111,99,97,108,32,122,112,32,61,32,109,105,110,95,99,104,97,114,115,32,45,32,40,105,102,32,110,101,103,32,124,124,32,98,108,97,110,107,32,124,124,32,112,108,117,115,32,116,104,101,110,32,49,32,101,108,115,101,32,48,41,59,10,32,32,32,32,32,32,108,111,99,97,108,32,122,112,50,32,61,32,115,116,100,46,109,97,120,40,122,112,44,32,109,105,110,95,100,105,103,105,116,115,41,59,10,32,32,32,32,32,32,108,111,99,97,108,32,100,101,99,50,32,61,32,112,97,100,95,108,101,102,116,40,100,101,99,44,32,122,112,50,44,32,39,48,39,41,59,10,32,32,32,32,32,32,40,105,102,32,110,101,103,32,116,104,101,110,32,39,45,39,32,101,108,115,101,32,105,102,32,112,108,117,115,32,116,104,101,110,32,39,43,39,32,101,108,115,101,32,105,102,32,98,108,97,110,107,32,116,104,101,110,32,39,32,39,32,101,108,115,101,32,39,39,41,32,43,32,100,101,99,50,59,10,10,32,32,32,32,47,47,32,82,101,110,100,101,114,32,97,110,32,105,110,116,101,103,101,114,32,105,110,32,104,101,120,97,100,101,99,105,109,97,108,46,10,32,32,32,32,108,111,99,97,108,32,114,101,110,100,101,114,95,104,101,120,40,110,95,95,44,32,109,105,110,95,99,104,97,114,115,44,32,109,105,110,95,100,105,103,105,116,115,44,32,98,108,97,110,107,44,32,112,108,117,115,44,32,97,100,100,95,122,101,114,111,120,44,32,99,97,112,105,116,97,108,115,41,32,61,10,32,32,32,32,32,32,108,111,99,97,108,32,110,117,109,101,114,97,108,115,32,61,32,91,48,44,32,49,44,32,50,44,32,51,44,32,52,44,32,53,44,32,54,44,32,55,44,32,56,44,32,57,93,10,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,43,32,105,102,32,99,97,112,105,116,97,108,115,32,116,104,101,110,32,91,39,65,39,44,32,39,66,39,44,32,39,67,39,44,32,39,68,39,44,32,39,69,39,44,32,39,70,39,93,10,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,101,108,115,101,32,91,39,97,39,44,32,39,98,39,44,32,39,99,39,44,32,39,100,39,44,32,39,101,39,44,32,39,102,39,93,59,10,32,32,32,32,32,32,108,111,99,97,108,32,110,95,32,61,32,115,116,100,46,97,98,115,40,110,95,95,41,59,10,32,32,32,32,32,32,108,111,99,97,108,32,97,117,120,40,110,41,32,61,10,32,32,32,32,32,32,32,32,105,102,32,110,32,61,61,32,48,32,116,104,101,110,10,32,32,32,32,32,32,32,32,32,32,39,39,10,32,32,32,32,32,32,32,32,101,108,115,101,10,32,32,32,32,32,32,32,32,32,32,97,117,120,40,115,116,100,46,102,108,111,111,114,40,110,32,47,32,49,54,41,41,32,43,32,110,117,109,101,114,97,108,115,91,110,32,37,32,49,54,93,59,10,32,32,32,32,32,32,108,111,99,97,108,32,104,101,120,32,61,32,105,102,32,115,116,100,46,102,108,111,111,114,40,110,95,41,32,61,61,32,48,32,116,104,101,110,32,39,48,39,32,101,108,115,101,32,97,117,120,40,115,116,100,46,102,108,111,111,114,40,110,95,41,41,59,10,32,32,32,32,32,32,108,111,99,97,108,32,110,101,103,32,61,32,110,95,95,32,60,32,48,59,10,32,32,32,32,32,32,108,111,99,97,108,32,122,112,32,61,32,109,105,110,95,99,104,97,114,115,32,45,32,40,105,102,32,110,101,103,32,124,124,32,98,108,97,110,107,32,124,124,32,112,108,117,115,32,116,104,101,110,32,49,32,101,108,115,101,32,48,41,10,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,45,32,40,105,102,32,97,100,100,95,122,101,114,111,120,32,116,104,101,110,32,50,32,101,108,115,101,32,48,41,59,10,32,32,32,32,32,32,108,111,99,97,108,32,122,112,50,32,61,32,115,116,100,46,109,97,120,40,122,112,44,32,109,105,110,95,100,105,103,105,116,115,41,59,10,32,32,32,32,32,32,108,111,99,97,108,32,104,101,120,50,32,61,32,40,105,102,32,97,100,100,95,122,101,114,111,120,32,116,104,101,110,32,40,105,102,32,99,97,112,105,116,97,108,115,32,116,104,101,110,32,39,48,88,39,32,101,108,115,101,32,39,48,120,39,41,32,101,108,115,101,32,39,39,41,10,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,43,32,112,97,100,95,108,101,102,116,40,104,101,120,44,32,122,112,50,44,32,39,48,39,41,59,10,32,32,32,32,32,32,40,105,102,32,110,101,103,32,116,104,101,110,32,39,45,39,32,101,108,115,101,32,105,102,32,112,108,117,115,32,116,104,101,110,32,39,43,39,32,101,108,115,101,32,105,102,32,98,108,97,110,107,32,116,104,101,110,32,39,32,39,32,101,108,115,101,32,39,39,41,32,43,32,104,101,120,50,59,10,10,32,32,32,32,108,111,99,97,108,32,115,116,114,105,112,95,116,114,97,105,108,105,110,103,95,122,101,114,111,40,115,116,114,41,32,61,10,32,32,32,32,32,32,108,111,99,97,108,32,97,117,120,40,115,116,114,44,32,105,41,32,61,10,32,32,32,32,32,32,32,32,105,102,32,105,32,60,32,48,32,116,104,101,110,10,32,32,32,32,32,32,32,32,32,32,39,39,10,32,32,32,32,32,32,32,32,101,108,115,101,10,32,32,32,32,32,32,32,32,32,32,105,102,32,115,116,114,91,105,93,32,61,61,32,39,48,39,32,116,104,101,110,10,32,32,32,32,32,32,32,32,32,32,32,32,97,117,120,40,115,116,114,44,32,105,32,45,32,49,41,10,32,32,32,32,32,32,32,32,32,32,101,108,115,101,10,32,32,32,32,32,32,32,32,32,32,32,32,115,116,100,46,115,117,98,115,116,114,40,115,116,114,44,32,48,44,32,105,32,43,32,49,41,59,10,32,32,32,32,32,32,97,117,120,40,115,116,114,44,32,115,116,100,46,108,101,110,103,116,104,40,115,116,114,41,32,45,32,49,41,59,10,10,32,32,32,32,47,47,32,82,101,110,100,101,114,32,102,108,111,97,116,105,110,103,32,112,111,105,110,116,32,105,110,32,100,101,99,105,109,97,108,32,102,111,114,109,10,32,32,32,32,108,111,99,97,108,32,114,101,110,100,101,114,95,102,108,111,97,116,95,100,101,99,40,110,95,95,44,32,122,101,114,111,95,112,97,100,44,32,98,108,97,110,107,44,32,112,108,117,115,44,32,101,110,115,117,114,101,95,112,116,44,32,116,114,97,105,108,105,110,103,44,32,112,114,101,99,41,32,61,10,32,32,32,32,32,32,108,111,99,97,108,32,110,95,32,61,32,115,116,100,46,97,98,115,40,110,95,95,41,59,10,32,32,32,32,32,32,108,111,99,97,108,32,119,104,111,108,101,32,61,32,115,116,100,46,102,108,111,111,114,40,110,95,41,59,10,32,32,32,32,32,32,108,111,99,97,108,32,100,111,116,95,115,105,122,101,32,61,32,105,102,32,112,114,101,99,32,61,61,32,48,32,38,38,32,33,101,110,115,117,114,101,95,112,116,32,116,104,101,110,32,48,32,101,108,115,101,32,49,59,10,32,32,32,32,32,32,108,111,99,97,108,32,122,112,32,61,32,122,101,114,111,95,112,97,100,32,45,32,112,114,101,99,32,45,32,100,111,116,95,115,105,122,101,59,10,32,32,32,32,32,32,108,111,99,97,108,32,115,116,114,32,61,32,114,101,110,100,101,114,95,105,110,116,40,110,95,95,32,60,32,48,44,32,119,104,111,108,101,44,32,122,112,44,32,48,44,32,98,108,97,110,107,44,32,112,108,117,115,44,32,49,48,44,32,39,39,41,59,10,32,32,32,32,32,32,105,102,32,112,114,101,99,32,61,61,32,48,32,116,104,101,110,10,32,32,32,32,32,32,32,32,115,116,114,32,43,32,105,102,32,101,110,115,117,114,101,95,112,116,32,116,104,101,110,32,39,46,39,32,101,108,115,101,32,39,39,10,32,32,32,32,32,32,101,108,115,101,10,32,32,32,32,32,32,32,32,108,111,99,97,108,32,102,114,97,99,32,61,32,115,116,100,46,102,108,111,111,114,40,40,110,95,32,45,32,119,104,111,108,101,41,32,42,32,115,116,100,46,112,111,119,40,49,48,44,32,112,114,101,99,41,32,43,32,48,46,53,41,59,10,32,32,32,32,32,32,32,32,105,102,32,116,114,97,105,108,105,110,103,32,124,124,32,102,114,97,99,32,62,32,48,32,116,104,101,110,10,32,32,32,32,32,32,32,32,32,32,108,111,99,97,108,32,102,114,97,99,95,115,116,114,32,61,32,114,101,110,100,101,114,95,105,110,116,40,102,97,108,115,101,44,32,102,114,97,99,44,32,112,114,101,99,44,32,48,44,32,102,97,108,115,101,44,32,102,97,108,115,101,44,32,49,48,44,32,39,39,41,59,10,32,32,32,32,32,32,32,32,32,32,115,116,114,32,43,32,39,46,39,32,43,32,105,102,32,33,116,114,97,105,108,105,110,103,32,116,104,101,110,32,115,116,114,105,112,95,116,114,97,105,108,105,110,103,95,122,101,114,111,40,102,114,97,99,95,115,116,114,41,32,101,108,115,101,32,102,114,97,99,95,115,116,114,10,32,32,32,32,32,32,32,32,101,108,115,101,10,32,32,32,32,32,32,32,32,32,32,115,116,114,59,10,10,32,32,32,32,47,47,32,82,101,110,100,101,114,32,102,108,111,97,116,105,110,103,32,112,111,105,110,116,32,105,110,32,115,99,105,101,110,116,105,102,105,99,32,102,111,114,109,10,32,32,32,32,108,111,99,97,108,32,114,101,110,100,101,114,95,102,108,111,97,116,95,115,99,105,40,110,95,95,44,32,122,101,114,111,95,112,97,100,44,32,98,108,97,110,107,44,32,112,108,117,115,44,32,101,110,115,117,114,101,95,112,116,44,32,116,114,97,105,108,105,110,103,44,32,99,97,112,115,44,32,112,114,101,99,41,32,61,10,32,32,32,32,32,32,108,111,99,97,108,32,101,120,112,111,110,101,110,116,32,61,32,105,102,32,110,95,95,32,61,61,32,48,32,116,104,101,110,32,48,32,101,108,115,101,32,115,116,100,46,102,108,111,111,114,40,115,116,100,46,108,111,103,40,115,116,100,46,97,98,115,40,110,95,95,41,41,32,47,32,115,116,100,46,108,111,103,40,49,48,41,41,59,10,32,32,32,32,32,32,108,111,99,97,108,32,115,117,102,102,32,61,32,40,105,102,32,99,97,112,115,32,116,104,101,110,32,39,69,39,32,101,108,115,101,32,39,101,39,41,10,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,43,32,114,101,110,100,101,114,95,105,110,116,40,101,120,112,111,110,101,110,116,32,60,32,48,44,32,115,116,100,46,97,98,115,40,101,120,112,111,110,101,110,116,41,44,32,51,44,32,48,44,32,102,97,108,115,101,44,32,116,114,117,101,44,32,49,48,44,32,39,39,41,59,10,32,32,32,32,32,32,108,111,99,97,108,32,109,97,110,116,105,115,115,97,32,61,32,105,102,32,101,120,112,111,110,101,110,116,32,61,61,32,45,51,50,52,32,116,104,101,110,10,32,32,32,32,32,32,32,32,47,47,32,65,118,111,105,100,32,97,32,114,111,117,110,100,105,110,103,32,101,114,114,111,114,32,119,104,101,114,101,32,115,116,100,46,112,111,119,40,49,48,44,32,45,51,50,52,41,32,105,115,32,48,10,32,32,32,32,32,32,32,32,47,47,32,45,51,50,52,32,105,115,32,116,104,101,32,115,109,97,108,108,101,115,116,32,101,120,112,111,110,101,110,116,32,112,111,115,115,105,98,108,101,46,10,32,32,32,32,32,32,32,32,110,95,95,32,42,32,49,48,32,47,32,115,116,100,46,112,111,119,40,49,48,44,32,101,120,112,111,110,101,110,116,32,43,32,49,41,10,32,32,32,32,32,32,101,108,115,101,10,32,32,32,32,32,32,32,32,110,95,95,32,47,32,115,116,100,46,112,111,119,40,49,48,44,32,101,120,112,111,110,101,110,116,41,59,10,32,32,32,32,32,32,108,111,99,97,108,32,122,112,50,32,61,32,122,101,114,111,95,112,97,100,32,45,32,115,116,100,46,108,101,110,103,116,104,40,115,117,102,102,41,59,10,32,32,32,32,32,32,114,101,110,100,101,114,95,102,108,111,97,116,95,100,101,99,40,109,97,110,116,105,115,115,97,44,32,122,112,50,44,32,98,108,97,110,107,44,32,112,108,117,115,44,32,101,110,115,117,114,101,95,112,116,44,32,116,114,97,105,108,105,110,103,44,32,112,114,101,99,41,32,43,32,115,117,102,102,59,10,10,32,32,32,32,47,47,32,82,101,110,100,101,114,32,97,32,118,97,108,117,101,32,119,105,116,104,32,97,110,32,97,114,98,105,116,114,97,114,121,32,102,111,114,109,97,116,32,99,111,100,101,46,10,32,32,32,32,108,111,99,97,108,32,102,111,114,109,97,116,95,99,111,100,101,40,118,97,108,44,32,99,111,100,101,44,32,102,119,44,32,112,114,101,99,95,111,114,95,110,117,108,108,44,32,105,41,32,61,10,32,32,32,32,32,32,108,111,99,97,108,32,99,102,108,97,103,115,32,61,32,99,111,100,101,46,99,102,108,97,103,115,59,10,32,32,32,32,32,32,108,111,99,97,108,32,102,112,112,114,101,99,32,61,32,105,102,32,112,114,101,99,95,111,114,95,110,117,108,108,32,33,61,32,110,117,108,108,32,116,104,101,110,32,112,114,101,99,95,111,114,95,110,117,108,108,32,101,108,115,101,32,54,59,10,32,32,32,32,32,32,108,111,99,97,108,32,105,112,114,101,99,32,61,32,105,102,32,112,114,101,99,95,111,114,95,110,117,108,108,32,33,61,32,110,117,108,108,32,116,104,101,110,32,112,114,101,99,95,111,114,95,110,117,108,108,32,101,108,115,101,32,48,59,10,32,32,32,32,32,32,108,111,99,97,108,32,122,112,32,61,32,105,102,32,99,102,108,97,103,115,46,122,101,114,111,32,38,38,32,33,99,102,108,97,103,115,46,108,101,102,116,32,116,104,101,110,32,102,119,32,101,108,115,101,32,48,59,10,32,32,32,32,32,32,105,102,32,99,111,100,101,46,99,116,121,112,101,32,61,61,32,39,115,39,32,116,104,101,110,10,32,32,32,32,32,32,32,32,115,116,100,46,116,111,83,116,114,105,110,103,40,118,97,108,41,10,32,32,32,32,32,32,101,108,115,101,32,105,102,32,99,111,100,101,46,99,116,121,112,101,32,61,61,32,39,100,39,32,116,104,101,110,10,32,32,32,32,32,32,32,32,105,102,32,115,116,100,46,116,121,112,101,40,118,97,108,41,32,33,61,32,39,110,117,109,98,101,114,39,32,116,104,101,110,10,32,32,32,32,32,32,32,32,32,32,101,114,114,111,114,32,39,70,111,114,109,97,116,32,114,101,113,117,105,114,101,100,32,110,117,109,98,101,114,32,97,116,32,39,10,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,43,32,105,32,43,32,39,44,32,103,111,116,32,39,32,43,32,115,116,100,46,116,121,112,101,40,118,97,108,41,10,32,32,32,32,32,32,32,32,101,108,115,101,10,32,32,32,32,32,32,32,32,32,32,114,101,110,100,101,114,95,105,110,116,40,118,97,108,32,60,61,32,45,49,44,32,115,116,100,46,102,108,111,111,114,40,115,116,100,46,97,98,115,40,118,97,108,41,41,44,32,122,112,44,32,105,112,114,101,99,44,32,99,102,108,97,103,115,46,98,108,97,110,107,44,32,99,102,108,97,103,115,46,112,108,117,115,44,32,49,48,44,32,39,39,41,10,32,32,32,32,32,32,101,108,115,101,32,105,102,32,99,111,100,101,46,99,116,121,112,101,32,61,61,32,39,111,39,32,116,104,101,110,10,32,32,32,32,32,32,32,32,105,102,32,115,116,100,46,116,121,112,101,40,118,97,108,41,32,33,61,32,39,110,117,109,98,101,114,39,32,116,104,101,110,10,32,32,32,32,32,32,32,32,32,32,101,114,114,111,114,32,39,70,111,114,109,97,116,32,114,101,113,117,105,114,101,100,32,110,117,109,98,101,114,32,97,116,32,39,10,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,43,32,105,32,43,32,39,44,32,103,111,116,32,39,32,43,32,115,116,100,46,116,121,112,101,40,118,97,108,41,10,32,32,32,32,32,32,32,32,101,108,115,101,10,32,32,32,32,32,32,32,32,32,32,108,111,99,97,108,32,122,101,114,111,95,112,114,101,102,105,120,32,61,32,105,102,32,99,102,108,97,103,115,46,97,108,116,32,116,104,101,110,32,39,48,39,32,101,108,115,101,32,39,39,59,10,32,32,32,32,32,32,32,32,32,32,114,101,110,100,101,114,95,105,110,116,40,118,97,108,32,60,61,32,45,49,44,32,115,116,100,46,102,108,111,111,114,40,115,116,100,46,97,98,115,40,118,97,108,41,41,44,32,122,112,44,32,105,112,114,101,99,44,32,99,102,108,97,103,115,46,98,108,97,110,107,44,32,99,102,108,97,103,115,46,112,108,117,115,44,32,56,44,32,122,101,114,111,95,112,114,101,102,105,120,41,10,32,32,32,32,32,32,101,108,115,101,32,105,102,32,99,111,100,101,46,99,116,121,112,101,32,61,61,32,39,120,39,32,116,104,101,110,10,32,32,32,32,32,32,32,32,105,102,32,115,116,100,46,116,121,112,101,40,118,97,108,41,32,33,61,32,39,110,117,109,98,101,114,39,32,116,104,101,110,10,32,32,32,32,32,32,32,32,32,32,101,114,114,111,114,32,39,70,111,114,109,97,116,32,114,101,113,117,105,114,101,100,32,110,117,109,98,101,114,32,97,116,32,39,10,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,43,32,105,32,43,32,39,44,32,103,111,116,32,39,32,43,32,115,116,100,46,116,121,112,101,40,118,97,108,41,10,32,32,32,32,32,32,32,32,101,108,115,101,10,32,32,32,32,32,32,32,32,32,32,114,101,110,100,101,114,95,104,101,120,40,115,116,100,46,102,108,111,111,114,40,118,97,108,41,44,10,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,122,112,44,10,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,105,112,114,101,99,44,10,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,99,102,108,97,103,115,46,98,108,97,110,107,44,10,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,99,102,108,97,103,115,46,112,108,117,115,44,10,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,99,102,108,97,103,115,46,97,108,116,44,10,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,99,111,100,101,46,99,97,112,115,41,10,32,32,32,32,32,32,101,108,115,101,32,105,102,32,99,111,100,101,46,99,116,121,112,101,32,61,61,32,39,102,39,32,116,104,101,110,10,32,32,32,32,32,32,32,32,105,102,32,115,116,100,46,116,121,112,101,40,118,97,108,41,32,33,61,32,39,110,117,109,98,101,114,39,32,116,104,101,110,10,32,32,32,32,32,32,32,32,32,32,101,114,114,111,114,32,39,70,111,114,109,97,116,32,114,101,113,117,105,114,101,100,32,110,117,109,98,101,114,32,97,116,32,39,10,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,43,32,105,32,43,32,39,44,32,103,111,116,32,39,32,43,32,115,116,100,46,116,121,112,101,40,118,97,108,41,10,32,32,32,32,32,32,32,32,101,108,115,101,10,32,32,32,32,32,32,32,32,32,32,114,101,110,100,101,114,95,102,108,111,97,116,95,100,101,99,40,118,97,108,44,10,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,122,112,44,10,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,99,102,108,97,103,115,46,98,108,97,110,107,44,10,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,99,102,108,97,103,115,46,112,108,117,115,44,10,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,99,102,108,97,103,115,46,97,108,116,44,10,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,116,114,117,101,44,10,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,102,112,112,114,101,99,41,10,32,32,32,32,32,32,101,108,115,101,32,105,102,32,99,111,100,101,46,99,116,121,112,101,32,61,61,32,39,101,39,32,116,104,101,110,10,32,32,32,32,32,32,32,32,105,102,32,115,116,100,46,116,121,112,101,40,118,97,108,41,32,33,61,32,39,110,117,109,98,101,114,39,32,116,104,101,110,10,32,32,32,32,32,32,32,32,32,32,101,114,114,111,114,32,39,70,111,114,109,97,116,32,114,101,113,117,105,114,101,100,32,110,117,109,98,101,114,32,97,116,32,39,10,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,43,32,105,32,43,32,39,44,32,103,111,116,32,39,32,43,32,115,116,100,46,116,121,112,101,40,118,97,108,41,10,32,32,32,32,32,32,32,32,101,108,115,101,10,32,32,32,32,32,32,32,32,32,32,114,101,110,100,101,114,95,102,108,111,97,116,95,115,99,105,40,118,97,108,44,10,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,122,112,44,10,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,99,102,108,97,103,115,46,98,108,97,110,107,44,10,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,99,102,108,97,103,115,46,112,108,117,115,44,10,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,99,102,108,97,103,115,46,97,108,116,44,10,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,116,114,117,101,44,10,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,99,111,100,101,46,99,97,112,115,44,10,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,102,112,112,114,101,99,41,10,32,32,32,32,32,32,101,108,115,101,32,105,102,32,99,111,100,101,46,99,116,121,112,101,32,61,61,32,39,103,39,32,116,104,101,110,10,32,32,32,32,32,32,32,32,105,102,32,115,116,100,46,116,121,112,101,40,118,97,108,41,32,33,61,32,39,110,117,109,98,101,114,39,32,116,104,101,110,10,32,32,32,32,32,32,32,32,32,32,101,114,114,111,114,32,39,70,111,114,109,97,116,32,114,101,113,117,105,114,101,100,32,110,117,109,98,101,114,32,97,116,32,39,10,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,43,32,105,32,43,32,39,44,32,103,111,116,32,39,32,43,32,115,116,100,46,116,121,112,101,40,118,97,108,41,10,32,32,32,32,32,32,32,32,101,108,115,101,10,32,32,32,32,32,32,32,32,32,32,108,111,99,97,108,32,101,120,112,111,110,101,110,116,32,61,32,115,116,100,46,102,108,111,111,114,40,115,116,100,46,108,111,103,40,115,116,100,46,97,98,115,40,118,97,108,41,41,32,47,32,115,116,100,46,108,111,103,40,49,48,41,41,59,10,32,32,32,32,32,32,32,32,32,32,105,102,32,101,120,112,111,110,101,110,116,32,60,32,45,52,32,124,124,32,101,120,112,111,110,101,110,116,32,62,61,32,102,112,112,114,101,99,32,116,104,101,110,10,32,32,32,32,32,32,32,32,32,32,32,32,114,101,110,100,101,114,95,102,108,111,97,116,95,115,99,105,40,118,97,108,44,10,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,122,112,44,10,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,99,102,108,97,103,115,46,98,108,97,110,107,44,10,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,99,102,108,97,103,115,46,112,108,117,115,44,10,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,99,102,108,97,103,115,46,97,108,116,44,10,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,99,102,108,97,103,115,46,97,108,116,44,10,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,99,111,100,101,46,99,97,112,115,44,10,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,102,112,112,114,101,99,32,45,32,49,41,10,32,32,32,32,32,32,32,32,32,32,101,108,115,101,10,32,32,32,32,32,32,32,32,32,32,32,32,108,111,99,97,108,32,100,105,103,105,116,115,95,98,101,102,111,114,101,95,112,116,32,61,32,115,116,100,46,109,97,120,40,49,44,32,101,120,112,111,110,101,110,116,32,43,32,49,41,59,10,32,32,32,32,32,32,32,32,32,32,32,32,114,101,110,100,101,114,95,102,108,111,97,116,95,100,101,99,40,118,97,108,44,10,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,122,112,44,10,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,99,102,108,97,103,115,46,98,108,97,110,107,44,10,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,99,102,108,97,103,115,46,112,108,117,115,44,10,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,99,102,108,97,103,115,46,97,108,116,44,10,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,99,102,108,97,103,115,46,97,108,116,44,10,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,102,112,112,114,101,99,32,45,32,100,105,103,105,116,115,95,98,101,102,111,114,101,95,112,116,41,10,32,32,32,32,32,32,101,108,115,101,32,105,102,32,99,111,100,101,46,99,116,121,112,101,32,61,61,32,39,99,39,32,116,104,101,110,10,32,32,32,32,32,32,32,32,105,102,32,115,116,100,46,116,121,112,101,40,118,97,108,41,32,61,61,32,39,110,117,109,98,101,114,39,32,116,104,101,110,10,32,32,32,32,32,32,32,32,32,32,115,116,100,46,99,104,97,114,40,118,97,108,41,10,32,32,32,32,32,32,32,32,101,108,115,101,32,105,102,32,115,116,100,46,116,121,112,101,40,118,97,108,41,32,61,61,32,39,115,116,114,105,110,103,39,32,116,104,101,110,10,32,32,32,32,32,32,32,32,32,32,105,102,32,115,116,100,46,108,101,110,103,116,104,40,118,97,108,41,32,61,61,32,49,32,116,104,101,110,10,32,32,32,32,32,32,32,32,32,32,32,32,118,97,108,10,32,32,32,32,32,32,32,32,32,32,101,108,115,101,10,32,32,32,32,32,32,32,32,32,32,32,32,101,114,114,111,114,32,39,37,99,32,101,120,112,101,99,116,101,100,32,49,45,115,105,122,101,100,32,115,116,114,105,110,103,32,103,111,116,58,32,39,32,43,32,115,116,100,46,108,101,110,103,116,104,40,118,97,108,41,10,32,32,32,32,32,32,32,32,101,108,115,101,10,32,32,32,32,32,32,32,32,32,32,101,114,114,111,114,32,39,37,99,32,101,120,112,101,99,116,101,100,32,110,117,109,98,101,114,32,47,32,115,116,114,105,110,103,44,32,103,111,116,58,32,39,32,43,32,115,116,100,46,116,121,112,101,40,118,97,108,41,10,32,32,32,32,32,32,101,108,115,101,10,32,32,32,32,32,32,32,32,101,114,114,111,114,32,39,85,110,107,110,111,119,110,32,99,111,100,101,58,32,39,32,43,32,99,111,100,101,46,99,116,121,112,101,59,10,10,32,32,32,32,47,47,32,82,101,110,100,101,114,32,97,32,112,97,114,115,101,100,32,102,111,114,109,97,116,32,115,116,114,105,110,103,32,119,105,116,104,32,97,110,32,97,114,114,97,121,32,111,102,32,118,97,108,117,101,115,46,10,32,32,32,32,108,111,99,97,108,32,102,111,114,109,97,116,95,99,111,100,101,115,95,97,114,114,40,99,111,100,101,115,44,32,97,114,114,44,32,105,44,32,106,44,32,118,41,32,61,10,32,32,32,32,32,32,105,102,32,105,32,62,61,32,115,116,100,46,108,101,110,103,116,104,40,99,111,100,101,115,41,32,116,104,101,110,10,32,32,32,32,32,32,32,32,105,102,32,106,32,60,32,115,116,100,46,108,101,110,103,116,104,40,97,114,114,41,32,116,104,101,110,10,32,32,32,32,32,32,32,32,32,32,101,114,114,111,114,32,40,39,84,111,111,32,109,97,110,121,32,118,97,108,117,101,115,32,116,111,32,102,111,114,109,97,116,58,32,39,32,43,32,115,116,100,46,108,101,110,103,116,104,40,97,114,114,41,32,43,32,39,44,32,101,120,112,101,99,116,101,100,32,39,32,43,32,106,41,10,32,32,32,32,32,32,32,32,101,108,115,101,10,32,32,32,32,32,32,32,32,32,32,118,10,32,32,32,32,32,32,101,108,115,101,10,32,32,32,32,32,32,32,32,108,111,99,97,108,32,99,111,100,101,32,61,32,99,111,100,101,115,91,105,93,59,10,32,32,32,32,32,32,32,32,105,102,32,115,116,100,46,116,121,112,101,40,99,111,100,101,41,32,61,61,32,39,115,116,114,105,110,103,39,32,116,104,101,110,10,32,32,32,32,32,32,32,32,32,32,102,111,114,109,97,116,95,99,111,100,101,115,95,97,114,114,40,99,111,100,101,115,44,32,97,114,114,44,32,105,32,43,32,49,44,32,106,44,32,118,32,43,32,99,111,100,101,41,32,116,97,105,108,115,116,114,105,99,116,10,32,32,32,32,32,32,32,32,101,108,115,101,10,32,32,32,32,32,32,32,32,32,32,108,111,99,97,108,32,116,109,112,32,61,32,105,102,32,99,111,100,101,46,102,119,32,61,61,32,39,42,39,32,116,104,101,110,32,123,10,32,32,32,32,32,32,32,32,32,32,32,32,106,58,32,106,32,43,32,49,44,10,32,32,32,32,32,32,32,32,32,32,32,32,102,119,58,32,105,102,32,106,32,62,61,32,115,116,100,46,108,101,110,103,116,104,40,97,114,114,41,32,116,104,101,110,10,32,32,32,32,32,32,32,32,32,32,32,32,32,32,101,114,114,111,114,32,40,39,78,111,116,32,101,110,111,117,103,104,32,118,97,108,117,101,115,32,116,111,32,102,111,114,109,97,116,58,32,39,32,43,32,115,116,100,46,108,101,110,103,116,104,40,97,114,114,41,32,43,32,39,44,32,101,120,112,101,99,116,101,100,32,97,116,32,108,101,97,115,116,32,39,32,43,32,106,41,10,32,32,32,32,32,32,32,32,32,32,32,32,101,108,115,101,10,32,32,32,32,32,32,32,32,32,32,32,32,32,32,97,114,114,91,106,93,44,10,32,32,32,32,32,32,32,32,32,32,125,32,101,108,115,101,32,123,10,32,32,32,32,32,32,32,32,32,32,32,32,106,58,32,106,44,10,32,32,32,32,32,32,32,32,32,32,32,32,102,119,58,32,99,111,100,101,46,102,119,44,10,32,32,32,32,32,32,32,32,32,32,125,59,10,32,32,32,32,32,32,32,32,32,32,108,111,99,97,108,32,116,109,112,50,32,61,32,105,102,32,99,111,100,101,46,112,114,101,99,32,61,61,32,39,42,39,32,116,104,101,110,32,123,10,32,32,32,32,32,32,32,32,32,32,32,32,106,58,32,116,109,112,46,106,32,43,32,49,44,10,32,32,32,32,32,32,32,32,32,32,32,32,112,114,101,99,58,32,105,102,32,116,109,112,46,106,32,62,61,32,115,116,100,46,108,101,110,103,116,104,40,97,114,114,41,32,116,104,101,110,10,32,32,32,32,32,32,32,32,32,32,32,32,32,32,101,114,114,111,114,32,40,39,78,111,116,32,101,110,111,117,103,104,32,118,97,108,117,101,115,32,116,111,32,102,111,114,109,97,116,58,32,39,32,43,32,115,116,100,46,108,101,110,103,116,104,40,97,114,114,41,32,43,32,39,44,32,101,120,112,101,99,116,101,100,32,97,116,32,108,101,97,115,116,32,39,32,43,32,116,109,112,46,106,41,10,32,32,32,32,32,32,32,32,32,32,32,32,101,108,115,101,10,32,32,32,32,32,32,32,32,32,32,32,32,32,32,97,114,114,91,116,109,112,46,106,93,44,10,32,32,32,32,32,32,32,32,32,32,125,32,101,108,115,101,32,123,10,32,32,32,32,32,32,32,32,32,32,32,32,106,58,32,116,109,112,46,106,44,10,32,32,32,32,32,32,32,32,32,32,32,32,112,114,101,99,58,32,99,111,100,101,46,112,114,101,99,44,10,32,32,32,32,32,32,32,32,32,32,125,59,10,32,32,32,32,32,32,32,32,32,32,108,111,99,97,108,32,106,50,32,61,32,116,109,112,50,46,106,59,10,32,32,32,32,32,32,32,32,32,32,108,111,99,97,108,32,118,97,108,32,61,10,32,32,32,32,32,32,32,32,32,32,32,32,105,102,32,106,50,32,60,32,115,116,100,46,108,101,110,103,116,104,40,97,114,114,41,32,116,104,101,110,10,32,32,32,32,32,32,32,32,32,32,32,32,32,32,97,114,114,91,106,50,93,10,32,32,32,32,32,32,32,32,32,32,32,32,101,108,115,101,10,32,32,32,32,32,32,32,32,32,32,32,32,32,32,101,114,114,111,114,32,40,39,78,111,116,32,101,110,111,117,103,104,32,118,97,108,117,101,115,32,116,111,32,102,111,114,109,97,116,58,32,39,32,43,32,115,116,100,46,108,101,110,103,116,104,40,97,114,114,41,32,43,32,39,44,32,101,120,112,101,99,116,101,100,32,109,111,114,101,32,116,104,97,110,32,39,32,43,32,106,50,41,59,10,32,32,32,32,32,32,32,32,32,32,108,111,99,97,108,32,115,32,61,10,32,32,32,32,32,32,32,32,32,32,32,32,105,102,32,99,111,100,101,46,99,116,121,112,101,32,61,61,32,39,37,39,32,116,104,101,110,10,32,32,32,32,32,32,32,32,32,32,32,32,32,32,39,37,39,10,32,32,32,32,32,32,32,32,32,32,32,32,101,108,115,101,10,32,32,32,32,32,32,32,32,32,32,32,32,32,32,102,111,114,109,97,116,95,99,111,100,101,40,118,97,108,44,32,99,111,100,101,44,32,116,109,112,46,102,119,44,32,116,109,112,50,46,112,114,101,99,44,32,106,50,41,59,10,32,32,32,32,32,32,32,32,32,32,108,111,99,97,108,32,115,95,112,97,100,100,101,100,32,61,10,32,32,32,32,32,32,32,32,32,32,32,32,105,102,32,99,111,100,101,46,99,102,108,97,103,115,46,108,101,102,116,32,116,104,101,110,10,32,32,32,32,32,32,32,32,32,32,32,32,32,32,112,97,100,95,114,105,103,104,116,40,115,44,32,116,109,112,46,102,119,44,32,39,32,39,41,10,32,32,32,32,32,32,32,32,32,32,32,32,101,108,115,101,10,32,32,32,32,32,32,32,32,32,32,32,32,32,32,112,97,100,95,108,101,102,116,40,115,44,32,116,109,112,46,102,119,44,32,39,32,39,41,59,10,32,32,32,32,32,32,32,32,32,32,108,111,99,97,108,32,106,51,32,61,10,32,32,32,32,32,32,32,32,32,32,32,32,105,102,32,99,111,100,101,46,99,116,121,112,101,32,61,61,32,39,37,39,32,116,104,101,110,10,32,32,32,32,32,32,32,32,32,32,32,32,32,32,106,50,10,32,32,32,32,32,32,32,32,32,32,32,32,101,108,115,101,10,32,32,32,32,32,32,32,32,32,32,32,32,32,32,106,50,32,43,32,49,59,10,32,32,32,32,32,32,32,32,32,32,102,111,114,109,97,116,95,99,111,100,101,115,95,97,114,114,40,99,111,100,101,115,44,32,97,114,114,44,32,105,32,43,32,49,44,32,106,51,44,32,118,32,43,32,115,95,112,97,100,100,101,100,41,32,116,97,105,108,115,116,114,105,99,116,59,10,10,32,32,32,32,47,47,32,82,101,110,100,101,114,32,97,32,112,97,114,115,101,100,32,102,111,114,109,97,116,32,115,116,114,105,110,103,32,119,105,116,104,32,97,110,32,111,98,106,101,99,116,32,111,102,32,118,97,108,117,101,115,46,10,32,32,32,32,108,111,99,97,108,32,102,111,114,109,97,116,95,99,111,100,101,115,95,111,98,106,40,99,111,100,101,115,44,32,111,98,106,44,32,105,44,32,118,41,32,61,10,32,32,32,32,32,32,105,102,32,105,32,62,61,32,115,116,100,46,108,101,110,103,116,104,40,99,111,100,101,115,41,32,116,104,101,110,10,32,32,32,32,32,32,32,32,118,10,32,32,32,32,32,32,101,108,115,101,10,32,32,32,32,32,32,32,32,108,111,99,97,108,32,99,111,100,101,32,61,32,99,111,100,101,115,91,105,93,59,10,32,32,32,32,32,32,32,32,105,102,32,115,116,100,46,116,121,112,101,40,99,111,100,101,41,32,61,61,32,39,115,116,114,105,110,103,39,32,116,104,101,110,10,32,32,32,32,32,32,32,32,32,32,102,111,114,109,97,116,95,99,111,100,101,115,95,111,98,106,40,99,111,100,101,115,44,32,111,98,106,44,32,105,32,43,32,49,44,32,118,32,43,32,99,111,100,101,41,32,116,97,105,108,115,116,114,105,99,116,10,32,32,32,32,32,32,32,32,101,108,115,101,10,32,32,32,32,32,32,32,32,32,32,108,111,99,97,108,32,102,32,61,10,32,32,32,32,32,32,32,32,32,32,32,32,105,102,32,99,111,100,101,46,109,107,101,121,32,61,61,32,110,117,108,108,32,116,104,101,110,10,32,32,32,32,32,32,32,32,32,32,32,32,32,32,101,114,114,111,114,32,39,77,97,112,112,105,110,103,32,107,101,121,115,32,114,101,113,117,105,114,101,100,46,39,10,32,32,32,32,32,32,32,32,32,32,32,32,101,108,115,101,10,32,32,32,32,32,32,32,32,32,32,32,32,32,32,99,111,100,101,46,109,107,101,121,59,10,32,32,32,32,32,32,32,32,32,32,108,111,99,97,108,32,102,119,32,61,10,32,32,32,32,32,32,32,32,32,32,32,32,105,102,32,99,111,100,101,46,102,119,32,61,61,32,39,42,39,32,116,104,101,110,10,32,32,32,32,32,32,32,32,32,32,32,32,32,32,101,114,114,111,114,32,39,67,97,110,110,111,116,32,117,115,101,32,42,32,102,105,101,108,100,32,119,105,100,116,104,32,119,105,116,104,32,111,98,106,101,99,116,46,39,10,32,32,32,32,32,32,32,32,32,32,32,32,101,108,115,101,10,32,32,32,32,32,32,32,32,32,32,32,32,32,32,99,111,100,101,46,102,119,59,10,32,32,32,32,32,32,32,32,32,32,108,111,99,97,108,32,112,114,101,99,32,61,10,32,32,32,32,32,32,32,32,32,32,32,32,105,102,32,99,111,100,101,46,112,114,101,99,32,61,61,32,39,42,39,32,116,104,101,110,10,32,32,32,32,32,32,32,32,32,32,32,32,32,32,101,114,114,111,114,32,39,67,97,110,110,111,116,32,117,115,101,32,42,32,112,114,101,99,105,115,105,111,110,32,119,105,116,104,32,111,98,106,101,99,116,46,39,10,32,32,32,32,32,32,32,32,32,32,32,32,101,108,115,101,10,32,32,32,32,32,32,32,32,32,32,32,32,32,32,99,111,100,101,46,112,114,101,99,59,10,32,32,32,32,32,32,32,32,32,32,108,111,99,97,108,32,118,97,108,32,61,10,32,32,32,32,32,32,32,32,32,32,32,32,105,102,32,115,116,100,46,111,98,106,101,99,116,72,97,115,65,108,108,40,111,98,106,44,32,102,41,32,116,104,101,110,10,32,32,32,32,32,32,32,32,32,32,32,32,32,32,111,98,106,91,102,93,10,32,32,32,32,32,32,32,32,32,32,32,32,101,108,115,101,10,32,32,32,32,32,32,32,32,32,32,32,32,32,32,101,114,114,111,114,32,39,78,111,32,115,117,99,104,32,102,105,101,108,100,58,32,39,32,43,32,102,59,10,32,32,32,32,32,32,32,32,32,32,108,111,99,97,108,32,115,32,61,10,32,32,32,32,32,32,32,32,32,32,32,32,105,102,32,99,111,100,101,46,99,116,121,112,101,32,61,61,32,39,37,39,32,116,104,101,110,10,32,32,32,32,32,32,32,32,32,32,32,32,32,32,39,37,39,10,32,32,32,32,32,32,32,32,32,32,32,32,101,108,115,101,10,32,32,32,32,32,32,32,32,32,32,32,32,32,32,102,111,114,109,97,116,95,99,111,100,101,40,118,97,108,44,32,99,111,100,101,44,32,102,119,44,32,112,114,101,99,44,32,102,41,59,10,32,32,32,32,32,32,32,32,32,32,108,111,99,97,108,32,115,95,112,97,100,100,101,100,32,61,10,32,32,32,32,32,32,32,32,32,32,32,32,105,102,32,99,111,100,101,46,99,102,108,97,103,115,46,108,101,102,116,32,116,104,101,110,10,32,32,32,32,32,32,32,32,32,32,32,32,32,32,112,97,100,95,114,105,103,104,116,40,115,44,32,102,119,44,32,39,32,39,41,10,32,32,32,32,32,32,32,32,32,32,32,32,101,108,115,101,10,32,32,32,32,32,32,32,32,32,32,32,32,32,32,112,97,100,95,108,101,102,116,40,115,44,32,102,119,44,32,39,32,39,41,59,10,32,32,32,32,32,32,32,32,32,32,102,111,114,109,97,116,95,99,111,100,101,115,95,111,98,106,40,99,111,100,101,115,44,32,111,98,106,44,32,105,32,43,32,49,44,32,118,32,43,32,115,95,112,97,100,100,101,100,41,32,116,97,105,108,115,116,114,105,99,116,59,10,10,32,32,32,32,105,102,32,115,116,100,46,105,115,65,114,114,97,121,40,118,97,108,115,41,32,116,104,101,110,10,32,32,32,32,32,32,102,111,114,109,97,116,95,99,111,100,101,115,95,97,114,114,40,99,111,100,101,115,44,32,118,97,108,115,44,32,48,44,32,48,44,32,39,39,41,10,32,32,32,32,101,108,115,101,32,105,102,32,115,116,100,46,105,115,79,98,106,101,99,116,40,118,97,108,115,41,32,116,104,101,110,10,32,32,32,32,32,32,102,111,114,109,97,116,95,99,111,100,101,115,95,111,98,106,40,99,111,100,101,115,44,32,118,97,108,115,44,32,48,44,32,39,39,41,10,32,32,32,32,101,108,115,101,10,32,32,32,32,32,32,102,111,114,109,97,116,95,99,111,100,101,115,95,97,114,114,40,99,111,100,101,115,44,32,91,118,97,108,115,93,44,32,48,44,32,48,44,32,39,39,41,44,10,10,32,32,102,111,108,100,114,40,102,117,110,99,44,32,97,114,114,44,32,105,110,105,116,41,58,58,10,32,32,32,32,108,111,99,97,108,32,97,117,120,40,102,117,110,99,44,32,97,114,114,44,32,114,117,110,110,105,110,103,44,32,105,100,120,41,32,61,10,32,32,32,32,32,32,105,102,32,105,100,120,32,60,32,48,32,116,104,101,110,10,32,32,32,32,32,32,32,32,114,117,110,110,105,110,103,10,32,32,32,32,32,32,101,108,115,101,10,32,32,32,32,32,32,32,32,97,117,120,40,102,117,110,99,44,32,97,114,114,44,32,102,117,110,99,40,97,114,114,91,105,100,120,93,44,32,114,117,110,110,105,110,103,41,44,32,105,100,120,32,45,32,49,41,32,116,97,105,108,115,116,114,105,99,116,59,10,32,32,32,32,97,117,120,40,102,117,110,99,44,32,97,114,114,44,32,105,110,105,116,44,32,115,116,100,46,108,101,110,103,116,104,40,97,114,114,41,32,45,32,49,41,44,10,10,32,32,102,111,108,100,108,40,102,117,110,99,44,32,97,114,114,44,32,105,110,105,116,41,58,58,10,32,32,32,32,108,111,99,97,108,32,97,117,120,40,102,117,110,99,44,32,97,114,114,44,32,114,117,110,110,105,110,103,44,32,105,100,120,41,32,61,10,32,32,32,32,32,32,105,102,32,105,100,120,32,62,61,32,115,116,100,46,108,101,110,103,116,104,40,97,114,114,41,32,116,104,101,110,10,32,32,32,32,32,32,32,32,114,117,110,110,105,110,103,10,32,32,32,32,32,32,101,108,115,101,10,32,32,32,32,32,32,32,32,97,117,120,40,102,117,110,99,44,32,97,114,114,44,32,102,117,110,99,40,114,117,110,110,105,110,103,44,32,97,114,114,91,105,100,120,93,41,44,32,105,100,120,32,43,32,49,41,32,116,97,105,108,115,116,114,105,99,116,59,10,32,32,32,32,97,117,120,40,102,117,110,99,44,32,97,114,114,44,32,105,110,105,116,44,32,48,41,44,10,10,10,32,32,102,105,108,116,101,114,77,97,112,40,102,105,108,116,101,114,95,102,117,110,99,44,32,109,97,112,95,102,117,110,99,44,32,97,114,114,41,58,58,10,32,32,32,32,105,102,32,33,115,116,100,46,105,115,70,117,110,99,116,105,111,110,40,102,105,108,116,101,114,95,102,117,110,99,41,32,116,104,101,110,10,32,32,32,32,32,32,101,114,114,111,114,32,40,39,115,116,100,46,102,105,108,116,101,114,77,97,112,32,102,105,114,115,116,32,112,97,114,97,109,32,109,117,115,116,32,98,101,32,102,117,110,99,116,105,111,110,44,32,103,111,116,32,39,32,43,32,115,116,100,46,116,121,112,101,40,102,105,108,116,101,114,95,102,117,110,99,41,41,10,32,32,32,32,101,108,115,101,32,105,102,32,33,115,116,100,46,105,115,70,117,110,99,116,105,111,110,40,109,97,112,95,102,117,110,99,41,32,116,104,101,110,10,32,32,32,32,32,32,101,114,114,111,114,32,40,39,115,116,100,46,102,105,108,116,101,114,77,97,112,32,115,101,99,111,110,100,32,112,97,114,97,109,32,109,117,115,116,32,98,101,32,102,117,110,99,116,105,111,110,44,32,103,111,116,32,39,32,43,32,115,116,100,46,116,121,112,101,40,109,97,112,95,102,117,110,99,41,41,10,32,32,32,32,101,108,115,101,32,105,102,32,33,115,116,100,46,105,115,65,114,114,97,121,40,97,114,114,41,32,116,104,101,110,10,32,32,32,32,32,32,101,114,114,111,114,32,40,39,115,116,100,46,102,105,108,116,101,114,77,97,112,32,116,104,105,114,100,32,112,97,114,97,109,32,109,117,115,116,32,98,101,32,97,114,114,97,121,44,32,103,111,116,32,39,32,43,32,115,116,100,46,116,121,112,101,40,97,114,114,41,41,10,32,32,32,32,101,108,115,101,10,32,32,32,32,32,32,115,116,100,46,109,97,112,40,109,97,112,95,102,117,110,99,44,32,115,116,100,46,102,105,108,116,101,114,40,102,105,108,116,101,114,95,102,117,110,99,44,32,97,114,114,41,41,44,10,10,32,32,97,115,115,101,114,116,69,113,117,97,108,40,97,44,32,98,41,58,58,10,32,32,32,32,105,102,32,97,32,61,61,32,98,32,116,104,101,110,10,32,32,32,32,32,32,116,114,117,101,10,32,32,32,32,101,108,115,101,10,32,32,32,32,32,32,101,114,114,111,114,32,39,65,115,115,101,114,116,105,111,110,32,102,97,105,108,101,100,46,32,39,32,43,32,97,32,43,32,39,32,33,61,32,39,32,43,32,98,44,10,10,32,32,97,98,115,40,110,41,58,58,10,32,32,32,32,105,102,32,33,115,116,100,46,105,115,78,117,109,98,101,114,40,110,41,32,116,104,101,110,10,32,32,32,32,32,32,101,114,114,111,114,32,39,115,116,100,46,97,98,115,32,101,120,112,101,99,116,101,100,32,110,117,109,98,101,114,44,32,103,111,116,32,39,32,43,32,115,116,100,46,116,121,112,101,40,110,41,10,32,32,32,32,101,108,115,101,10,32,32,32,32,32,32,105,102,32,110,32,62,32,48,32,116,104,101,110,32,110,32,101,108,115,101,32,45,110,44,10,10,32,32,115,105,103,110,40,110,41,58,58,10,32,32,32,32,105,102,32,33,115,116,100,46,105,115,78,117,109,98,101,114,40,110,41,32,116,104,101,110,10,32,32,32,32,32,32,101,114,114,111,114,32,39,115,116,100,46,115,105,103,110,32,101,120,112,101,99,116,101,100,32,110,117,109,98,101,114,44,32,103,111,116,32,39,32,43,32,115,116,100,46,116,121,112,101,40,110,41,10,32,32,32,32,101,108,115,101,10,32,32,32,32,32,32,105,102,32,110,32,62,32,48,32,116,104,101,110,10,32,32,32,32,32,32,32,32,49,10,32,32,32,32,32,32,101,108,115,101,32,105,102,32,110,32,60,32,48,32,116,104,101,110,10,32,32,32,32,32,32,32,32,45,49,10,32,32,32,32,32,32,101,108,115,101,32,48,44,10,10,32,32,109,97,120,40,97,44,32,98,41,58,58,10,32,32,32,32,105,102,32,33,115,116,100,46,105,115,78,117,109,98,101,114,40,97,41,32,116,104,101,110,10,32,32,32,32,32,32,101,114,114,111,114,32,39,115,116,100,46,109,97,120,32,102,105,114,115,116,32,112,97,114,97,109,32,101,120,112,101,99,116,101,100,32,110,117,109,98,101,114,44,32,103,111,116,32,39,32,43,32,115,116,100,46,116,121,112,101,40,97,41,10,32,32,32,32,101,108,115,101,32,105,102,32,33,115,116,100,46,105,115,78,117,109,98,101,114,40,98,41,32,116,104,101,110,10,32,32,32,32,32,32,101,114,114,111,114,32,39,115,116,100,46,109,97,120,32,115,101,99,111,110,100,32,112,97,114,97,109,32,101,120,112,101,99,116,101,100,32,110,117,109,98,101,114,44,32,103,111,116,32,39,32,43,32,115,116,100,46,116,121,112,101,40,98,41,10,32,32,32,32,101,108,115,101,10,32,32,32,32,32,32,105,102,32,97,32,62,32,98,32,116,104,101,110,32,97,32,101,108,115,101,32,98,44,10,10,32,32,109,105,110,40,97,44,32,98,41,58,58,10,32,32,32,32,105,102,32,33,115,116,100,46,105,115,78,117,109,98,101,114,40,97,41,32,116,104,101,110,10,32,32,32,32,32,32,101,114,114,111,114,32,39,115,116,100,46,109,97,120,32,102,105,114,115,116,32,112,97,114,97,109,32,101,120,112,101,99,116,101,100,32,110,117,109,98,101,114,44,32,103,111,116,32,39,32,43,32,115,116,100,46,116,121,112,101,40,97,41,10,32,32,32,32,101,108,115,101,32,105,102,32,33,115,116,100,46,105,115,78,117,109,98,101,114,40,98,41,32,116,104,101,110,10,32,32,32,32,32,32,101,114,114,111,114,32,39,115,116,100,46,109,97,120,32,115,101,99,111,110,100,32,112,97,114,97,109,32,101,120,112,101,99,116,101,100,32,110,117,109,98,101,114,44,32,103,111,116,32,39,32,43,32,115,116,100,46,116,121,112,101,40,98,41,10,32,32,32,32,101,108,115,101,10,32,32,32,32,32,32,105,102,32,97,32,60,32,98,32,116,104,101,110,32,97,32,101,108,115,101,32,98,44,10,10,32,32,99,108,97,109,112,40,120,44,32,109,105,110,86,97,108,44,32,109,97,120,86,97,108,41,58,58,10,32,32,32,32,105,102,32,120,32,60,32,109,105,110,86,97,108,32,116,104,101,110,32,109,105,110,86,97,108,10,32,32,32,32,101,108,115,101,32,105,102,32,120,32,62,32,109,97,120,86,97,108,32,116,104,101,110,32,109,97,120,86,97,108,10,32,32,32,32,101,108,115,101,32,120,44,10,10,32,32,102,108,97,116,116,101,110,65,114,114,97,121,115,40,97,114,114,115,41,58,58,10,32,32,32,32,115,116,100,46,102,111,108,100,108,40,102,117,110,99,116,105,111,110,40,97,44,32,98,41,32,97,32,43,32,98,44,32,97,114,114,115,44,32,91,93,41,44,10,10,32,32,109,97,110,105,102,101,115,116,73,110,105,40,105,110,105,41,58,58,10,32,32,32,32,108,111,99,97,108,32,98,111,100,121,95,108,105,110,101,115,40,98,111,100,121,41,32,61,10,32,32,32,32,32,32,115,116,100,46,106,111,105,110,40,91,93,44,32,91,10,32,32,32,32,32,32,32,32,108,111,99,97,108,32,118,97,108,117,101,95,111,114,95,118,97,108,117,101,115,32,61,32,98,111,100,121,91,107,93,59,10,32,32,32,32,32,32,32,32,105,102,32,115,116,100,46,105,115,65,114,114,97,121,40,118,97,108,117,101,95,111,114,95,118,97,108,117,101,115,41,32,116,104,101,110,10,32,32,32,32,32,32,32,32,32,32,91,39,37,115,32,61,32,37,115,39,32,37,32,91,107,44,32,118,97,108,117,101,93,32,102,111,114,32,118,97,108,117,101,32,105,110,32,118,97,108,117,101,95,111,114,95,118,97,108,117,101,115,93,10,32,32,32,32,32,32,32,32,101,108,115,101,10,32,32,32,32,32,32,32,32,32,32,91,39,37,115,32,61,32,37,115,39,32,37,32,91,107,44,32,118,97,108,117,101,95,111,114,95,118,97,108,117,101,115,93,93,10,10,32,32,32,32,32,32,32,32,102,111,114,32,107,32,105,110,32,115,116,100,46,111,98,106,101,99,116,70,105,101,108,100,115,40,98,111,100,121,41,10,32,32,32,32,32,32,93,41,59,10,10,32,32,32,32,108,111,99,97,108,32,115,101,99,116,105,111,110,95,108,105,110,101,115,40,115,110,97,109,101,44,32,115,98,111,100,121,41,32,61,32,91,39,91,37,115,93,39,32,37,32,91,115,110,97,109,101,93,93,32,43,32,98,111,100,121,95,108,105,110,101,115,40,115,98,111,100,121,41,44,10,32,32,32,32,32,32,32,32,32,32,109,97,105,110,95,98,111,100,121,32,61,32,105,102,32,115,116,100,46,111,98,106,101,99,116,72,97,115,40,105,110,105,44,32,39,109,97,105,110,39,41,32,116,104,101,110,32,98,111,100,121,95,108,105,110,101,115,40,105,110,105,46,109,97,105,110,41,32,101,108,115,101,32,91,93,44,10,32,32,32,32,32,32,32,32,32,32,97,108,108,95,115,101,99,116,105,111,110,115,32,61,32,91,10,32,32,32,32,32,32,115,101,99,116,105,111,110,95,108,105,110,101,115,40,107,44,32,105,110,105,46,115,101,99,116,105,111,110,115,91,107,93,41,10,32,32,32,32,32,32,102,111,114,32,107,32,105,110,32,115,116,100,46,111,98,106,101,99,116,70,105,101,108,100,115,40,105,110,105,46,115,101,99,116,105,111,110,115,41,10,32,32,32,32,93,59,10,32,32,32,32,115,116,100,46,106,111,105,110,40,39,92,110,39,44,32,109,97,105,110,95,98,111,100,121,32,43,32,115,116,100,46,102,108,97,116,116,101,110,65,114,114,97,121,115,40,97,108,108,95,115,101,99,116,105,111,110,115,41,32,43,32,91,39,39,93,41,44,10,10,32,32,101,115,99,97,112,101,83,116,114,105,110,103,74,115,111,110,40,115,116,114,95,41,58,58,10,32,32,32,32,108,111,99,97,108,32,115,116,114,32,61,32,115,116,100,46,116,111,83,116,114,105,110,103,40,115,116,114,95,41,59,10,32,32,32,32,108,111,99,97,108,32,116,114,97,110,115,40,99,104,41,32,61,10,32,32,32,32,32,32,105,102,32,99,104,32,61,61,32,39,34,39,32,116,104,101,110,10,32,32,32,32,32,32,32,32,39,92,92,34,39,10,32,32,32,32,32,32,101,108,115,101,32,105,102,32,99,104,32,61,61,32,39,92,92,39,32,116,104,101,110,10,32,32,32,32,32,32,32,32,39,92,92,92,92,39,10,32,32,32,32,32,32,101,108,115,101,32,105,102,32,99,104,32,61,61,32,39,92,98,39,32,116,104,101,110,10,32,32,32,32,32,32,32,32,39,92,92,98,39,10,32,32,32,32,32,32,101,108,115,101,32,105,102,32,99,104,32,61,61,32,39,92,102,39,32,116,104,101,110,10,32,32,32,32,32,32,32,32,39,92,92,102,39,10,32,32,32,32,32,32,101,108,115,101,32,105,102,32,99,104,32,61,61,32,39,92,110,39,32,116,104,101,110,10,32,32,32,32,32,32,32,32,39,92,92,110,39,10,32,32,32,32,32,32,101,108,115,101,32,105,102,32,99,104,32,61,61,32,39,92,114,39,32,116,104,101,110,10,32,32,32,32,32,32,32,32,39,92,92,114,39,10,32,32,32,32,32,32,101,108,115,101,32,105,102,32,99,104,32,61,61,32,39,92,116,39,32,116,104,101,110,10,32,32,32,32,32,32,32,32,39,92,92,116,39,10,32,32,32,32,32,32,101,108,115,101,10,32,32,32,32,32,32,32,32,108,111,99,97,108,32,99,112,32,61,32,115,116,100,46,99,111,100,101,112,111,105,110,116,40,99,104,41,59,10,32,32,32,32,32,32,32,32,105,102,32,99,112,32,60,32,51,50,32,124,124,32,40,99,112,32,62,61,32,49,50,55,32,38,38,32,99,112,32,60,61,32,49,53,57,41,32,116,104,101,110,10,32,32,32,32,32,32,32,32,32,32,39,92,92,117,37,48,52,120,39,32,37,32,91,99,112,93,10,32,32,32,32,32,32,32,32,101,108,115,101,10,32,32,32,32,32,32,32,32,32,32,99,104,59,10,32,32,32,32,39,34,37,115,34,39,32,37,32,115,116,100,46,106,111,105,110,40,39,39,44,32,91,116,114,97,110,115,40,99,104,41,32,102,111,114,32,99,104,32,105,110,32,115,116,100,46,115,116,114,105,110,103,67,104,97,114,115,40,115,116,114,41,93,41,44,10,10,32,32,101,115,99,97,112,101,83,116,114,105,110,103,80,121,116,104,111,110,40,115,116,114,41,58,58,10,32,32,32,32,115,116,100,46,101,115,99,97,112,101,83,116,114,105,110,103,74,115,111,110,40,115,116,114,41,44,10,10,32,32,101,115,99,97,112,101,83,116,114,105,110,103,66,97,115,104,40,115,116,114,95,41,58,58,10,32,32,32,32,108,111,99,97,108,32,115,116,114,32,61,32,115,116,100,46,116,111,83,116,114,105,110,103,40,115,116,114,95,41,59,10,32,32,32,32,108,111,99,97,108,32,116,114,97,110,115,40,99,104,41,32,61,10,32,32,32,32,32,32,105,102,32,99,104,32,61,61,32,34,39,34,32,116,104,101,110,10,32,32,32,32,32,32,32,32,34,39,92,34,39,92,34,39,34,10,32,32,32,32,32,32,101,108,115,101,10,32,32,32,32,32,32,32,32,99,104,59,10,32,32,32,32,34,39,37,115,39,34,32,37,32,115,116,100,46,106,111,105,110,40,39,39,44,32,91,116,114,97,110,115,40,99,104,41,32,102,111,114,32,99,104,32,105,110,32,115,116,100,46,115,116,114,105,110,103,67,104,97,114,115,40,115,116,114,41,93,41,44,10,10,32,32,101,115,99,97,112,101,83,116,114,105,110,103,68,111,108,108,97,114,115,40,115,116,114,95,41,58,58,10,32,32,32,32,108,111,99,97,108,32,115,116,114,32,61,32,115,116,100,46,116,111,83,116,114,105,110,103,40,115,116,114,95,41,59,10,32,32,32,32,108,111,99,97,108,32,116,114,97,110,115,40,99,104,41,32,61,10,32,32,32,32,32,32,105,102,32,99,104,32,61,61,32,39,36,39,32,116,104,101,110,10,32,32,32,32,32,32,32,32,39,36,36,39,10,32,32,32,32,32,32,101,108,115,101,10,32,32,32,32,32,32,32,32,99,104,59,10,32,32,32,32,115,116,100,46,102,111,108,100,108,40,102,117,110,99,116,105,111,110,40,97,44,32,98,41,32,97,32,43,32,116,114,97,110,115,40,98,41,44,32,115,116,100,46,115,116,114,105,110,103,67,104,97,114,115,40,115,116,114,41,44,32,39,39,41,44,10,10,32,32,109,97,110,105,102,101,115,116,74,115,111,110,40,118,97,108,117,101,41,58,58,32,115,116,100,46,109,97,110,105,102,101,115,116,74,115,111,110,69,120,40,118,97,108,117,101,44,32,39,32,32,32,32,39,41,44,10,10,32,32,109,97,110,105,102,101,115,116,74,115,111,110,69,120,40,118,97,108,117,101,44,32,105,110,100,101,110,116,41,58,58,10,32,32,32,32,108,111,99,97,108,32,97,117,120,40,118,44,32,112,97,116,104,44,32,99,105,110,100,101,110,116,41,32,61,10,32,32,32,32,32,32,105,102,32,118,32,61,61,32,116,114,117,101,32,116,104,101,110,10,32,32,32,32,32,32,32,32,39,116,114,117,101,39,10,32,32,32,32,32,32,101,108,115,101,32,105,102,32,118,32,61,61,32,102,97,108,115,101,32,116,104,101,110,10,32,32,32,32,32,32,32,32,39,102,97,108,115,101,39,10,32,32,32,32,32,32,101,108,115,101,32,105,102,32,118,32,61,61,32,110,117,108,108,32,116,104,101,110,10,32,32,32,32,32,32,32,32,39,110,117,108,108,39,10,32,32,32,32,32,32,101,108,115,101,32,105,102,32,115,116,100,46,105,115,78,117,109,98,101,114,40,118,41,32,116,104,101,110,10,32,32,32,32,32,32,32,32,39,39,32,43,32,118,10,32,32,32,32,32,32,101,108,115,101,32,105,102,32,115,116,100,46,105,115,83,116,114,105,110,103,40,118,41,32,116,104,101,110,10,32,32,32,32,32,32,32,32,115,116,100,46,101,115,99,97,112,101,83,116,114,105,110,103,74,115,111,110,40,118,41,10,32,32,32,32,32,32,101,108,115,101,32,105,102,32,115,116,100,46,105,115,70,117,110,99,116,105,111,110,40,118,41,32,116,104,101,110,10,32,32,32,32,32,32,32,32,101,114,114,111,114,32,39,84,114,105,101,100,32,116,111,32,109,97,110,105,102,101,115,116,32,102,117,110,99,116,105,111,110,32,97,116,32,39,32,43,32,112,97,116,104,10,32,32,32,32,32,32,101,108,115,101,32,105,102,32,115,116,100,46,105,115,65,114,114,97,121,40,118,41,32,116,104,101,110,10,32,32,32,32,32,32,32,32,108,111,99,97,108,32,114,97,110,103,101,32,61,32,115,116,100,46,114,97,110,103,101,40,48,44,32,115,116,100,46,108,101,110,103,116,104,40,118,41,32,45,32,49,41,59,10,32,32,32,32,32,32,32,32,108,111,99,97,108,32,110,101,119,95,105,110,100,101,110,116,32,61,32,99,105,110,100,101,110,116,32,43,32,105,110,100,101,110,116,59,10,32,32,32,32,32,32,32,32,108,111,99,97,108,32,108,105,110,101,115,32,61,32,91,39,91,92,110,39,93,10,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,43,32,115,116,100,46,106,111,105,110,40,91,39,44,92,110,39,93,44,10,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,91,10,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,91,110,101,119,95,105,110,100,101,110,116,32,43,32,97,117,120,40,118,91,105,93,44,32,112,97,116,104,32,43,32,91,105,93,44,32,110,101,119,95,105,110,100,101,110,116,41,93,10,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,102,111,114,32,105,32,105,110,32,114,97,110,103,101,10,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,93,41,10,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,43,32,91,39,92,110,39,32,43,32,99,105,110,100,101,110,116,32,43,32,39,93,39,93,59,10,32,32,32,32,32,32,32,32,115,116,100,46,106,111,105,110,40,39,39,44,32,108,105,110,101,115,41,10,32,32,32,32,32,32,101,108,115,101,32,105,102,32,115,116,100,46,105,115,79,98,106,101,99,116,40,118,41,32,116,104,101,110,10,32,32,32,32,32,32,32,32,108,111,99,97,108,32,108,105,110,101,115,32,61,32,91,39,123,92,110,39,93,10,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,43,32,115,116,100,46,106,111,105,110,40,91,39,44,92,110,39,93,44,10,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,91,10,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,91,99,105,110,100,101,110,116,32,43,32,105,110,100,101,110,116,32,43,32,115,116,100,46,101,115,99,97,112,101,83,116,114,105,110,103,74,115,111,110,40,107,41,32,43,32,39,58,32,39,10,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,43,32,97,117,120,40,118,91,107,93,44,32,112,97,116,104,32,43,32,91,107,93,44,32,99,105,110,100,101,110,116,32,43,32,105,110,100,101,110,116,41,93,10,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,102,111,114,32,107,32,105,110,32,115,116,100,46,111,98,106,101,99,116,70,105,101,108,100,115,40,118,41,10,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,93,41,10,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,32,43,32,91,39,92,110,39,32,43,32,99,105,110,100,101,110,116,32,43,32,39,125,39,93,59,10,32,32,32,32,32,32,32,32,115,116,100,46,106,111,105,110,40,39,39,44,32,108,105,110,101,115,41,59,10,32,32,32,32,97,117,120,40,118,97,108,117,101,44,32,91,93,44,32,39,39,41,44,10,10,32,32,109,97,110,105,102,101,115,116,89,97,109,108,68,111,99,40,118,97,108,117,101,44,32,105,110,100,101,110,116,95,97,114,114,97,121,95,105,110,95,111,98,106,101,99,116,61,102,97,108,115,101,41,58,58,10,32,32,32,32,115,116,100,46,109,97,110,105,102,101,115,116,89,97,109,108,68,111,99,73,109,112,108,40,118,97,108,117,101,44,32,105,110,100,101,110,116,95,97,114,114,97,121,95,105,110,95,111,98,106,101,99,116,41,44,10,10,32,32,109,97,110,105,102,101,115,116,89,97,109,108,83,116,114,101,97,109,40,118,97,108,117,101,44,32,105,110,100,101,110,116,95,97,114,114,97,121,95,105,110,95,111,98,106,101,99,116,61,102,97,108,115,101,44,32,99,95,100,111,99,117,109,101,110,116,95,101,110,100,61,116,114,117,101,41,58,58,10,32,32,32,32,105,102,32,33,115,116,100,46,105,115,65,114,114,97,121,40,118,97,108,117,101,41,32,116,104,101,110,10,32,32,32,32,32,32,101,114,114,111,114,32,39,109,97,110,105,102,101,115,116,89,97,109,108,83,116,114,101,97,109,32,111,110,108,121,32,116,97,107,101,115,32,97,114,114,97,121,115,44,32,103,111,116,32,39,32,43,32,115,116,100,46,116,121,112,101,40,118,97,108,117,101,41,10,32,32,32,32,101,108,115,101,10,32,32,32,32,32,32,39,45,45,45,92,110,39,32,43,32,115,116,100,46,106,111,105,110,40,10,32,32,32,32,32,32,32,32,39,92,110,45,45,45,92,110,39,44,32,91,115,116,100,46,109,97,110,105,102,101,115,116,89,97,109,108,68,111,99,40,101,44,32,105,110,100,101,110,116,95,97,114,114,97,121,95,105,110,95,111,98,106,101,99,116,41,32,102,111,114,32,101,32,105,110,32,118,97,108,117,101,93,10,32,32,32,32,32,32,41,32,43,32,105,102,32,99,95,100,111,99,117,109,101,110,116,95,101,110,100,32,116,104,101,110,32,39,92,110,46,46,46,92,110,39,32,101,108,115,101,32,39,92,110,39,44,10,10,10,32,32,109,97,110,105,102,101,115,116,80,121,116,104,111,110,40,118,41,58,58,10,32,32,32,32,105,102,32,115,116,100,46,105,115,79,98,106,101,99,116,40,118,41,32,116,104,101,110,10,32,32,32,32,32,32,108,111,99,97,108,32,102,105,101,108,100,115,32,61,32,91,10,32,32,32,32,32,32,32,32,39,37,115,58,32,37,115,39,32,37,32,91,115,116,100,46,101,115,99,97,112,101,83,116,114,105,110,103,80,121,116,104,111,110,40,107,41,44,32,115,116,100,46,109,97,110,105,102,101,115,116,80,121,116,104,111,110,40,118,91,107,93,41,93,10,32,32,32,32,32,32,32,32,102,111,114,32,107,32,105,110,32,115,116,100,46,111,98,106,101,99,116,70,105,101,108,100,115,40,118,41,10,32,32,32,32,32,32,93,59,10,32,32,32,32,32,32,39,123,37,115,125,39,32,37,32,91,115,116,100,46,106,111,105,110,40,39,44,32,39,44,32,102,105,101,108,100,115,41,93,10,32,32,32,32,101,108,115,101,32,105,102,32,115,116,100,46,105,115,65,114,114,97,121,40,118,41,32,116,104,101,110,10,32,32,32,32,32,32,39,91,37,115,93,39,32,37,32,91,115,116,100,46,106,111,105,110,40,39,44,32,39,44,32,91,115,116,100,46,109,97,110,105,102,101,115,116,80,121,116,104,111,110,40,118,50,41,32,102,111,114,32,118,50,32,105,110,32,118,93,41,93,10,32,32,32,32,101,108,115,101,32,105,102,32,115,116,100,46,105,115,83,116,114,105,110,103,40,118,41,32,116,104,101,110,10,32,32,32,32,32,32,39,37,115,39,32,37,32,91,115,116,100,46,101,115,99,97,112,101,83,116,114,105,110,103,80,121,116,104,111,110,40,118,41,93,10,32,32,32,32,101,108,115,101,32,105,102,32,115,116,100,46,105,115,70,117,110,99,116,105,111,110,40,118,41,32,116,104,101,110,10,32,32,32,32,32,32,101,114,114,111,114,32,39,99,97,110,110,111,116,32,109,97,110,105,102,101,115,116,32,102,117,110,99,116,105,111,110,39,10,32,32,32,32,101,108,115,101,32,105,102,32,115,116,100,46,105,115,78,117,109,98,101,114,40,118,41,32,116,104,101,110,10,32,32,32,32,32,32,115,116,100,46,116,111,83,116,114,105,110,103,40,118,41,10,32,32,32,32,101,108,115,101,32,105,102,32,118,32,61,61,32,116,114,117,101,32,116,104,101,110,10,32,32,32,32,32,32,39,84,114,117,101,39,10,32,32,32,32,101,108,115,101,32,105,102,32,118,32,61,61,32,102,97,108,115,101,32,116,104,101,110,10,32,32,32,32,32,32,39,70,97,108,115,101,39,10,32,32,32,32,101,108,115,101,32,105,102,32,118,32,61,61,32,110,117,108,108,32,116,104,101,110,10,32,32,32,32,32,32,39,78,111,110,101,39,44,10,10,32,32,109,97,110,105,102,101,115,116,80,121,116,104,111,110,86,97,114,115,40,99,111,110,102,41,58,58,10,32,32,32,32,108,111,99,97,108,32,118,97,114,115,32,61,32,91,39,37,115,32,61,32,37,115,39,32,37,32,91,107,44,32,115,116,100,46,109,97,110,105,102,101,115,116,80,121,116,104,111,110,40,99,111,110,102,91,107,93,41,93,32,102,111,114,32,107,32,105,110,32,115,116,100,46,111,98,106,101,99,116,70,105,101,108,100,115,40,99,111,110,102,41,93,59,10,32,32,32,32,115,116,100,46,106,111,105,110,40,39,92,110,39,44,32,118,97,114,115,32,43,32,91,39,39,93,41,44,10,10,32,32,109,97,110,105,102,101,115,116,88,109,108,74,115,111,110,109,108,40,118,97,108,117,101,41,58,58,10,32,32,32,32,105,102,32,33,115,116,100,46,105,115,65,114,114,97,121,40,118,97,108,117,101,41,32,116,104,101,110,10,32,32,32,32,32,32,101,114,114,111,114,32,39,69,120,112,101,99,116,101,100,32,97,32,74,83,79,78,77,76,32,118,97,108,117,101,32,40,97,110,32,97,114,114,97,121,41,44,32,103,111,116,32,37,115,39,32,37,32,115,116,100,46,116,121,112,101,40,118,97,108,117,101,41,10,32,32,32,32,101,108,115,101,10,32,32,32,32,32,32,108,111,99,97,108,32,97,117,120,40,118,41,32,61,10,32,32,32,32,32,32,32,32,105,102,32,115,116,100,46,105,115,83,116,114,105,110,103,40,118,41,32,116,104,101,110,10,32,32,32,32,32,32,32,32,32,32,118,10,32,32,32,32,32,32,32,32,101,108,115,101,10,32,32,32,32,32,32,32,32,32,32,108,111,99,97,108,32,116,97,103,32,61,32,118,91,48,93,59,10,32,32,32,32,32,32,32,32,32,32,108,111,99,97,108,32,104,97,115,95,97,116,116,114,115,32,61,32,115,116,100,46,108,101,110,103,116,104,40,118,41,32,62,32,49,32,38,38,32,115,116,100,46,105,115,79,98,106,101,99,116,40,118,91,49,93,41,59,10,32,32,32,32,32,32,32,32,32,32,108,111,99,97,108,32,97,116,116,114,115,32,61,32,105,102,32,104,97,115,95,97,116,116,114,115,32,116,104,101,110,32,118,91,49,93,32,101,108,115,101,32,123,125,59,10,32,32,32,32,32,32,32,32,32,32,108,111,99,97,108,32,99,104,105,108,100,114,101,110,32,61,32,105,102,32,104,97,115,95,97,116,116,114,115,32,116,104,101,110,32,118,91,50,58,93,32,101,108,115,101,32,118,91,49,58,93,59,10,32,32,32,32,32,32,32,32,32,32,108,111,99,97,108,32,97,116,116,114,115,95,115,116,114,32,61,10,32,32,32,32,32,32,32,32,32,32,32,32,115,116,100,46,106,111,105,110,40,39,39,44,32,91,39,32,37,115,61,34,37,115,34,39,32,37,32,91,107,44,32,97,116,116,114,115,91,107,93,93,32,102,111,114,32,107,32,105,110,32,115,116,100,46,111,98,106,101,99,116,70,105,101,108,100,115,40,97,116,116,114,115,41,93,41,59,10,32,32,32,32,32,32,32,32,32,32,115,116,100,46,100,101,101,112,74,111,105,110,40,91,39,60,39,44,32,116,97,103,44,32,97,116,116,114,115,95,115,116,114,44,32,39,62,39,44,32,91,97,117,120,40,120,41,32,102,111,114,32,120,32,105,110,32,99,104,105,108,100,114,101,110,93,44,32,39,60,47,39,44,32,116,97,103,44,32,39,62,39,93,41,59,10,10,32,32,32,32,32,32,97,117,120,40,118,97,108,117,101,41,44,10,10,32,32,108,111,99,97,108,32,98,97,115,101,54,52,95,116,97,98,108,101,32,61,32,39,65,66,67,68,69,70,71,72,73,74,75,76,77,78,79,80,81,82,83,84,85,86,87,88,89,90,97,98,99,100,101,102,103,104,105,106,107,108,109,110,111,112,113,114,115,116,117,118,119,120,121,122,48,49,50,51,52,53,54,55,56,57,43,47,39,44,10,32,32,108,111,99,97,108,32,98,97,115,101,54,52,95,105,110,118,32,61,32,123,32,91,98,97,115,101,54,52,95,116,97,98,108,101,91,105,93,93,58,32,105,32,102,111,114,32,105,32,105,110,32,115,116,100,46,114,97,110,103,101,40,48,44,32,54,51,41,32,125,44,10,10,32,32,98,97,115,101,54,52,40,105,110,112,117,116,41,58,58,10,32,32,32,32,108,111,99,97,108,32,98,121,116,101,115,32,61,10,32,32,32,32,32,32,105,102,32,115,116,100,46,105,115,83,116,114,105,110,103,40,105,110,112,117,116,41,32,116,104,101,110,10,32,32,32,32,32,32,32,32,115,116,100,46,109,97,112,40,102,117,110,99,116,105,111,110,40,99,41,32,115,116,100,46,99,111,100,101,112,111,105,110,116,40,99,41,44,32,105,110,112,117,116,41,10,32,32,32,32,32,32,101,108,115,101,10,32,32,32,32,32,32,32,32,105,110,112,117,116,59,10,10,32,32,32,32,108,111,99,97,108,32,97,117,120,40,97,114,114,44,32,105,44,32,114,41,32,61,10,32,32,32,32,32,32,105,102,32,105,32,62,61,32,115,116,100,46,108,101,110,103,116,104,40,97,114,114,41,32,116,104,101,110,10,32,32,32,32,32,32,32,32,114,10,32,32,32,32,32,32,101,108,115,101,32,105,102,32,105,32,43,32,49,32,62,61,32,115,116,100,46,108,101,110,103,116,104,40,97,114,114,41,32,116,104,101,110,10,32,32,32,32,32,32,32,32,108,111,99,97,108,32,115,116,114,32,61,10,32,32,32,32,32,32,32,32,32,32,47,47,32,54,32,77,83,66,32,111,102,32,105,10,32,32,32,32,32,32,32,32,32,32,98,97,115,101,54,52,95,116,97,98,108,101,91,40,97,114,114,91,105,93,32,38,32,50,53,50,41,32,62,62,32,50,93,32,43,10,32,32,32,32,32,32,32,32,32,32,47,47,32,50,32,76,83,66,32,111,102,32,105,10,32,32,32,32,32,32,32,32,32,32,98,97,115,101,54,52,95,116,97,98,108,101,91,40,97,114,114,91,105,93,32,38,32,51,41,32,60,60,32,52,93,32,43,10,32,32,32,32,32,32,32,32,32,32,39,61,61,39,59,10,32,32,32,32,32,32,32,32,97,117,120,40,97,114,114,44,32,105,32,43,32,51,44,32,114,32,43,32,115,116,114,41,32,116,97,105,108,115,116,114,105,99,116,10,32,32,32,32,32,32,101,108,115,101,32,105,102,32,105,32,43,32,50,32,62,61,32,115,116,100,46,108,101,110,103,116,104,40,97,114,114,41,32,116,104,101,110,10,32,32,32,32,32,32,32,32,108,111,99,97,108,32,115,116,114,32,61,10,32,32,32,32,32,32,32,32,32,32,47,47,32,54,32,77,83,66,32,111,102,32,105,10,32,32,32,32,32,32,32,32,32,32,98,97,115,101,54,52,95,116,97,98,108,101,91,40,97,114,114,91,105,93,32,38,32,50,53,50,41,32,62,62,32,50,93,32,43,10,32,32,32,32,32,32,32,32,32,32,47,47,32,50,32,76,83,66,32,111,102,32,105,44,32,52,32,77,83,66,32,111,102,32,105,43,49,10,32,32,32,32,32,32,32,32,32,32,98,97,115,101,54,52,95,116,97,98,108,101,91,40,97,114,114,91,105,93,32,38,32,51,41,32,60,60,32,52,32,124,32,40,97,114,114,91,105,32,43,32,49,93,32,38,32,50,52,48,41,32,62,62,32,52,93,32,43,10,32,32,32,32,32,32,32,32,32,32,47,47,32,52,32,76,83,66,32,111,102,32,105,43,49,10,32,32,32,32,32,32,32,32,32,32,98,97,115,101,54,52,95,116,97,98,108,101,91,40,97,114,114,91,105,32,43,32,49,93,32,38,32,49,53,41,32,60,60,32,50,93,32,43,10,32,32,32,32,32,32,32,32,32,32,39,61,39,59,10,32,32,32,32,32,32,32,32,97,117,120,40,97,114,114,44,32,105,32,43,32,51,44,32,114,32,43,32,115,116,114,41,32,116,97,105,108,115,116,114,105,99,116,10,32,32,32,32,32,32,101,108,115,101,10,32,32,32,32,32,32,32,32,108,111,99,97,108,32,115,116,114,32,61,10,32,32,32,32,32,32,32,32,32,32,47,47,32,54,32,77,83,66,32,111,102,32,105,10,32,32,32,32,32,32,32,32,32,32,98,97,115,101,54,52,95,116,97,98,108,101,91,40,97,114,114,91,105,93,32,38,32,50,53,50,41,32,62,62,32,50,93,32,43,10,32,32,32,32,32,32,32,32,32,32,47,47,32,50,32,76,83,66,32,111,102,32,105,44,32,52,32,77,83,66,32,111,102,32,105,43,49,10,32,32,32,32,32,32,32,32,32,32,98,97,115,101,54,52,95,116,97,98,108,101,91,40,97,114,114,91,105,93,32,38,32,51,41,32,60,60,32,52,32,124,32,40,97,114,114,91,105,32,43,32,49,93,32,38,32,50,52,48,41,32,62,62,32,52,93,32,43,10,32,32,32,32,32,32,32,32,32,32,47,47,32,52,32,76,83,66,32,111,102,32,105,43,49,44,32,50,32,77,83,66,32,111,102,32,105,43,50,10,32,32,32,32,32,32,32,32,32,32,98,97,115,101,54,52,95,116,97,98,108,101,91,40,97,114,114,91,105,32,43,32,49,93,32,38,32,49,53,41,32,60,60,32,50,32,124,32,40,97,114,114,91,105,32,43,32,50,93,32,38,32,49,57,50,41,32,62,62,32,54,93,32,43,10,32,32,32,32,32,32,32,32,32,32,47,47,32,54,32,76,83,66,32,111,102,32,105,43,50,10,32,32,32,32,32,32,32,32,32,32,98,97,115,101,54,52,95,116,97,98,108,101,91,40,97,114,114,91,105,32,43,32,50,93,32,38,32,54,51,41,93,59,10,32,32,32,32,32,32,32,32,97,117,120,40,97,114,114,44,32,105,32,43,32,51,44,32,114,32,43,32,115,116,114,41,32,116,97,105,108,115,116,114,105,99,116,59,10,10,32,32,32,32,108,111,99,97,108,32,115,97,110,105,116,121,32,61,32,115,116,100,46,102,111,108,100,108,40,102,117,110,99,116,105,111,110,40,114,44,32,97,41,32,114,32,38,38,32,40,97,32,60,32,50,53,54,41,44,32,98,121,116,101,115,44,32,116,114,117,101,41,59,10,32,32,32,32,105,102,32,33,115,97,110,105,116,121,32,116,104,101,110,10,32,32,32,32,32,32,101,114,114,111,114,32,39,67,97,110,32,111,110,108,121,32,98,97,115,101,54,52,32,101,110,99,111,100,101,32,115,116,114,105,110,103,115,32,47,32,97,114,114,97,121,115,32,111,102,32,115,105,110,103,108,101,32,98,121,116,101,115,46,39,10,32,32,32,32,101,108,115,101,10,32,32,32,32,32,32,97,117,120,40,98,121,116,101,115,44,32,48,44,32,39,39,41,44,10,10,10,32,32,98,97,115,101,54,52,68,101,99,111,100,101,66,121,116,101,115,40,115,116,114,41,58,58,10,32,32,32,32,105,102,32,115,116,100,46,108,101,110,103,116,104,40,115,116,114,41,32,37,32,52,32,33,61,32,48,32,116,104,101,110,10,32,32,32,32,32,32,101,114,114,111,114,32,39,78,111,116,32,97,32,98,97,115,101,54,52,32,101,110,99,111,100,101,100,32,115,116,114,105,110,103,32,34,37,115,34,39,32,37,32,115,116,114,10,32,32,32,32,101,108,115,101,10,32,32,32,32,32,32,108,111,99,97,108,32,97,117,120,40,115,116,114,44,32,105,44,32,114,41,32,61,10,32,32,32,32,32,32,32,32,105,102,32,105,32,62,61,32,115,116,100,46,108,101,110,103,116,104,40,115,116,114,41,32,116,104,101,110,10,32,32,32,32,32,32,32,32,32,32,114,10,32,32,32,32,32,32,32,32,101,108,115,101,10,32,32,32,32,32,32,32,32,32,32,47,47,32,97,108,108,32,54,32,98,105,116,115,32,111,102,32,105,44,32,50,32,77,83,66,32,111,102,32,105,43,49,10,32,32,32,32,32,32,32,32,32,32,108,111,99,97,108,32,110,49,32,61,32,91,98,97,115,101,54,52,95,105,110,118,91,115,116,114,91,105,93,93,32,60,60,32,50,32,124,32,40,98,97,115,101,54,52,95,105,110,118,91,115,116,114,91,105,32,43,32,49,93,93,32,62,62,32,52,41,93,59,10,32,32,32,32,32,32,32,32,32,32,47,47,32,52,32,76,83,66,32,111,102,32,105,43,49,44,32,52,77,83,66,32,111,102,32,105,43,50,10,32,32,32,32,32,32,32,32,32,32,108,111,99,97,108,32,110,50,32,61,10,32,32,32,32,32,32,32,32,32,32,32,32,105,102,32,115,116,114,91,105,32,43,32,50,93,32,61,61,32,39,61,39,32,116,104,101,110,32,91,93,10,32,32,32,32,32,32,32,32,32,32,32,32,101,108,115,101,32,91,40,98,97,115,101,54,52,95,105,110,118,91,115,116,114,91,105,32,43,32,49,93,93,32,38,32,49,53,41,32,60,60,32,52,32,124,32,40,98,97,115,101,54,52,95,105,110,118,91,115,116,114,91,105,32,43,32,50,93,93,32,62,62,32,50,41,93,59,10,32,32,32,32,32,32,32,32,32,32,47,47,32,50,32,76,83,66,32,111,102,32,105,43,50,44,32,97,108,108,32,54,32,98,105,116,115,32,111,102,32,105,43,51,10,32,32,32,32,32,32,32,32,32,32,108,111,99,97,108,32,110,51,32,61,10,32,32,32,32,32,32,32,32,32,32,32,32,105,102,32,115,116,114,91,105,32,43,32,51,93,32,61,61,32,39,61,39,32,116,104,101,110,32,91,93,10,32,32,32,32,32,32,32,32,32,32,32,32,101,108,115,101,32,91,40,98,97,115,101,54,52,95,105,110,118,91,115,116,114,91,105,32,43,32,50,93,93,32,38,32,51,41,32,60,60,32,54,32,124,32,98,97,115,101,54,52,95,105,110,118,91,115,116,114,91,105,32,43,32,51,93,93,93,59,10,32,32,32,32,32,32,32,32,32,32,97,117,120,40,115,116,114,44,32,105,32,43,32,52,44,32,114,32,43,32,110,49,32,43,32,110,50,32,43,32,110,51,41,32,116,97,105,108,115,116,114,105,99,116,59,10,32,32,32,32,32,32,97,117,120,40,115,116,114,44,32,48,44,32,91,93,41,44,10,10,32,32,98,97,115,101,54,52,68,101,99,111,100,101,40,115,116,114,41,58,58,10,32,32,32,32,108,111,99,97,108,32,98,121,116,101,115,32,61,32,115,116,100,46,98,97,115,101,54,52,68,101,99,111,100,101,66,121,116,101,115,40,115,116,114,41,59,10,32,32,32,32,115,116,100,46,106,111,105,110,40,39,39,44,32,115,116,100,46,109,97,112,40,102,117,110,99,116,105,111,110,40,98,41,32,115,116,100,46,99,104,97,114,40,98,41,44,32,98,121,116,101,115,41,41,44,10,10,32,32,114,101,118,101,114,115,101,40,97,114,114,41,58,58,10,32,32,32,32,108,111,99,97,108,32,108,32,61,32,115,116,100,46,108,101,110,103,116,104,40,97,114,114,41,59,10,32,32,32,32,115,116,100,46,109,97,107,101,65,114,114,97,121,40,108,44,32,102,117,110,99,116,105,111,110,40,105,41,32,97,114,114,91,108,32,45,32,105,32,45,32,49,93,41,44,10,10,32,32,115,111,114,116,40,97,114,114,44,32,107,101,121,70,61,105,100,41,58,58,10,32,32,32,32,115,116,100,46,115,111,114,116,73,109,112,108,40,97,114,114,44,32,107,101,121,70,41,44,10,10,32,32,117,110,105,113,40,97,114,114,44,32,107,101,121,70,61,105,100,41,58,58,10,32,32,32,32,115,116,100,46,117,110,105,113,73,109,112,108,40,97,114,114,44,32,107,101,121,70,41,44,10,10,32,32,115,101,116,40,97,114,114,44,32,107,101,121,70,61,105,100,41,58,58,10,32,32,32,32,115,116,100,46,117,110,105,113,40,115,116,100,46,115,111,114,116,40,97,114,114,44,32,107,101,121,70,41,44,32,107,101,121,70,41,44,10,10,32,32,115,101,116,77,101,109,98,101,114,40,120,44,32,97,114,114,44,32,107,101,121,70,61,105,100,41,58,58,10,32,32,32,32,47,47,32,84,79,68,79,40,100,99,117,110,110,105,110,41,58,32,66,105,110,97,114,121,32,99,104,111,112,32,102,111,114,32,79,40,108,111,103,32,110,41,32,99,111,109,112,108,101,120,105,116,121,10,32,32,32,32,115,116,100,46,108,101,110,103,116,104,40,115,116,100,46,115,101,116,73,110,116,101,114,40,91,120,93,44,32,97,114,114,44,32,107,101,121,70,41,41,32,62,32,48,44,10,10,32,32,115,101,116,85,110,105,111,110,40,97,44,32,98,44,32,107,101,121,70,61,105,100,41,58,58,10,32,32,32,32,47,47,32,78,79,84,69,58,32,111,114,100,101,114,32,109,97,116,116,101,114,115,44,32,118,97,108,117,101,115,32,105,110,32,96,97,96,32,119,105,110,10,32,32,32,32,115,116,100,46,115,101,116,85,110,105,111,110,73,109,112,108,40,97,44,32,98,44,32,107,101,121,70,41,44,10,10,32,32,115,101,116,73,110,116,101,114,40,97,44,32,98,44,32,107,101,121,70,61,105,100,41,58,58,10,32,32,32,32,115,116,100,46,115,101,116,73,110,116,101,114,73,109,112,108,40,97,44,32,98,44,32,107,101,121,70,41,44,10,10,32,32,115,101,116,68,105,102,102,40,97,44,32,98,44,32,107,101,121,70,61,105,100,41,58,58,10,32,32,32,32,115,116,100,46,115,101,116,68,105,102,102,73,109,112,108,40,97,44,32,98,44,32,107,101,121,70,41,44,10,10,32,32,109,101,114,103,101,80,97,116,99,104,40,116,97,114,103,101,116,44,32,112,97,116,99,104,41,58,58,10,32,32,32,32,105,102,32,115,116,100,46,105,115,79,98,106,101,99,116,40,112,97,116,99,104,41,32,116,104,101,110,10,32,32,32,32,32,32,108,111,99,97,108,32,116,97,114,103,101,116,95,111,98,106,101,99,116,32,61,10,32,32,32,32,32,32,32,32,105,102,32,115,116,100,46,105,115,79,98,106,101,99,116,40,116,97,114,103,101,116,41,32,116,104,101,110,32,116,97,114,103,101,116,32,101,108,115,101,32,123,125,59,10,10,32,32,32,32,32,32,108,111,99,97,108,32,116,97,114,103,101,116,95,102,105,101,108,100,115,32,61,10,32,32,32,32,32,32,32,32,105,102,32,115,116,100,46,105,115,79,98,106,101,99,116,40,116,97,114,103,101,116,95,111,98,106,101,99,116,41,32,116,104,101,110,32,115,116,100,46,111,98,106,101,99,116,70,105,101,108,100,115,40,116,97,114,103,101,116,95,111,98,106,101,99,116,41,32,101,108,115,101,32,91,93,59,10,10,32,32,32,32,32,32,108,111,99,97,108,32,110,117,108,108,95,102,105,101,108,100,115,32,61,32,91,107,32,102,111,114,32,107,32,105,110,32,115,116,100,46,111,98,106,101,99,116,70,105,101,108,100,115,40,112,97,116,99,104,41,32,105,102,32,112,97,116,99,104,91,107,93,32,61,61,32,110,117,108,108,93,59,10,32,32,32,32,32,32,108,111,99,97,108,32,98,111,116,104,95,102,105,101,108,100,115,32,61,32,115,116,100,46,115,101,116,85,110,105,111,110,40,116,97,114,103,101,116,95,102,105,101,108,100,115,44,32,115,116,100,46,111,98,106,101,99,116,70,105,101,108,100,115,40,112,97,116,99,104,41,41,59,10,10,32,32,32,32,32,32,123,10,32,32,32,32,32,32,32,32,91,107,93,58,10,32,32,32,32,32,32,32,32,32,32,105,102,32,33,115,116,100,46,111,98,106,101,99,116,72,97,115,40,112,97,116,99,104,44,32,107,41,32,116,104,101,110,10,32,32,32,32,32,32,32,32,32,32,32,32,116,97,114,103,101,116,95,111,98,106,101,99,116,91,107,93,10,32,32,32,32,32,32,32,32,32,32,101,108,115,101,32,105,102,32,33,115,116,100,46,111,98,106,101,99,116,72,97,115,40,116,97,114,103,101,116,95,111,98,106,101,99,116,44,32,107,41,32,116,104,101,110,10,32,32,32,32,32,32,32,32,32,32,32,32,115,116,100,46,109,101,114,103,101,80,97,116,99,104,40,110,117,108,108,44,32,112,97,116,99,104,91,107,93,41,32,116,97,105,108,115,116,114,105,99,116,10,32,32,32,32,32,32,32,32,32,32,101,108,115,101,10,32,32,32,32,32,32,32,32,32,32,32,32,115,116,100,46,109,101,114,103,101,80,97,116,99,104,40,116,97,114,103,101,116,95,111,98,106,101,99,116,91,107,93,44,32,112,97,116,99,104,91,107,93,41,32,116,97,105,108,115,116,114,105,99,116,10,32,32,32,32,32,32,32,32,102,111,114,32,107,32,105,110,32,115,116,100,46,115,101,116,68,105,102,102,40,98,111,116,104,95,102,105,101,108,100,115,44,32,110,117,108,108,95,102,105,101,108,100,115,41,10,32,32,32,32,32,32,125,10,32,32,32,32,101,108,115,101,10,32,32,32,32,32,32,112,97,116,99,104,44,10,10,32,32,111,98,106,101,99,116,70,105,101,108,100,115,40,111,41,58,58,10,32,32,32,32,115,116,100,46,111,98,106,101,99,116,70,105,101,108,100,115,69,120,40,111,44,32,102,97,108,115,101,41,44,10,10,32,32,111,98,106,101,99,116,70,105,101,108,100,115,65,108,108,40,111,41,58,58,10,32,32,32,32,115,116,100,46,111,98,106,101,99,116,70,105,101,108,100,115,69,120,40,111,44,32,116,114,117,101,41,44,10,10,32,32,111,98,106,101,99,116,72,97,115,40,111,44,32,102,41,58,58,10,32,32,32,32,115,116,100,46,111,98,106,101,99,116,72,97,115,69,120,40,111,44,32,102,44,32,102,97,108,115,101,41,44,10,10,32,32,111,98,106,101,99,116,72,97,115,65,108,108,40,111,44,32,102,41,58,58,10,32,32,32,32,115,116,100,46,111,98,106,101,99,116,72,97,115,69,120,40,111,44,32,102,44,32,116,114,117,101,41,44,10,10,32,32,111,98,106,101,99,116,86,97,108,117,101,115,40,111,41,58,58,10,32,32,32,32,91,111,91,107,93,32,102,111,114,32,107,32,105,110,32,115,116,100,46,111,98,106,101,99,116,70,105,101,108,100,115,40,111,41,93,44,10,10,32,32,111,98,106,101,99,116,86,97,108,117,101,115,65,108,108,40,111,41,58,58,10,32,32,32,32,91,111,91,107,93,32,102,111,114,32,107,32,105,110,32,115,116,100,46,111,98,106,101,99,116,70,105,101,108,100,115,65,108,108,40,111,41,93,44,10,10,32,32,101,113,117,97,108,115,40,97,44,32,98,41,58,58,10,32,32,32,32,108,111,99,97,108,32,116,97,32,61,32,115,116,100,46,116,121,112,101,40,97,41,59,10,32,32,32,32,108,111,99,97,108,32,116,98,32,61,32,115,116,100,46,116,121,112,101,40,98,41,59,10,32,32,32,32,105,102,32,33,115,116,100,46,112,114,105,109,105,116,105,118,101,69,113,117,97,108,115,40,116,97,44,32,116,98,41,32,116,104,101,110,10,32,32,32,32,32,32,102,97,108,115,101,10,32,32,32,32,101,108,115,101,10,32,32,32,32,32,32,105,102,32,115,116,100,46,112,114,105,109,105,116,105,118,101,69,113,117,97,108,115,40,116,97,44,32,39,97,114,114,97,121,39,41,32,116,104,101,110,10,32,32,32,32,32,32,32,32,108,111,99,97,108,32,108,97,32,61,32,115,116,100,46,108,101,110,103,116,104,40,97,41,59,10,32,32,32,32,32,32,32,32,105,102,32,33,115,116,100,46,112,114,105,109,105,116,105,118,101,69,113,117,97,108,115,40,108,97,44,32,115,116,100,46,108,101,110,103,116,104,40,98,41,41,32,116,104,101,110,10,32,32,32,32,32,32,32,32,32,32,102,97,108,115,101,10,32,32,32,32,32,32,32,32,101,108,115,101,10,32,32,32,32,32,32,32,32,32,32,108,111,99,97,108,32,97,117,120,40,97,44,32,98,44,32,105,41,32,61,10,32,32,32,32,32,32,32,32,32,32,32,32,105,102,32,105,32,62,61,32,108,97,32,116,104,101,110,10,32,32,32,32,32,32,32,32,32,32,32,32,32,32,116,114,117,101,10,32,32,32,32,32,32,32,32,32,32,32,32,101,108,115,101,32,105,102,32,97,91,105,93,32,33,61,32,98,91,105,93,32,116,104,101,110,10,32,32,32,32,32,32,32,32,32,32,32,32,32,32,102,97,108,115,101,10,32,32,32,32,32,32,32,32,32,32,32,32,101,108,115,101,10,32,32,32,32,32,32,32,32,32,32,32,32,32,32,97,117,120,40,97,44,32,98,44,32,105,32,43,32,49,41,32,116,97,105,108,115,116,114,105,99,116,59,10,32,32,32,32,32,32,32,32,32,32,97,117,120,40,97,44,32,98,44,32,48,41,10,32,32,32,32,32,32,101,108,115,101,32,105,102,32,115,116,100,46,112,114,105,109,105,116,105,118,101,69,113,117,97,108,115,40,116,97,44,32,39,111,98,106,101,99,116,39,41,32,116,104,101,110,10,32,32,32,32,32,32,32,32,108,111,99,97,108,32,102,105,101,108,100,115,32,61,32,115,116,100,46,111,98,106,101,99,116,70,105,101,108,100,115,40,97,41,59,10,32,32,32,32,32,32,32,32,108,111,99,97,108,32,108,102,105,101,108,100,115,32,61,32,115,116,100,46,108,101,110,103,116,104,40,102,105,101,108,100,115,41,59,10,32,32,32,32,32,32,32,32,105,102,32,102,105,101,108,100,115,32,33,61,32,115,116,100,46,111,98,106,101,99,116,70,105,101,108,100,115,40,98,41,32,116,104,101,110,10,32,32,32,32,32,32,32,32,32,32,102,97,108,115,101,10,32,32,32,32,32,32,32,32,101,108,115,101,10,32,32,32,32,32,32,32,32,32,32,108,111,99,97,108,32,97,117,120,40,97,44,32,98,44,32,105,41,32,61,10,32,32,32,32,32,32,32,32,32,32,32,32,105,102,32,105,32,62,61,32,108,102,105,101,108,100,115,32,116,104,101,110,10,32,32,32,32,32,32,32,32,32,32,32,32,32,32,116,114,117,101,10,32,32,32,32,32,32,32,32,32,32,32,32,101,108,115,101,32,105,102,32,108,111,99,97,108,32,102,32,61,32,102,105,101,108,100,115,91,105,93,59,32,97,91,102,93,32,33,61,32,98,91,102,93,32,116,104,101,110,10,32,32,32,32,32,32,32,32,32,32,32,32,32,32,102,97,108,115,101,10,32,32,32,32,32,32,32,32,32,32,32,32,101,108,115,101,10,32,32,32,32,32,32,32,32,32,32,32,32,32,32,97,117,120,40,97,44,32,98,44,32,105,32,43,32,49,41,32,116,97,105,108,115,116,114,105,99,116,59,10,32,32,32,32,32,32,32,32,32,32,97,117,120,40,97,44,32,98,44,32,48,41,10,32,32,32,32,32,32,101,108,115,101,10,32,32,32,32,32,32,32,32,115,116,100,46,112,114,105,109,105,116,105,118,101,69,113,117,97,108,115,40,97,44,32,98,41,44,10,10,10,32,32,114,101,115,111,108,118,101,80,97,116,104,40,102,44,32,114,41,58,58,10,32,32,32,32,108,111,99,97,108,32,97,114,114,32,61,32,115,116,100,46,115,112,108,105,116,40,102,44,32,39,47,39,41,59,10,32,32,32,32,115,116,100,46,106,111,105,110,40,39,47,39,44,32,115,116,100,46,109,97,107,101,65,114,114,97,121,40,115,116,100,46,108,101,110,103,116,104,40,97,114,114,41,32,45,32,49,44,32,102,117,110,99,116,105,111,110,40,105,41,32,97,114,114,91,105,93,41,32,43,32,91,114,93,41,44,10,10,32,32,112,114,117,110,101,40,97,41,58,58,10,32,32,32,32,108,111,99,97,108,32,105,115,67,111,110,116,101,110,116,40,98,41,32,61,10,32,32,32,32,32,32,105,102,32,98,32,61,61,32,110,117,108,108,32,116,104,101,110,10,32,32,32,32,32,32,32,32,102,97,108,115,101,10,32,32,32,32,32,32,101,108,115,101,32,105,102,32,115,116,100,46,105,115,65,114,114,97,121,40,98,41,32,116,104,101,110,10,32,32,32,32,32,32,32,32,115,116,100,46,108,101,110,103,116,104,40,98,41,32,62,32,48,10,32,32,32,32,32,32,101,108,115,101,32,105,102,32,115,116,100,46,105,115,79,98,106,101,99,116,40,98,41,32,116,104,101,110,10,32,32,32,32,32,32,32,32,115,116,100,46,108,101,110,103,116,104,40,98,41,32,62,32,48,10,32,32,32,32,32,32,101,108,115,101,10,32,32,32,32,32,32,32,32,116,114,117,101,59,10,32,32,32,32,105,102,32,115,116,100,46,105,115,65,114,114,97,121,40,97,41,32,116,104,101,110,10,32,32,32,32,32,32,91,115,116,100,46,112,114,117,110,101,40,120,41,32,102,111,114,32,120,32,105,110,32,97,32,105,102,32,105,115,67,111,110,116,101,110,116,40,36,46,112,114,117,110,101,40,120,41,41,93,10,32,32,32,32,101,108,115,101,32,105,102,32,115,116,100,46,105,115,79,98,106,101,99,116,40,97,41,32,116,104,101,110,32,123,10,32,32,32,32,32,32,91,120,93,58,32,36,46,112,114,117,110,101,40,97,91,120,93,41,10,32,32,32,32,32,32,102,111,114,32,120,32,105,110,32,115,116,100,46,111,98,106,101,99,116,70,105,101,108,100,115,40,97,41,10,32,32,32,32,32,32,105,102,32,105,115,67,111,110,116,101,110,116,40,115,116,100,46,112,114,117,110,101,40,97,91,120,93,41,41,10,32,32,32,32,125,32,101,108,115,101,10,32,32,32,32,32,32,97,44,10,10,32,32,102,105,110,100,83,117,98,115,116,114,40,112,97,116,44,32,115,116,114,41,58,58,10,32,32,32,32,105,102,32,33,115,116,100,46,105,115,83,116,114,105,110,103,40,112,97,116,41,32,116,104,101,110,10,32,32,32,32,32,32,101,114,114,111,114,32,39,102,105,110,100,83,117,98,115,116,114,32,102,105,114,115,116,32,112,97,114,97,109,101,116,101,114,32,115,104,111,117,108,100,32,98,101,32,97,32,115,116,114,105,110,103,44,32,103,111,116,32,39,32,43,32,115,116,100,46,116,121,112,101,40,112,97,116,41,10,32,32,32,32,101,108,115,101,32,105,102,32,33,115,116,100,46,105,115,83,116,114,105,110,103,40,115,116,114,41,32,116,104,101,110,10,32,32,32,32,32,32,101,114,114,111,114,32,39,102,105,110,100,83,117,98,115,116,114,32,115,101,99,111,110,100,32,112,97,114,97,109,101,116,101,114,32,115,104,111,117,108,100,32,98,101,32,97,32,115,116,114,105,110,103,44,32,103,111,116,32,39,32,43,32,115,116,100,46,116,121,112,101,40,115,116,114,41,10,32,32,32,32,101,108,115,101,10,32,32,32,32,32,32,108,111,99,97,108,32,112,97,116,95,108,101,110,32,61,32,115,116,100,46,108,101,110,103,116,104,40,112,97,116,41,59,10,32,32,32,32,32,32,108,111,99,97,108,32,115,116,114,95,108,101,110,32,61,32,115,116,100,46,108,101,110,103,116,104,40,115,116,114,41,59,10,32,32,32,32,32,32,105,102,32,112,97,116,95,108,101,110,32,61,61,32,48,32,124,124,32,115,116,114,95,108,101,110,32,61,61,32,48,32,124,124,32,112,97,116,95,108,101,110,32,62,32,115,116,114,95,108,101,110,32,116,104,101,110,10,32,32,32,32,32,32,32,32,91,93,10,32,32,32,32,32,32,101,108,115,101,10,32,32,32,32,32,32,32,32,115,116,100,46,102,105,108,116,101,114,40,102,117,110,99,116,105,111,110,40,105,41,32,115,116,114,91,105,58,105,32,43,32,112,97,116,95,108,101,110,93,32,61,61,32,112,97,116,44,32,115,116,100,46,114,97,110,103,101,40,48,44,32,115,116,114,95,108,101,110,32,45,32,112,97,116,95,108,101,110,41,41,44,10,10,32,32,102,105,110,100,40,118,97,108,117,101,44,32,97,114,114,41,58,58,10,32,32,32,32,105,102,32,33,115,116,100,46,105,115,65,114,114,97,121,40,97,114,114,41,32,116,104,101,110,10,32,32,32,32,32,32,101,114,114,111,114,32,39,102,105,110,100,32,115,101,99,111,110,100,32,112,97,114,97,109,101,116,101,114,32,115,104,111,117,108,100,32,98,101,32,97,110,32,97,114,114,97,121,44,32,103,111,116,32,39,32,43,32,115,116,100,46,116,121,112,101,40,97,114,114,41,10,32,32,32,32,101,108,115,101,10,32,32,32,32,32,32,115,116,100,46,102,105,108,116,101,114,40,102,117,110,99,116,105,111,110,40,105,41,32,97,114,114,91,105,93,32,61,61,32,118,97,108,117,101,44,32,115,116,100,46,114,97,110,103,101,40,48,44,32,115,116,100,46,108,101,110,103,116,104,40,97,114,114,41,32,45,32,49,41,41,44,10,125,10,0
+
@@ -62,20 +62,21 @@ static inline int encode_utf8(char32_t x, std::string &s)
     }
 }
 
-/** Convert the UTF8 byte sequence in the given string to a unicode code point.
+/** Convert the UTF8 byte sequence in the given buffer to a unicode code point.
  *
- * \param str The string.
- * \param i The index of the string from which to start decoding and returns the index of the last
+ * \param str The buffer.
+ * \param length The length of the buffer.
+ * \param i The index of the buffer from which to start decoding and returns the index of the last
  *          byte of the encoded codepoint.
  * \returns The decoded unicode codepoint.
  */
-static inline char32_t decode_utf8(const std::string &str, size_t &i)
+static inline char32_t decode_utf8(const char *str, size_t length, size_t &i)
 {
     char c0 = str[i];
     if ((c0 & 0x80) == 0) {  // 0xxxxxxx
         return c0;
     } else if ((c0 & 0xE0) == 0xC0) {  // 110yyyxx 10xxxxxx
-        if (i + 1 >= str.length()) {
+        if (i + 1 >= length) {
             return JSONNET_CODEPOINT_ERROR;
         }
         char c1 = str[++i];
@@ -84,7 +85,7 @@ static inline char32_t decode_utf8(const std::string &str, size_t &i)
         }
         return ((c0 & 0x1F) << 6ul) | (c1 & 0x3F);
     } else if ((c0 & 0xF0) == 0xE0) {  // 1110yyyy 10yyyyxx 10xxxxxx
-        if (i + 2 >= str.length()) {
+        if (i + 2 >= length) {
             return JSONNET_CODEPOINT_ERROR;
         }
         char c1 = str[++i];
@@ -97,7 +98,7 @@ static inline char32_t decode_utf8(const std::string &str, size_t &i)
         }
         return ((c0 & 0xF) << 12ul) | ((c1 & 0x3F) << 6) | (c2 & 0x3F);
     } else if ((c0 & 0xF8) == 0xF0) {  // 11110zzz 10zzyyyy 10yyyyxx 10xxxxxx
-        if (i + 3 >= str.length()) {
+        if (i + 3 >= length) {
             return JSONNET_CODEPOINT_ERROR;
         }
         char c1 = str[++i];
@@ -118,6 +119,18 @@ static inline char32_t decode_utf8(const std::string &str, size_t &i)
     }
 }
 
+/** Convert the UTF8 byte sequence in the given string to a unicode code point.
+ *
+ * \param str The string.
+ * \param i The index of the string from which to start decoding and returns the index of the last
+ *          byte of the encoded codepoint.
+ * \returns The decoded unicode codepoint.
+ */
+static inline char32_t decode_utf8(const std::string &str, size_t &i)
+{
+    return decode_utf8(str.data(), str.length(), i);
+}
+
 /** A string class capable of holding unicode codepoints. */
 typedef std::basic_string<char32_t> UString;
 
@@ -134,14 +147,20 @@ static inline std::string encode_utf8(const UString &s)
     return r;
 }
 
-static inline UString decode_utf8(const std::string &s)
+static inline UString decode_utf8(const char *s, size_t length)
 {
     UString r;
-    for (size_t i = 0; i < s.length(); ++i)
-        r.push_back(decode_utf8(s, i));
+    r.reserve(length);
+    for (size_t i = 0; i < length; ++i)
+        r.push_back(decode_utf8(s, length, i));
     return r;
 }
 
+static inline UString decode_utf8(const std::string &s)
+{
+    return decode_utf8(s.data(), s.length());
+}
+
 /** A stringstream-like class capable of holding unicode codepoints.
  * The C++ standard does not support std::basic_stringstream<char32_t.
  */
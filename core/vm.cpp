@@ -14,9 +14,21 @@ See the License for the specific language governing permissions and
 limitations under the License.
 */
 
+#include <algorithm>
 #include <cassert>
+#include <chrono>
 #include <cmath>
 
+#include <sys/stat.h>
+#ifndef _WIN32
+#include <fcntl.h>
+#include <sys/mman.h>
+#include <unistd.h>
+#endif
+
+#include <cerrno>
+#include <cstring>
+#include <fstream>
 #include <memory>
 #include <set>
 #include <string>
@@ -35,6 +47,32 @@ using json = nlohmann::json;
 
 namespace {
 
+/** The MD5 of the content of an imported file. */
+std::string content_digest(const JsonnetImportBuffer &buffer)
+{
+    MD5 md5;
+    // MD5 takes at most 4GB at a time.
+    const size_t CHUNK = 1 << 30;
+    for (size_t done = 0; done < buffer.length; done += CHUNK)
+        md5.update(buffer.content + done, MD5::size_type(std::min(CHUNK, buffer.length - done)));
+    md5.finalize();
+    return md5.hexdigest();
+}
+
+/** Whether a file was modified so recently that a change now might not change its stats.
+ *
+ * File systems keep timestamps at a resolution of up to 2 seconds, and may take them from a clock
+ * that only advances every few milliseconds.
+ */
+bool is_racy(const FileStats &stats)
+{
+    const long long MARGIN = 2000000000;
+    long long now = std::chrono::duration_cast<std::chrono::nanoseconds>(
+                        std::chrono::system_clock::now().time_since_epoch())
+                        .count();
+    return stats.mtime > now - MARGIN || stats.ctime > now - MARGIN;
+}
+
 /** Turn a path e.g. "/a/b/c" into a dir, e.g. "/a/b/".  If there is no path returns "".
  */
 std::string dir_name(const std::string &path)
@@ -46,6 +84,42 @@ std::string dir_name(const std::string &path)
     return "";
 }
 
+/** Append an encoding of v to key, which is the same for equal values, to look up the results of
+ * pure native callbacks.
+ */
+void native_memo_key(const JsonnetJsonValue &v, std::string &key)
+{
+    key += char(v.kind);
+    switch (v.kind) {
+        case JsonnetJsonValue::STRING:
+            key += std::to_string(v.string.length()) + ":";
+            key += v.string;
+            break;
+
+        case JsonnetJsonValue::BOOL:
+        case JsonnetJsonValue::NUMBER:
+            key.append(reinterpret_cast<const char *>(&v.number), sizeof(v.number));
+            break;
+
+        case JsonnetJsonValue::NULL_KIND: break;
+
+        case JsonnetJsonValue::ARRAY:
+            key += std::to_string(v.elements.size()) + ":";
+            for (const auto &el : v.elements)
+                native_memo_key(*el, key);
+            break;
+
+        case JsonnetJsonValue::OBJECT:
+            key += std::to_string(v.fields.size()) + ":";
+            for (const auto &f : v.fields) {
+                key += std::to_string(f.first.length()) + ":";
+                key += f.first;
+                native_memo_key(*f.second, key);
+            }
+            break;
+    }
+}
+
 /** Stack frames.
  *
  * Of these, FRAME_CALL is the most special, as it is the only frame the stack
@@ -74,6 +148,7 @@ enum FrameKind {
     FRAME_BUILTIN_JOIN_STRINGS, // When executing std.join over strings, used to hold intermediate state.
     FRAME_BUILTIN_JOIN_ARRAYS,  // When executing std.join over arrays, used to hold intermediate state.
     FRAME_BUILTIN_DECODE_UTF8,  // When executing std.decodeUTF8, used to hold intermediate state.
+    FRAME_SELECT,               // Holds the top-level value and the result while selecting paths.
 };
 
 /** A frame on the stack.
@@ -162,6 +237,11 @@ struct Frame {
      */
     unsigned offset;
 
+    /** In a FRAME_CALL that evaluates an object's field, the field, so that its value can be
+     * cached in self (\see HeapObject::fieldValues) when the frame is done.  Otherwise nullptr.
+     */
+    const Identifier *field;
+
     /** A set of variables introduced at this point. */
     BindingFrame bindings;
 
@@ -173,7 +253,8 @@ struct Frame {
           elementId(0),
           context(NULL),
           self(NULL),
-          offset(0)
+          offset(0),
+          field(nullptr)
     {
         val.t = Value::NULL_TYPE;
         val2.t = Value::NULL_TYPE;
@@ -187,7 +268,8 @@ struct Frame {
           elementId(0),
           context(NULL),
           self(NULL),
-          offset(0)
+          offset(0),
+          field(nullptr)
     {
         val.t = Value::NULL_TYPE;
         val2.t = Value::NULL_TYPE;
@@ -227,6 +309,17 @@ class Stack {
     /** The stack frames. */
     std::vector<Frame> stack;
 
+    /** A frame that holds bindings (\see VarSlot). */
+    struct Scope {
+        /** The index of the frame in the stack. */
+        unsigned frame;
+        /** The index in scopes of the innermost call frame, at or below this scope. */
+        unsigned call;
+    };
+
+    /** The frames that hold bindings: calls, locals and object comprehensions. */
+    std::vector<Scope> scopes;
+
    public:
     Stack(unsigned limit) : calls(0), limit(limit) {}
 
@@ -252,6 +345,28 @@ class Stack {
         return nullptr;
     }
 
+    /** Find the variable at the given slot, as resolved by static analysis.
+     *
+     * The slot is checked against the binding found there, so this falls back to searching by
+     * name if the frames do not have the statically expected layout.
+     */
+    HeapThunk *lookUpVar(const Identifier *id, const VarSlot &slot)
+    {
+        if (slot.depth < scopes.size()) {
+            unsigned i = scopes.size() - 1 - slot.depth;
+            // Do not go into the next call frame, as above.
+            if (i >= scopes.back().call) {
+                const auto &binds = stack[scopes[i].frame].bindings;
+                if (slot.index < binds.size()) {
+                    const auto &bind = binds.begin()[slot.index];
+                    if (bind.first == id)
+                        return bind.second;
+                }
+            }
+        }
+        return lookUpVar(id);
+    }
+
     /** Mark everything visible from the stack (any frame). */
     void mark(Heap &heap)
     {
@@ -274,6 +389,8 @@ class Stack {
     {
         if (top().isCall())
             calls--;
+        if (!scopes.empty() && scopes.back().frame == stack.size() - 1)
+            scopes.pop_back();
         stack.pop_back();
     }
 
@@ -362,6 +479,14 @@ class Stack {
         stack.emplace_back(args...);
     }
 
+    /** New frame that holds bindings, see lookUpVar. */
+    void newScope(const FrameKind &kind, const AST *ast)
+    {
+        stack.emplace_back(kind, ast);
+        unsigned call = scopes.empty() ? 0 : scopes.back().call;
+        scopes.push_back(Scope{unsigned(stack.size() - 1), call});
+    }
+
     /** If there is a tailstrict annotated frame followed by some locals, pop them all. */
     void tailCallTrimStack(void)
     {
@@ -374,6 +499,8 @@ class Stack {
                     // Remove all stack frames including this one.
                     while (stack.size() > unsigned(i))
                         stack.pop_back();
+                    while (!scopes.empty() && scopes.back().frame >= stack.size())
+                        scopes.pop_back();
                     calls--;
                     return;
                 } break;
@@ -394,6 +521,7 @@ class Stack {
             throw makeError(loc, "max stack frames exceeded.");
         }
         stack.emplace_back(FRAME_CALL, loc);
+        scopes.push_back(Scope{unsigned(stack.size() - 1), unsigned(scopes.size())});
         calls++;
         top().context = context;
         top().self = self;
@@ -445,6 +573,258 @@ typedef std::map<std::string, VmExt> ExtMap;
 /** Typedef to save some typing. */
 typedef std::map<std::string, std::string> StrMap;
 
+/** The size in characters of the chunks of output given to a ManifestOutput sink. */
+static const size_t MANIFEST_CHUNK_SIZE = 64 * 1024;
+
+/** The output of Interpreter::manifestJson. */
+struct ManifestOutput {
+    /** The output not yet passed on to the sink. */
+    UString buf;
+    /** Called with the output in UTF-8 chunks as it is produced, or null to keep it all in buf.
+     * Returns false to stop the evaluation. */
+    const std::function<bool(const std::string &)> *sink = nullptr;
+
+    /** Pass buf on to the sink, if there is one and buf reached MANIFEST_CHUNK_SIZE or force is
+     * set.  Returns false if the sink failed.
+     */
+    bool flush(bool force)
+    {
+        if (sink == nullptr || (!force && buf.length() < MANIFEST_CHUNK_SIZE))
+            return true;
+        if (!(*sink)(encode_utf8(buf)))
+            return false;
+        buf.clear();
+        return true;
+    }
+};
+
+/** A ManifestVisitor that writes the value as JSON to a ManifestOutput. */
+class JsonWriter : public ManifestVisitor {
+    /** An array or object being written. */
+    struct Open {
+        bool array;
+        size_t size;
+        /** Whether none of its elements or fields was written yet. */
+        bool first;
+    };
+
+    ManifestOutput &out;
+    bool multiline;
+    /** The indentation of the elements and fields of the innermost open array or object. */
+    UString indent;
+    /** The arrays and objects being written, innermost last. */
+    std::vector<Open> open;
+
+    /** Write what goes before an element or field of the innermost open array or object. */
+    void separate(void)
+    {
+        Open &o = open.back();
+        if (o.first)
+            out.buf += multiline ? U"\n" : U"";
+        else
+            out.buf += multiline ? U",\n" : U", ";
+        o.first = false;
+        out.buf += indent;
+    }
+
+    /** Write what goes before a value, which is nothing unless it is an element of an array. */
+    void element(void)
+    {
+        if (!open.empty() && open.back().array)
+            separate();
+    }
+
+    void begin(size_t size, bool array)
+    {
+        element();
+        if (size == 0) {
+            out.buf += array ? U"[ ]" : U"{ }";
+        } else {
+            out.buf += array ? U"[" : U"{";
+            if (multiline)
+                indent += U"   ";
+        }
+        open.push_back(Open{array, size, true});
+    }
+
+    void end(void)
+    {
+        Open o = open.back();
+        open.pop_back();
+        if (o.size == 0)
+            return;
+        if (multiline) {
+            indent.resize(indent.length() - 3);
+            out.buf += U"\n";
+        }
+        out.buf += indent;
+        out.buf += o.array ? U"]" : U"}";
+    }
+
+   public:
+    JsonWriter(ManifestOutput &out, bool multiline, const UString &indent)
+        : out(out), multiline(multiline), indent(indent)
+    {
+    }
+
+    void null(void)
+    {
+        element();
+        out.buf += U"null";
+    }
+
+    void boolean(bool v)
+    {
+        element();
+        out.buf += v ? U"true" : U"false";
+    }
+
+    void number(double v)
+    {
+        element();
+        out.buf += decode_utf8(jsonnet_unparse_number(v));
+    }
+
+    void string(const UString &v)
+    {
+        element();
+        out.buf += jsonnet_string_unparse(v, false);
+    }
+
+    void beginArray(size_t size)
+    {
+        begin(size, true);
+    }
+
+    void endArray(void)
+    {
+        end();
+    }
+
+    void beginObject(size_t size)
+    {
+        begin(size, false);
+    }
+
+    void field(const UString &name)
+    {
+        separate();
+        out.buf += jsonnet_string_unparse(name, false);
+        out.buf += U": ";
+    }
+
+    void endObject(void)
+    {
+        end();
+    }
+
+    bool done(void)
+    {
+        return out.flush(false);
+    }
+};
+
+/** A ManifestVisitor that builds a JsonnetJsonValue. */
+class JsonValueBuilder : public ManifestVisitor {
+    std::unique_ptr<JsonnetJsonValue> root;
+    /** The arrays and objects being built, innermost last. */
+    std::vector<JsonnetJsonValue *> open;
+    /** The name of the field whose value comes next. */
+    std::string name;
+
+    JsonnetJsonValue *add(JsonnetJsonValue::Kind kind, double number)
+    {
+        std::unique_ptr<JsonnetJsonValue> v(new JsonnetJsonValue(kind, "", number));
+        JsonnetJsonValue *r = v.get();
+        if (open.empty())
+            root = std::move(v);
+        else if (open.back()->kind == JsonnetJsonValue::ARRAY)
+            open.back()->elements.push_back(std::move(v));
+        else
+            open.back()->fields.emplace_back(std::move(name), std::move(v));
+        return r;
+    }
+
+   public:
+    void null(void)
+    {
+        add(JsonnetJsonValue::NULL_KIND, 0);
+    }
+
+    void boolean(bool v)
+    {
+        add(JsonnetJsonValue::BOOL, v ? 1.0 : 0.0);
+    }
+
+    void number(double v)
+    {
+        add(JsonnetJsonValue::NUMBER, v);
+    }
+
+    void string(const UString &v)
+    {
+        encode_utf8(v, add(JsonnetJsonValue::STRING, 0)->string);
+    }
+
+    void beginArray(size_t size)
+    {
+        open.push_back(add(JsonnetJsonValue::ARRAY, 0));
+        open.back()->elements.reserve(size);
+    }
+
+    void endArray(void)
+    {
+        open.pop_back();
+    }
+
+    void beginObject(size_t size)
+    {
+        open.push_back(add(JsonnetJsonValue::OBJECT, 0));
+        open.back()->fields.reserve(size);
+    }
+
+    void field(const UString &v)
+    {
+        name = encode_utf8(v);
+    }
+
+    void endObject(void)
+    {
+        open.pop_back();
+    }
+
+    /** The value, once it was visited. */
+    std::unique_ptr<JsonnetJsonValue> result(void)
+    {
+        return std::move(root);
+    }
+};
+
+/** A conversion specification of std.format, e.g. %(name)-5.2f, and the text before it. */
+struct FormatCode {
+    /** The text between the previous code (or the start) and this one. */
+    UString literal;
+    /** The mapping key, if hasKey. */
+    UString key;
+    bool hasKey;
+    /** The conversion flags. */
+    bool alt, zero, left, blank, plus;
+    /** The field width, or whether it is given by the next value (*). */
+    double fw;
+    bool fwStar;
+    /** The precision, if hasPrec, or whether it is given by the next value (*). */
+    double prec;
+    bool hasPrec, precStar;
+    /** The conversion type, one of d o x e f g c s %. */
+    char32_t ctype;
+    /** Whether the conversion type was upper case, e.g. X. */
+    bool caps;
+};
+
+/** Strings concatenated with + are only made into ropes from this length, as copying shorter
+ * strings is cheaper than keeping and later flattening the rope. */
+static const size_t ROPE_MIN_LENGTH = 256;
+
 class Interpreter;
 
 typedef const AST *(Interpreter::*BuiltinFunc)(const LocationRange &loc,
@@ -453,10 +833,10 @@ typedef const AST *(Interpreter::*BuiltinFunc)(const LocationRange &loc,
 /** Holds the intermediate state during execution and implements the necessary functions to
  * implement the semantics of the language.
  *
- * The garbage collector used is a simple stop-the-world mark and sweep collector.  It runs upon
- * memory allocation if the heap is large enough and has grown enough since the last collection.
- * All reachable entities have their mark field incremented.  Then all entities with the old
- * mark are removed from the heap.
+ * The garbage collector used is an incremental mark and sweep collector (\see Heap).  A cycle
+ * starts upon memory allocation if the heap is large enough and has grown enough since the last
+ * collection, and then runs in small steps between allocations.  All reachable entities have
+ * their mark field incremented.  Then all entities with the old mark are removed from the heap.
  */
 class Interpreter {
     /** The heap. */
@@ -474,6 +854,9 @@ class Interpreter {
      */
     Allocator *alloc;
 
+    /** The standard library shared by every file desugared by this interpreter, or null. */
+    const DesugaredObject *stdlib;
+
     /** Used to "name" thunks created to cache imports. */
     const Identifier *idImport;
 
@@ -489,27 +872,50 @@ class Interpreter {
     /** Used to refer to idJsonObjVar. */
     const AST *jsonObjVar;
 
+    /** Used by builtins to call keyF(x) and func(x, y), \see callFunction. */
+    const Apply *callKeyF;
+    const Apply *callFunc;
+
     struct ImportCacheValue {
-        std::string foundHere;
-        std::string content;
+        /** Possibly shared with importCache. */
+        std::shared_ptr<ImportedFile> file;
         /** Thunk to store cached result of execution.
          *
          * Null if this file was only ever successfully imported with importstr.
          */
         HeapThunk *thunk;
+        /** The string given by importstr, or null if it was not used yet. */
+        HeapString *str;
     };
 
     /** Cache for imported Jsonnet files. */
     std::map<std::pair<std::string, UString>, ImportCacheValue *> cachedImports;
 
+    /** Files imported by earlier evaluations, or null. */
+    ImportCache *importCache;
+
+    /** Set from another thread to stop the evaluation, see jsonnet_cancel.  May be null. */
+    const std::atomic<bool> *cancelled;
+
+    /** Statistics of the garbage collection cycles are added to this, see jsonnet_gc_stats.  May
+     * be null.
+     */
+    JsonnetGcStats *gcStats;
+
     /** External variables for std.extVar. */
     ExtMap externalVars;
 
+    /** External variables given as JSON values, converted at their first use. */
+    std::map<std::string, HeapThunk *> externalValues;
+
+    /** Top-level arguments given as JSON values, see builtinTlaValue. */
+    ExtMap topLevelArgs;
+
     /** The callback used for loading imported files. */
     VmNativeCallbackMap nativeCallbacks;
 
     /** The callback used for loading imported files. */
-    JsonnetImportCallback *importCallback;
+    JsonnetImportBufferCallback *importCallback;
 
     /** User context pointer for the import callback. */
     void *importCallbackContext;
@@ -523,34 +929,94 @@ class Interpreter {
         return stack.makeError(loc, msg);
     }
 
-    /** Create an object on the heap, maybe collect garbage.
-     * \param T Something under HeapEntity
-     * \returns The new object
+    /** Stop the evaluation if it was cancelled, see jsonnet_cancel. */
+    void checkCancelled(const LocationRange &loc)
+    {
+        if (cancelled != nullptr && cancelled->load(std::memory_order_relaxed))
+            throw makeError(loc, "evaluation cancelled.");
+    }
+
+    /** Mark the roots: the stack, the scratch register, cached imports and external variables.
+     *
+     * \param r An entity just made, which is not reachable from the roots yet.
      */
-    template <class T, class... Args>
-    T *makeHeap(Args &&... args)
+    void markRoots(HeapEntity *r)
     {
-        T *r = heap.makeEntity<T, Args...>(std::forward<Args>(args)...);
-        if (heap.checkHeap()) {  // Do a GC cycle?
-            // Avoid the object we just made being collected.
-            heap.markFrom(r);
+        // Avoid the object we just made being collected.
+        heap.markFrom(r);
+
+        // Mark from the stack.
+        stack.mark(heap);
 
-            // Mark from the stack.
-            stack.mark(heap);
+        // Mark from the scratch register
+        heap.markFrom(scratch);
 
-            // Mark from the scratch register
-            heap.markFrom(scratch);
+        // Mark from cached imports
+        for (const auto &pair : cachedImports) {
+            HeapThunk *thunk = pair.second->thunk;
+            if (thunk != nullptr)
+                heap.markFrom(thunk);
+            if (pair.second->str != nullptr)
+                heap.markFrom(pair.second->str);
+        }
+
+        // Mark from external variables given as values
+        for (const auto &pair : externalValues) {
+            if (pair.second != nullptr)
+                heap.markFrom(pair.second);
+        }
+    }
 
-            // Mark from cached imports
-            for (const auto &pair : cachedImports) {
-                HeapThunk *thunk = pair.second->thunk;
-                if (thunk != nullptr)
-                    heap.markFrom(thunk);
+    /** Start a garbage collection cycle or do the next step of the running one.
+     *
+     * \param r An entity just made, which is not reachable from the roots yet.
+     */
+    void collectGarbage(HeapEntity *r)
+    {
+        // Builtins like makeArray can run for long without evaluating any code.
+        checkCancelled(LocationRange());
+
+        auto start = std::chrono::steady_clock::now();
+        bool finished = false;
+        if (!heap.collecting()) {
+            if (gcStats != nullptr)
+                gcStats->peak_entities = std::max(gcStats->peak_entities, heap.size());
+            heap.startCycle();
+            markRoots(r);
+        } else if (heap.marking()) {
+            if (heap.markStep()) {
+                // The roots are not guarded by write barriers, so they may hold entities that
+                // were not marked yet.
+                markRoots(r);
+                heap.finishMark();
             }
+        } else {
+            finished = heap.sweepStep();
+        }
 
-            // Delete unreachable objects.
-            heap.sweep();
+        if (gcStats != nullptr) {
+            std::chrono::duration<double, std::milli> pause =
+                std::chrono::steady_clock::now() - start;
+            if (finished) {
+                gcStats->cycles++;
+                gcStats->freed += heap.freed();
+            }
+            gcStats->steps++;
+            gcStats->pause_ms += pause.count();
+            gcStats->max_pause_ms = std::max(gcStats->max_pause_ms, pause.count());
         }
+    }
+
+    /** Create an object on the heap, maybe collect garbage.
+     * \param T Something under HeapEntity
+     * \returns The new object
+     */
+    template <class T, class... Args>
+    T *makeHeap(Args &&... args)
+    {
+        T *r = heap.makeEntity<T, Args...>(std::forward<Args>(args)...);
+        if (heap.checkHeap())  // Start a GC cycle or do a step of it?
+            collectGarbage(r);
         return r;
     }
 
@@ -596,6 +1062,35 @@ class Interpreter {
         return r;
     }
 
+    /** Concatenate two arrays, appending to the storage of lhs if possible (\see HeapArray).
+     *
+     * The arrays must be reachable from the stack, in case of garbage collection.
+     */
+    Value makeArrayConcat(HeapArray *lhs, HeapArray *rhs)
+    {
+        Value r;
+        r.t = Value::ARRAY;
+        if (rhs->size() == 0) {
+            r.v.h = lhs;
+        } else if (lhs->size() == 0) {
+            r.v.h = rhs;
+        } else {
+            HeapArray *arr;
+            if (lhs->atEnd()) {
+                arr = makeHeap<HeapArray>(lhs->base, lhs->offset, lhs->size());
+            } else {
+                arr = makeHeap<HeapArray>(std::vector<HeapThunk *>(lhs->begin(), lhs->end()));
+            }
+            // Not a range-based for, as rhs may share the storage that is appended to.
+            for (size_t i = 0; i < rhs->size(); ++i) {
+                arr->push_back((*rhs)[i]);
+                heap.writeBarrier(arr->base, (*rhs)[i]);
+            }
+            r.v.h = arr;
+        }
+        return r;
+    }
+
     Value makeClosure(const BindingFrame &env, HeapObject *self, unsigned offset,
                       const HeapClosure::Params &params, AST *body)
     {
@@ -640,10 +1135,119 @@ class Interpreter {
         return r;
     }
 
+    /** Concatenate two strings, as a rope if the result is long (\see HeapString).
+     *
+     * The strings must be reachable from the stack, in case of garbage collection.
+     */
+    Value makeStringConcat(HeapString *lhs, HeapString *rhs)
+    {
+        Value r;
+        r.t = Value::STRING;
+        if (rhs->length == 0) {
+            r.v.h = lhs;
+        } else if (lhs->length == 0) {
+            r.v.h = rhs;
+        } else if (lhs->length + rhs->length < ROPE_MIN_LENGTH) {
+            r.v.h = makeHeap<HeapString>(lhs->value() + rhs->value());
+        } else if (lhs->left != nullptr && lhs->right->left == nullptr &&
+                   lhs->right->length + rhs->length < ROPE_MIN_LENGTH) {
+            // Appending a little at a time, e.g. in a fold.  Rather than a rope node per piece,
+            // which would keep all the pieces alive, extend the last piece.  It is kept in
+            // scratch in case making the node collects garbage.
+            scratch = makeString(lhs->right->value() + rhs->value());
+            r.v.h = makeHeap<HeapString>(lhs->left, static_cast<HeapString *>(scratch.v.h));
+        } else {
+            r.v.h = makeHeap<HeapString>(lhs, rhs);
+        }
+        return r;
+    }
+
+    /** Auxiliary function of objectFieldIndex.
+     *
+     * Add the fields of the leaves of the tree to the index, from left to right.
+     */
+    void indexLeaves(HeapObject *curr, HeapExtendedObject::FieldIndex &index)
+    {
+        auto add = [&](const Identifier *f, HeapLeafObject *leaf, ObjectField::Hide hide) {
+            auto &leaves = index.fields[f];
+            if (hide == ObjectField::INHERIT && !leaves.empty()) {
+                // Inherited visibility, so use the visibility of the leaves to the left.
+                hide = leaves.back().hide;
+            }
+            leaves.push_back(HeapExtendedObject::IndexedLeaf{leaf, index.numLeaves, hide});
+        };
+        if (auto *ext = dynamic_cast<HeapExtendedObject *>(curr)) {
+            indexLeaves(ext->left, index);
+            indexLeaves(ext->right, index);
+            return;
+        } else if (auto *simp = dynamic_cast<HeapSimpleObject *>(curr)) {
+            for (const auto &f : simp->fields)
+                add(f.first, simp, f.second.hide);
+        } else if (auto *comp = dynamic_cast<HeapComprehensionObject *>(curr)) {
+            for (const auto &f : comp->compValues)
+                add(f.first, comp, ObjectField::VISIBLE);
+        }
+        index.numLeaves++;
+    }
+
+    /** Get the index of the fields of an extended object, building it on first use.
+     *
+     * If the left operand was indexed and no other object added to its index since, the index
+     * is shared with it and only the leaves of the right operand are added.  So when each
+     * object of a chain of + is used in turn, the chain is not indexed again for every one of
+     * them.  The left operand is not indexed just for this, as most of the objects of a chain
+     * are never used by themselves.
+     *
+     * \see HeapExtendedObject::fieldIndex
+     */
+    HeapExtendedObject::FieldIndex &objectFieldIndex(HeapExtendedObject *ext)
+    {
+        if (ext->fieldIndex == nullptr) {
+            auto *left = dynamic_cast<HeapExtendedObject *>(ext->left);
+            if (left != nullptr && left->fieldIndex != nullptr &&
+                left->fieldIndex->numLeaves == left->numLeaves) {
+                ext->fieldIndex = left->fieldIndex;
+            } else {
+                ext->fieldIndex = std::make_shared<HeapExtendedObject::FieldIndex>();
+                indexLeaves(ext->left, *ext->fieldIndex);
+            }
+            indexLeaves(ext->right, *ext->fieldIndex);
+            ext->numLeaves = ext->fieldIndex->numLeaves;
+        }
+        return *ext->fieldIndex;
+    }
+
+    /** Find the rightmost of the leaves of an extended object before a position that has a
+     * field.
+     *
+     * \param end The position to look before, at most the number of leaves of the object.
+     * \returns The leaf, or nullptr if none of them has the field.
+     */
+    const HeapExtendedObject::IndexedLeaf *findIndexedLeaf(HeapExtendedObject *ext,
+                                                           const Identifier *f, unsigned end)
+    {
+        const auto &index = objectFieldIndex(ext);
+        auto it = index.fields.find(f);
+        if (it == index.fields.end())
+            return nullptr;
+        return findIndexedLeaf(it->second, end);
+    }
+
+    /** Find the rightmost of the given leaves before a position. */
+    static const HeapExtendedObject::IndexedLeaf *findIndexedLeaf(
+        const std::vector<HeapExtendedObject::IndexedLeaf> &leaves, unsigned end)
+    {
+        auto it = std::lower_bound(
+            leaves.begin(), leaves.end(), end,
+            [](const HeapExtendedObject::IndexedLeaf &leaf, unsigned position) {
+                return leaf.position < position;
+            });
+        return it == leaves.begin() ? nullptr : &*(it - 1);
+    }
+
     /** Auxiliary function of objectIndex.
      *
-     * Traverse the object's tree from right to left, looking for an object
-     * with the given field.  Call with offset initially set to 0.
+     * Find the rightmost leaf of the object's tree with the given field.
      *
      * \param f The field we're looking for.
      * \param start_from Step over this many leaves first.
@@ -654,71 +1258,76 @@ class Interpreter {
                                unsigned &counter)
     {
         if (auto *ext = dynamic_cast<HeapExtendedObject *>(curr)) {
-            auto *r = findObject(f, ext->right, start_from, counter);
-            if (r)
-                return r;
-            auto *l = findObject(f, ext->left, start_from, counter);
-            if (l)
-                return l;
-        } else {
-            if (counter >= start_from) {
-                if (auto *simp = dynamic_cast<HeapSimpleObject *>(curr)) {
-                    auto it = simp->fields.find(f);
-                    if (it != simp->fields.end()) {
-                        return simp;
-                    }
-                } else if (auto *comp = dynamic_cast<HeapComprehensionObject *>(curr)) {
-                    auto it = comp->compValues.find(f);
-                    if (it != comp->compValues.end()) {
-                        return comp;
-                    }
-                }
+            unsigned num_leaves = countLeaves(ext);
+            if (start_from >= num_leaves)
+                return nullptr;
+            const auto *leaf = findIndexedLeaf(ext, f, num_leaves - start_from);
+            if (leaf != nullptr) {
+                counter = num_leaves - 1 - leaf->position;
+                return leaf->leaf;
+            }
+        } else if (start_from == 0) {
+            if (auto *simp = dynamic_cast<HeapSimpleObject *>(curr)) {
+                if (simp->fields.find(f) != simp->fields.end())
+                    return simp;
+            } else if (auto *comp = dynamic_cast<HeapComprehensionObject *>(curr)) {
+                if (comp->compValues.find(f) != comp->compValues.end())
+                    return comp;
             }
-            counter++;
         }
         return nullptr;
     }
 
-    typedef std::map<const Identifier *, ObjectField::Hide> IdHideMap;
-
-    /** Auxiliary function.
+    /** Find a field of an object.
+     *
+     * \param hide Return the visibility of the field in the object as a whole.
+     * \returns Whether the object has the field.
      */
-    IdHideMap objectFieldsAux(const HeapObject *obj_)
+    bool objectHasField(HeapObject *obj_, const Identifier *f, ObjectField::Hide &hide)
     {
-        IdHideMap r;
-        if (auto *obj = dynamic_cast<const HeapSimpleObject *>(obj_)) {
-            for (const auto &f : obj->fields) {
-                r[f.first] = f.second.hide;
-            }
-
-        } else if (auto *obj = dynamic_cast<const HeapExtendedObject *>(obj_)) {
-            r = objectFieldsAux(obj->right);
-            for (const auto &pair : objectFieldsAux(obj->left)) {
-                auto it = r.find(pair.first);
-                if (it == r.end()) {
-                    // First time it is seen
-                    r[pair.first] = pair.second;
-                } else if (it->second == ObjectField::INHERIT) {
-                    // Seen before, but with inherited visibility so use new visibility
-                    r[pair.first] = pair.second;
-                }
-            }
+        if (auto *obj = dynamic_cast<HeapSimpleObject *>(obj_)) {
+            auto it = obj->fields.find(f);
+            if (it == obj->fields.end())
+                return false;
+            hide = it->second.hide;
+            return true;
+
+        } else if (auto *obj = dynamic_cast<HeapExtendedObject *>(obj_)) {
+            const auto *leaf = findIndexedLeaf(obj, f, countLeaves(obj));
+            if (leaf == nullptr)
+                return false;
+            hide = leaf->hide;
+            return true;
 
-        } else if (auto *obj = dynamic_cast<const HeapComprehensionObject *>(obj_)) {
-            for (const auto &f : obj->compValues)
-                r[f.first] = ObjectField::VISIBLE;
+        } else {
+            auto *comp = static_cast<HeapComprehensionObject *>(obj_);
+            hide = ObjectField::VISIBLE;
+            return comp->compValues.find(f) != comp->compValues.end();
         }
-        return r;
     }
 
     /** Auxiliary function.
      */
-    std::set<const Identifier *> objectFields(const HeapObject *obj_, bool manifesting)
+    std::set<const Identifier *> objectFields(HeapObject *obj_, bool manifesting)
     {
         std::set<const Identifier *> r;
-        for (const auto &pair : objectFieldsAux(obj_)) {
-            if (!manifesting || pair.second != ObjectField::HIDDEN)
-                r.insert(pair.first);
+        if (auto *obj = dynamic_cast<HeapSimpleObject *>(obj_)) {
+            for (const auto &f : obj->fields) {
+                if (!manifesting || f.second.hide != ObjectField::HIDDEN)
+                    r.insert(f.first);
+            }
+
+        } else if (auto *obj = dynamic_cast<HeapExtendedObject *>(obj_)) {
+            unsigned num_leaves = countLeaves(obj);
+            for (const auto &f : objectFieldIndex(obj).fields) {
+                const auto *leaf = findIndexedLeaf(f.second, num_leaves);
+                if (leaf != nullptr && (!manifesting || leaf->hide != ObjectField::HIDDEN))
+                    r.insert(f.first);
+            }
+
+        } else if (auto *obj = dynamic_cast<HeapComprehensionObject *>(obj_)) {
+            for (const auto &f : obj->compValues)
+                r.insert(f.first);
         }
         return r;
     }
@@ -736,12 +1345,22 @@ class Interpreter {
     {
         ImportCacheValue *input = importString(loc, file);
         if (input->thunk == nullptr) {
-            Tokens tokens = jsonnet_lex(input->foundHere, input->content.c_str());
-            AST *expr = jsonnet_parse(alloc, tokens);
-            jsonnet_desugar(alloc, expr, nullptr);
-            jsonnet_static_analysis(expr);
+            ImportedFile &imported = *input->file;
+            if (imported.ast == nullptr) {
+                size_t first_ast = alloc->numASTs();
+                Tokens tokens = jsonnet_lex(imported.foundHere, imported.buffer.content);
+                AST *expr = jsonnet_parse(alloc, tokens);
+                jsonnet_desugar(alloc, expr, nullptr, stdlib);
+                jsonnet_static_analysis(expr);
+                // The ASTs live as long as the file, which may be longer than this evaluation.
+                alloc->moveASTsTo(imported.alloc, first_ast);
+                imported.ast = expr;
+                if (importCache != nullptr)
+                    importCache->insert(ImportCache::Key(dir_name(loc.file), file->value),
+                                        input->file);
+            }
             // If no errors then populate cache.
-            auto *thunk = makeHeap<HeapThunk>(idImport, nullptr, 0, expr);
+            auto *thunk = makeHeap<HeapThunk>(idImport, nullptr, 0, imported.ast);
             input->thunk = thunk;
         }
         return input->thunk;
@@ -767,40 +1386,91 @@ class Interpreter {
         if (cached_value != nullptr)
             return cached_value;
 
+        std::shared_ptr<ImportedFile> kept;
+        if (importCache != nullptr) {
+            kept = importCache->find(key);
+            if (kept != nullptr && importCache->checkFileStats && !kept->racy) {
+                auto *input_ptr = new ImportCacheValue();
+                input_ptr->file = kept;
+                input_ptr->thunk = nullptr;  // May be filled in later by import().
+                input_ptr->str = nullptr;
+                cachedImports[key] = input_ptr;
+                return input_ptr;
+            }
+        }
+
         int success = 0;
         char *found_here_cptr;
-        char *content = importCallback(importCallbackContext,
-                                       dir.c_str(),
-                                       encode_utf8(path).c_str(),
-                                       &found_here_cptr,
-                                       &success);
-
-        std::string input(content);
-        ::free(content);
+        // The buffer is released with the file, also if anything below throws.
+        auto loaded = std::make_shared<ImportedFile>();
+        char *err = importCallback(importCallbackContext,
+                                   dir.c_str(),
+                                   encode_utf8(path).c_str(),
+                                   &found_here_cptr,
+                                   &loaded->buffer,
+                                   &success);
 
         if (!success) {
             std::string epath = encode_utf8(jsonnet_string_escape(path, false));
             std::string msg = "couldn't open import \"" + epath + "\": ";
-            msg += input;
+            msg += err;
+            ::free(err);
             throw makeError(loc, msg);
         }
+        loaded->foundHere = found_here_cptr;
+        ::free(found_here_cptr);
+
+        bool has_stats = false;
+        if (loaded->buffer.content == nullptr) {
+            std::string err_msg;
+            has_stats = true;
+            if (!jsonnet_vm_load_file(
+                    loaded->foundHere, loaded->buffer, err_msg, &loaded->stats)) {
+                std::string epath = encode_utf8(jsonnet_string_escape(path, false));
+                throw makeError(loc, "couldn't open import \"" + epath + "\": " + err_msg);
+            }
+        }
 
         auto *input_ptr = new ImportCacheValue();
-        input_ptr->foundHere = found_here_cptr;
-        input_ptr->content = input;
+        if (importCache == nullptr) {
+            input_ptr->file = loaded;
+        } else {
+            // The content is compared by digest, as that of a kept file that was mapped into
+            // memory follows changes to the file.
+            loaded->digest = content_digest(loaded->buffer);
+            if (has_stats)
+                loaded->racy = is_racy(loaded->stats);
+            if (kept != nullptr && kept->foundHere == loaded->foundHere &&
+                kept->digest == loaded->digest) {
+                // Unchanged, so the ASTs can be reused.
+                kept->stats = loaded->stats;
+                kept->racy = loaded->racy;
+                input_ptr->file = kept;
+            } else {
+                input_ptr->file = loaded;
+                if (!importCache->checkFileStats || has_stats)
+                    importCache->insert(key, input_ptr->file);
+            }
+        }
         input_ptr->thunk = nullptr;  // May be filled in later by import().
-        ::free(found_here_cptr);
+        input_ptr->str = nullptr;
         cachedImports[key] = input_ptr;
         return input_ptr;
     }
 
-    /** Capture the required variables from the environment. */
-    BindingFrame capture(const std::vector<const Identifier *> &free_vars)
+    /** Capture the required variables from the environment.
+     *
+     * \param slots Where static analysis found the variables, or empty.
+     */
+    BindingFrame capture(const std::vector<const Identifier *> &free_vars,
+                         const std::vector<VarSlot> &slots)
     {
         BindingFrame env;
-        for (auto fv : free_vars) {
-            auto *th = stack.lookUpVar(fv);
-            env[fv] = th;
+        env.reserve(free_vars.size());
+        for (unsigned i = 0; i < free_vars.size(); ++i) {
+            auto *th = slots.empty() ? stack.lookUpVar(free_vars[i])
+                                     : stack.lookUpVar(free_vars[i], slots[i]);
+            env[free_vars[i]] = th;
         }
         return env;
     }
@@ -813,7 +1483,8 @@ class Interpreter {
     unsigned countLeaves(HeapObject *obj)
     {
         if (auto *ext = dynamic_cast<HeapExtendedObject *>(obj)) {
-            return countLeaves(ext->left) + countLeaves(ext->right);
+            objectFieldIndex(ext);
+            return ext->numLeaves;
         } else {
             // Must be a HeapLeafObject.
             return 1;
@@ -825,24 +1496,34 @@ class Interpreter {
      *
      * \param loc The location range of the file to be executed.
      */
-    Interpreter(Allocator *alloc, const ExtMap &ext_vars, unsigned max_stack, double gc_min_objects,
-                double gc_growth_trigger, const VmNativeCallbackMap &native_callbacks,
-                JsonnetImportCallback *import_callback, void *import_callback_context)
+    Interpreter(Allocator *alloc, const DesugaredObject *stdlib, const ExtMap &ext_vars,
+                const ExtMap &tla, unsigned max_stack, double gc_min_objects, double gc_growth_trigger,
+                const VmNativeCallbackMap &native_callbacks,
+                JsonnetImportBufferCallback *import_callback, void *import_callback_context,
+                ImportCache *import_cache, const std::atomic<bool> *cancelled,
+                JsonnetGcStats *gc_stats)
 
         : heap(gc_min_objects, gc_growth_trigger),
           stack(max_stack),
           alloc(alloc),
+          stdlib(stdlib),
           idImport(alloc->makeIdentifier(U"import")),
           idArrayElement(alloc->makeIdentifier(U"array_element")),
           idInvariant(alloc->makeIdentifier(U"object_assert")),
           idJsonObjVar(alloc->makeIdentifier(U"_")),
           jsonObjVar(alloc->make<Var>(LocationRange(), Fodder{}, idJsonObjVar)),
+          importCache(import_cache),
+          cancelled(cancelled),
+          gcStats(gc_stats),
           externalVars(ext_vars),
+          topLevelArgs(tla),
           nativeCallbacks(native_callbacks),
           importCallback(import_callback),
           importCallbackContext(import_callback_context)
     {
         scratch = makeNull();
+        callKeyF = makeCallAST(U"keyF", {U"x"});
+        callFunc = makeCallAST(U"func", {U"x", U"y"});
         builtins["makeArray"] = &Interpreter::builtinMakeArray;
         builtins["pow"] = &Interpreter::builtinPow;
         builtins["floor"] = &Interpreter::builtinFloor;
@@ -874,6 +1555,7 @@ class Interpreter {
         builtins["splitLimit"] = &Interpreter::builtinSplitLimit;
         builtins["substr"] = &Interpreter::builtinSubstr;
         builtins["range"] = &Interpreter::builtinRange;
+        builtins["slice"] = &Interpreter::builtinSlice;
         builtins["strReplace"] = &Interpreter::builtinStrReplace;
         builtins["asciiLower"] = &Interpreter::builtinAsciiLower;
         builtins["asciiUpper"] = &Interpreter::builtinAsciiUpper;
@@ -881,6 +1563,46 @@ class Interpreter {
         builtins["parseJson"] = &Interpreter::builtinParseJson;
         builtins["encodeUTF8"] = &Interpreter::builtinEncodeUTF8;
         builtins["decodeUTF8"] = &Interpreter::builtinDecodeUTF8;
+        builtins["tlaValue"] = &Interpreter::builtinTlaValue;
+        builtins["stringChars"] = &Interpreter::builtinStringChars;
+        builtins["foldl"] = &Interpreter::builtinFoldl;
+        builtins["foldr"] = &Interpreter::builtinFoldr;
+        builtins["flattenArrays"] = &Interpreter::builtinFlattenArrays;
+        builtins["equals"] = &Interpreter::builtinEquals;
+        builtins["sortImpl"] = &Interpreter::builtinSortImpl;
+        builtins["uniqImpl"] = &Interpreter::builtinUniqImpl;
+        builtins["setInterImpl"] = &Interpreter::builtinSetInterImpl;
+        builtins["setUnionImpl"] = &Interpreter::builtinSetUnionImpl;
+        builtins["setDiffImpl"] = &Interpreter::builtinSetDiffImpl;
+        builtins["format"] = &Interpreter::builtinFormat;
+        builtins["escapeStringJson"] = &Interpreter::builtinEscapeStringJson;
+        builtins["manifestJsonEx"] = &Interpreter::builtinManifestJsonEx;
+        builtins["manifestYamlDocImpl"] = &Interpreter::builtinManifestYamlDocImpl;
+        builtins["base64"] = &Interpreter::builtinBase64;
+        builtins["mapImpl"] = &Interpreter::builtinMapImpl;
+    }
+
+    /** Make the AST of a call like func(x, y) for callFunction.
+     *
+     * The AST is not statically analysed, so the names are looked up in the bindings of the
+     * thunk that evaluates it.
+     */
+    const Apply *makeCallAST(const UString &func, const std::vector<UString> &params)
+    {
+        Identifiers free_vars{alloc->makeIdentifier(func)};
+        ArgParams args;
+        for (const auto &param : params) {
+            const Identifier *id = alloc->makeIdentifier(param);
+            auto *var = alloc->make<Var>(LocationRange(), Fodder{}, id);
+            var->freeVariables.push_back(id);
+            args.emplace_back(var, Fodder{});
+            free_vars.push_back(id);
+        }
+        auto *target = alloc->make<Var>(LocationRange(), Fodder{}, free_vars[0]);
+        auto *call = alloc->make<Apply>(LocationRange(), Fodder{}, target, Fodder{}, args, false,
+                                        Fodder{}, Fodder{}, false);
+        call->freeVariables = free_vars;
+        return call;
     }
 
     /** Clean up the heap, stack, stash, and builtin function ASTs. */
@@ -1062,7 +1784,7 @@ class Interpreter {
         if (func->params.size() != 1) {
             throw makeError(loc, "filter function takes 1 parameter.");
         }
-        if (arr->elements.size() == 0) {
+        if (arr->size() == 0) {
             scratch = makeArray({});
         } else {
             f.kind = FRAME_BUILTIN_FILTER;
@@ -1071,7 +1793,7 @@ class Interpreter {
             f.thunks.clear();
             f.elementId = 0;
 
-            auto *thunk = arr->elements[f.elementId];
+            auto *thunk = (*arr)[f.elementId];
             BindingFrame bindings = func->upValues;
             bindings[func->params[0].id] = thunk;
             stack.newCall(loc, func, func->self, func->offset, bindings);
@@ -1084,17 +1806,15 @@ class Interpreter {
     {
         validateBuiltinArgs(
             loc, "objectHasEx", args, {Value::OBJECT, Value::STRING, Value::BOOLEAN});
-        const auto *obj = static_cast<const HeapObject *>(args[0].v.h);
+        auto *obj = static_cast<HeapObject *>(args[0].v.h);
         const auto *str = static_cast<const HeapString *>(args[1].v.h);
         bool include_hidden = args[2].v.b;
-        bool found = false;
-        for (const auto &field : objectFields(obj, !include_hidden)) {
-            if (field->name == str->value) {
-                found = true;
-                break;
-            }
-        }
-        scratch = makeBoolean(found);
+        // Fields are interned identifiers, so a name that was never interned is not a field.
+        // Looking it up rather than interning it keeps queries from growing the identifier table.
+        const Identifier *f = alloc->findIdentifier(str->value());
+        ObjectField::Hide hide;
+        bool found = f != nullptr && objectHasField(obj, f, hide);
+        scratch = makeBoolean(found && (include_hidden || hide != ObjectField::HIDDEN));
         return nullptr;
     }
 
@@ -1111,11 +1831,11 @@ class Interpreter {
             } break;
 
             case Value::ARRAY:
-                scratch = makeNumber(static_cast<HeapArray *>(e)->elements.size());
+                scratch = makeNumber(static_cast<HeapArray *>(e)->size());
                 break;
 
             case Value::STRING:
-                scratch = makeNumber(static_cast<HeapString *>(e)->value.length());
+                scratch = makeNumber(static_cast<HeapString *>(e)->length);
                 break;
 
             case Value::FUNCTION:
@@ -1134,7 +1854,7 @@ class Interpreter {
     const AST *builtinObjectFieldsEx(const LocationRange &loc, const std::vector<Value> &args)
     {
         validateBuiltinArgs(loc, "objectFieldsEx", args, {Value::OBJECT, Value::BOOLEAN});
-        const auto *obj = static_cast<HeapObject *>(args[0].v.h);
+        auto *obj = static_cast<HeapObject *>(args[0].v.h);
         bool include_hidden = args[1].v.b;
         // Stash in a set first to sort them.
         std::set<UString> fields;
@@ -1142,7 +1862,7 @@ class Interpreter {
             fields.insert(field->name);
         }
         scratch = makeArray({});
-        auto &elements = static_cast<HeapArray *>(scratch.v.h)->elements;
+        auto &elements = *static_cast<HeapArray *>(scratch.v.h);
         for (const auto &field : fields) {
             auto *th = makeHeap<HeapThunk>(idArrayElement, nullptr, 0, nullptr);
             elements.push_back(th);
@@ -1154,13 +1874,13 @@ class Interpreter {
     const AST *builtinCodepoint(const LocationRange &loc, const std::vector<Value> &args)
     {
         validateBuiltinArgs(loc, "codepoint", args, {Value::STRING});
-        const UString &str = static_cast<HeapString *>(args[0].v.h)->value;
+        const UString &str = static_cast<HeapString *>(args[0].v.h)->value();
         if (str.length() != 1) {
             std::stringstream ss;
             ss << "codepoint takes a string of length 1, got length " << str.length();
             throw makeError(loc, ss.str());
         }
-        char32_t c = static_cast<HeapString *>(args[0].v.h)->value[0];
+        char32_t c = static_cast<HeapString *>(args[0].v.h)->value()[0];
         scratch = makeNumber((unsigned long)(c));
         return nullptr;
     }
@@ -1230,7 +1950,7 @@ class Interpreter {
     const AST *builtinExtVar(const LocationRange &loc, const std::vector<Value> &args)
     {
         validateBuiltinArgs(loc, "extVar", args, {Value::STRING});
-        const UString &var = static_cast<HeapString *>(args[0].v.h)->value;
+        const UString &var = static_cast<HeapString *>(args[0].v.h)->value();
         std::string var8 = encode_utf8(var);
         auto it = externalVars.find(var8);
         if (it == externalVars.end()) {
@@ -1242,16 +1962,42 @@ class Interpreter {
             std::string filename = "<extvar:" + var8 + ">";
             Tokens tokens = jsonnet_lex(filename, ext.data.c_str());
             AST *expr = jsonnet_parse(alloc, tokens);
-            jsonnet_desugar(alloc, expr, nullptr);
+            jsonnet_desugar(alloc, expr, nullptr, stdlib);
             jsonnet_static_analysis(expr);
             stack.pop();
             return expr;
+        } else if (ext.value != nullptr) {
+            // Values can be large, so only convert them once.
+            HeapThunk *&thunk = externalValues[var8];
+            if (thunk == nullptr) {
+                thunk = makeHeap<HeapThunk>(idJsonObjVar, nullptr, 0, nullptr);
+                jsonToHeap(*ext.value, thunk->filled, thunk->content);
+            }
+            scratch = thunk->content;
+            return nullptr;
         } else {
             scratch = makeString(decode_utf8(ext.data));
             return nullptr;
         }
     }
 
+    /** Not in std, only called by the code made by jsonnet_desugar to pass top-level arguments
+     * that were given as values.
+     */
+    const AST *builtinTlaValue(const LocationRange &loc, const std::vector<Value> &args)
+    {
+        validateBuiltinArgs(loc, "tlaValue", args, {Value::STRING});
+        std::string var8 = encode_utf8(static_cast<HeapString *>(args[0].v.h)->value());
+        auto it = topLevelArgs.find(var8);
+        if (it == topLevelArgs.end() || it->second.value == nullptr) {
+            std::string msg = "undefined top-level argument: " + var8;
+            throw makeError(loc, msg);
+        }
+        bool filled;
+        jsonToHeap(*it->second.value, filled, scratch);
+        return nullptr;
+    }
+
     const AST *builtinPrimitiveEquals(const LocationRange &loc, const std::vector<Value> &args)
     {
         if (args.size() != 2) {
@@ -1269,10 +2015,11 @@ class Interpreter {
 
             case Value::NUMBER: r = args[0].v.d == args[1].v.d; break;
 
-            case Value::STRING:
-                r = static_cast<HeapString *>(args[0].v.h)->value ==
-                    static_cast<HeapString *>(args[1].v.h)->value;
-                break;
+            case Value::STRING: {
+                const auto *a = static_cast<HeapString *>(args[0].v.h);
+                const auto *b = static_cast<HeapString *>(args[1].v.h);
+                r = a->length == b->length && a->value() == b->value();
+            } break;
 
             case Value::NULL_TYPE: r = true; break;
 
@@ -1292,7 +2039,7 @@ class Interpreter {
     {
         validateBuiltinArgs(loc, "native", args, {Value::STRING});
 
-        std::string builtin_name = encode_utf8(static_cast<HeapString *>(args[0].v.h)->value);
+        std::string builtin_name = encode_utf8(static_cast<HeapString *>(args[0].v.h)->value());
 
         VmNativeCallbackMap::const_iterator nit = nativeCallbacks.find(builtin_name);
         if (nit == nativeCallbacks.end()) {
@@ -1304,11 +2051,97 @@ class Interpreter {
         return nullptr;
     }
 
+    /** The error for the result of a native callback that failed. */
+    RuntimeError nativeError(const LocationRange &loc, const JsonnetJsonValue &result)
+    {
+        if (result.kind != JsonnetJsonValue::STRING)
+            return makeError(loc, "native extension returned an error that was not a string.");
+        return makeError(loc, result.string);
+    }
+
+    /** Call a vectorized native callback, see jsonnet_native_callback_vectorized.
+     *
+     * \param calls An array with the array of arguments of each call.
+     * \returns An array with the result of each call.
+     */
+    std::unique_ptr<JsonnetJsonValue> callNativeBatch(const LocationRange &loc,
+                                                      const std::string &name,
+                                                      const VmNativeCallback &cb,
+                                                      const JsonnetJsonValue &calls)
+    {
+        const JsonnetJsonValue *argv[] = {&calls};
+        int succ;
+        std::unique_ptr<JsonnetJsonValue> r(cb.cb(cb.ctx, argv, &succ));
+        if (!succ)
+            throw nativeError(loc, *r);
+        if (r->kind != JsonnetJsonValue::ARRAY || r->elements.size() != calls.elements.size()) {
+            std::stringstream ss;
+            ss << "vectorized native extension " << name << " must return an array of "
+               << calls.elements.size() << " results.";
+            throw makeError(loc, ss.str());
+        }
+        return r;
+    }
+
+    /** Implements std.map for arrays, or gives null to leave it to the Jsonnet code.
+     *
+     * For a function of one parameter, each element is a thunk of its body, with the parameter
+     * bound to the element of arr.  Vectorized native callbacks get all the elements in one call.
+     */
+    const AST *builtinMapImpl(const LocationRange &loc, const std::vector<Value> &args)
+    {
+        Frame &f = stack.top();
+        scratch = makeNull();
+        if (args[0].t != Value::FUNCTION || args[1].t != Value::ARRAY)
+            return nullptr;
+        auto *func = static_cast<HeapClosure *>(args[0].v.h);
+        auto *arr = static_cast<HeapArray *>(args[1].v.h);
+        if (func->params.size() != 1)
+            return nullptr;
+        if (func->body != nullptr) {
+            std::vector<HeapThunk *> elements(arr->size());
+            for (size_t i = 0; i < arr->size(); ++i) {
+                auto *th =
+                    makeHeap<HeapThunk>(idArrayElement, func->self, func->offset, func->body);
+                // The next line stops the new thunks from being GCed.
+                f.thunks.push_back(th);
+                th->upValues = func->upValues;
+                th->upValues[func->params[0].id] = (*arr)[i];
+                elements[i] = th;
+            }
+            scratch = makeArray(elements);
+            return nullptr;
+        }
+        if (builtins.find(func->builtinName) != builtins.end())
+            return nullptr;
+        VmNativeCallbackMap::const_iterator nit = nativeCallbacks.find(func->builtinName);
+        if (nit == nativeCallbacks.end() || !nit->second.vectorized)
+            return nullptr;
+
+        std::unique_ptr<JsonnetJsonValue> calls(
+            new JsonnetJsonValue(JsonnetJsonValue::ARRAY, "", 0));
+        calls->elements.reserve(arr->size());
+        for (size_t i = 0; i < arr->size(); ++i) {
+            forceThunk(loc, (*arr)[i]);
+            if (scratch.t == Value::FUNCTION)
+                throw makeError(loc, "native extensions cannot take functions.");
+            std::unique_ptr<JsonnetJsonValue> call(
+                new JsonnetJsonValue(JsonnetJsonValue::ARRAY, "", 0));
+            call->elements.push_back(manifestJsonValue(loc));
+            calls->elements.push_back(std::move(call));
+        }
+        std::unique_ptr<JsonnetJsonValue> results =
+            callNativeBatch(loc, func->builtinName, nit->second, *calls);
+        bool unused;
+        jsonToHeap(*results, unused, scratch);
+        return nullptr;
+    }
+
     const AST *builtinMd5(const LocationRange &loc, const std::vector<Value> &args)
     {
         validateBuiltinArgs(loc, "md5", args, {Value::STRING});
 
-        std::string value = encode_utf8(static_cast<HeapString *>(args[0].v.h)->value);
+        std::string value = encode_utf8(static_cast<HeapString *>(args[0].v.h)->value());
 
         scratch = makeString(decode_utf8(md5(value)));
         return nullptr;
@@ -1318,10 +2151,10 @@ class Interpreter {
     {
         validateBuiltinArgs(loc, "encodeUTF8", args, {Value::STRING});
 
-        std::string byteString = encode_utf8(static_cast<HeapString *>(args[0].v.h)->value);
+        std::string byteString = encode_utf8(static_cast<HeapString *>(args[0].v.h)->value());
 
         scratch = makeArray({});
-        auto &elements = static_cast<HeapArray *>(scratch.v.h)->elements;
+        auto &elements = *static_cast<HeapArray *>(scratch.v.h);
         for (const auto c : byteString) {
             auto *th = makeHeap<HeapThunk>(idArrayElement, nullptr, 0, nullptr);
             elements.push_back(th);
@@ -1333,7 +2166,7 @@ class Interpreter {
     const AST *decodeUTF8(void)
     {
         Frame &f = stack.top();
-        const auto& elements = static_cast<HeapArray*>(f.val.v.h)->elements;
+        const auto& elements = *static_cast<HeapArray*>(f.val.v.h);
         while (f.elementId < elements.size()) {
             auto *th = elements[f.elementId];
             if (th->filled) {
@@ -1382,7 +2215,7 @@ class Interpreter {
             throw makeError(loc, ss.str());
         }
 
-        std::string str = encode_utf8(static_cast<HeapString *>(args[0].v.h)->value);
+        std::string str = encode_utf8(static_cast<HeapString *>(args[0].v.h)->value());
         std::cerr << "TRACE: " << loc.file << ":" << loc.begin.line << " " <<  str
             << std::endl;
 
@@ -1399,13 +2232,13 @@ class Interpreter {
         unsigned start = 0;
         unsigned test = 0;
         scratch = makeArray({});
-        auto &elements = static_cast<HeapArray *>(scratch.v.h)->elements;
-        while (test < str->value.size() && (maxsplits == -1 ||
+        auto &elements = *static_cast<HeapArray *>(scratch.v.h);
+        while (test < str->value().size() && (maxsplits == -1 ||
                                             size_t(maxsplits) > elements.size())) {
-            if (c->value[0] == str->value[test]) {
+            if (c->value()[0] == str->value()[test]) {
                 auto *th = makeHeap<HeapThunk>(idArrayElement, nullptr, 0, nullptr);
                 elements.push_back(th);
-                th->fill(makeString(str->value.substr(start, test - start)));
+                th->fill(makeString(str->value().substr(start, test - start)));
                 start = test + 1;
                 test = start;
             } else {
@@ -1414,7 +2247,7 @@ class Interpreter {
         }
         auto *th = makeHeap<HeapThunk>(idArrayElement, nullptr, 0, nullptr);
         elements.push_back(th);
-        th->fill(makeString(str->value.substr(start)));
+        th->fill(makeString(str->value().substr(start)));
 
         return nullptr;
     }
@@ -1435,14 +2268,84 @@ class Interpreter {
             ss << "substr third parameter should be greater than zero, got " << len;
             throw makeError(loc, ss.str());
         }
-        if (static_cast<unsigned long>(from) > str->value.size()) {
+        if (static_cast<unsigned long>(from) > str->value().size()) {
             scratch = makeString(UString());
             return nullptr;
         }
-        if (size_t(len + from) > str->value.size()) {
-          len = str->value.size() - from;
+        if (size_t(len + from) > str->value().size()) {
+          len = str->value().size() - from;
+        }
+        scratch = makeString(str->value().substr(from, len));
+        return nullptr;
+    }
+
+    const AST *builtinSlice(const LocationRange &loc, const std::vector<Value> &args)
+    {
+        if (args.size() != 4) {
+            throw makeError(loc, "slice takes 4 parameters.");
+        }
+        const Value &indexable = args[0];
+        if (indexable.t != Value::STRING && indexable.t != Value::ARRAY) {
+            throw makeError(loc, "std.slice accepts a string or an array, but got: " +
+                                     type_str(indexable));
+        }
+        size_t length = indexable.t == Value::STRING
+                            ? static_cast<HeapString *>(indexable.v.h)->length
+                            : static_cast<HeapArray *>(indexable.v.h)->size();
+        // index, end and step, with the defaults applied.
+        double bounds[3] = {0, double(length), 1};
+        for (unsigned i = 0; i < 3; ++i) {
+            if (args[i + 1].t == Value::NUMBER) {
+                bounds[i] = args[i + 1].v.d;
+            } else if (args[i + 1].t != Value::NULL_TYPE) {
+                throw makeError(loc, "slice index, end, and step must be numbers or null, got " +
+                                         type_str(args[i + 1]));
+            }
+        }
+        if (bounds[0] < 0 || bounds[1] < 0 || bounds[2] < 0) {
+            std::stringstream ss;
+            ss << "got [" << jsonnet_unparse_number(bounds[0]) << ":"
+               << jsonnet_unparse_number(bounds[1]) << ":" << jsonnet_unparse_number(bounds[2])
+               << "] but negative index, end, and steps are not supported";
+            throw makeError(loc, ss.str());
+        }
+        if (bounds[2] == 0) {
+            throw makeError(loc, "got 0 but step must be greater than 0");
+        }
+        if (bounds[0] != std::floor(bounds[0]) || bounds[2] != std::floor(bounds[2])) {
+            std::stringstream ss;
+            ss << "slice index and step must be integers, got " << bounds[0] << " and "
+               << bounds[2];
+            throw makeError(loc, ss.str());
+        }
+        // Clamp before converting, the numbers may be too big for size_t.
+        size_t from = size_t(std::min(bounds[0], double(length)));
+        size_t to = size_t(std::min(std::ceil(bounds[1]), double(length)));
+        size_t step = size_t(std::min(bounds[2], double(length)));
+
+        if (from >= to) {
+            scratch = indexable.t == Value::STRING ? makeString(UString()) : makeArray({});
+        } else if (from == 0 && to == length && step == 1) {
+            scratch = indexable;
+        } else if (indexable.t == Value::STRING) {
+            const UString &str = static_cast<HeapString *>(indexable.v.h)->value();
+            UString r;
+            for (size_t i = from; i < to; i += step)
+                r += str[i];
+            scratch = makeString(r);
+        } else if (step == 1) {
+            // Share the elements, see HeapArray.
+            auto *arr = static_cast<HeapArray *>(indexable.v.h);
+            auto *view = makeHeap<HeapArray>(arr->base, arr->offset + from, to - from);
+            scratch.t = Value::ARRAY;
+            scratch.v.h = view;
+        } else {
+            const auto *arr = static_cast<HeapArray *>(indexable.v.h);
+            std::vector<HeapThunk *> elements;
+            for (size_t i = from; i < to; i += step)
+                elements.push_back((*arr)[i]);
+            scratch = makeArray(elements);
         }
-        scratch = makeString(str->value.substr(from, len));
         return nullptr;
     }
 
@@ -1454,7 +2357,7 @@ class Interpreter {
         long len = to - from + 1;
         scratch = makeArray({});
         if (len > 0) {
-            auto &elements = static_cast<HeapArray *>(scratch.v.h)->elements;
+            auto &elements = *static_cast<HeapArray *>(scratch.v.h);
             for (int i = 0; i < len; ++i) {
                 auto *th = makeHeap<HeapThunk>(idArrayElement, nullptr, 0, nullptr);
                 elements.push_back(th);
@@ -1470,18 +2373,18 @@ class Interpreter {
         const auto *str = static_cast<const HeapString *>(args[0].v.h);
         const auto *from = static_cast<const HeapString *>(args[1].v.h);
         const auto *to = static_cast<const HeapString *>(args[2].v.h);
-        if (from->value.empty()) {
+        if (from->value().empty()) {
           throw makeError(loc, "'from' string must not be zero length.");
         }
-        UString new_str(str->value);
+        UString new_str(str->value());
         UString::size_type pos = 0;
         while (pos < new_str.size()) {
-            auto index = new_str.find(from->value, pos);
+            auto index = new_str.find(from->value(), pos);
             if (index == new_str.npos) {
                 break;
             }
-            new_str.replace(index, from->value.size(), to->value);
-            pos = index + to->value.size();
+            new_str.replace(index, from->value().size(), to->value());
+            pos = index + to->value().size();
         }
         scratch = makeString(new_str);
         return nullptr;
@@ -1491,7 +2394,7 @@ class Interpreter {
     {
         validateBuiltinArgs(loc, "asciiLower", args, {Value::STRING});
         const auto *str = static_cast<const HeapString *>(args[0].v.h);
-        UString new_str(str->value);
+        UString new_str(str->value());
         for (size_t i = 0; i < new_str.size(); ++i) {
             if (new_str[i] >= 'A' && new_str[i] <= 'Z') {
                 new_str[i] = new_str[i] - 'A' + 'a';
@@ -1505,7 +2408,7 @@ class Interpreter {
     {
         validateBuiltinArgs(loc, "asciiUpper", args, {Value::STRING});
         const auto *str = static_cast<const HeapString *>(args[0].v.h);
-        UString new_str(str->value);
+        UString new_str(str->value());
         for (size_t i = 0; i < new_str.size(); ++i) {
             if (new_str[i] >= 'a' && new_str[i] <= 'z') {
                 new_str[i] = new_str[i] - 'a' + 'A';
@@ -1519,7 +2422,7 @@ class Interpreter {
     {
         validateBuiltinArgs(loc, "parseJson", args, {Value::STRING});
 
-        std::string value = encode_utf8(static_cast<HeapString *>(args[0].v.h)->value);
+        std::string value = encode_utf8(static_cast<HeapString *>(args[0].v.h)->value());
 
         auto j = json::parse(value);
 
@@ -1561,8 +2464,8 @@ class Interpreter {
                 filled = true;
                 auto *arr = static_cast<HeapArray *>(attach.v.h);
                 for (size_t i = 0; i < v.size(); ++i) {
-                    arr->elements.push_back(makeHeap<HeapThunk>(idArrayElement, nullptr, 0, nullptr));
-                    otherJsonToHeap(v[i], arr->elements[i]->filled, arr->elements[i]->content);
+                    arr->push_back(makeHeap<HeapThunk>(idArrayElement, nullptr, 0, nullptr));
+                    otherJsonToHeap(v[i], (*arr)[i]->filled, (*arr)[i]->content);
                 }
             } break;
 
@@ -1571,10 +2474,15 @@ class Interpreter {
                     BindingFrame{}, jsonObjVar, idJsonObjVar, BindingFrame{});
                 filled = true;
                 auto *obj = static_cast<HeapComprehensionObject *>(attach.v.h);
-                for (auto it = v.begin(); it != v.end(); ++it) {
+                // Add the fields in the order of compValues, so that each one is appended.
+                std::vector<std::pair<const Identifier *, const json *>> fields;
+                for (auto it = v.begin(); it != v.end(); ++it)
+                    fields.emplace_back(alloc->makeIdentifier(decode_utf8(it.key())), &it.value());
+                std::stable_sort(fields.begin(), fields.end(), identifierLess<const json *>);
+                for (const auto &field : fields) {
                     auto *thunk = makeHeap<HeapThunk>(idJsonObjVar, nullptr, 0, nullptr);
-                    obj->compValues[alloc->makeIdentifier(decode_utf8(it.key()))] = thunk;
-                    otherJsonToHeap(it.value(), thunk->filled, thunk->content);
+                    obj->compValues[field.first] = thunk;
+                    otherJsonToHeap(*field.second, thunk->filled, thunk->content);
                 }
             } break;
 
@@ -1595,16 +2503,16 @@ class Interpreter {
             throw makeError(stack.top().location, ss.str());
         }
         if (!first) {
-            running.append(static_cast<HeapString *>(sep.v.h)->value);
+            running.append(static_cast<HeapString *>(sep.v.h)->value());
         }
         first = false;
-        running.append(static_cast<HeapString *>(elt.v.h)->value);
+        running.append(static_cast<HeapString *>(elt.v.h)->value());
     }
 
     const AST *joinStrings(void)
     {
         Frame &f = stack.top();
-        const auto& elements = static_cast<HeapArray*>(f.val2.v.h)->elements;
+        const auto& elements = *static_cast<HeapArray*>(f.val2.v.h);
         while (f.elementId < elements.size()) {
             auto *th = elements[f.elementId];
             if (th->filled) {
@@ -1631,18 +2539,18 @@ class Interpreter {
             throw makeError(stack.top().location, ss.str());
         }
         if (!first) {
-            auto& elts = static_cast<HeapArray *>(sep.v.h)->elements;
+            auto& elts = *static_cast<HeapArray *>(sep.v.h);
             running.insert(running.end(), elts.begin(), elts.end());
         }
         first = false;
-        auto& elts = static_cast<HeapArray *>(elt.v.h)->elements;
+        auto& elts = *static_cast<HeapArray *>(elt.v.h);
         running.insert(running.end(), elts.begin(), elts.end());
     }
 
     const AST *joinArrays(void)
     {
         Frame &f = stack.top();
-        const auto& elements = static_cast<HeapArray*>(f.val2.v.h)->elements;
+        const auto& elements = *static_cast<HeapArray*>(f.val2.v.h);
         while (f.elementId < elements.size()) {
             auto *th = elements[f.elementId];
             if (th->filled) {
@@ -1689,23 +2597,1032 @@ class Interpreter {
         }
     }
 
-    void jsonToHeap(const std::unique_ptr<JsonnetJsonValue> &v, bool &filled, Value &attach)
+    const AST *builtinStringChars(const LocationRange &loc, const std::vector<Value> &args)
+    {
+        if (args[0].t == Value::ARRAY) {
+            scratch = args[0];
+            return nullptr;
+        }
+        validateBuiltinArgs(loc, "stringChars", args, {Value::STRING});
+        const UString &str = static_cast<HeapString *>(args[0].v.h)->value();
+        scratch = makeArray({});
+        auto &elements = *static_cast<HeapArray *>(scratch.v.h);
+        for (char32_t c : str) {
+            auto *th = makeHeap<HeapThunk>(idArrayElement, nullptr, 0, nullptr);
+            elements.push_back(th);
+            th->fill(makeString(UString(&c, 1)));
+        }
+        return nullptr;
+    }
+
+    /** Get the array argument of a builtin that the stdlib implemented by indexing it, so a
+     * string is taken as the array of its characters.
+     */
+    HeapArray *sequenceArg(const LocationRange &loc, const std::string &name,
+                           const std::string &param, const Value &v)
+    {
+        if (v.t == Value::STRING) {
+            builtinStringChars(loc, {v});
+            keepValue(scratch);
+            return static_cast<HeapArray *>(scratch.v.h);
+        }
+        if (v.t != Value::ARRAY) {
+            std::stringstream ss;
+            ss << name << " " << param << " parameter should be array, got " << type_str(v);
+            throw makeError(loc, ss.str());
+        }
+        return static_cast<HeapArray *>(v.v.h);
+    }
+
+    /** Raise the error of calling v, unless it is a function. */
+    void checkCallable(const LocationRange &loc, const Value &v)
+    {
+        if (v.t != Value::FUNCTION)
+            throw makeError(loc, "only functions can be called, got " + type_str(v));
+    }
+
+    /** Whether a builtin takes the argument at index i as it was given, without forcing it.
+     *
+     * The builtin finds the thunk of such an argument in the thunks of its frame, and the value
+     * it is passed for the argument is null.
+     */
+    static bool builtinArgIsLazy(const std::string &name, size_t i)
+    {
+        // The initial value of a fold is only evaluated if the function uses it.
+        return (name == "foldl" || name == "foldr") && i == 2;
+    }
+
+    const AST *builtinFoldl(const LocationRange &loc, const std::vector<Value> &args)
+    {
+        HeapArray *arr = sequenceArg(loc, "foldl", "second", args[1]);
+        HeapThunk *func = keepValue(args[0]);
+        HeapThunk *running = stack.top().thunks[2];
+        // Only the latest running value is kept in the frame.
+        stack.top().thunks.push_back(running);
+        size_t slot = stack.top().thunks.size() - 1;
+        for (size_t i = 0; i < arr->size(); ++i) {
+            running = callFunction(loc, callFunc, func, {running, (*arr)[i]});
+            stack.top().thunks[slot] = running;
+        }
+        forceThunk(loc, running);
+        return nullptr;
+    }
+
+    const AST *builtinFoldr(const LocationRange &loc, const std::vector<Value> &args)
+    {
+        HeapArray *arr = sequenceArg(loc, "foldr", "second", args[1]);
+        HeapThunk *func = keepValue(args[0]);
+        HeapThunk *running = stack.top().thunks[2];
+        stack.top().thunks.push_back(running);
+        size_t slot = stack.top().thunks.size() - 1;
+        for (size_t i = arr->size(); i > 0; --i) {
+            running = callFunction(loc, callFunc, func, {(*arr)[i - 1], running});
+            stack.top().thunks[slot] = running;
+        }
+        forceThunk(loc, running);
+        return nullptr;
+    }
+
+    const AST *builtinFlattenArrays(const LocationRange &loc, const std::vector<Value> &args)
+    {
+        validateBuiltinArgs(loc, "flattenArrays", args, {Value::ARRAY});
+        const auto &arrs = *static_cast<HeapArray *>(args[0].v.h);
+        std::vector<HeapThunk *> elements;
+        // Not a range-based for, as evaluating an element may append to the storage of arrs.
+        for (size_t i = 0; i < arrs.size(); ++i) {
+            forceThunk(loc, arrs[i]);
+            if (scratch.t != Value::ARRAY) {
+                throw makeError(loc,
+                                "binary operator + requires matching types, got array and " +
+                                    type_str(scratch) + ".");
+            }
+            const auto &arr = *static_cast<HeapArray *>(scratch.v.h);
+            elements.insert(elements.end(), arr.begin(), arr.end());
+        }
+        scratch = makeArray(elements);
+        return nullptr;
+    }
+
+    const AST *builtinEquals(const LocationRange &loc, const std::vector<Value> &args)
+    {
+        scratch = makeBoolean(equalValues(loc, args[0], args[1]));
+        return nullptr;
+    }
+
+    /** Get the key of an element for std.sort and the set functions, leaving it in scratch.
+     *
+     * If key_f is the identity function, which is the default, the element is its own key.
+     *
+     * \returns The thunk that holds the key.  It is kept in the frame if it is a new one.
+     */
+    HeapThunk *elementKey(const LocationRange &loc, HeapThunk *key_f, HeapThunk *element)
+    {
+        checkCallable(loc, key_f->content);
+        const auto *func = static_cast<HeapClosure *>(key_f->content.v.h);
+        if (func->params.size() == 1 && func->body != nullptr && func->body->type == AST_VAR &&
+            static_cast<const Var *>(func->body)->id == func->params[0].id) {
+            forceThunk(loc, element);
+            return element;
+        }
+        HeapThunk *key = callFunction(loc, callKeyF, key_f, {element});
+        stack.top().thunks.push_back(key);
+        return key;
+    }
+
+    /** Compare two keys with <, like the stdlib's sort and set functions did. */
+    bool keyLess(const LocationRange &loc, const Value &a, const Value &b)
+    {
+        if (a.t != b.t) {
+            throw makeError(loc,
+                            "binary operator < requires matching types, got " + type_str(a) +
+                                " and " + type_str(b) + ".");
+        }
+        switch (a.t) {
+            case Value::NUMBER: return a.v.d < b.v.d;
+
+            case Value::STRING:
+                return static_cast<HeapString *>(a.v.h)->value() <
+                       static_cast<HeapString *>(b.v.h)->value();
+
+            case Value::ARRAY: throw makeError(loc, "binary operator < does not operate on arrays.");
+
+            case Value::BOOLEAN:
+                throw makeError(loc, "binary operator < does not operate on booleans.");
+
+            case Value::FUNCTION:
+                throw makeError(loc, "binary operator < does not operate on functions.");
+
+            case Value::NULL_TYPE: throw makeError(loc, "binary operator < does not operate on null.");
+
+            case Value::OBJECT: throw makeError(loc, "binary operator < does not operate on objects.");
+        }
+        return false;  // Quiet, compiler.
+    }
+
+    const AST *builtinSortImpl(const LocationRange &loc, const std::vector<Value> &args)
+    {
+        HeapArray *arr = sequenceArg(loc, "sort", "first", args[0]);
+        if (arr->size() <= 1) {
+            scratch = args[0];
+            return nullptr;
+        }
+        HeapThunk *key_f = keepValue(args[1]);
+        std::vector<Value> keys;
+        // Not a range-based for, as evaluating a key may append to arr's storage.
+        for (size_t i = 0; i < arr->size(); ++i)
+            keys.push_back(elementKey(loc, key_f, (*arr)[i])->content);
+        // Check the keys up front, so that they can be compared without checks.
+        for (const auto &key : keys)
+            keyLess(loc, key, keys[0]);
+        std::vector<size_t> order(keys.size());
+        for (size_t i = 0; i < order.size(); ++i)
+            order[i] = i;
+        if (keys[0].t == Value::NUMBER) {
+            std::stable_sort(order.begin(), order.end(), [&](size_t a, size_t b) {
+                return keys[a].v.d < keys[b].v.d;
+            });
+        } else {
+            std::vector<const UString *> strs;
+            for (const auto &key : keys)
+                strs.push_back(&static_cast<HeapString *>(key.v.h)->value());
+            std::stable_sort(order.begin(), order.end(), [&](size_t a, size_t b) {
+                return *strs[a] < *strs[b];
+            });
+        }
+        std::vector<HeapThunk *> elements;
+        for (size_t i : order)
+            elements.push_back((*arr)[i]);
+        scratch = makeArray(elements);
+        return nullptr;
+    }
+
+    const AST *builtinUniqImpl(const LocationRange &loc, const std::vector<Value> &args)
+    {
+        HeapArray *arr = sequenceArg(loc, "uniq", "first", args[0]);
+        std::vector<HeapThunk *> elements;
+        if (arr->size() > 0) {
+            HeapThunk *key_f = keepValue(args[1]);
+            HeapThunk *last_key = nullptr;
+            elements.push_back((*arr)[0]);
+            for (size_t i = 1; i < arr->size(); ++i) {
+                if (last_key == nullptr)
+                    last_key = elementKey(loc, key_f, elements.back());
+                HeapThunk *key = elementKey(loc, key_f, (*arr)[i]);
+                if (!equalValues(loc, last_key->content, key->content)) {
+                    elements.push_back((*arr)[i]);
+                    last_key = key;
+                }
+            }
+        }
+        scratch = makeArray(elements);
+        return nullptr;
+    }
+
+    /** The arrays and keys of the set functions, whose keys are computed when first needed. */
+    struct SetArgs {
+        HeapArray *a, *b;
+        HeapThunk *keyF;
+        std::vector<HeapThunk *> keysA, keysB;
+    };
+
+    SetArgs setArgs(const LocationRange &loc, const std::string &name,
+                    const std::vector<Value> &args)
+    {
+        SetArgs r;
+        r.a = sequenceArg(loc, name, "first", args[0]);
+        r.b = sequenceArg(loc, name, "second", args[1]);
+        r.keyF = keepValue(args[2]);
+        r.keysA.resize(r.a->size());
+        r.keysB.resize(r.b->size());
+        return r;
+    }
+
+    /** Compare the keys of a[i] and b[j] as the set functions do: -1, 0 or 1. */
+    int setCompare(const LocationRange &loc, SetArgs &s, size_t i, size_t j)
+    {
+        if (s.keysA[i] == nullptr)
+            s.keysA[i] = elementKey(loc, s.keyF, (*s.a)[i]);
+        if (s.keysB[j] == nullptr)
+            s.keysB[j] = elementKey(loc, s.keyF, (*s.b)[j]);
+        const Value &ka = s.keysA[i]->content;
+        const Value &kb = s.keysB[j]->content;
+        if (equalValues(loc, ka, kb))
+            return 0;
+        return keyLess(loc, ka, kb) ? -1 : 1;
+    }
+
+    const AST *builtinSetInterImpl(const LocationRange &loc, const std::vector<Value> &args)
+    {
+        SetArgs s = setArgs(loc, "setInter", args);
+        std::vector<HeapThunk *> elements;
+        size_t i = 0, j = 0;
+        while (i < s.a->size() && j < s.b->size()) {
+            int cmp = setCompare(loc, s, i, j);
+            if (cmp == 0)
+                elements.push_back((*s.a)[i]);
+            if (cmp <= 0)
+                i++;
+            if (cmp >= 0)
+                j++;
+        }
+        scratch = makeArray(elements);
+        return nullptr;
+    }
+
+    const AST *builtinSetUnionImpl(const LocationRange &loc, const std::vector<Value> &args)
+    {
+        // NOTE: order matters, values in `a` win
+        SetArgs s = setArgs(loc, "setUnion", args);
+        std::vector<HeapThunk *> elements;
+        size_t i = 0, j = 0;
+        while (i < s.a->size() && j < s.b->size()) {
+            int cmp = setCompare(loc, s, i, j);
+            if (cmp <= 0) {
+                elements.push_back((*s.a)[i++]);
+                if (cmp == 0)
+                    j++;
+            } else {
+                elements.push_back((*s.b)[j++]);
+            }
+        }
+        for (; i < s.a->size(); ++i)
+            elements.push_back((*s.a)[i]);
+        for (; j < s.b->size(); ++j)
+            elements.push_back((*s.b)[j]);
+        scratch = makeArray(elements);
+        return nullptr;
+    }
+
+    const AST *builtinSetDiffImpl(const LocationRange &loc, const std::vector<Value> &args)
+    {
+        SetArgs s = setArgs(loc, "setDiff", args);
+        std::vector<HeapThunk *> elements;
+        size_t i = 0, j = 0;
+        while (i < s.a->size() && j < s.b->size()) {
+            int cmp = setCompare(loc, s, i, j);
+            if (cmp < 0)
+                elements.push_back((*s.a)[i]);
+            if (cmp <= 0)
+                i++;
+            if (cmp >= 0)
+                j++;
+        }
+        for (; i < s.a->size(); ++i)
+            elements.push_back((*s.a)[i]);
+        scratch = makeArray(elements);
+        return nullptr;
+    }
+
+    /** Parse the codes of a std.format format string.
+     *
+     * \param tail Set to the text after the last code.
+     */
+    std::vector<FormatCode> parseFormatCodes(const LocationRange &loc, const UString &str,
+                                             UString &tail)
+    {
+        std::vector<FormatCode> codes;
+        size_t i = 0;
+        auto next = [&]() -> char32_t {
+            if (i >= str.length())
+                throw makeError(loc, "Truncated format code.");
+            return str[i];
+        };
+        while (i < str.length()) {
+            char32_t c = str[i++];
+            if (c != U'%') {
+                tail += c;
+                continue;
+            }
+            FormatCode code;
+            code.literal = tail;
+            tail.clear();
+
+            // Mapping key, e.g. (name).
+            code.hasKey = next() == U'(';
+            if (code.hasKey) {
+                size_t start = ++i;
+                while (next() != U')')
+                    i++;
+                code.key = str.substr(start, i++ - start);
+            }
+
+            // Conversion flags.
+            code.alt = code.zero = code.left = code.blank = code.plus = false;
+            for (;; ++i) {
+                c = next();
+                if (c == U'#')
+                    code.alt = true;
+                else if (c == U'0')
+                    code.zero = true;
+                else if (c == U'-')
+                    code.left = true;
+                else if (c == U' ')
+                    code.blank = true;
+                else if (c == U'+')
+                    code.plus = true;
+                else
+                    break;
+            }
+
+            // Field width and precision, a number or *.
+            auto parse_width = [&](double &width, bool &star) {
+                width = 0;
+                star = i < str.length() && str[i] == U'*';
+                if (star) {
+                    i++;
+                    return;
+                }
+                for (; next() >= U'0' && next() <= U'9'; ++i)
+                    width = width * 10 + (str[i] - U'0');
+            };
+            parse_width(code.fw, code.fwStar);
+            code.hasPrec = next() == U'.';
+            code.prec = 0;
+            code.precStar = false;
+            if (code.hasPrec) {
+                i++;
+                parse_width(code.prec, code.precStar);
+            }
+
+            // Length modifier, ignored.
+            c = next();
+            if (c == U'h' || c == U'l' || c == U'L')
+                i++;
+
+            // Conversion type.
+            c = next();
+            i++;
+            code.caps = false;
+            switch (c) {
+                case U'd':
+                case U'i':
+                case U'u': code.ctype = U'd'; break;
+
+                case U'X': code.caps = true;
+                // Fall through.
+                case U'x': code.ctype = U'x'; break;
+
+                case U'E': code.caps = true;
+                // Fall through.
+                case U'e': code.ctype = U'e'; break;
+
+                case U'F': code.caps = true;
+                // Fall through.
+                case U'f': code.ctype = U'f'; break;
+
+                case U'G': code.caps = true;
+                // Fall through.
+                case U'g': code.ctype = U'g'; break;
+
+                case U'o':
+                case U'c':
+                case U's':
+                case U'%': code.ctype = c; break;
+
+                default:
+                    throw makeError(loc,
+                                    "Unrecognised conversion type: " + encode_utf8(UString(&c, 1)));
+            }
+            codes.push_back(code);
+        }
+        return codes;
+    }
+
+    /** Repeat s while w > 0, decrementing w, as std.format pads its output. */
+    static UString formatPadding(double w, const UString &s)
+    {
+        UString r;
+        for (; w > 0; w -= 1)
+            r += s;
+        return r;
+    }
+
+    /** Render a sign & magnitude integer as std.format does.
+     *
+     * \param mag The magnitude, a whole number >= 0.
+     * \param min_chars The field width.
+     * \param min_digits The number of digits to pad to with zeroes.
+     * \param radix From 2 to 10.
+     * \param zero_prefix Put before the digits of numbers other than 0.
+     */
+    static UString formatInt(bool neg, double mag, double min_chars, double min_digits,
+                             bool blank, bool plus, double radix, const UString &zero_prefix)
+    {
+        UString dec;
+        if (mag == 0) {
+            dec = U"0";
+        } else {
+            // Compute the digits with floating point arithmetic as the stdlib did, which matters
+            // for magnitudes above 2^53.
+            for (double n = mag; n != 0; n = std::floor(n / radix))
+                dec += char32_t(U'0' + int(std::fmod(n, radix)));
+            dec += UString(zero_prefix.rbegin(), zero_prefix.rend());
+            std::reverse(dec.begin(), dec.end());
+        }
+        double zp = min_chars - (neg || blank || plus ? 1 : 0);
+        double zp2 = std::max(zp, min_digits);
+        UString sign = neg ? U"-" : plus ? U"+" : blank ? U" " : U"";
+        return sign + formatPadding(zp2 - dec.length(), U"0") + dec;
+    }
+
+    /** Render an integer in hexadecimal as std.format does. */
+    static UString formatHex(double n__, double min_chars, double min_digits, bool blank,
+                             bool plus, bool add_zerox, bool capitals)
+    {
+        double n_ = std::fabs(n__);
+        UString hex;
+        if (std::floor(n_) == 0) {
+            hex = U"0";
+        } else {
+            const char32_t *numerals = capitals ? U"0123456789ABCDEF" : U"0123456789abcdef";
+            for (double n = std::floor(n_); n != 0; n = std::floor(n / 16))
+                hex += numerals[int(std::fmod(n, 16))];
+            std::reverse(hex.begin(), hex.end());
+        }
+        bool neg = n__ < 0;
+        double zp = min_chars - (neg || blank || plus ? 1 : 0) - (add_zerox ? 2 : 0);
+        double zp2 = std::max(zp, min_digits);
+        UString sign = neg ? U"-" : plus ? U"+" : blank ? U" " : U"";
+        UString zerox = add_zerox ? (capitals ? U"0X" : U"0x") : U"";
+        return sign + zerox + formatPadding(zp2 - hex.length(), U"0") + hex;
+    }
+
+    /** Render a number in decimal form as std.format does. */
+    UString formatFloatDec(const LocationRange &loc, double n__, double zero_pad, bool blank,
+                           bool plus, bool ensure_pt, bool trailing, double prec)
+    {
+        double n_ = std::fabs(n__);
+        double whole = std::floor(n_);
+        double dot_size = prec == 0 && !ensure_pt ? 0 : 1;
+        double zp = zero_pad - prec - dot_size;
+        UString str = formatInt(n__ < 0, whole, zp, 0, blank, plus, 10, U"");
+        if (prec == 0)
+            return ensure_pt ? str + U"." : str;
+        double frac = std::floor((n_ - whole) * makeNumberCheck(loc, std::pow(10, prec)).v.d + 0.5);
+        if (!trailing && frac <= 0)
+            return str;
+        UString frac_str = formatInt(false, frac, prec, 0, false, false, 10, U"");
+        if (!trailing) {
+            size_t len = frac_str.find_last_not_of(U'0');
+            frac_str.resize(len == UString::npos ? 0 : len + 1);
+        }
+        return str + U"." + frac_str;
+    }
+
+    /** Render a number in scientific form as std.format does. */
+    UString formatFloatSci(const LocationRange &loc, double n__, double zero_pad, bool blank,
+                           bool plus, bool ensure_pt, bool trailing, bool caps, double prec)
+    {
+        double exponent = 0;
+        if (n__ != 0)
+            exponent = std::floor(makeNumberCheck(loc, std::log(std::fabs(n__))).v.d / std::log(10));
+        UString suff = (caps ? U"E" : U"e") +
+                       formatInt(exponent < 0, std::fabs(exponent), 3, 0, false, true, 10, U"");
+        // Avoid a rounding error where 10^-324 is 0, -324 is the smallest exponent possible.
+        double mantissa = exponent == -324 ? n__ * 10 / std::pow(10, exponent + 1)
+                                           : n__ / std::pow(10, exponent);
+        double zp2 = zero_pad - suff.length();
+        return formatFloatDec(loc, mantissa, zp2, blank, plus, ensure_pt, trailing, prec) + suff;
+    }
+
+    /** Render a value with a format code other than %.
+     *
+     * \param index The index or field of the value, for errors.
+     */
+    UString formatValue(const LocationRange &loc, const Value &val, const FormatCode &code,
+                        double fw, double prec, const std::string &index)
+    {
+        double fpprec = code.hasPrec ? prec : 6;
+        double iprec = code.hasPrec ? prec : 0;
+        double zp = code.zero && !code.left ? fw : 0;
+        if (code.ctype == U's') {
+            if (val.t == Value::STRING)
+                return static_cast<HeapString *>(val.v.h)->value();
+            scratch = val;
+            return toString(loc);
+        }
+        if (code.ctype == U'c') {
+            if (val.t == Value::NUMBER) {
+                builtinChar(loc, {val});
+                return static_cast<HeapString *>(scratch.v.h)->value();
+            }
+            if (val.t != Value::STRING)
+                throw makeError(loc, "%c expected number / string, got: " + type_str(val));
+            const auto *str = static_cast<HeapString *>(val.v.h);
+            if (str->length != 1) {
+                throw makeError(loc,
+                                "%c expected 1-sized string got: " +
+                                    jsonnet_unparse_number(str->length));
+            }
+            return str->value();
+        }
+        if (val.t != Value::NUMBER) {
+            throw makeError(loc,
+                            "Format required number at " + index + ", got " + type_str(val));
+        }
+        double n = val.v.d;
+        switch (code.ctype) {
+            case U'd':
+                return formatInt(
+                    n <= -1, std::floor(std::fabs(n)), zp, iprec, code.blank, code.plus, 10, U"");
+
+            case U'o':
+                return formatInt(n <= -1,
+                                 std::floor(std::fabs(n)),
+                                 zp,
+                                 iprec,
+                                 code.blank,
+                                 code.plus,
+                                 8,
+                                 code.alt ? U"0" : U"");
+
+            case U'x':
+                return formatHex(
+                    std::floor(n), zp, iprec, code.blank, code.plus, code.alt, code.caps);
+
+            case U'f':
+                return formatFloatDec(loc, n, zp, code.blank, code.plus, code.alt, true, fpprec);
+
+            case U'e':
+                return formatFloatSci(
+                    loc, n, zp, code.blank, code.plus, code.alt, true, code.caps, fpprec);
+
+            default: {  // g
+                double exponent =
+                    std::floor(makeNumberCheck(loc, std::log(std::fabs(n))).v.d / std::log(10));
+                if (exponent < -4 || exponent >= fpprec) {
+                    return formatFloatSci(loc,
+                                          n,
+                                          zp,
+                                          code.blank,
+                                          code.plus,
+                                          code.alt,
+                                          code.alt,
+                                          code.caps,
+                                          fpprec - 1);
+                }
+                double digits_before_pt = std::max(1.0, exponent + 1);
+                return formatFloatDec(loc,
+                                      n,
+                                      zp,
+                                      code.blank,
+                                      code.plus,
+                                      code.alt,
+                                      code.alt,
+                                      fpprec - digits_before_pt);
+            }
+        }
+    }
+
+    /** Pad the rendering of a format code to the field width. */
+    static UString formatPad(const FormatCode &code, const UString &s, double fw)
+    {
+        UString padding = formatPadding(fw - s.length(), U" ");
+        return code.left ? s + padding : padding + s;
+    }
+
+    /** Force a value given for * in a format code, leaving it in scratch. */
+    void formatStarValue(const LocationRange &loc, const std::vector<HeapThunk *> &vals,
+                         size_t j)
+    {
+        if (j >= vals.size()) {
+            std::stringstream ss;
+            ss << "Not enough values to format: " << vals.size() << ", expected at least " << j;
+            throw makeError(loc, ss.str());
+        }
+        forceThunk(loc, vals[j]);
+        if (scratch.t != Value::NUMBER) {
+            throw makeError(loc,
+                            "binary operator - requires matching types, got " +
+                                type_str(scratch) + " and number.");
+        }
+    }
+
+    const AST *builtinFormat(const LocationRange &loc, const std::vector<Value> &args)
+    {
+        if (args[0].t != Value::STRING) {
+            std::stringstream ss;
+            ss << "format first parameter should be string, got " << type_str(args[0]);
+            throw makeError(loc, ss.str());
+        }
+        UString tail;
+        std::vector<FormatCode> codes =
+            parseFormatCodes(loc, static_cast<HeapString *>(args[0].v.h)->value(), tail);
+        UString out;
+
+        if (args[1].t == Value::OBJECT) {
+            auto *obj = static_cast<HeapObject *>(args[1].v.h);
+            for (const auto &code : codes) {
+                out += code.literal;
+                if (code.fwStar)
+                    throw makeError(loc, "Cannot use * field width with object.");
+                if (code.ctype == U'%') {
+                    out += formatPad(code, U"%", code.fw);
+                    continue;
+                }
+                if (!code.hasKey)
+                    throw makeError(loc, "Mapping keys required.");
+                const Identifier *f = alloc->makeIdentifier(code.key);
+                unsigned unused_found_at = 0;
+                if (findObject(f, obj, 0, unused_found_at) == nullptr)
+                    throw makeError(loc, "No such field: " + encode_utf8(code.key));
+                runInvariants(loc, obj);
+                evaluateField(loc, obj, f);
+                Value val = scratch;
+                if (code.precStar)
+                    throw makeError(loc, "Cannot use * precision with object.");
+                UString s = formatValue(loc, val, code, code.fw, code.prec, encode_utf8(code.key));
+                out += formatPad(code, s, code.fw);
+            }
+        } else {
+            std::vector<HeapThunk *> vals;
+            if (args[1].t == Value::ARRAY) {
+                const auto &arr = *static_cast<HeapArray *>(args[1].v.h);
+                vals.assign(arr.begin(), arr.end());
+            } else {
+                vals.push_back(keepValue(args[1]));
+            }
+            size_t j = 0;
+            for (const auto &code : codes) {
+                out += code.literal;
+                double fw = code.fw;
+                if (code.fwStar) {
+                    formatStarValue(loc, vals, j++);
+                    fw = scratch.v.d;
+                }
+                // A * precision is only evaluated if the conversion type uses it.
+                double prec = code.prec;
+                size_t prec_index = j;
+                if (code.precStar)
+                    j++;
+                if (code.ctype == U'%') {
+                    out += formatPad(code, U"%", fw);
+                    continue;
+                }
+                if (j >= vals.size()) {
+                    std::stringstream ss;
+                    ss << "Not enough values to format: " << vals.size() << ", expected more than "
+                       << j;
+                    throw makeError(loc, ss.str());
+                }
+                forceThunk(loc, vals[j]);
+                Value val = scratch;
+                if (code.precStar && code.ctype != U's' && code.ctype != U'c') {
+                    formatStarValue(loc, vals, prec_index);
+                    prec = scratch.v.d;
+                }
+                UString s = formatValue(loc, val, code, fw, prec, std::to_string(j));
+                out += formatPad(code, s, fw);
+                j++;
+            }
+            if (j < vals.size()) {
+                std::stringstream ss;
+                ss << "Too many values to format: " << vals.size() << ", expected " << j;
+                throw makeError(loc, ss.str());
+            }
+        }
+        out += tail;
+        scratch = makeString(out);
+        return nullptr;
+    }
+
+    const AST *builtinEscapeStringJson(const LocationRange &loc, const std::vector<Value> &args)
+    {
+        if (args[0].t == Value::STRING) {
+            const UString &str = static_cast<HeapString *>(args[0].v.h)->value();
+            scratch = makeString(jsonnet_string_unparse(str, false));
+        } else {
+            scratch = args[0];
+            scratch = makeString(jsonnet_string_unparse(toString(loc), false));
+        }
+        return nullptr;
+    }
+
+    /** Render the path of a value in std.manifestJsonEx and std.manifestYamlDoc errors, which
+     * is a JSON array of indexes and field names.
+     */
+    static std::string manifestPath(const std::vector<UString> &path)
+    {
+        if (path.empty())
+            return "[ ]";
+        UString r = U"[";
+        for (size_t i = 0; i < path.size(); ++i) {
+            if (i > 0)
+                r += U", ";
+            r += path[i];
+        }
+        return encode_utf8(r + U"]");
+    }
+
+    /** The visible fields of an object in the order the stdlib manifests them. */
+    std::map<UString, const Identifier *> sortedFields(HeapObject *obj)
+    {
+        std::map<UString, const Identifier *> fields;
+        for (const auto &f : objectFields(obj, true))
+            fields[f->name] = f;
+        return fields;
+    }
+
+    /** Append v as std.manifestJsonEx renders it to buf.
+     *
+     * \param path The indexes and fields of v in the value being manifested, for errors.
+     */
+    void manifestJsonEx(const LocationRange &loc, const Value &v, const UString &indent,
+                        const UString &cindent, std::vector<UString> &path, UString &buf)
+    {
+        switch (v.t) {
+            case Value::NULL_TYPE: buf += U"null"; break;
+
+            case Value::BOOLEAN: buf += v.v.b ? U"true" : U"false"; break;
+
+            case Value::NUMBER: buf += decode_utf8(jsonnet_unparse_number(v.v.d)); break;
+
+            case Value::STRING:
+                buf += jsonnet_string_unparse(static_cast<HeapString *>(v.v.h)->value(), false);
+                break;
+
+            case Value::FUNCTION:
+                throw makeError(loc, "Tried to manifest function at " + manifestPath(path));
+
+            case Value::ARRAY: {
+                const auto &arr = *static_cast<HeapArray *>(v.v.h);
+                UString new_indent = cindent + indent;
+                buf += U"[\n";
+                for (size_t i = 0; i < arr.size(); ++i) {
+                    if (i > 0)
+                        buf += U",\n";
+                    buf += new_indent;
+                    forceThunk(loc, arr[i]);
+                    Value element = scratch;
+                    path.push_back(decode_utf8(jsonnet_unparse_number(i)));
+                    manifestJsonEx(loc, element, indent, new_indent, path, buf);
+                    path.pop_back();
+                }
+                buf += U"\n" + cindent + U"]";
+            } break;
+
+            case Value::OBJECT: {
+                auto *obj = static_cast<HeapObject *>(v.v.h);
+                UString new_indent = cindent + indent;
+                buf += U"{\n";
+                bool first = true;
+                for (const auto &f : sortedFields(obj)) {
+                    if (first)
+                        runInvariants(loc, obj);
+                    else
+                        buf += U",\n";
+                    first = false;
+                    UString name = jsonnet_string_unparse(f.first, false);
+                    buf += new_indent + name + U": ";
+                    evaluateField(loc, obj, f.second);
+                    Value field = scratch;
+                    path.push_back(name);
+                    manifestJsonEx(loc, field, indent, new_indent, path, buf);
+                    path.pop_back();
+                }
+                buf += U"\n" + cindent + U"}";
+            } break;
+        }
+    }
+
+    const AST *builtinManifestJsonEx(const LocationRange &loc, const std::vector<Value> &args)
+    {
+        if (args[1].t != Value::STRING) {
+            std::stringstream ss;
+            ss << "manifestJsonEx second parameter should be string, got " << type_str(args[1]);
+            throw makeError(loc, ss.str());
+        }
+        UString indent = static_cast<HeapString *>(args[1].v.h)->value();
+        std::vector<UString> path;
+        UString buf;
+        manifestJsonEx(loc, args[0], indent, U"", path, buf);
+        scratch = makeString(buf);
+        return nullptr;
+    }
+
+    /** Append v as std.manifestYamlDoc renders it to buf.
+     *
+     * \param indent_array_in_object The argument of std.manifestYamlDoc, which is only checked
+     * to be a boolean when it is used.
+     * \param path The indexes and fields of v in the value being manifested, for errors.
+     */
+    void manifestYamlDoc(const LocationRange &loc, const Value &v,
+                         const Value &indent_array_in_object, const UString &cindent,
+                         std::vector<UString> &path, UString &buf)
+    {
+        // Whether a value is put on the next line, and how much it is indented.
+        auto nested = [&](const Value &value, bool in_object, UString &new_indent) -> bool {
+            if (value.t == Value::ARRAY && static_cast<HeapArray *>(value.v.h)->size() > 0) {
+                new_indent = cindent + U"  ";
+                if (in_object) {
+                    if (indent_array_in_object.t != Value::BOOLEAN) {
+                        throw makeError(loc,
+                                        "condition must be boolean, got " +
+                                            type_str(indent_array_in_object) + ".");
+                    }
+                    if (!indent_array_in_object.v.b)
+                        new_indent = cindent;
+                }
+                return true;
+            }
+            if (value.t == Value::OBJECT &&
+                objectFields(static_cast<HeapObject *>(value.v.h), true).size() > 0) {
+                new_indent = cindent + U"  ";
+                return in_object;
+            }
+            new_indent = cindent;
+            return false;
+        };
+
+        switch (v.t) {
+            case Value::STRING: {
+                const UString &str = static_cast<HeapString *>(v.v.h)->value();
+                if (str.empty()) {
+                    buf += U"\"\"";
+                } else if (str.back() == U'\n') {
+                    buf += U"|";
+                    for (size_t start = 0; start < str.length();) {
+                        size_t end = str.find(U'\n', start);
+                        buf += U"\n" + cindent + U"  " + str.substr(start, end - start);
+                        start = end + 1;
+                    }
+                } else {
+                    buf += jsonnet_string_unparse(str, false);
+                }
+            } break;
+
+            case Value::ARRAY: {
+                const auto &arr = *static_cast<HeapArray *>(v.v.h);
+                if (arr.size() == 0) {
+                    buf += U"[]";
+                    break;
+                }
+                for (size_t i = 0; i < arr.size(); ++i) {
+                    if (i > 0)
+                        buf += U"\n" + cindent;
+                    forceThunk(loc, arr[i]);
+                    Value element = scratch;
+                    UString new_indent;
+                    bool newline = nested(element, false, new_indent);
+                    buf += newline ? U"-\n" + new_indent : U"- ";
+                    path.push_back(decode_utf8(jsonnet_unparse_number(i)));
+                    manifestYamlDoc(loc, element, indent_array_in_object, new_indent, path, buf);
+                    path.pop_back();
+                }
+            } break;
+
+            case Value::OBJECT: {
+                auto *obj = static_cast<HeapObject *>(v.v.h);
+                auto fields = sortedFields(obj);
+                if (fields.size() == 0) {
+                    buf += U"{}";
+                    break;
+                }
+                bool first = true;
+                for (const auto &f : fields) {
+                    if (first)
+                        runInvariants(loc, obj);
+                    else
+                        buf += U"\n" + cindent;
+                    first = false;
+                    UString name = jsonnet_string_unparse(f.first, false);
+                    buf += name + U":";
+                    evaluateField(loc, obj, f.second);
+                    Value field = scratch;
+                    UString new_indent;
+                    bool newline = nested(field, true, new_indent);
+                    buf += newline ? U"\n" + new_indent : U" ";
+                    path.push_back(name);
+                    manifestYamlDoc(loc, field, indent_array_in_object, new_indent, path, buf);
+                    path.pop_back();
+                }
+            } break;
+
+            default: manifestJsonEx(loc, v, U"", U"", path, buf);
+        }
+    }
+
+    const AST *builtinManifestYamlDocImpl(const LocationRange &loc,
+                                          const std::vector<Value> &args)
+    {
+        std::vector<UString> path;
+        UString buf;
+        manifestYamlDoc(loc, args[0], args[1], U"", path, buf);
+        scratch = makeString(buf);
+        return nullptr;
+    }
+
+    const AST *builtinBase64(const LocationRange &loc, const std::vector<Value> &args)
+    {
+        std::vector<int64_t> bytes;
+        if (args[0].t == Value::STRING) {
+            for (char32_t c : static_cast<HeapString *>(args[0].v.h)->value()) {
+                if (c >= 256)
+                    throw makeError(loc, "Can only base64 encode strings / arrays of single bytes.");
+                bytes.push_back(c);
+            }
+        } else if (args[0].t == Value::ARRAY) {
+            const auto &arr = *static_cast<HeapArray *>(args[0].v.h);
+            // Not a range-based for, as evaluating an element may append to arr's storage.
+            for (size_t i = 0; i < arr.size(); ++i) {
+                forceThunk(loc, arr[i]);
+                if (scratch.t != Value::NUMBER) {
+                    throw makeError(loc,
+                                    "binary operator < requires matching types, got " +
+                                        type_str(scratch) + " and number.");
+                }
+                if (!(scratch.v.d < 256))
+                    throw makeError(loc, "Can only base64 encode strings / arrays of single bytes.");
+                bytes.push_back(int64_t(scratch.v.d));
+            }
+        } else {
+            std::stringstream ss;
+            ss << "base64 first parameter should be string or array, got " << type_str(args[0]);
+            throw makeError(loc, ss.str());
+        }
+        static const char32_t table[] =
+            U"ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/";
+        UString r;
+        for (size_t i = 0; i < bytes.size(); i += 3) {
+            int64_t b0 = bytes[i];
+            r += table[(b0 & 252) >> 2];
+            if (i + 1 >= bytes.size()) {
+                r += table[(b0 & 3) << 4];
+                r += U"==";
+                break;
+            }
+            int64_t b1 = bytes[i + 1];
+            r += table[(b0 & 3) << 4 | (b1 & 240) >> 4];
+            if (i + 2 >= bytes.size()) {
+                r += table[(b1 & 15) << 2];
+                r += U"=";
+                break;
+            }
+            int64_t b2 = bytes[i + 2];
+            r += table[(b1 & 15) << 2 | (b2 & 192) >> 6];
+            r += table[b2 & 63];
+        }
+        scratch = makeString(r);
+        return nullptr;
+    }
+
+    void jsonToHeap(const JsonnetJsonValue &v, bool &filled, Value &attach)
     {
         // In order to not anger the garbage collector, assign to attach immediately after
         // making the heap object.
-        switch (v->kind) {
+        switch (v.kind) {
             case JsonnetJsonValue::STRING:
-                attach = makeString(decode_utf8(v->string));
+                attach = makeString(decode_utf8(v.string));
                 filled = true;
                 break;
 
             case JsonnetJsonValue::BOOL:
-                attach = makeBoolean(v->number != 0.0);
+                attach = makeBoolean(v.number != 0.0);
                 filled = true;
                 break;
 
             case JsonnetJsonValue::NUMBER:
-                attach = makeNumber(v->number);
+                attach = makeNumber(v.number);
                 filled = true;
                 break;
 
@@ -1718,10 +3635,10 @@ class Interpreter {
                 attach = makeArray(std::vector<HeapThunk *>{});
                 filled = true;
                 auto *arr = static_cast<HeapArray *>(attach.v.h);
-                for (size_t i = 0; i < v->elements.size(); ++i) {
-                    arr->elements.push_back(
+                for (size_t i = 0; i < v.elements.size(); ++i) {
+                    arr->push_back(
                         makeHeap<HeapThunk>(idArrayElement, nullptr, 0, nullptr));
-                    jsonToHeap(v->elements[i], arr->elements[i]->filled, arr->elements[i]->content);
+                    jsonToHeap(*v.elements[i], (*arr)[i]->filled, (*arr)[i]->content);
                 }
             } break;
 
@@ -1730,10 +3647,17 @@ class Interpreter {
                     BindingFrame{}, jsonObjVar, idJsonObjVar, BindingFrame{});
                 filled = true;
                 auto *obj = static_cast<HeapComprehensionObject *>(attach.v.h);
-                for (const auto &pair : v->fields) {
+                // Add the fields in the order of compValues, so that each one is appended.
+                std::vector<std::pair<const Identifier *, const JsonnetJsonValue *>> fields;
+                for (const auto &pair : v.fields)
+                    fields.emplace_back(alloc->makeIdentifier(decode_utf8(pair.first)),
+                                        pair.second.get());
+                std::stable_sort(
+                    fields.begin(), fields.end(), identifierLess<const JsonnetJsonValue *>);
+                for (const auto &field : fields) {
                     auto *thunk = makeHeap<HeapThunk>(idJsonObjVar, nullptr, 0, nullptr);
-                    obj->compValues[alloc->makeIdentifier(decode_utf8(pair.first))] = thunk;
-                    jsonToHeap(pair.second, thunk->filled, thunk->content);
+                    obj->compValues[field.first] = thunk;
+                    jsonToHeap(*field.second, thunk->filled, thunk->content);
                 }
             } break;
         }
@@ -1770,6 +3694,10 @@ class Interpreter {
     }
 
     /** Index an object's field.
+     *
+     * If the field was already evaluated with obj as self, its value is put in scratch and
+     * nullptr is returned.  Otherwise a FRAME_CALL is pushed to evaluate the returned body, and
+     * the value is cached in obj when that frame is done.
      *
      * \param loc Location where the e.f occured.
      * \param obj The target
@@ -1784,11 +3712,17 @@ class Interpreter {
         if (found == nullptr) {
             throw makeError(loc, "field does not exist: " + encode_utf8(f->name));
         }
+        auto cached = self->fieldValues.find(std::make_pair(f, found_at));
+        if (cached != self->fieldValues.end()) {
+            scratch = cached->second;
+            return nullptr;
+        }
         if (auto *simp = dynamic_cast<HeapSimpleObject *>(found)) {
             auto it = simp->fields.find(f);
             const AST *body = it->second.body;
 
             stack.newCall(loc, simp, self, found_at, simp->upValues);
+            stack.top().field = f;
             return body;
         } else {
             // If a HeapLeafObject is not HeapSimpleObject, it must be HeapComprehensionObject.
@@ -1798,10 +3732,45 @@ class Interpreter {
             BindingFrame binds = comp->upValues;
             binds[comp->id] = th;
             stack.newCall(loc, comp, self, found_at, binds);
+            stack.top().field = f;
             return comp->value;
         }
     }
 
+    /** Cache the value in scratch as the value of the field evaluated by the given frame. */
+    void cacheField(const Frame &f)
+    {
+        f.self->fieldValues[std::make_pair(f.field, f.offset)] = scratch;
+        heap.writeBarrier(f.self, scratch);
+    }
+
+    /** Evaluate an object's field during manifestation, leaving its value in scratch.
+     *
+     * The object must be in scratch.  A FRAME_CALL is pushed with the object in val, so that it
+     * is not collected while the field is manifested.  The caller must pop it.
+     *
+     * \returns The body of the field, for the location of errors.
+     */
+    const AST *manifestField(const LocationRange &loc, HeapObject *obj, const Identifier *f)
+    {
+        Value obj_value = scratch;
+        const AST *body = objectIndex(loc, obj, f, 0);
+        if (body != nullptr) {
+            stack.top().val = obj_value;
+            evaluate(body, stack.size());
+            cacheField(stack.top());
+            return body;
+        }
+        // The value was cached, but we still need the frame and the body.
+        unsigned found_at = 0;
+        HeapLeafObject *found = findObject(f, obj, 0, found_at);
+        stack.newCall(loc, found, obj, found_at, BindingFrame());
+        stack.top().val = obj_value;
+        if (auto *simp = dynamic_cast<HeapSimpleObject *>(found))
+            return simp->fields.find(f)->second.body;
+        return static_cast<HeapComprehensionObject *>(found)->value;
+    }
+
     void runInvariants(const LocationRange &loc, HeapObject *self)
     {
         if (stack.alreadyExecutingInvariants(self))
@@ -1823,6 +3792,160 @@ class Interpreter {
         evaluate(thunk->body, initial_stack_size);
     }
 
+    /** Force a thunk, leaving its value in scratch.
+     *
+     * This is for builtins that need the values of the elements of their arguments.  The
+     * thunk is evaluated before this returns, like the invariants in runInvariants.
+     */
+    void forceThunk(const LocationRange &loc, HeapThunk *thunk)
+    {
+        if (thunk->filled) {
+            scratch = thunk->content;
+            return;
+        }
+        unsigned initial_stack_size = stack.size();
+        stack.newCall(loc, thunk, thunk->self, thunk->offset, thunk->upValues);
+        evaluate(thunk->body, initial_stack_size);
+    }
+
+    /** Evaluate an object's field, leaving its value in scratch.
+     *
+     * The value is cached in the object, so it is not collected while the object is alive.
+     * Unlike e.f, this does not run the object's invariants.
+     */
+    void evaluateField(const LocationRange &loc, HeapObject *obj, const Identifier *f)
+    {
+        unsigned initial_stack_size = stack.size();
+        const AST *body = objectIndex(loc, obj, f, 0);
+        if (body != nullptr)
+            evaluate(body, initial_stack_size);
+    }
+
+    /** Call a function from a builtin, leaving the result in scratch.
+     *
+     * The call is made by evaluating one of the ASTs made by makeCallAST, so that builtins,
+     * default arguments and the errors for the wrong number of arguments are handled like in
+     * any other call.
+     *
+     * \param call callKeyF or callFunc.
+     * \param func A forced thunk that holds the function.
+     * \param args The thunks of the arguments, in the order of the parameters of call.
+     * \returns The thunk that holds the result.  The caller has to keep it reachable, e.g. in
+     * the thunks of its frame.
+     */
+    HeapThunk *callFunction(const LocationRange &loc, const Apply *call, HeapThunk *func,
+                            const std::vector<HeapThunk *> &args)
+    {
+        // Check the arguments here, as errors in call would have no location.
+        checkCallable(loc, func->content);
+        const auto &params = static_cast<HeapClosure *>(func->content.v.h)->params;
+        if (args.size() > params.size()) {
+            std::stringstream ss;
+            ss << "too many args, function has " << params.size() << " parameter(s)";
+            throw makeError(loc, ss.str());
+        }
+        for (unsigned i = args.size(); i < params.size(); ++i) {
+            if (params[i].def == nullptr) {
+                std::stringstream ss;
+                ss << "function parameter " << encode_utf8(params[i].id->name)
+                   << " not bound in call.";
+                throw makeError(loc, ss.str());
+            }
+        }
+        auto *thunk = makeHeap<HeapThunk>(nullptr, nullptr, 0, call);
+        thunk->upValues[call->freeVariables[0]] = func;
+        for (unsigned i = 0; i < args.size(); ++i)
+            thunk->upValues[call->freeVariables[i + 1]] = args[i];
+        forceThunk(loc, thunk);
+        return thunk;
+    }
+
+    /** Keep a value reachable until the builtin that is running returns.
+     *
+     * \returns A thunk filled with the value, e.g. to pass to callFunction.
+     */
+    HeapThunk *keepValue(const Value &v)
+    {
+        auto *thunk = makeHeap<HeapThunk>(nullptr, nullptr, 0, nullptr);
+        thunk->fill(v);
+        stack.top().thunks.push_back(thunk);
+        return thunk;
+    }
+
+    /** Compare two values like std.equals, evaluating the elements and fields that are compared.
+     */
+    bool equalValues(const LocationRange &loc, const Value &a, const Value &b)
+    {
+        if (a.t != b.t)
+            return false;
+        switch (a.t) {
+            case Value::NULL_TYPE: return true;
+
+            case Value::BOOLEAN: return a.v.b == b.v.b;
+
+            case Value::NUMBER: return a.v.d == b.v.d;
+
+            case Value::STRING: {
+                const auto *str_a = static_cast<HeapString *>(a.v.h);
+                const auto *str_b = static_cast<HeapString *>(b.v.h);
+                return str_a->length == str_b->length && str_a->value() == str_b->value();
+            }
+
+            case Value::FUNCTION: throw makeError(loc, "cannot test equality of functions");
+
+            case Value::ARRAY: {
+                const auto *arr_a = static_cast<HeapArray *>(a.v.h);
+                const auto *arr_b = static_cast<HeapArray *>(b.v.h);
+                if (arr_a->size() != arr_b->size())
+                    return false;
+                for (size_t i = 0; i < arr_a->size(); ++i) {
+                    // The values stay reachable from their thunks.
+                    forceThunk(loc, (*arr_a)[i]);
+                    Value el_a = scratch;
+                    forceThunk(loc, (*arr_b)[i]);
+                    Value el_b = scratch;
+                    if (!equalValues(loc, el_a, el_b))
+                        return false;
+                }
+                return true;
+            }
+
+            case Value::OBJECT: {
+                auto *obj_a = static_cast<HeapObject *>(a.v.h);
+                auto *obj_b = static_cast<HeapObject *>(b.v.h);
+                std::map<UString, const Identifier *> fields_a, fields_b;
+                for (const auto &f : objectFields(obj_a, true))
+                    fields_a[f->name] = f;
+                for (const auto &f : objectFields(obj_b, true))
+                    fields_b[f->name] = f;
+                if (fields_a.size() != fields_b.size())
+                    return false;
+                auto it_b = fields_b.begin();
+                for (const auto &f : fields_a) {
+                    if (f.first != (it_b++)->first)
+                        return false;
+                }
+                bool first = true;
+                for (const auto &f : fields_a) {
+                    // Like a[f] != b[f], which runs the invariants of the objects.
+                    if (first)
+                        runInvariants(loc, obj_a);
+                    evaluateField(loc, obj_a, f.second);
+                    Value field_a = scratch;
+                    if (first)
+                        runInvariants(loc, obj_b);
+                    first = false;
+                    evaluateField(loc, obj_b, f.second);
+                    Value field_b = scratch;
+                    if (!equalValues(loc, field_a, field_b))
+                        return false;
+                }
+                return true;
+            }
+        }
+        return false;  // Quiet, compiler.
+    }
+
     /** Evaluate the given AST to a value.
      *
      * Rather than call itself recursively, this function maintains a separate stack of
@@ -1839,6 +3962,8 @@ class Interpreter {
     {
     recurse:
 
+        checkCancelled(ast_->location);
+
         switch (ast_->type) {
             case AST_APPLY: {
                 const auto &ast = *static_cast<const Apply *>(ast_);
@@ -1853,10 +3978,10 @@ class Interpreter {
                 unsigned offset;
                 stack.getSelfBinding(self, offset);
                 scratch = makeArray({});
-                auto &elements = static_cast<HeapArray *>(scratch.v.h)->elements;
+                auto &elements = *static_cast<HeapArray *>(scratch.v.h);
                 for (const auto &el : ast.elements) {
                     auto *el_th = makeHeap<HeapThunk>(idArrayElement, self, offset, el.expr);
-                    el_th->upValues = capture(el.expr->freeVariables);
+                    el_th->upValues = capture(el.expr->freeVariables, el.expr->thunkSlots);
                     elements.push_back(el_th);
                 }
             } break;
@@ -1895,7 +4020,7 @@ class Interpreter {
 
             case AST_FUNCTION: {
                 const auto &ast = *static_cast<const Function *>(ast_);
-                auto env = capture(ast.freeVariables);
+                auto env = capture(ast.freeVariables, ast.freeVariableSlots);
                 HeapObject *self;
                 unsigned offset;
                 stack.getSelfBinding(self, offset);
@@ -1921,8 +4046,14 @@ class Interpreter {
 
             case AST_IMPORTSTR: {
                 const auto &ast = *static_cast<const Importstr *>(ast_);
-                const ImportCacheValue *value = importString(ast.location, ast.file);
-                scratch = makeString(decode_utf8(value->content));
+                ImportCacheValue *value = importString(ast.location, ast.file);
+                if (value->str == nullptr) {
+                    const JsonnetImportBuffer &buffer = value->file->buffer;
+                    UString str = decode_utf8(buffer.content, buffer.length);
+                    value->str = makeHeap<HeapString>(str);
+                }
+                scratch.t = Value::STRING;
+                scratch.v.h = value->str;
             } break;
 
             case AST_IN_SUPER: {
@@ -1941,7 +4072,7 @@ class Interpreter {
 
             case AST_LOCAL: {
                 const auto &ast = *static_cast<const Local *>(ast_);
-                stack.newFrame(FRAME_LOCAL, ast_);
+                stack.newScope(FRAME_LOCAL, ast_);
                 Frame &f = stack.top();
                 // First build all the thunks and bind them.
                 HeapObject *self;
@@ -1956,7 +4087,8 @@ class Interpreter {
                 // Now capture the environment (including the new thunks, to make cycles).
                 for (const auto &bind : ast.binds) {
                     auto *thunk = f.bindings[bind.var];
-                    thunk->upValues = capture(bind.body->freeVariables);
+                    thunk->upValues = capture(bind.body->freeVariables, bind.body->thunkSlots);
+                    heap.writeBarrier(thunk);
                 }
                 ast_ = ast.body;
                 goto recurse;
@@ -1984,11 +4116,10 @@ class Interpreter {
             case AST_DESUGARED_OBJECT: {
                 const auto &ast = *static_cast<const DesugaredObject *>(ast_);
                 if (ast.fields.empty()) {
-                    auto env = capture(ast.freeVariables);
+                    auto env = capture(ast.freeVariables, ast.freeVariableSlots);
                     std::map<const Identifier *, HeapSimpleObject::Field> fields;
                     scratch = makeObject<HeapSimpleObject>(env, fields, ast.asserts);
                 } else {
-                    auto env = capture(ast.freeVariables);
                     stack.newFrame(FRAME_OBJECT, ast_);
                     auto fit = ast.fields.begin();
                     stack.top().fit = fit;
@@ -1999,7 +4130,7 @@ class Interpreter {
 
             case AST_OBJECT_COMPREHENSION_SIMPLE: {
                 const auto &ast = *static_cast<const ObjectComprehensionSimple *>(ast_);
-                stack.newFrame(FRAME_OBJECT_COMP_ARRAY, ast_);
+                stack.newScope(FRAME_OBJECT_COMP_ARRAY, ast_);
                 ast_ = ast.array;
                 goto recurse;
             } break;
@@ -2028,7 +4159,7 @@ class Interpreter {
 
             case AST_VAR: {
                 const auto &ast = *static_cast<const Var *>(ast_);
-                auto *thunk = stack.lookUpVar(ast.id);
+                auto *thunk = stack.lookUpVar(ast.id, ast.slot);
                 if (thunk == nullptr) {
                     std::cerr << "INTERNAL ERROR: Could not bind variable: "
                               << encode_utf8(ast.id->name) << std::endl;
@@ -2058,14 +4189,9 @@ class Interpreter {
                     const auto &ast = *static_cast<const Apply *>(f.ast);
                     if (scratch.t != Value::FUNCTION) {
                         throw makeError(ast.location,
-                                        "only functions can be called, got " + type_str(scratch));
-                    }
-                    auto *func = static_cast<HeapClosure *>(scratch.v.h);
-
-                    std::set<const Identifier *> params_needed;
-                    for (const auto &param : func->params) {
-                        params_needed.insert(param.id);
+                                        "only functions can be called, got " + type_str(scratch));
                     }
+                    auto *func = static_cast<HeapClosure *>(scratch.v.h);
 
                     // Create thunks for arguments.
                     std::vector<HeapThunk *> positional_args;
@@ -2100,7 +4226,7 @@ class Interpreter {
                         unsigned offset;
                         stack.getSelfBinding(self, offset);
                         auto *thunk = makeHeap<HeapThunk>(name_, self, offset, arg.expr);
-                        thunk->upValues = capture(arg.expr->freeVariables);
+                        thunk->upValues = capture(arg.expr->freeVariables, arg.expr->thunkSlots);
                         // While making the thunks, keep them in a frame to avoid premature garbage
                         // collection.
                         f.thunks.push_back(thunk);
@@ -2110,7 +4236,14 @@ class Interpreter {
                             throw makeError(ast.location, ss.str());
                         }
                         args[name] = thunk;
-                        if (params_needed.find(name) == params_needed.end()) {
+                        bool param_found = false;
+                        for (const auto &param : func->params) {
+                            if (param.id == name) {
+                                param_found = true;
+                                break;
+                            }
+                        }
+                        if (!param_found) {
                             std::stringstream ss;
                             ss << "function has no parameter " << encode_utf8(name->name);
                             throw makeError(ast.location, ss.str());
@@ -2150,6 +4283,7 @@ class Interpreter {
                     // Fill in upvalues
                     for (HeapThunk *thunk : def_arg_thunks) {
                         thunk->upValues = up_values;
+                        heap.writeBarrier(thunk);
                     }
 
                     // Cache these, because pop will invalidate them.
@@ -2162,8 +4296,13 @@ class Interpreter {
                         // Built-in function.
                         // Give nullptr for self because noone looking at this frame will
                         // attempt to bind to self (it's native code).
+                        // Builtins take their arguments by position, so named arguments must
+                        // be put back in the order of the parameters.
+                        std::vector<HeapThunk *> builtin_args;
+                        for (const auto &param : func->params)
+                            builtin_args.push_back(args[param.id]);
                         stack.newFrame(FRAME_BUILTIN_FORCE_THUNKS, f_ast);
-                        stack.top().thunks = thunks_copy;
+                        stack.top().thunks = builtin_args;
                         stack.top().val = scratch;
                         goto replaceframe;
                     } else {
@@ -2254,7 +4393,7 @@ class Interpreter {
                             switch (rhs.t) {
                                 case Value::OBJECT: {
                                     auto *obj = static_cast<HeapObject *>(rhs.v.h);
-                                    auto *fid = alloc->makeIdentifier(field->value);
+                                    auto *fid = alloc->makeIdentifier(field->value());
                                     unsigned unused_found_at = 0;
                                     bool in = findObject(fid, obj, 0, unused_found_at);
                                     scratch = makeBoolean(in);
@@ -2285,12 +4424,7 @@ class Interpreter {
                             if (ast.op == BOP_PLUS) {
                                 auto *arr_l = static_cast<HeapArray *>(lhs.v.h);
                                 auto *arr_r = static_cast<HeapArray *>(rhs.v.h);
-                                std::vector<HeapThunk *> elements;
-                                for (auto *el : arr_l->elements)
-                                    elements.push_back(el);
-                                for (auto *el : arr_r->elements)
-                                    elements.push_back(el);
-                                scratch = makeArray(elements);
+                                scratch = makeArrayConcat(arr_l, arr_r);
                             } else {
                                 throw makeError(ast.location,
                                                 "binary operator " + bop_string(ast.op) +
@@ -2408,8 +4542,8 @@ class Interpreter {
                         } break;
 
                         case Value::STRING: {
-                            const UString &lhs_str = static_cast<HeapString *>(lhs.v.h)->value;
-                            const UString &rhs_str = static_cast<HeapString *>(rhs.v.h)->value;
+                            const UString &lhs_str = static_cast<HeapString *>(lhs.v.h)->value();
+                            const UString &rhs_str = static_cast<HeapString *>(rhs.v.h)->value();
                             switch (ast.op) {
                                 case BOP_PLUS: scratch = makeString(lhs_str + rhs_str); break;
 
@@ -2442,13 +4576,13 @@ class Interpreter {
                             "filter function must return boolean, got: " + type_str(scratch));
                     }
                     if (scratch.v.b)
-                        f.thunks.push_back(arr->elements[f.elementId]);
+                        f.thunks.push_back((*arr)[f.elementId]);
                     f.elementId++;
                     // Iterate through arr, calling the function on each.
-                    if (f.elementId == arr->elements.size()) {
+                    if (f.elementId == arr->size()) {
                         scratch = makeArray(f.thunks);
                     } else {
-                        auto *thunk = arr->elements[f.elementId];
+                        auto *thunk = (*arr)[f.elementId];
                         BindingFrame bindings = func->upValues;
                         bindings[func->params[0].id] = thunk;
                         stack.newCall(ast.location, func, func->self, func->offset, bindings);
@@ -2466,7 +4600,7 @@ class Interpreter {
                         const std::string &builtin_name = func->builtinName;
                         std::vector<Value> args;
                         for (auto *th : f.thunks) {
-                            args.push_back(th->content);
+                            args.push_back(th->filled ? th->content : makeNull());
                         }
                         BuiltinMap::const_iterator bit = builtins.find(builtin_name);
                         if (bit != builtins.end()) {
@@ -2479,70 +4613,76 @@ class Interpreter {
                         }
                         VmNativeCallbackMap::const_iterator nit =
                             nativeCallbacks.find(builtin_name);
-                        // TODO(dcunnin): Support arrays.
-                        // TODO(dcunnin): Support objects.
-                        std::vector<JsonnetJsonValue> args2;
-                        for (const Value &arg : args) {
-                            switch (arg.t) {
-                                case Value::STRING:
-                                    args2.emplace_back(
-                                        JsonnetJsonValue::STRING,
-                                        encode_utf8(static_cast<HeapString *>(arg.v.h)->value),
-                                        0);
-                                    break;
-
-                                case Value::BOOLEAN:
-                                    args2.emplace_back(
-                                        JsonnetJsonValue::BOOL, "", arg.v.b ? 1.0 : 0.0);
-                                    break;
-
-                                case Value::NUMBER:
-                                    args2.emplace_back(JsonnetJsonValue::NUMBER, "", arg.v.d);
-                                    break;
-
-                                case Value::NULL_TYPE:
-                                    args2.emplace_back(JsonnetJsonValue::NULL_KIND, "", 0);
-                                    break;
-
-                                default:
-                                    throw makeError(ast.location,
-                                                    "native extensions can only take primitives.");
-                            }
-                        }
-                        std::vector<const JsonnetJsonValue *> args3;
-                        for (size_t i = 0; i < args2.size(); ++i) {
-                            args3.push_back(&args2[i]);
-                        }
                         if (nit == nativeCallbacks.end()) {
                             throw makeError(ast.location,
                                             "unrecognized builtin name: " + builtin_name);
                         }
                         const VmNativeCallback &cb = nit->second;
 
-                        int succ;
-                        std::unique_ptr<JsonnetJsonValue> r(cb.cb(cb.ctx, args3.data(), &succ));
+                        // Arrays and objects are forced and converted whole.  This evaluates
+                        // code, so f must not be used after this.
+                        std::vector<std::unique_ptr<JsonnetJsonValue>> args2;
+                        for (const Value &arg : args) {
+                            if (arg.t == Value::FUNCTION) {
+                                throw makeError(ast.location,
+                                                "native extensions cannot take functions.");
+                            }
+                            scratch = arg;
+                            args2.push_back(manifestJsonValue(loc));
+                        }
+                        std::vector<const JsonnetJsonValue *> args3;
+                        for (const auto &arg : args2) {
+                            args3.push_back(arg.get());
+                        }
 
-                        if (succ) {
-                            bool unused;
-                            jsonToHeap(r, unused, scratch);
-                        } else {
-                            if (r->kind != JsonnetJsonValue::STRING) {
-                                throw makeError(
-                                    ast.location,
-                                    "native extension returned an error that was not a string.");
+                        std::string memo_key;
+                        std::shared_ptr<const JsonnetJsonValue> r;
+                        if (cb.memo != nullptr) {
+                            for (const JsonnetJsonValue *arg : args3)
+                                native_memo_key(*arg, memo_key);
+                            std::lock_guard<std::mutex> lock(cb.memo->mutex);
+                            auto it = cb.memo->results.find(memo_key);
+                            if (it != cb.memo->results.end())
+                                r = it->second;
+                        }
+                        if (r == nullptr) {
+                            if (cb.vectorized) {
+                                // A single call is a batch of one.
+                                std::unique_ptr<JsonnetJsonValue> calls(
+                                    new JsonnetJsonValue(JsonnetJsonValue::ARRAY, "", 0));
+                                calls->elements.emplace_back(
+                                    new JsonnetJsonValue(JsonnetJsonValue::ARRAY, "", 0));
+                                calls->elements[0]->elements = std::move(args2);
+                                r = std::move(
+                                    callNativeBatch(ast.location, builtin_name, cb, *calls)
+                                        ->elements[0]);
+                            } else {
+                                int succ;
+                                std::unique_ptr<JsonnetJsonValue> result(
+                                    cb.cb(cb.ctx, args3.data(), &succ));
+                                if (!succ)
+                                    throw nativeError(ast.location, *result);
+                                r = std::move(result);
+                            }
+                            if (cb.memo != nullptr) {
+                                std::lock_guard<std::mutex> lock(cb.memo->mutex);
+                                cb.memo->results[memo_key] = r;
                             }
-                            std::string rs = r->string;
-                            throw makeError(ast.location, rs);
                         }
+                        bool unused;
+                        jsonToHeap(*r, unused, scratch);
 
                     } else {
                         // Not all arguments forced yet.
-                        HeapThunk *th = f.thunks[f.elementId++];
-                        if (!th->filled) {
+                        size_t i = f.elementId++;
+                        HeapThunk *th = f.thunks[i];
+                        if (!th->filled && !builtinArgIsLazy(func->builtinName, i)) {
                             stack.newCall(ast.location, th, th->self, th->offset, th->upValues);
                             ast_ = th->body;
                             goto recurse;
                         }
+                        // Nothing to force, move on to the next argument.
+                        goto replaceframe;
                     }
                 } break;
 
@@ -2550,6 +4690,10 @@ class Interpreter {
                     if (auto *thunk = dynamic_cast<HeapThunk *>(f.context)) {
                         // If we called a thunk, cache result.
                         thunk->fill(scratch);
+                        heap.writeBarrier(thunk, scratch);
+                    } else if (f.field != nullptr) {
+                        // If we evaluated a field, cache result.
+                        cacheField(f);
                     } else if (auto *closure = dynamic_cast<HeapClosure *>(f.context)) {
                         if (f.elementId < f.thunks.size()) {
                             // If tailstrict, force thunks
@@ -2576,7 +4720,7 @@ class Interpreter {
                     const auto &ast = *static_cast<const Error *>(f.ast);
                     UString msg;
                     if (scratch.t == Value::STRING) {
-                        msg = static_cast<HeapString *>(scratch.v.h)->value;
+                        msg = static_cast<HeapString *>(scratch.v.h)->value();
                     } else {
                         msg = toString(ast.location);
                     }
@@ -2611,10 +4755,12 @@ class Interpreter {
                             "super index must be string, got " + type_str(scratch) + ".");
                     }
 
-                    const UString &index_name = static_cast<HeapString *>(scratch.v.h)->value;
+                    const UString &index_name = static_cast<HeapString *>(scratch.v.h)->value();
                     auto *fid = alloc->makeIdentifier(index_name);
                     stack.pop();
                     ast_ = objectIndex(ast.location, self, fid, offset);
+                    if (ast_ == nullptr)
+                        goto replaceframe;  // The value was cached, and is in scratch.
                     goto recurse;
                 } break;
 
@@ -2633,7 +4779,7 @@ class Interpreter {
                         // There is no super object.
                         scratch = makeBoolean(false);
                     } else {
-                        const UString &element_name = static_cast<HeapString *>(scratch.v.h)->value;
+                        const UString &element_name = static_cast<HeapString *>(scratch.v.h)->value();
                         auto *fid = alloc->makeIdentifier(element_name);
                         unsigned unused_found_at = 0;
                         bool in = findObject(fid, self, offset, unused_found_at);
@@ -2647,7 +4793,7 @@ class Interpreter {
                     if (target.t == Value::ARRAY) {
                         const auto *array = static_cast<HeapArray *>(target.v.h);
                         if (scratch.t == Value::STRING) {
-                            const UString &str = static_cast<HeapString *>(scratch.v.h)->value;
+                            const UString &str = static_cast<HeapString *>(scratch.v.h)->value();
                             throw makeError(
                                 ast.location,
                                 "attempted index an array with string \""
@@ -2659,7 +4805,7 @@ class Interpreter {
                                 "array index must be number, got " + type_str(scratch) + ".");
                         }
                         double index = ::floor(scratch.v.d);
-                        long sz = array->elements.size();
+                        long sz = array->size();
                         if (index < 0 || index >= sz) {
                             std::stringstream ss;
                             ss << "array bounds error: " << index << " not within [0, " << sz
@@ -2672,7 +4818,7 @@ class Interpreter {
                             throw makeError(ast.location, ss.str());
                         }
                         // index < sz <= SIZE_T_MAX
-                        auto *thunk = array->elements[size_t(index)];
+                        auto *thunk = (*array)[size_t(index)];
                         if (thunk->filled) {
                             scratch = thunk->content;
                         } else {
@@ -2690,10 +4836,12 @@ class Interpreter {
                                 ast.location,
                                 "object index must be string, got " + type_str(scratch) + ".");
                         }
-                        const UString &index_name = static_cast<HeapString *>(scratch.v.h)->value;
+                        const UString &index_name = static_cast<HeapString *>(scratch.v.h)->value();
                         auto *fid = alloc->makeIdentifier(index_name);
                         stack.pop();
                         ast_ = objectIndex(ast.location, obj, fid, 0);
+                        if (ast_ == nullptr)
+                            goto replaceframe;  // The value was cached, and is in scratch.
                         goto recurse;
                     } else if (target.t == Value::STRING) {
                         auto *obj = static_cast<HeapString *>(target.v.h);
@@ -2703,14 +4851,14 @@ class Interpreter {
                                 ast.location,
                                 "string index must be a number, got " + type_str(scratch) + ".");
                         }
-                        long sz = obj->value.length();
+                        long sz = obj->length;
                         long i = (long)scratch.v.d;
                         if (i < 0 || i >= sz) {
                             std::stringstream ss;
                             ss << "string bounds error: " << i << " not within [0, " << sz << ")";
                             throw makeError(ast.location, ss.str());
                         }
-                        char32_t ch[] = {obj->value[i], U'\0'};
+                        char32_t ch[] = {obj->value()[i], U'\0'};
                         scratch = makeString(ch);
                     } else {
                         std::cerr << "INTERNAL ERROR: not object / array / string." << std::endl;
@@ -2781,7 +4929,7 @@ class Interpreter {
                         if (scratch.t != Value::STRING) {
                             throw makeError(ast.location, "field name was not a string.");
                         }
-                        const auto &fname = static_cast<const HeapString *>(scratch.v.h)->value;
+                        const auto &fname = static_cast<const HeapString *>(scratch.v.h)->value();
                         const Identifier *fid = alloc->makeIdentifier(fname);
                         if (f.objectFields.find(fid) != f.objectFields.end()) {
                             std::string msg =
@@ -2796,7 +4944,7 @@ class Interpreter {
                         ast_ = f.fit->name;
                         goto recurse;
                     } else {
-                        auto env = capture(ast.freeVariables);
+                        auto env = capture(ast.freeVariables, ast.freeVariableSlots);
                         scratch = makeObject<HeapSimpleObject>(env, f.objectFields, ast.asserts);
                     }
                 } break;
@@ -2809,14 +4957,14 @@ class Interpreter {
                                         "object comprehension needs array, got " + type_str(arr_v));
                     }
                     const auto *arr = static_cast<const HeapArray *>(arr_v.v.h);
-                    if (arr->elements.size() == 0) {
+                    if (arr->size() == 0) {
                         // Degenerate case.  Just create the object now.
                         scratch = makeObject<HeapComprehensionObject>(
                             BindingFrame{}, ast.value, ast.id, BindingFrame{});
                     } else {
                         f.kind = FRAME_OBJECT_COMP_ELEMENT;
                         f.val = scratch;
-                        f.bindings[ast.id] = arr->elements[0];
+                        f.bindings[ast.id] = (*arr)[0];
                         f.elementId = 0;
                         ast_ = ast.field;
                         goto recurse;
@@ -2832,22 +4980,22 @@ class Interpreter {
                             ss << "field must be string, got: " << type_str(scratch);
                             throw makeError(ast.location, ss.str());
                         }
-                        const auto &fname = static_cast<const HeapString *>(scratch.v.h)->value;
+                        const auto &fname = static_cast<const HeapString *>(scratch.v.h)->value();
                         const Identifier *fid = alloc->makeIdentifier(fname);
                         if (f.elements.find(fid) != f.elements.end()) {
                             throw makeError(ast.location,
                                             "duplicate field name: \"" + encode_utf8(fname) + "\"");
                         }
-                        f.elements[fid] = arr->elements[f.elementId];
+                        f.elements[fid] = (*arr)[f.elementId];
                     }
                     f.elementId++;
 
-                    if (f.elementId == arr->elements.size()) {
-                        auto env = capture(ast.freeVariables);
-                        scratch =
-                            makeObject<HeapComprehensionObject>(env, ast.value, ast.id, f.elements);
+                    if (f.elementId == arr->size()) {
+                        auto env = capture(ast.freeVariables, ast.freeVariableSlots);
+                        scratch = makeObject<HeapComprehensionObject>(
+                            env, ast.value, ast.id, IdentifierMap<HeapThunk *>(f.elements));
                     } else {
-                        f.bindings[ast.id] = arr->elements[f.elementId];
+                        f.bindings[ast.id] = (*arr)[f.elementId];
                         ast_ = ast.field;
                         goto recurse;
                     }
@@ -2855,22 +5003,20 @@ class Interpreter {
 
                 case FRAME_STRING_CONCAT: {
                     const auto &ast = *static_cast<const Binary *>(f.ast);
-                    const Value &lhs = stack.top().val;
-                    const Value &rhs = stack.top().val2;
-                    UString output;
-                    if (lhs.t == Value::STRING) {
-                        output.append(static_cast<const HeapString *>(lhs.v.h)->value);
-                    } else {
-                        scratch = lhs;
-                        output.append(toString(ast.left->location));
+                    // Convert the operands in place, where they are safe from the GC.  Do not
+                    // use f after toString, which may grow the stack.
+                    if (stack.top().val.t != Value::STRING) {
+                        scratch = stack.top().val;
+                        UString lhs = toString(ast.left->location);
+                        stack.top().val = makeString(lhs);
                     }
-                    if (rhs.t == Value::STRING) {
-                        output.append(static_cast<const HeapString *>(rhs.v.h)->value);
-                    } else {
-                        scratch = rhs;
-                        output.append(toString(ast.right->location));
+                    if (stack.top().val2.t != Value::STRING) {
+                        scratch = stack.top().val2;
+                        UString rhs = toString(ast.right->location);
+                        stack.top().val2 = makeString(rhs);
                     }
-                    scratch = makeString(output);
+                    scratch = makeStringConcat(static_cast<HeapString *>(stack.top().val.v.h),
+                                               static_cast<HeapString *>(stack.top().val2.v.h));
                 } break;
 
                 case FRAME_UNARY: {
@@ -2951,59 +5097,54 @@ class Interpreter {
         }
     }
 
-    /** Manifest the scratch value by evaluating any remaining fields, and then convert to JSON.
+    /** Manifest the scratch value by evaluating any remaining fields, passing it to visitor as it
+     * goes.
      *
      * This can trigger a garbage collection cycle.  Be sure to stash any objects that aren't
      * reachable via the stack or heap.
-     *
-     * \param multiline If true, will print objects and arrays in an indented fashion.
      */
-    UString manifestJson(const LocationRange &loc, bool multiline, const UString &indent)
+    void manifest(const LocationRange &loc, ManifestVisitor &visitor)
     {
         // Printing fields means evaluating and binding them, which can trigger
         // garbage collection.
 
-        UStringStream ss;
         switch (scratch.t) {
             case Value::ARRAY: {
                 HeapArray *arr = static_cast<HeapArray *>(scratch.v.h);
-                if (arr->elements.size() == 0) {
-                    ss << U"[ ]";
-                } else {
-                    const char32_t *prefix = multiline ? U"[\n" : U"[";
-                    UString indent2 = multiline ? indent + U"   " : indent;
-                    for (auto *thunk : arr->elements) {
-                        LocationRange tloc = thunk->body == nullptr ? loc : thunk->body->location;
-                        if (thunk->filled) {
-                            stack.newCall(loc, thunk, nullptr, 0, BindingFrame{});
-                            // Keep arr alive when scratch is overwritten
-                            stack.top().val = scratch;
-                            scratch = thunk->content;
-                        } else {
-                            stack.newCall(loc, thunk, thunk->self, thunk->offset, thunk->upValues);
-                            // Keep arr alive when scratch is overwritten
-                            stack.top().val = scratch;
-                            evaluate(thunk->body, stack.size());
-                        }
-                        auto element = manifestJson(tloc, multiline, indent2);
-                        // Restore scratch
-                        scratch = stack.top().val;
-                        stack.pop();
-                        ss << prefix << indent2 << element;
-                        prefix = multiline ? U",\n" : U", ";
+                visitor.beginArray(arr->size());
+                // Not a range-based for, as evaluating an element may append to arr's storage.
+                for (size_t i = 0; i < arr->size(); ++i) {
+                    HeapThunk *thunk = (*arr)[i];
+                    LocationRange tloc = thunk->body == nullptr ? loc : thunk->body->location;
+                    if (thunk->filled) {
+                        stack.newCall(loc, thunk, nullptr, 0, BindingFrame{});
+                        // Keep arr alive when scratch is overwritten
+                        stack.top().val = scratch;
+                        scratch = thunk->content;
+                    } else {
+                        stack.newCall(loc, thunk, thunk->self, thunk->offset, thunk->upValues);
+                        // Keep arr alive when scratch is overwritten
+                        stack.top().val = scratch;
+                        evaluate(thunk->body, stack.size());
                     }
-                    ss << (multiline ? U"\n" : U"") << indent << U"]";
+                    manifest(tloc, visitor);
+                    // Restore scratch
+                    scratch = stack.top().val;
+                    stack.pop();
+                    if (!visitor.done())
+                        throw makeError(tloc, "output callback failed.");
                 }
+                visitor.endArray();
             } break;
 
-            case Value::BOOLEAN: ss << (scratch.v.b ? U"true" : U"false"); break;
+            case Value::BOOLEAN: visitor.boolean(scratch.v.b); break;
 
-            case Value::NUMBER: ss << decode_utf8(jsonnet_unparse_number(scratch.v.d)); break;
+            case Value::NUMBER: visitor.number(scratch.v.d); break;
 
             case Value::FUNCTION:
                 throw makeError(loc, "couldn't manifest function in JSON output.");
 
-            case Value::NULL_TYPE: ss << U"null"; break;
+            case Value::NULL_TYPE: visitor.null(); break;
 
             case Value::OBJECT: {
                 auto *obj = static_cast<HeapObject *>(scratch.v.h);
@@ -3014,35 +5155,62 @@ class Interpreter {
                 for (const auto &f : objectFields(obj, true)) {
                     fields[f->name] = f;
                 }
-                if (fields.size() == 0) {
-                    ss << U"{ }";
-                } else {
-                    UString indent2 = multiline ? indent + U"   " : indent;
-                    const char32_t *prefix = multiline ? U"{\n" : U"{";
-                    for (const auto &f : fields) {
-                        // pushes FRAME_CALL
-                        const AST *body = objectIndex(loc, obj, f.second, 0);
-                        stack.top().val = scratch;
-                        evaluate(body, stack.size());
-                        auto vstr = manifestJson(body->location, multiline, indent2);
-                        // Reset scratch so that the object we're manifesting doesn't
-                        // get GC'd.
-                        scratch = stack.top().val;
-                        stack.pop();
-                        ss << prefix << indent2 << jsonnet_string_unparse(f.first, false) << U": "
-                           << vstr;
-                        prefix = multiline ? U",\n" : U", ";
-                    }
-                    ss << (multiline ? U"\n" : U"") << indent << U"}";
+                visitor.beginObject(fields.size());
+                for (const auto &f : fields) {
+                    // pushes FRAME_CALL
+                    const AST *body = manifestField(loc, obj, f.second);
+                    visitor.field(f.first);
+                    manifest(body->location, visitor);
+                    // Reset scratch so that the object we're manifesting doesn't
+                    // get GC'd.
+                    scratch = stack.top().val;
+                    stack.pop();
+                    if (!visitor.done())
+                        throw makeError(body->location, "output callback failed.");
                 }
+                visitor.endObject();
             } break;
 
-            case Value::STRING: {
-                const UString &str = static_cast<HeapString *>(scratch.v.h)->value;
-                ss << jsonnet_string_unparse(str, false);
-            } break;
+            case Value::STRING:
+                visitor.string(static_cast<HeapString *>(scratch.v.h)->value());
+                break;
         }
-        return ss.str();
+    }
+
+    /** Manifest the scratch value and convert it to JSON.
+     *
+     * \param multiline If true, will print objects and arrays in an indented fashion.
+     */
+    UString manifestJson(const LocationRange &loc, bool multiline, const UString &indent)
+    {
+        ManifestOutput out;
+        manifestJson(loc, multiline, indent, out);
+        return out.buf;
+    }
+
+    /** Pass the output on to its sink, if it has one and enough output accumulated or force is
+     * set.
+     */
+    void flushOutput(const LocationRange &loc, ManifestOutput &out, bool force)
+    {
+        if (!out.flush(force))
+            throw makeError(loc, "output callback failed.");
+    }
+
+    /** Like manifestJson above, but appends to out, passing it on in chunks if it has a sink. */
+    void manifestJson(const LocationRange &loc, bool multiline, const UString &indent,
+                      ManifestOutput &out)
+    {
+        JsonWriter writer(out, multiline, indent);
+        manifest(loc, writer);
+    }
+
+    /** Like manifestJson, but builds a JsonnetJsonValue instead of a string. */
+    std::unique_ptr<JsonnetJsonValue> manifestJsonValue(const LocationRange &loc)
+    {
+        JsonValueBuilder builder;
+        manifest(loc, builder);
+        return builder.result();
     }
 
     UString manifestString(const LocationRange &loc)
@@ -3052,12 +5220,94 @@ class Interpreter {
             ss << "expected string result, got: " << type_str(scratch.t);
             throw makeError(loc, ss.str());
         }
-        return static_cast<HeapString *>(scratch.v.h)->value;
+        return static_cast<HeapString *>(scratch.v.h)->value();
     }
 
-    StrMap manifestMulti(bool string)
+    /** Replace the value in scratch by the value at a path of it, see jsonnet_select_add.
+     *
+     * The path is a list of components separated by '.'.  A component selects the field of that
+     * name from an object, after running its assertions, or the element at that index from an
+     * array.  Only the values on the path are forced.  The empty path selects the whole value.
+     */
+    void selectPath(const LocationRange &loc, const std::string &path)
+    {
+        if (path.empty())
+            return;
+        size_t begin = 0;
+        while (true) {
+            size_t end = path.find('.', begin);
+            if (end == std::string::npos)
+                end = path.length();
+            std::string component = path.substr(begin, end - begin);
+            if (scratch.t == Value::OBJECT) {
+                auto *obj = static_cast<HeapObject *>(scratch.v.h);
+                runInvariants(loc, obj);
+                const Identifier *f = alloc->makeIdentifier(decode_utf8(component));
+                unsigned found_at = 0;
+                if (findObject(f, obj, 0, found_at) == nullptr) {
+                    throw makeError(loc,
+                                    "select " + path + ": field does not exist: " + component);
+                }
+                evaluateField(loc, obj, f);
+            } else if (scratch.t == Value::ARRAY) {
+                auto *arr = static_cast<HeapArray *>(scratch.v.h);
+                char *digits_end;
+                unsigned long i = std::strtoul(component.c_str(), &digits_end, 10);
+                if (component.empty() || *digits_end != '\0' || component[0] == '-' ||
+                    i >= arr->size()) {
+                    std::stringstream ss;
+                    ss << "select " << path << ": array has " << arr->size()
+                       << " elements, no element " << component;
+                    throw makeError(loc, ss.str());
+                }
+                forceThunk(loc, (*arr)[i]);
+            } else {
+                throw makeError(loc,
+                                "select " + path + ": cannot select " + component + " from " +
+                                    type_str(scratch));
+            }
+            if (end == path.length())
+                return;
+            begin = end + 1;
+        }
+    }
+
+    /** Replace the value in scratch by the values at the given paths, see selectPath.
+     *
+     * For one path, scratch becomes the value at that path.  For several, it becomes an object
+     * with a field for each path, whose value is the value at that path.
+     */
+    void select(const std::vector<std::string> &paths)
+    {
+        LocationRange loc("During selection");
+        if (paths.empty())
+            return;
+        if (paths.size() == 1) {
+            selectPath(loc, paths[0]);
+            return;
+        }
+        stack.newFrame(FRAME_SELECT, loc);
+        stack.top().val = scratch;
+        stack.top().val2 = makeObject<HeapComprehensionObject>(
+            BindingFrame{}, jsonObjVar, idJsonObjVar, BindingFrame{});
+        for (const auto &path : paths) {
+            scratch = stack.top().val;
+            selectPath(loc, path);
+            auto *thunk = makeHeap<HeapThunk>(idJsonObjVar, nullptr, 0, nullptr);
+            thunk->fill(scratch);
+            auto *obj = static_cast<HeapComprehensionObject *>(stack.top().val2.v.h);
+            obj->compValues[alloc->makeIdentifier(decode_utf8(path))] = thunk;
+        }
+        scratch = stack.top().val2;
+        stack.pop();
+    }
+
+    /** The fields of the object yielded by the program in multi mode, sorted by name.
+     *
+     * The object must be in scratch, and is left there.
+     */
+    std::vector<const Identifier *> multiFields(void)
     {
-        StrMap r;
         LocationRange loc("During manifestation");
         if (scratch.t != Value::OBJECT) {
             std::stringstream ss;
@@ -3072,18 +5322,46 @@ class Interpreter {
         for (const auto &f : objectFields(obj, true)) {
             fields[f->name] = f;
         }
+        std::vector<const Identifier *> r;
         for (const auto &f : fields) {
+            r.push_back(f.second);
+        }
+        return r;
+    }
+
+    /** Manifest one of the multiFields of the object in scratch.
+     *
+     * The object is left in scratch and the stack as it was, even if this throws, so that other
+     * fields can still be manifested afterwards.
+     */
+    UString manifestMultiField(const Identifier *field, bool string)
+    {
+        LocationRange loc("During manifestation");
+        Value obj = scratch;
+        unsigned stack_size = stack.size();
+        try {
             // pushes FRAME_CALL
-            const AST *body = objectIndex(loc, obj, f.second, 0);
-            stack.top().val = scratch;
-            evaluate(body, stack.size());
+            const AST *body = manifestField(loc, static_cast<HeapObject *>(obj.v.h), field);
             auto vstr =
                 string ? manifestString(body->location) : manifestJson(body->location, true, U"");
             // Reset scratch so that the object we're manifesting doesn't
             // get GC'd.
             scratch = stack.top().val;
             stack.pop();
-            r[encode_utf8(f.first)] = encode_utf8(vstr);
+            return vstr;
+        } catch (...) {
+            while (stack.size() > stack_size)
+                stack.pop();
+            scratch = obj;
+            throw;
+        }
+    }
+
+    StrMap manifestMulti(bool string)
+    {
+        StrMap r;
+        for (const Identifier *f : multiFields()) {
+            r[encode_utf8(f->name)] = encode_utf8(manifestMultiField(f, string));
         }
         return r;
     }
@@ -3100,7 +5378,9 @@ class Interpreter {
             throw makeError(loc, ss.str());
         }
         auto *arr = static_cast<HeapArray *>(scratch.v.h);
-        for (auto *thunk : arr->elements) {
+        // Not a range-based for, as evaluating an element may append to arr's storage.
+        for (size_t i = 0; i < arr->size(); ++i) {
+            HeapThunk *thunk = (*arr)[i];
             LocationRange tloc = thunk->body == nullptr ? loc : thunk->body->location;
             if (thunk->filled) {
                 stack.newCall(loc, thunk, nullptr, 0, BindingFrame{});
@@ -3124,21 +5404,318 @@ class Interpreter {
 
 }  // namespace
 
-std::string jsonnet_vm_execute(Allocator *alloc, const AST *ast, const ExtMap &ext_vars,
-                               unsigned max_stack, double gc_min_objects, double gc_growth_trigger,
+size_t ImportCache::approxSize(const ImportedFile &file)
+{
+    // The size of the ASTs is not known exactly, so guess that of a typical node.
+    const size_t AST_SIZE = 128;
+    return sizeof(ImportedFile) + 2 * file.foundHere.length() + file.buffer.length +
+           file.alloc.numASTs() * AST_SIZE;
+}
+
+void ImportCache::erase(std::map<Key, Entries::iterator>::iterator it)
+{
+    bytes -= approxSize(*it->second->second);
+    entries.erase(it->second);
+    index.erase(it);
+}
+
+void ImportCache::setMaxBytes(size_t v)
+{
+    maxBytes = v;
+    while (bytes > maxBytes && !entries.empty())
+        erase(index.find(entries.back().first));
+}
+
+void ImportCache::clear(void)
+{
+    entries.clear();
+    index.clear();
+    bytes = 0;
+}
+
+std::shared_ptr<ImportedFile> ImportCache::find(const Key &key)
+{
+    auto it = index.find(key);
+    if (it == index.end())
+        return nullptr;
+    std::shared_ptr<ImportedFile> file = it->second->second;
+    if (checkFileStats) {
+        FileStats stats;
+        if (!statFile(file->foundHere, stats) || stats != file->stats) {
+            erase(it);
+            return nullptr;
+        }
+    }
+    entries.splice(entries.begin(), entries, it->second);
+    return file;
+}
+
+void ImportCache::insert(const Key &key, const std::shared_ptr<ImportedFile> &file)
+{
+    auto it = index.find(key);
+    if (it != index.end())
+        erase(it);
+    entries.emplace_front(key, file);
+    index[key] = entries.begin();
+    bytes += approxSize(*file);
+    inserted = true;
+    setMaxBytes(maxBytes);
+}
+
+namespace {
+
+/** Convert the result of stat, with the times in nanoseconds where the platform has them. */
+FileStats file_stats(const struct stat &st)
+{
+    const long long NS = 1000000000;
+    FileStats stats;
+    stats.device = st.st_dev;
+    stats.inode = st.st_ino;
+    stats.size = st.st_size;
+#if defined(__APPLE__)
+    stats.mtime = st.st_mtimespec.tv_sec * NS + st.st_mtimespec.tv_nsec;
+    stats.ctime = st.st_ctimespec.tv_sec * NS + st.st_ctimespec.tv_nsec;
+#elif defined(_WIN32)
+    stats.mtime = st.st_mtime * NS;
+    stats.ctime = st.st_ctime * NS;
+#else
+    stats.mtime = st.st_mtim.tv_sec * NS + st.st_mtim.tv_nsec;
+    stats.ctime = st.st_ctim.tv_sec * NS + st.st_ctim.tv_nsec;
+#endif
+    return stats;
+}
+
+}  // namespace
+
+bool ImportCache::statFile(const std::string &path, FileStats &stats)
+{
+    struct stat st;
+    if (stat(path.c_str(), &st) != 0)
+        return false;
+    stats = file_stats(st);
+    return true;
+}
+
+namespace {
+
+/** Files smaller than this are read instead, since mapping them costs more than copying them. */
+const long long MAP_MIN_SIZE = 64 * 1024;
+
+void delete_string(void *owner)
+{
+    delete static_cast<std::string *>(owner);
+}
+
+#ifndef _WIN32
+struct MappedFile {
+    void *addr;
+    size_t length;
+};
+
+void unmap_file(void *owner)
+{
+    auto *mapped = static_cast<MappedFile *>(owner);
+    ::munmap(mapped->addr, mapped->length);
+    delete mapped;
+}
+
+/** Map the open file into memory, if it is large enough.
+ *
+ * Only the whole pages of the file are mapped.  They are followed by a page of anonymous memory
+ * that holds a copy of the rest of the file, so the NUL that must follow the content is there
+ * even if the file grows.
+ */
+bool map_file(int fd, const struct stat &st, JsonnetImportBuffer &buffer)
+{
+    long page_size = ::sysconf(_SC_PAGESIZE);
+    if (!S_ISREG(st.st_mode) || st.st_size < MAP_MIN_SIZE || page_size <= 0)
+        return false;
+    size_t size = st.st_size;
+    size_t whole = size - size % page_size;
+    size_t length = whole + page_size;
+    void *addr =
+        ::mmap(nullptr, length, PROT_READ | PROT_WRITE, MAP_PRIVATE | MAP_ANONYMOUS, -1, 0);
+    if (addr == MAP_FAILED)
+        return false;
+    char *tail = static_cast<char *>(addr) + whole;
+    bool ok = whole == 0 || ::mmap(addr, whole, PROT_READ, MAP_PRIVATE | MAP_FIXED, fd, 0) == addr;
+    size_t done = 0;
+    while (ok && done < size - whole) {
+        ssize_t n = ::pread(fd, tail + done, size - whole - done, whole + done);
+        if (n < 0 && errno == EINTR)
+            continue;
+        // A file that shrank is read instead, which then sees the new content.
+        ok = n > 0;
+        done += ok ? n : 0;
+    }
+    if (!ok || ::mprotect(tail, page_size, PROT_READ) != 0) {
+        ::munmap(addr, length);
+        return false;
+    }
+    buffer.content = static_cast<const char *>(addr);
+    buffer.length = size;
+    buffer.release = unmap_file;
+    buffer.owner = new MappedFile{addr, length};
+    return true;
+}
+
+/** Read the rest of the open file. */
+bool read_file(int fd, std::string &content, std::string &err_msg)
+{
+    char buf[64 * 1024];
+    while (true) {
+        ssize_t n = ::read(fd, buf, sizeof buf);
+        if (n < 0 && errno == EINTR)
+            continue;
+        if (n < 0) {
+            err_msg = strerror(errno);
+            return false;
+        }
+        if (n == 0)
+            return true;
+        content.append(buf, n);
+    }
+}
+#endif
+
+}  // namespace
+
+bool jsonnet_vm_load_file(const std::string &path, JsonnetImportBuffer &buffer,
+                          std::string &err_msg, FileStats *stats)
+{
+    std::unique_ptr<std::string> content(new std::string());
+#ifndef _WIN32
+    // Stat the file that is read, before reading it, so a change while it is read is noticed.
+    int fd = ::open(path.c_str(), O_RDONLY | O_CLOEXEC);
+    if (fd < 0) {
+        err_msg = strerror(errno);
+        return false;
+    }
+    struct stat st;
+    if (::fstat(fd, &st) != 0) {
+        err_msg = strerror(errno);
+        ::close(fd);
+        return false;
+    }
+    if (stats != nullptr)
+        *stats = file_stats(st);
+    if (map_file(fd, st, buffer)) {
+        ::close(fd);
+        return true;
+    }
+    bool ok = read_file(fd, *content, err_msg);
+    ::close(fd);
+    if (!ok)
+        return false;
+#else
+    if (stats != nullptr && !ImportCache::statFile(path, *stats)) {
+        err_msg = strerror(errno);
+        return false;
+    }
+    std::ifstream f;
+    f.open(path.c_str());
+    if (!f.good()) {
+        err_msg = strerror(errno);
+        return false;
+    }
+    try {
+        content->assign(std::istreambuf_iterator<char>(f), std::istreambuf_iterator<char>());
+    } catch (const std::ios_base::failure &io_err) {
+        err_msg = io_err.what();
+        return false;
+    }
+    if (!f.good()) {
+        err_msg = strerror(errno);
+        return false;
+    }
+#endif
+    buffer.content = content->c_str();
+    buffer.length = content->length();
+    buffer.release = delete_string;
+    buffer.owner = content.release();
+    return true;
+}
+
+namespace {
+
+/** Keeps the interpreter of a multi mode program, to manifest its files on demand. */
+class LazyMultiResult : public VmMultiResult {
+    Interpreter vm;
+    bool stringOutput;
+    std::vector<const Identifier *> fields;
+    std::vector<std::string> fileNames;
+
+   public:
+    LazyMultiResult(Allocator *alloc, const DesugaredObject *stdlib, const ExtMap &ext_vars,
+                    const ExtMap &tla, unsigned max_stack, double gc_min_objects,
+                    double gc_growth_trigger, const VmNativeCallbackMap &natives,
+                    JsonnetImportBufferCallback *import_callback, void *ctx,
+                    const std::atomic<bool> *cancelled, JsonnetGcStats *gc_stats,
+                    bool string_output)
+        : vm(alloc,
+             stdlib,
+             ext_vars,
+             tla,
+             max_stack,
+             gc_min_objects,
+             gc_growth_trigger,
+             natives,
+             import_callback,
+             ctx,
+             nullptr,
+             cancelled,
+             gc_stats),
+          stringOutput(string_output)
+    {
+    }
+
+    /** Evaluate the program to the object whose fields are the files. */
+    void start(const AST *ast, const std::vector<std::string> &select)
+    {
+        vm.evaluate(ast, 0);
+        vm.select(select);
+        fields = vm.multiFields();
+        for (const Identifier *f : fields)
+            fileNames.push_back(encode_utf8(f->name));
+    }
+
+    const std::vector<std::string> &names(void) const
+    {
+        return fileNames;
+    }
+
+    std::string manifest(size_t i)
+    {
+        return encode_utf8(vm.manifestMultiField(fields[i], stringOutput));
+    }
+};
+
+}  // namespace
+
+std::string jsonnet_vm_execute(Allocator *alloc, const DesugaredObject *stdlib, const AST *ast,
+                               const ExtMap &ext_vars, const ExtMap &tla, unsigned max_stack,
+                               double gc_min_objects, double gc_growth_trigger,
                                const VmNativeCallbackMap &natives,
-                               JsonnetImportCallback *import_callback, void *ctx,
-                               bool string_output)
+                               JsonnetImportBufferCallback *import_callback, void *ctx,
+                               ImportCache *import_cache, const std::atomic<bool> *cancelled,
+                               JsonnetGcStats *gc_stats,
+                               const std::vector<std::string> &select, bool string_output)
 {
     Interpreter vm(alloc,
+                   stdlib,
                    ext_vars,
+                   tla,
                    max_stack,
                    gc_min_objects,
                    gc_growth_trigger,
                    natives,
                    import_callback,
-                   ctx);
+                   ctx,
+                   import_cache,
+                   cancelled,
+                   gc_stats);
     vm.evaluate(ast, 0);
+    vm.select(select);
     if (string_output) {
         return encode_utf8(vm.manifestString(LocationRange("During manifestation")));
     } else {
@@ -3146,39 +5723,181 @@ std::string jsonnet_vm_execute(Allocator *alloc, const AST *ast, const ExtMap &e
     }
 }
 
-StrMap jsonnet_vm_execute_multi(Allocator *alloc, const AST *ast, const ExtMap &ext_vars,
-                                unsigned max_stack, double gc_min_objects, double gc_growth_trigger,
+void jsonnet_vm_execute_sink(Allocator *alloc, const DesugaredObject *stdlib, const AST *ast,
+                             const ExtMap &ext_vars, const ExtMap &tla, unsigned max_stack,
+                             double gc_min_objects, double gc_growth_trigger,
+                             const VmNativeCallbackMap &natives,
+                             JsonnetImportBufferCallback *import_callback, void *ctx,
+                             ImportCache *import_cache, const std::atomic<bool> *cancelled,
+                             JsonnetGcStats *gc_stats,
+                             const std::vector<std::string> &select,
+                             const std::function<bool(const std::string &)> &sink,
+                             bool string_output)
+{
+    Interpreter vm(alloc,
+                   stdlib,
+                   ext_vars,
+                   tla,
+                   max_stack,
+                   gc_min_objects,
+                   gc_growth_trigger,
+                   natives,
+                   import_callback,
+                   ctx,
+                   import_cache,
+                   cancelled,
+                   gc_stats);
+    vm.evaluate(ast, 0);
+    vm.select(select);
+    LocationRange loc("During manifestation");
+    ManifestOutput out;
+    out.sink = &sink;
+    if (string_output) {
+        out.buf = vm.manifestString(loc);
+    } else {
+        vm.manifestJson(loc, true, U"", out);
+    }
+    vm.flushOutput(loc, out, true);
+}
+
+void jsonnet_vm_execute_visit(Allocator *alloc, const DesugaredObject *stdlib, const AST *ast,
+                              const ExtMap &ext_vars, const ExtMap &tla, unsigned max_stack,
+                              double gc_min_objects, double gc_growth_trigger,
+                              const VmNativeCallbackMap &natives,
+                              JsonnetImportBufferCallback *import_callback, void *ctx,
+                              ImportCache *import_cache, const std::atomic<bool> *cancelled,
+                              JsonnetGcStats *gc_stats,
+                              const std::vector<std::string> &select, ManifestVisitor &visitor,
+                              bool string_output)
+{
+    Interpreter vm(alloc,
+                   stdlib,
+                   ext_vars,
+                   tla,
+                   max_stack,
+                   gc_min_objects,
+                   gc_growth_trigger,
+                   natives,
+                   import_callback,
+                   ctx,
+                   import_cache,
+                   cancelled,
+                   gc_stats);
+    vm.evaluate(ast, 0);
+    vm.select(select);
+    LocationRange loc("During manifestation");
+    if (string_output) {
+        visitor.string(vm.manifestString(loc));
+    } else {
+        vm.manifest(loc, visitor);
+    }
+}
+
+std::unique_ptr<JsonnetJsonValue> jsonnet_vm_execute_json(
+    Allocator *alloc, const DesugaredObject *stdlib, const AST *ast, const ExtMap &ext_vars,
+    const ExtMap &tla, unsigned max_stack, double gc_min_objects, double gc_growth_trigger,
+    const VmNativeCallbackMap &natives, JsonnetImportBufferCallback *import_callback, void *ctx,
+    ImportCache *import_cache, const std::atomic<bool> *cancelled, JsonnetGcStats *gc_stats,
+    const std::vector<std::string> &select, bool string_output)
+{
+    JsonValueBuilder builder;
+    jsonnet_vm_execute_visit(alloc,
+                             stdlib,
+                             ast,
+                             ext_vars,
+                             tla,
+                             max_stack,
+                             gc_min_objects,
+                             gc_growth_trigger,
+                             natives,
+                             import_callback,
+                             ctx,
+                             import_cache,
+                             cancelled,
+                             gc_stats,
+                             select,
+                             builder,
+                             string_output);
+    return builder.result();
+}
+
+StrMap jsonnet_vm_execute_multi(Allocator *alloc, const DesugaredObject *stdlib, const AST *ast,
+                                const ExtMap &ext_vars, const ExtMap &tla, unsigned max_stack,
+                                double gc_min_objects, double gc_growth_trigger,
                                 const VmNativeCallbackMap &natives,
-                                JsonnetImportCallback *import_callback, void *ctx,
-                                bool string_output)
+                                JsonnetImportBufferCallback *import_callback, void *ctx,
+                                ImportCache *import_cache, const std::atomic<bool> *cancelled,
+                                JsonnetGcStats *gc_stats,
+                                const std::vector<std::string> &select, bool string_output)
 {
     Interpreter vm(alloc,
+                   stdlib,
                    ext_vars,
+                   tla,
                    max_stack,
                    gc_min_objects,
                    gc_growth_trigger,
                    natives,
                    import_callback,
-                   ctx);
+                   ctx,
+                   import_cache,
+                   cancelled,
+                   gc_stats);
     vm.evaluate(ast, 0);
+    vm.select(select);
     return vm.manifestMulti(string_output);
 }
 
-std::vector<std::string> jsonnet_vm_execute_stream(Allocator *alloc, const AST *ast,
-                                                   const ExtMap &ext_vars, unsigned max_stack,
-                                                   double gc_min_objects, double gc_growth_trigger,
+std::unique_ptr<VmMultiResult> jsonnet_vm_execute_multi_lazy(
+    Allocator *alloc, const DesugaredObject *stdlib, const AST *ast, const ExtMap &ext_vars,
+    const ExtMap &tla, unsigned max_stack, double gc_min_objects, double gc_growth_trigger,
+    const VmNativeCallbackMap &natives, JsonnetImportBufferCallback *import_callback, void *ctx,
+    const std::atomic<bool> *cancelled, JsonnetGcStats *gc_stats,
+    const std::vector<std::string> &select, bool string_output)
+{
+    std::unique_ptr<LazyMultiResult> r(new LazyMultiResult(alloc,
+                                                           stdlib,
+                                                           ext_vars,
+                                                           tla,
+                                                           max_stack,
+                                                           gc_min_objects,
+                                                           gc_growth_trigger,
+                                                           natives,
+                                                           import_callback,
+                                                           ctx,
+                                                           cancelled,
+                                                           gc_stats,
+                                                           string_output));
+    r->start(ast, select);
+    return std::unique_ptr<VmMultiResult>(r.release());
+}
+
+std::vector<std::string> jsonnet_vm_execute_stream(Allocator *alloc,
+                                                   const DesugaredObject *stdlib, const AST *ast,
+                                                   const ExtMap &ext_vars, const ExtMap &tla,
+                                                   unsigned max_stack, double gc_min_objects,
+                                                   double gc_growth_trigger,
                                                    const VmNativeCallbackMap &natives,
-                                                   JsonnetImportCallback *import_callback,
-                                                   void *ctx)
+                                                   JsonnetImportBufferCallback *import_callback,
+                                                   void *ctx, ImportCache *import_cache,
+                                                   const std::atomic<bool> *cancelled,
+                                                   JsonnetGcStats *gc_stats,
+                                                   const std::vector<std::string> &select)
 {
     Interpreter vm(alloc,
+                   stdlib,
                    ext_vars,
+                   tla,
                    max_stack,
                    gc_min_objects,
                    gc_growth_trigger,
                    natives,
                    import_callback,
-                   ctx);
+                   ctx,
+                   import_cache,
+                   cancelled,
+                   gc_stats);
     vm.evaluate(ast, 0);
+    vm.select(select);
     return vm.manifestStream();
 }
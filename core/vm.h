@@ -19,7 +19,14 @@ limitations under the License.
 
 #include <libjsonnet.h>
 
+#include <atomic>
+#include <functional>
+#include <list>
+#include <memory>
+#include <mutex>
+
 #include "ast.h"
+#include "json.h"
 
 /** A single line of a stack trace from a runtime error.
  */
@@ -44,11 +51,23 @@ struct RuntimeError {
     }
 };
 
+/** The results of a native callback, by its arguments, see jsonnet_native_callback_memo. */
+struct VmNativeMemo {
+    /** Evaluations that are still manifesting files may share this with a new one. */
+    std::mutex mutex;
+    /** Keyed by the arguments, encoded by native_memo_key in vm.cpp. */
+    std::map<std::string, std::shared_ptr<const JsonnetJsonValue>> results;
+};
+
 /** Holds native callback and context. */
 struct VmNativeCallback {
     JsonnetNativeCallback *cb;
     void *ctx;
     std::vector<std::string> params;
+    /** Whether the callback takes a batch of calls, see jsonnet_native_callback_vectorized. */
+    bool vectorized;
+    /** If not null, the callback is pure and its results are kept here. */
+    std::shared_ptr<VmNativeMemo> memo;
 };
 
 typedef std::map<std::string, VmNativeCallback> VmNativeCallbackMap;
@@ -57,52 +76,321 @@ typedef std::map<std::string, VmNativeCallback> VmNativeCallbackMap;
 struct VmExt {
     std::string data;
     bool isCode;
+    /** If not null, the value is this instead of data. */
+    std::shared_ptr<const JsonnetJsonValue> value;
     VmExt() : isCode(false) {}
     VmExt(const std::string &data, bool is_code) : data(data), isCode(is_code) {}
+    VmExt(JsonnetJsonValue *value) : isCode(false), value(value) {}
+};
+
+/** What tells versions of a file on disk apart, short of reading it, see ImportCache. */
+struct FileStats {
+    long long device, inode, size;
+    /** Modification and status change times, in nanoseconds. */
+    long long mtime, ctime;
+    FileStats(void) : device(0), inode(0), size(0), mtime(0), ctime(0) {}
+    bool operator==(const FileStats &other) const
+    {
+        return device == other.device && inode == other.inode && size == other.size &&
+               mtime == other.mtime && ctime == other.ctime;
+    }
+    bool operator!=(const FileStats &other) const
+    {
+        return !(*this == other);
+    }
+};
+
+/** A file loaded by the import callback, which may be shared between evaluations by an
+ * ImportCache.
+ */
+struct ImportedFile {
+    /** Path to the file, as given by the import callback. */
+    std::string foundHere;
+    /** The content, kept without copying it until the file is dropped. */
+    JsonnetImportBuffer buffer;
+    /** The MD5 of the content when it was loaded, to tell whether a file loaded again changed. */
+    std::string digest;
+    /** The stats of foundHere, taken before it was read, see ImportCache::checkFileStats. */
+    FileStats stats;
+    /** Whether foundHere was modified so recently when it was read that a later change could
+     * leave its stats as they are.  Such a file is loaded again and compared by its digest.
+     */
+    bool racy;
+    /** Owns ast and the ASTs it refers to, but not their identifiers. */
+    Allocator alloc;
+    /** The desugared and analysed file, or null if it was only ever used by importstr. */
+    const AST *ast;
+    ImportedFile(void) : buffer(), racy(false), ast(nullptr) {}
+    ImportedFile(const ImportedFile &) = delete;
+    ImportedFile &operator=(const ImportedFile &) = delete;
+    ~ImportedFile(void)
+    {
+        if (buffer.release != nullptr)
+            buffer.release(buffer.owner);
+    }
+};
+
+/** Load a file into buffer, mapping it into memory if it is large enough for that to pay off.
+ *
+ * \param stats If not null, set to the stats of the file, taken before it is read.
+ * \returns false with err_msg set if the file cannot be read.
+ */
+bool jsonnet_vm_load_file(const std::string &path, JsonnetImportBuffer &buffer,
+                          std::string &err_msg, FileStats *stats = nullptr);
+
+/** Imported files kept across evaluations, so that they need not be read, parsed or desugared
+ * again.
+ *
+ * Files are found again by the directory of the importing file and the imported path.  Since the
+ * identifiers in the ASTs are compared by address, the identifiers of every evaluation that added
+ * ASTs must be moved to an allocator that outlives the cache, see takeInserted.
+ *
+ * The least recently used files are dropped when the cache grows beyond its size limit.  Files
+ * still in use by an evaluation stay alive until it finishes.
+ */
+class ImportCache {
+   public:
+    typedef std::pair<std::string, UString> Key;
+
+   private:
+    typedef std::list<std::pair<Key, std::shared_ptr<ImportedFile>>> Entries;
+    /** Most recently used first. */
+    Entries entries;
+    std::map<Key, Entries::iterator> index;
+    /** Approximate memory used by the entries. */
+    size_t bytes;
+    size_t maxBytes;
+    bool inserted;
+
+    static size_t approxSize(const ImportedFile &file);
+    void erase(std::map<Key, Entries::iterator>::iterator it);
+
+   public:
+    /** If true, files are assumed to be read from disk at foundHere, and are validated by their
+     * stats instead of by loading them again.  This does not notice files that would now be found
+     * earlier in the search path.  Files that were modified just before they were read are still
+     * loaded again, as a change within the resolution of the file system's timestamps would not
+     * show in their stats.
+     *
+     * If false, every import still calls the import callback, but the ASTs are reused when it
+     * gives the same path and content as before.
+     */
+    bool checkFileStats;
+
+    ImportCache(void) : bytes(0), maxBytes(0), inserted(false), checkFileStats(false) {}
+
+    /** Whether maxBytes is non-zero. */
+    bool enabled(void) const
+    {
+        return maxBytes > 0;
+    }
+
+    /** Set the size limit in bytes, 0 drops all the files and disables the cache. */
+    void setMaxBytes(size_t v);
+
+    /** Drop all the files. */
+    void clear(void);
+
+    /** Find a file, which becomes the most recently used.
+     *
+     * If checkFileStats is set then files that changed on disk are dropped instead.
+     *
+     * \returns The file, or null.
+     */
+    std::shared_ptr<ImportedFile> find(const Key &key);
+
+    /** Add or replace a file, or update the size of a file to which an AST was added. */
+    void insert(const Key &key, const std::shared_ptr<ImportedFile> &file);
+
+    /** Whether insert was called since the last call to this. */
+    bool takeInserted(void)
+    {
+        bool r = inserted;
+        inserted = false;
+        return r;
+    }
+
+    /** Get the stats of a file.  Returns false if it cannot be found. */
+    static bool statFile(const std::string &path, FileStats &stats);
+};
+
+/** Receives a value as it is manifested, one part at a time, depth first.
+ *
+ * An array is given as beginArray, its elements and endArray.  An object is given as beginObject,
+ * the name and value of each field in alphabetical order, and endObject.  The fields of an object
+ * are evaluated while it is being visited, so the value is never held as a whole.
+ */
+struct ManifestVisitor {
+    virtual ~ManifestVisitor(void) {}
+    virtual void null(void) = 0;
+    virtual void boolean(bool v) = 0;
+    virtual void number(double v) = 0;
+    virtual void string(const UString &v) = 0;
+    virtual void beginArray(size_t size) = 0;
+    virtual void endArray(void) = 0;
+    virtual void beginObject(size_t size) = 0;
+    virtual void field(const UString &name) = 0;
+    virtual void endObject(void) = 0;
+    /** Called after each element and field value.  Returns false to stop the evaluation. */
+    virtual bool done(void)
+    {
+        return true;
+    }
 };
 
 /** Execute the program and return the value as a JSON string.
  *
  * \param alloc The allocator used to create the ast.
+ * \param stdlib The standard library to share with imported files and ext code, see
+ * jsonnet_desugar.  May be null.
  * \param ast The program to execute.
  * \param ext The external vars / code.
+ * \param tla The top-level arguments, only used for those given as values, see jsonnet_desugar.
  * \param max_stack Recursion beyond this level gives an error.
  * \param gc_min_objects The garbage collector does not run when the heap is this small.
  * \param gc_growth_trigger Growth since last garbage collection cycle to trigger a new cycle.
  * \param import_callback A callback to handle imports
  * \param import_callback_ctx Context param for the import callback.
+ * \param import_cache Files kept from earlier evaluations, or null.
+ * \param cancelled When this becomes true, the evaluation stops with an error.  May be null.
+ * \param select The paths to evaluate instead of the whole value, see jsonnet_select_add.
  * \param output_string Whether to expect a string and output it without JSON encoding
  * \throws RuntimeError reports runtime errors in the program.
  * \returns The JSON result in string form.
  */
-std::string jsonnet_vm_execute(Allocator *alloc, const AST *ast,
-                               const std::map<std::string, VmExt> &ext, unsigned max_stack,
+std::string jsonnet_vm_execute(Allocator *alloc, const DesugaredObject *stdlib, const AST *ast,
+                               const std::map<std::string, VmExt> &ext,
+                               const std::map<std::string, VmExt> &tla, unsigned max_stack,
                                double gc_min_objects, double gc_growth_trigger,
                                const VmNativeCallbackMap &natives,
-                               JsonnetImportCallback *import_callback, void *import_callback_ctx,
-                               bool string_output);
+                               JsonnetImportBufferCallback *import_callback,
+                               void *import_callback_ctx,
+                               ImportCache *import_cache, const std::atomic<bool> *cancelled,
+                               JsonnetGcStats *gc_stats,
+                               const std::vector<std::string> &select, bool string_output);
+
+/** Execute the program and pass the JSON (or string) it yields to sink as it is produced.
+ *
+ * The parameters are the same as for jsonnet_vm_execute.
+ *
+ * \param sink Called with consecutive UTF-8 chunks of the output.  If it returns false, the
+ * evaluation stops with an error.
+ * \throws RuntimeError reports runtime errors in the program.  The output produced until then
+ * has already been passed to sink.
+ */
+void jsonnet_vm_execute_sink(Allocator *alloc, const DesugaredObject *stdlib, const AST *ast,
+                             const std::map<std::string, VmExt> &ext,
+                             const std::map<std::string, VmExt> &tla, unsigned max_stack,
+                             double gc_min_objects, double gc_growth_trigger,
+                             const VmNativeCallbackMap &natives,
+                             JsonnetImportBufferCallback *import_callback,
+                             void *import_callback_ctx,
+                             ImportCache *import_cache, const std::atomic<bool> *cancelled,
+                             JsonnetGcStats *gc_stats,
+                             const std::vector<std::string> &select,
+                             const std::function<bool(const std::string &)> &sink,
+                             bool string_output);
+
+/** Execute the program and pass the value it yields to visitor as it is manifested.
+ *
+ * The parameters are the same as for jsonnet_vm_execute.  If string_output is set, the value is
+ * given as a single string.
+ *
+ * \throws RuntimeError reports runtime errors in the program, or that visitor.done returned false.
+ */
+void jsonnet_vm_execute_visit(Allocator *alloc, const DesugaredObject *stdlib, const AST *ast,
+                              const std::map<std::string, VmExt> &ext,
+                              const std::map<std::string, VmExt> &tla, unsigned max_stack,
+                              double gc_min_objects, double gc_growth_trigger,
+                              const VmNativeCallbackMap &natives,
+                              JsonnetImportBufferCallback *import_callback,
+                              void *import_callback_ctx,
+                              ImportCache *import_cache, const std::atomic<bool> *cancelled,
+                              JsonnetGcStats *gc_stats,
+                              const std::vector<std::string> &select, ManifestVisitor &visitor,
+                              bool string_output);
+
+/** Execute the program and return the value as a JSON tree.
+ *
+ * The parameters are the same as for jsonnet_vm_execute.
+ *
+ * \throws RuntimeError reports runtime errors in the program.
+ * \returns The JSON result, or a string if string_output is set.
+ */
+std::unique_ptr<JsonnetJsonValue> jsonnet_vm_execute_json(
+    Allocator *alloc, const DesugaredObject *stdlib, const AST *ast,
+    const std::map<std::string, VmExt> &ext, const std::map<std::string, VmExt> &tla,
+    unsigned max_stack, double gc_min_objects, double gc_growth_trigger,
+    const VmNativeCallbackMap &natives, JsonnetImportBufferCallback *import_callback,
+    void *import_callback_ctx, ImportCache *import_cache, const std::atomic<bool> *cancelled,
+    JsonnetGcStats *gc_stats, const std::vector<std::string> &select, bool string_output);
 
 /** Execute the program and return the value as a number of named JSON files.
  *
  * This assumes the given program yields an object whose keys are filenames.
  *
  * \param alloc The allocator used to create the ast.
+ * \param stdlib The standard library to share with imported files and ext code, see
+ * jsonnet_desugar.  May be null.
  * \param ast The program to execute.
  * \param ext The external vars / code.
- * \param tla The top-level arguments (strings or code).
+ * \param tla The top-level arguments, only used for those given as values, see jsonnet_desugar.
  * \param max_stack Recursion beyond this level gives an error.
  * \param gc_min_objects The garbage collector does not run when the heap is this small.
  * \param gc_growth_trigger Growth since last garbage collection cycle to trigger a new cycle.
  * \param import_callback A callback to handle imports
  * \param import_callback_ctx Context param for the import callback.
+ * \param import_cache Files kept from earlier evaluations, or null.
+ * \param cancelled When this becomes true, the evaluation stops with an error.  May be null.
+ * \param select The paths to evaluate instead of the whole value, see jsonnet_select_add.
  * \param output_string Whether to expect a string and output it without JSON encoding
  * \throws RuntimeError reports runtime errors in the program.
  * \returns A mapping from filename to the JSON strings for that file.
  */
 std::map<std::string, std::string> jsonnet_vm_execute_multi(
-    Allocator *alloc, const AST *ast, const std::map<std::string, VmExt> &ext, unsigned max_stack,
-    double gc_min_objects, double gc_growth_trigger, const VmNativeCallbackMap &natives,
-    JsonnetImportCallback *import_callback, void *import_callback_ctx, bool string_output);
+    Allocator *alloc, const DesugaredObject *stdlib, const AST *ast,
+    const std::map<std::string, VmExt> &ext, const std::map<std::string, VmExt> &tla,
+    unsigned max_stack, double gc_min_objects, double gc_growth_trigger,
+    const VmNativeCallbackMap &natives, JsonnetImportBufferCallback *import_callback,
+    void *import_callback_ctx, ImportCache *import_cache, const std::atomic<bool> *cancelled,
+    JsonnetGcStats *gc_stats, const std::vector<std::string> &select, bool string_output);
+
+/** The files of a program run in multi mode, each manifested only when it is asked for.
+ *
+ * It keeps the evaluation alive, so the allocator, standard library, callbacks and cancellation
+ * flag given to jsonnet_vm_execute_multi_lazy must outlive it.
+ */
+class VmMultiResult {
+   public:
+    virtual ~VmMultiResult(void) {}
+
+    /** The filenames, sorted. */
+    virtual const std::vector<std::string> &names(void) const = 0;
+
+    /** Manifest the file names()[i].
+     *
+     * \throws RuntimeError reports runtime errors in the program.  The other files can still be
+     * manifested afterwards.
+     * \returns The JSON string for that file.
+     */
+    virtual std::string manifest(size_t i) = 0;
+};
+
+/** Execute the program until it yields the object whose keys are filenames, and return it for
+ * the JSON of the files to be manifested on demand.
+ *
+ * The parameters are the same as for jsonnet_vm_execute_multi, except that imports cannot use an
+ * import cache since the evaluation goes on after the call returns.
+ *
+ * \throws RuntimeError reports runtime errors in the program.
+ */
+std::unique_ptr<VmMultiResult> jsonnet_vm_execute_multi_lazy(
+    Allocator *alloc, const DesugaredObject *stdlib, const AST *ast,
+    const std::map<std::string, VmExt> &ext, const std::map<std::string, VmExt> &tla,
+    unsigned max_stack, double gc_min_objects, double gc_growth_trigger,
+    const VmNativeCallbackMap &natives, JsonnetImportBufferCallback *import_callback,
+    void *import_callback_ctx, const std::atomic<bool> *cancelled, JsonnetGcStats *gc_stats,
+    const std::vector<std::string> &select, bool string_output);
 
 /** Execute the program and return the value as a stream of JSON files.
  *
@@ -110,21 +398,29 @@ std::map<std::string, std::string> jsonnet_vm_execute_multi(
  * JSON files.
  *
  * \param alloc The allocator used to create the ast.
+ * \param stdlib The standard library to share with imported files and ext code, see
+ * jsonnet_desugar.  May be null.
  * \param ast The program to execute.
  * \param ext The external vars / code.
- * \param tla The top-level arguments (strings or code).
+ * \param tla The top-level arguments, only used for those given as values, see jsonnet_desugar.
  * \param max_stack Recursion beyond this level gives an error.
  * \param gc_min_objects The garbage collector does not run when the heap is this small.
  * \param gc_growth_trigger Growth since last garbage collection cycle to trigger a new cycle.
  * \param import_callback A callback to handle imports
  * \param import_callback_ctx Context param for the import callback.
+ * \param import_cache Files kept from earlier evaluations, or null.
+ * \param cancelled When this becomes true, the evaluation stops with an error.  May be null.
+ * \param select The paths to evaluate instead of the whole value, see jsonnet_select_add.
  * \param output_string Whether to expect a string and output it without JSON encoding
  * \throws RuntimeError reports runtime errors in the program.
  * \returns A mapping from filename to the JSON strings for that file.
  */
 std::vector<std::string> jsonnet_vm_execute_stream(
-    Allocator *alloc, const AST *ast, const std::map<std::string, VmExt> &ext, unsigned max_stack,
-    double gc_min_objects, double gc_growth_trigger, const VmNativeCallbackMap &natives,
-    JsonnetImportCallback *import_callback, void *import_callback_ctx);
+    Allocator *alloc, const DesugaredObject *stdlib, const AST *ast,
+    const std::map<std::string, VmExt> &ext, const std::map<std::string, VmExt> &tla,
+    unsigned max_stack, double gc_min_objects, double gc_growth_trigger,
+    const VmNativeCallbackMap &natives, JsonnetImportBufferCallback *import_callback,
+    void *import_callback_ctx, ImportCache *import_cache, const std::atomic<bool> *cancelled,
+    JsonnetGcStats *gc_stats, const std::vector<std::string> &select);
 
 #endif
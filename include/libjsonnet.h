@@ -54,6 +54,48 @@ void jsonnet_gc_min_objects(struct JsonnetVm *vm, unsigned v);
 /** Run the garbage collector after this amount of growth in the number of objects. */
 void jsonnet_gc_growth_trigger(struct JsonnetVm *vm, double v);
 
+/** Statistics about the garbage collection cycles run by the evaluations on a VM. */
+struct JsonnetGcStats {
+    /** The number of collection cycles that finished. */
+    unsigned long cycles;
+    /** The number of steps the cycles ran in, each one a pause of the evaluation. */
+    unsigned long steps;
+    /** The number of objects deleted, summed over all the cycles. */
+    unsigned long freed;
+    /** The largest number of objects on the heap when a cycle started. */
+    unsigned long peak_entities;
+    /** The time spent in collection steps, in milliseconds. */
+    double pause_ms;
+    /** The time spent in the longest collection step, in milliseconds. */
+    double max_pause_ms;
+};
+
+/** Get the garbage collection statistics of the evaluations on this VM since it was made or the
+ * statistics were last reset.
+ */
+void jsonnet_gc_stats(struct JsonnetVm *vm, struct JsonnetGcStats *stats);
+
+/** Set the garbage collection statistics back to zero. */
+void jsonnet_gc_stats_reset(struct JsonnetVm *vm);
+
+/** Evaluate only the value at the given path, instead of the whole value of the program.
+ *
+ * The path is a list of components separated by '.'.  Each one is the name of a field of an
+ * object (whose assertions are run) or the index of an element of an array.  Only the values on
+ * the path are evaluated, so fields that are not selected may contain errors or be expensive
+ * without affecting the result.  The empty path selects the whole value.
+ *
+ * If more than one path is added, the result is an object with a field for each path, whose
+ * value is the value at that path.  The paths apply to every evaluation on this VM, including
+ * the multi and stream modes, until jsonnet_select_clear is called.
+ *
+ * \param path The path, as a NULL-terminated string, copied by this call.
+ */
+void jsonnet_select_add(struct JsonnetVm *vm, const char *path);
+
+/** Forget the paths given to jsonnet_select_add, so the whole value is evaluated again. */
+void jsonnet_select_clear(struct JsonnetVm *vm);
+
 /** Expect a string as output and don't JSON encode it. */
 void jsonnet_string_output(struct JsonnetVm *vm, int v);
 
@@ -74,6 +116,31 @@ void jsonnet_string_output(struct JsonnetVm *vm, int v);
 typedef char *JsonnetImportCallback(void *ctx, const char *base, const char *rel, char **found_here,
                                     int *success);
 
+/** The content of an imported file, kept by the VM without copying it.
+ *
+ * The VM reads content until the file is no longer needed, which may be after the evaluation if
+ * the file is kept by jsonnet_import_cache_max, and then calls release(owner) if release is not
+ * NULL.  The content must be followed by a NUL byte, which is not counted in length.
+ */
+struct JsonnetImportBuffer {
+    /** The content of the file, or NULL to have the VM load found_here itself. */
+    const char *content;
+    size_t length;
+    void (*release)(void *owner);
+    void *owner;
+};
+
+/** Callback used to load imports without copying their content, see JsonnetImportCallback.
+ *
+ * On success, fill in buffer and return NULL.  Large files on disk are best left to the VM by
+ * setting buffer->content to NULL, in which case it maps found_here into memory where possible.
+ * Such files must not be truncated while the VM keeps them.
+ * On failure, return an error message allocated with jsonnet_realloc.
+ */
+typedef char *JsonnetImportBufferCallback(void *ctx, const char *base, const char *rel,
+                                          char **found_here, struct JsonnetImportBuffer *buffer,
+                                          int *success);
+
 /** An opaque type which can only be utilized via the jsonnet_json_* family of functions.
  */
 struct JsonnetJsonValue;
@@ -95,6 +162,32 @@ int jsonnet_json_extract_bool(struct JsonnetVm *vm, const struct JsonnetJsonValu
  */
 int jsonnet_json_extract_null(struct JsonnetVm *vm, const struct JsonnetJsonValue *v);
 
+/** If the value is an array, return 1 and store its number of elements in out, otherwise return
+ * 0.
+ */
+int jsonnet_json_extract_array(struct JsonnetVm *vm, const struct JsonnetJsonValue *v,
+                               size_t *out);
+
+/** Return the element of the array at index i, which must be less than its number of elements.
+ */
+const struct JsonnetJsonValue *jsonnet_json_array_element(struct JsonnetVm *vm,
+                                                          const struct JsonnetJsonValue *arr,
+                                                          size_t i);
+
+/** If the value is an object, return 1 and store its number of fields in out, otherwise return 0.
+ */
+int jsonnet_json_extract_object(struct JsonnetVm *vm, const struct JsonnetJsonValue *v,
+                                size_t *out);
+
+/** Return the name of the field of the object at index i, which must be less than its number of
+ * fields, and store the value of the field in v.
+ *
+ * Fields are in the order they were added.  Objects produced by evaluation have their fields
+ * sorted, as in the JSON output.  If a field was added more than once, the last one counts.
+ */
+const char *jsonnet_json_object_field(struct JsonnetVm *vm, const struct JsonnetJsonValue *obj,
+                                      size_t i, const struct JsonnetJsonValue **v);
+
 /** Convert the given UTF8 string to a JsonnetJsonValue.
  */
 struct JsonnetJsonValue *jsonnet_json_make_string(struct JsonnetVm *vm, const char *v);
@@ -148,6 +241,9 @@ void jsonnet_json_destroy(struct JsonnetVm *vm, struct JsonnetJsonValue *v);
  * failure, which will appear in Jsonnet as an error.  The argv pointer is an array whose size
  * matches the array of parameters supplied when the native callback was originally registered.
  *
+ * Arguments that are arrays or objects are evaluated in full before the call, and can be read with
+ * jsonnet_json_extract_array and jsonnet_json_extract_object.  Functions cannot be passed.
+ *
  * \param ctx User pointer, given in jsonnet_native_callback.
  * \param argv Array of arguments from Jsonnet code.
  * \param success Set this byref param to 1 to indicate success and 0 for failure.
@@ -170,6 +266,43 @@ char *jsonnet_realloc(struct JsonnetVm *vm, char *buf, size_t sz);
  */
 void jsonnet_import_callback(struct JsonnetVm *vm, JsonnetImportCallback *cb, void *ctx);
 
+/** Override the callback used to locate imports with one that hands over its buffers.
+ */
+void jsonnet_import_buffer_callback(struct JsonnetVm *vm, JsonnetImportBufferCallback *cb,
+                                    void *ctx);
+
+/** Set the approximate memory in bytes that the VM may use to keep imported files, with their
+ * parsed and desugared code, for later evaluations (0 by default, which disables this).
+ *
+ * Files loaded by the default import callback are reused until their modification time, size or
+ * inode changes, and are read again while they were modified too recently to tell.  A different
+ * import callback is still called for every import, but the file is only parsed again if its path
+ * or content changed.  The least recently used files are dropped when the limit is reached.  The
+ * cache is emptied when the import callback or library search path change.
+ */
+void jsonnet_import_cache_max(struct JsonnetVm *vm, size_t v);
+
+/** Remember (v = 1) or stop remembering (v = 0) which files the default import callback found in
+ * each directory it searched, and which it did not, across evaluations.
+ *
+ * This saves opening every candidate file again for each import, but files added to or removed
+ * from the directories afterwards are not noticed until this is turned off.  Off by default.
+ */
+void jsonnet_import_path_cache(struct JsonnetVm *vm, int v);
+
+/** Set a callback for the default import callback to call with the files that it cannot find,
+ * e.g. to provide generated files.  NULL by default, which gives an error instead.
+ */
+void jsonnet_import_fallback(struct JsonnetVm *vm, JsonnetImportBufferCallback *cb, void *ctx);
+
+/** Request (v = 1) or withdraw (v = 0) the cancellation of evaluations on this VM.
+ *
+ * This is the only function that may be called while another thread is evaluating with the VM.
+ * While the request stands, the evaluation stops at the next step with an "evaluation cancelled"
+ * runtime error, as do further evaluations until it is withdrawn.
+ */
+void jsonnet_cancel(struct JsonnetVm *vm, int v);
+
 /** Register a native extension.
  *
  * This will appear in Jsonnet as a function type and can be accessed from std.nativeExt("foo").
@@ -186,6 +319,39 @@ void jsonnet_import_callback(struct JsonnetVm *vm, JsonnetImportCallback *cb, vo
 void jsonnet_native_callback(struct JsonnetVm *vm, const char *name, JsonnetNativeCallback *cb,
                              void *ctx, const char *const *params);
 
+/** Remember (v = 1) or stop remembering (v = 0) the results of a registered native extension.
+ *
+ * While this is on, the successful results of the callback are kept by the VM, keyed by the
+ * values of the arguments, and later calls with equal arguments, in this or later evaluations,
+ * return the kept result without calling it.  Only use this for callbacks whose result depends on
+ * nothing but their arguments.  The results are forgotten when it is turned off or the callback
+ * is registered again.
+ *
+ * \param vm The vm.
+ * \param name The name given to jsonnet_native_callback.  Does nothing if there is none.
+ * \param v Whether to remember the results.
+ */
+void jsonnet_native_callback_memo(struct JsonnetVm *vm, const char *name, int v);
+
+/** Register a native extension that handles a batch of calls at once.
+ *
+ * This is like jsonnet_native_callback, but cb is always given a single argument: an array with
+ * an element for each call, which is the array of the arguments of that call.  It returns an array
+ * with the result of each call, in the same order.  A call from Jsonnet code is a batch of one,
+ * except that std.map(f, arr) on such an extension f of one parameter evaluates all the elements
+ * of arr and passes them to cb in a single batch.  This saves the overhead of many calls into the
+ * host language, at the cost of evaluating elements of arr that may not be used.
+ *
+ * \param vm The vm.
+ * \param name The name of the function as visible to Jsonnet code, e.g. "foo".
+ * \param cb The PURE function that implements the behavior you want.
+ * \param ctx User pointer, stash non-global state you need here.
+ * \param params NULL-terminated array of the names of the params.  Must be valid identifiers.
+ */
+void jsonnet_native_callback_vectorized(struct JsonnetVm *vm, const char *name,
+                                        JsonnetNativeCallback *cb, void *ctx,
+                                        const char *const *params);
+
 /** Bind a Jsonnet external var to the given string.
  *
  * Argument values are copied so memory should be managed by caller.
@@ -210,6 +376,33 @@ void jsonnet_tla_var(struct JsonnetVm *vm, const char *key, const char *val);
  */
 void jsonnet_tla_code(struct JsonnetVm *vm, const char *key, const char *val);
 
+/** Bind a Jsonnet external var to the given JSON value.
+ *
+ * This avoids writing out and parsing large values as code.  The VM takes ownership of v, which
+ * must not be used afterwards.
+ */
+void jsonnet_ext_value(struct JsonnetVm *vm, const char *key, struct JsonnetJsonValue *v);
+
+/** Bind a top-level argument for a top-level parameter to the given JSON value.
+ *
+ * This avoids writing out and parsing large values as code.  The VM takes ownership of v, which
+ * must not be used afterwards.
+ */
+void jsonnet_tla_value(struct JsonnetVm *vm, const char *key, struct JsonnetJsonValue *v);
+
+/** Remove all external vars bound with jsonnet_ext_var, jsonnet_ext_code and jsonnet_ext_value.
+ *
+ * Useful when the same VM is reused for several evaluations with different bindings.
+ */
+void jsonnet_ext_clear(struct JsonnetVm *vm);
+
+/** Remove all top-level arguments bound with jsonnet_tla_var, jsonnet_tla_code and
+ * jsonnet_tla_value.
+ *
+ * Useful when the same VM is reused for several evaluations with different bindings.
+ */
+void jsonnet_tla_clear(struct JsonnetVm *vm);
+
 /** Set the number of lines of stack trace to display (0 for all of them). */
 void jsonnet_max_trace(struct JsonnetVm *vm, unsigned v);
 
@@ -289,6 +482,322 @@ char *jsonnet_evaluate_file_stream(struct JsonnetVm *vm, const char *filename, i
 char *jsonnet_evaluate_snippet_stream(struct JsonnetVm *vm, const char *filename,
                                       const char *snippet, int *error);
 
+/** Evaluate a file containing Jsonnet code, return the result as a JsonnetJsonValue.
+ *
+ * This is the same as jsonnet_evaluate_file, except the result is not turned into a string.  The
+ * result should be cleaned up with jsonnet_json_destroy.
+ *
+ * \param filename Path to a file containing Jsonnet code.
+ * \param error Upon failure, set to the error message.  It should be cleaned up with
+ *     jsonnet_realloc.
+ * \returns The result, or NULL upon failure.
+ */
+struct JsonnetJsonValue *jsonnet_evaluate_file_json(struct JsonnetVm *vm, const char *filename,
+                                                    char **error);
+
+/** Evaluate a string containing Jsonnet code, return the result as a JsonnetJsonValue.
+ *
+ * This is the same as jsonnet_evaluate_snippet, except the result is not turned into a string.
+ * The result should be cleaned up with jsonnet_json_destroy.
+ *
+ * \param filename Path to a file (used in error messages).
+ * \param snippet Jsonnet code to execute.
+ * \param error Upon failure, set to the error message.  It should be cleaned up with
+ *     jsonnet_realloc.
+ * \returns The result, or NULL upon failure.
+ */
+struct JsonnetJsonValue *jsonnet_evaluate_snippet_json(struct JsonnetVm *vm, const char *filename,
+                                                       const char *snippet, char **error);
+
+/** Callback used to receive the output of jsonnet_evaluate_file_sink and its variants.
+ *
+ * \param ctx User pointer, given in jsonnet_evaluate_file_sink.
+ * \param buf The next part of the output, in UTF-8.  Not terminated with \0.
+ * \param len The length of buf in bytes.
+ * \returns 0 on success, any other value to stop the evaluation with an error.
+ */
+typedef int JsonnetSinkCallback(void *ctx, const char *buf, size_t len);
+
+/** Evaluate a file containing Jsonnet code, writing the JSON to a callback as it is produced.
+ *
+ * This is the same as jsonnet_evaluate_file, except the output is given to sink in chunks while
+ * the fields are being evaluated, so that it never needs to be held in memory as a whole.  If an
+ * error occurs, what was already written stays written.
+ *
+ * \param filename Path to a file containing Jsonnet code.
+ * \param sink Called with consecutive parts of the output.
+ * \param ctx User pointer, passed to sink.
+ * \param error Upon failure, set to the error message.  It should be cleaned up with
+ *     jsonnet_realloc.
+ * \returns 1 on success, 0 upon failure.
+ */
+int jsonnet_evaluate_file_sink(struct JsonnetVm *vm, const char *filename,
+                               JsonnetSinkCallback *sink, void *ctx, char **error);
+
+/** Evaluate a string containing Jsonnet code, writing the JSON to a callback as it is produced.
+ *
+ * \see jsonnet_evaluate_file_sink
+ *
+ * \param filename Path to a file (used in error messages).
+ * \param snippet Jsonnet code to execute.
+ * \param sink Called with consecutive parts of the output.
+ * \param ctx User pointer, passed to sink.
+ * \param error Upon failure, set to the error message.  It should be cleaned up with
+ *     jsonnet_realloc.
+ * \returns 1 on success, 0 upon failure.
+ */
+int jsonnet_evaluate_snippet_sink(struct JsonnetVm *vm, const char *filename, const char *snippet,
+                                  JsonnetSinkCallback *sink, void *ctx, char **error);
+
+/** The kinds of JsonnetValueEvent. */
+enum JsonnetValueEventKind {
+    JSONNET_VALUE_NULL,
+    JSONNET_VALUE_BOOL,
+    JSONNET_VALUE_NUMBER,
+    JSONNET_VALUE_STRING,
+    JSONNET_VALUE_ARRAY,
+    JSONNET_VALUE_OBJECT,
+    JSONNET_VALUE_FIELD
+};
+
+/** A part of the result of jsonnet_evaluate_file_value and its variants.
+ *
+ * The result is given depth first.  An ARRAY is followed by its size elements, and an OBJECT by
+ * its size fields in alphabetical order, each a FIELD giving the name followed by the value.
+ */
+struct JsonnetValueEvent {
+    enum JsonnetValueEventKind kind;
+    /** The value of a NUMBER, or 1 or 0 for a BOOL. */
+    double number;
+    /** The UTF-8 text of a STRING or the name of a FIELD.  Not terminated with \0, and only valid
+     * until the callback returns. */
+    const char *string;
+    /** The length of string in bytes, or the number of elements or fields of an ARRAY or OBJECT. */
+    size_t size;
+};
+
+/** Callback used to receive the result of jsonnet_evaluate_file_value and its variants.
+ *
+ * \param ctx User pointer, given in jsonnet_evaluate_file_value.
+ * \param events The next parts of the result.
+ * \param n The number of events.
+ * \returns 0 on success, any other value to stop the evaluation with an error.
+ */
+typedef int JsonnetValueCallback(void *ctx, const struct JsonnetValueEvent *events, size_t n);
+
+/** Evaluate a file containing Jsonnet code, giving the result to a callback as it is manifested.
+ *
+ * This lets bindings build the result in their own representation without JSON text or a
+ * JsonnetJsonValue in between.  The callback is called with the events in batches while the
+ * fields are being evaluated.  If string output is set, the result is a single STRING.
+ *
+ * \param filename Path to a file containing Jsonnet code.
+ * \param cb Called with consecutive parts of the result.
+ * \param ctx User pointer, passed to cb.
+ * \param error Upon failure, set to the error message.  It should be cleaned up with
+ *     jsonnet_realloc.
+ * \returns 1 on success, 0 upon failure.
+ */
+int jsonnet_evaluate_file_value(struct JsonnetVm *vm, const char *filename,
+                                JsonnetValueCallback *cb, void *ctx, char **error);
+
+/** Evaluate a string containing Jsonnet code, giving the result to a callback as it is manifested.
+ *
+ * \see jsonnet_evaluate_file_value
+ *
+ * \param filename Path to a file (used in error messages).
+ * \param snippet Jsonnet code to execute.
+ * \param cb Called with consecutive parts of the result.
+ * \param ctx User pointer, passed to cb.
+ * \param error Upon failure, set to the error message.  It should be cleaned up with
+ *     jsonnet_realloc.
+ * \returns 1 on success, 0 upon failure.
+ */
+int jsonnet_evaluate_snippet_value(struct JsonnetVm *vm, const char *filename, const char *snippet,
+                                   JsonnetValueCallback *cb, void *ctx, char **error);
+
+/** A Jsonnet program that has been parsed, desugared and checked, ready to be evaluated any number
+ * of times with different ext vars and top-level arguments.
+ */
+struct JsonnetProgram;
+
+/** Set the number of compiled programs the VM keeps for reuse (0 by default, which disables the
+ * cache).
+ *
+ * When enabled, jsonnet_compile_* and jsonnet_evaluate_* look up programs by filename and a hash of
+ * the code, so evaluating the same code again skips parsing and desugaring.  The least recently
+ * used program is dropped when the cache is full.
+ */
+void jsonnet_program_cache_max(struct JsonnetVm *vm, unsigned v);
+
+/** Compile a file containing Jsonnet code.
+ *
+ * The result can only be used with the VM that compiled it, and must be cleaned up with
+ * jsonnet_program_destroy before the VM is destroyed.
+ *
+ * \param filename Path to a file containing Jsonnet code.
+ * \param error Upon failure, set to the error message.  It should be cleaned up with
+ *     jsonnet_realloc.
+ * \returns The program, or NULL upon failure.
+ */
+struct JsonnetProgram *jsonnet_compile_file(struct JsonnetVm *vm, const char *filename,
+                                            char **error);
+
+/** Compile a string containing Jsonnet code.
+ *
+ * The result can only be used with the VM that compiled it, and must be cleaned up with
+ * jsonnet_program_destroy before the VM is destroyed.
+ *
+ * \param filename Path to a file (used in error messages).
+ * \param snippet Jsonnet code to compile.
+ * \param error Upon failure, set to the error message.  It should be cleaned up with
+ *     jsonnet_realloc.
+ * \returns The program, or NULL upon failure.
+ */
+struct JsonnetProgram *jsonnet_compile_snippet(struct JsonnetVm *vm, const char *filename,
+                                               const char *snippet, char **error);
+
+/** Evaluate a compiled program with the VM's current ext vars and top-level arguments, return a
+ * JSON string.
+ *
+ * The returned string should be cleaned up with jsonnet_realloc.
+ *
+ * \param program A program compiled by this VM.
+ * \param error Return by reference whether or not there was an error.
+ * \returns Either JSON or the error message.
+ */
+char *jsonnet_program_evaluate(struct JsonnetVm *vm, struct JsonnetProgram *program, int *error);
+
+/** Evaluate a compiled program, return a number of named JSON files.
+ *
+ * The format of the result is the same as \see jsonnet_evaluate_file_multi.
+ *
+ * \param program A program compiled by this VM.
+ * \param error Return by reference whether or not there was an error.
+ * \returns Either the error, or a sequence of strings separated by \0, terminated with \0\0.
+ */
+char *jsonnet_program_evaluate_multi(struct JsonnetVm *vm, struct JsonnetProgram *program,
+                                     int *error);
+
+/** Evaluate a compiled program, return a number of JSON files.
+ *
+ * The format of the result is the same as \see jsonnet_evaluate_file_stream.
+ *
+ * \param program A program compiled by this VM.
+ * \param error Return by reference whether or not there was an error.
+ * \returns Either the error, or a sequence of strings separated by \0, terminated with \0\0.
+ */
+char *jsonnet_program_evaluate_stream(struct JsonnetVm *vm, struct JsonnetProgram *program,
+                                      int *error);
+
+/** Evaluate a compiled program, return the result as a JsonnetJsonValue.
+ *
+ * The result should be cleaned up with jsonnet_json_destroy.
+ *
+ * \param program A program compiled by this VM.
+ * \param error Upon failure, set to the error message.  It should be cleaned up with
+ *     jsonnet_realloc.
+ * \returns The result, or NULL upon failure.
+ */
+struct JsonnetJsonValue *jsonnet_program_evaluate_json(struct JsonnetVm *vm,
+                                                       struct JsonnetProgram *program,
+                                                       char **error);
+
+/** Evaluate a compiled program, writing the JSON to a callback as it is produced.
+ *
+ * \see jsonnet_evaluate_file_sink
+ *
+ * \param program A program compiled by this VM.
+ * \param sink Called with consecutive parts of the output.
+ * \param ctx User pointer, passed to sink.
+ * \param error Upon failure, set to the error message.  It should be cleaned up with
+ *     jsonnet_realloc.
+ * \returns 1 on success, 0 upon failure.
+ */
+int jsonnet_program_evaluate_sink(struct JsonnetVm *vm, struct JsonnetProgram *program,
+                                  JsonnetSinkCallback *sink, void *ctx, char **error);
+
+/** Evaluate a compiled program, giving the result to a callback as it is manifested.
+ *
+ * \see jsonnet_evaluate_file_value
+ *
+ * \param program A program compiled by this VM.
+ * \param cb Called with consecutive parts of the result.
+ * \param ctx User pointer, passed to cb.
+ * \param error Upon failure, set to the error message.  It should be cleaned up with
+ *     jsonnet_realloc.
+ * \returns 1 on success, 0 upon failure.
+ */
+int jsonnet_program_evaluate_value(struct JsonnetVm *vm, struct JsonnetProgram *program,
+                                   JsonnetValueCallback *cb, void *ctx, char **error);
+
+/** The files of a program evaluated in multi mode, manifested one at a time on demand.
+ *
+ * It must be destroyed with jsonnet_multi_destroy before the VM, and the VM must not be used by
+ * another thread while a file is being manifested.  Imports made while it is alive do not use the
+ * import cache.
+ */
+struct JsonnetMulti;
+
+/** Evaluate a file containing Jsonnet code until it yields the object whose keys are filenames,
+ * but do not manifest the files yet, see jsonnet_multi_manifest.
+ *
+ * \param filename Path to a file containing Jsonnet code.
+ * \param error Upon failure, set to the error message.  It should be cleaned up with
+ *     jsonnet_realloc.
+ * \returns The files, or NULL upon failure.
+ */
+struct JsonnetMulti *jsonnet_evaluate_file_multi_lazy(struct JsonnetVm *vm, const char *filename,
+                                                      char **error);
+
+/** Evaluate a string containing Jsonnet code until it yields the object whose keys are
+ * filenames, but do not manifest the files yet, see jsonnet_multi_manifest.
+ *
+ * \param filename Path to a file (used in error messages).
+ * \param snippet Jsonnet code to execute.
+ * \param error Upon failure, set to the error message.  It should be cleaned up with
+ *     jsonnet_realloc.
+ * \returns The files, or NULL upon failure.
+ */
+struct JsonnetMulti *jsonnet_evaluate_snippet_multi_lazy(struct JsonnetVm *vm,
+                                                         const char *filename,
+                                                         const char *snippet, char **error);
+
+/** Evaluate a compiled program until it yields the object whose keys are filenames, but do not
+ * manifest the files yet, see jsonnet_multi_manifest.
+ *
+ * \param program A program compiled by this VM.  It may be destroyed before the result.
+ * \param error Upon failure, set to the error message.  It should be cleaned up with
+ *     jsonnet_realloc.
+ * \returns The files, or NULL upon failure.
+ */
+struct JsonnetMulti *jsonnet_program_evaluate_multi_lazy(struct JsonnetVm *vm,
+                                                         struct JsonnetProgram *program,
+                                                         char **error);
+
+/** The number of files. */
+size_t jsonnet_multi_size(struct JsonnetVm *vm, struct JsonnetMulti *multi);
+
+/** The name of the i-th file, in sorted order.  Valid until the result is destroyed. */
+const char *jsonnet_multi_name(struct JsonnetVm *vm, struct JsonnetMulti *multi, size_t i);
+
+/** Manifest the JSON of the i-th file.
+ *
+ * The returned string should be cleaned up with jsonnet_realloc.  After an error, the other files
+ * can still be manifested.
+ *
+ * \param error Return by reference whether or not there was an error.
+ * \returns Either JSON or the error message.
+ */
+char *jsonnet_multi_manifest(struct JsonnetVm *vm, struct JsonnetMulti *multi, size_t i,
+                             int *error);
+
+/** Complement of the jsonnet_*_multi_lazy functions. */
+void jsonnet_multi_destroy(struct JsonnetVm *vm, struct JsonnetMulti *multi);
+
+/** Complement of \see jsonnet_compile_file and \see jsonnet_compile_snippet. */
+void jsonnet_program_destroy(struct JsonnetVm *vm, struct JsonnetProgram *program);
+
 /** Complement of \see jsonnet_vm_make. */
 void jsonnet_destroy(struct JsonnetVm *vm);
 
@@ -0,0 +1,108 @@
+/*
+Copyright 2015 Google Inc. All rights reserved.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+*/
+
+/* Counts the heap allocations made by the evaluation of each of the given Jsonnet files.
+ *
+ * The global operator new is replaced, which also counts the allocations made inside
+ * libjsonnet.so.  Each file is evaluated once to warm up the VM (stdlib, import cache), and then
+ * the given number of times.  The time spent collecting garbage is also given.
+ *
+ * Usage: alloc_count [-n iterations] file.jsonnet...
+ */
+
+#include <atomic>
+#include <chrono>
+#include <cstdio>
+#include <cstdlib>
+#include <cstring>
+#include <new>
+
+extern "C" {
+#include <libjsonnet.h>
+}
+
+static std::atomic<unsigned long> allocations(0);
+static std::atomic<unsigned long> allocated_bytes(0);
+
+void *operator new(std::size_t size)
+{
+    allocations++;
+    allocated_bytes += size;
+    void *p = std::malloc(size == 0 ? 1 : size);
+    if (p == nullptr)
+        throw std::bad_alloc();
+    return p;
+}
+
+void operator delete(void *p) noexcept
+{
+    std::free(p);
+}
+
+void operator delete(void *p, std::size_t) noexcept
+{
+    std::free(p);
+}
+
+static bool evaluate(JsonnetVm *vm, const char *filename)
+{
+    int error;
+    char *output = jsonnet_evaluate_file(vm, filename, &error);
+    if (error)
+        std::fprintf(stderr, "%s", output);
+    jsonnet_realloc(vm, output, 0);
+    return !error;
+}
+
+int main(int argc, const char **argv)
+{
+    long iterations = 1;
+    int i = 1;
+    if (argc > 2 && std::strcmp(argv[1], "-n") == 0) {
+        iterations = std::atol(argv[2]);
+        i = 3;
+    }
+    if (i >= argc || iterations <= 0) {
+        std::fprintf(stderr, "alloc_count [-n iterations] file.jsonnet...\n");
+        return EXIT_FAILURE;
+    }
+
+    std::printf("%-32s %14s %14s %10s %10s\n", "file", "allocs/eval", "bytes/eval", "ms/eval",
+                "gc ms/eval");
+    for (; i < argc; ++i) {
+        JsonnetVm *vm = jsonnet_make();
+        if (!evaluate(vm, argv[i])) {
+            jsonnet_destroy(vm);
+            continue;
+        }
+        unsigned long allocs_before = allocations, bytes_before = allocated_bytes;
+        jsonnet_gc_stats_reset(vm);
+        auto start = std::chrono::steady_clock::now();
+        for (long j = 0; j < iterations; ++j)
+            evaluate(vm, argv[i]);
+        std::chrono::duration<double, std::milli> elapsed = std::chrono::steady_clock::now() - start;
+        JsonnetGcStats gc;
+        jsonnet_gc_stats(vm, &gc);
+        std::printf("%-32s %14lu %14lu %10.1f %10.1f\n",
+                    argv[i],
+                    (allocations - allocs_before) / iterations,
+                    (allocated_bytes - bytes_before) / iterations,
+                    elapsed.count() / iterations,
+                    gc.pause_ms / iterations);
+        jsonnet_destroy(vm);
+    }
+    return EXIT_SUCCESS;
+}
@@ -0,0 +1,78 @@
+/*
+Copyright 2015 Google Inc. All rights reserved.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+*/
+
+/* Measures the fixed cost of an evaluation, i.e. everything that is not the user's code.
+ *
+ * Usage: eval_overhead [iterations] [snippet]
+ */
+
+#define _POSIX_C_SOURCE 199309L
+
+#include <stdio.h>
+#include <stdlib.h>
+#include <time.h>
+
+#include <libjsonnet.h>
+
+static double now(void)
+{
+    struct timespec ts;
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+    return ts.tv_sec + ts.tv_nsec / 1e9;
+}
+
+static void evaluate(struct JsonnetVm *vm, const char *snippet)
+{
+    int error;
+    char *output = jsonnet_evaluate_snippet(vm, "snippet", snippet, &error);
+    if (error) {
+        fprintf(stderr, "%s", output);
+        exit(EXIT_FAILURE);
+    }
+    jsonnet_realloc(vm, output, 0);
+}
+
+int main(int argc, const char **argv)
+{
+    long iterations = argc > 1 ? atol(argv[1]) : 200;
+    const char *snippet = argc > 2 ? argv[2] : "{ x: 1 }";
+    struct JsonnetVm *vm;
+    double start;
+    long i;
+
+    if (iterations <= 0) {
+        fprintf(stderr, "eval_overhead [iterations] [snippet]\n");
+        return EXIT_FAILURE;
+    }
+
+    vm = jsonnet_make();
+    evaluate(vm, snippet);  // Warm up.
+    start = now();
+    for (i = 0; i < iterations; ++i)
+        evaluate(vm, snippet);
+    printf("reused vm: %10.1f us/evaluation\n", (now() - start) * 1e6 / iterations);
+    jsonnet_destroy(vm);
+
+    start = now();
+    for (i = 0; i < iterations; ++i) {
+        vm = jsonnet_make();
+        evaluate(vm, snippet);
+        jsonnet_destroy(vm);
+    }
+    printf("fresh vm:  %10.1f us/evaluation\n", (now() - start) * 1e6 / iterations);
+
+    return EXIT_SUCCESS;
+}
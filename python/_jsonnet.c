@@ -14,6 +14,7 @@ See the License for the specific language governing permissions and
 limitations under the License.
 */
 
+#include <math.h>
 #include <stdlib.h>
 #include <stdio.h>
 
@@ -42,11 +43,52 @@ static const char *exc_to_str(void)
 
 struct NativeCtx {
     struct JsonnetVm *vm;
-    PyThreadState **py_thread;
     PyObject *callback;
     size_t argc;
+    /* Whether the callback takes a list of the argument tuples of several calls. */
+    int vectorized;
+    /* The event loop of an asynchronous evaluation, or NULL. */
+    PyObject *loop;
 };
 
+/** Wait for the result of a callback, if it is a coroutine.
+ *
+ * The coroutine is run on the event loop of the asynchronous evaluation that made the callback,
+ * and this thread blocks until it is done.  Otherwise, the result is returned as is.
+ *
+ * \param result A new reference, or NULL with an exception set.
+ * \returns A new reference, or NULL with an exception set.
+ */
+static PyObject *await_on_loop(PyObject *loop, PyObject *result)
+{
+    PyObject *asyncio, *is_coroutine, *future;
+
+    if (loop == NULL || result == NULL) return result;
+
+    asyncio = PyImport_ImportModule("asyncio");
+    if (asyncio == NULL) {
+        Py_DECREF(result);
+        return NULL;
+    }
+    is_coroutine = PyObject_CallMethod(asyncio, "iscoroutine", "(O)", result);
+    if (is_coroutine == NULL || !PyObject_IsTrue(is_coroutine)) {
+        Py_DECREF(asyncio);
+        if (is_coroutine == NULL)
+            Py_CLEAR(result);
+        Py_XDECREF(is_coroutine);
+        return result;
+    }
+    Py_DECREF(is_coroutine);
+    future = PyObject_CallMethod(asyncio, "run_coroutine_threadsafe", "(OO)", result, loop);
+    Py_DECREF(asyncio);
+    Py_DECREF(result);
+    if (future == NULL) return NULL;
+    /* Releases the GIL while waiting. */
+    result = PyObject_CallMethod(future, "result", NULL);
+    Py_DECREF(future);
+    return result;
+}
+
 static struct JsonnetJsonValue *python_to_jsonnet_json(struct JsonnetVm *vm, PyObject *v,
                                                        const char **err_msg)
 {
@@ -131,28 +173,79 @@ static struct JsonnetJsonValue *python_to_jsonnet_json(struct JsonnetVm *vm, PyO
     }
 }
 
-/* This function is bound for every native callback, but with a different
- * context.
+/** Convert a JsonnetJsonValue into the Python value that json.loads would give for it.
  */
-static struct JsonnetJsonValue *cpython_native_callback(
-    void *ctx_, const struct JsonnetJsonValue * const *argv, int *succ)
+static PyObject *jsonnet_json_to_python(struct JsonnetVm *vm, const struct JsonnetJsonValue *v)
 {
-    const struct NativeCtx *ctx = ctx_;
-    int i;
+    const char *str;
+    double number;
+    size_t len, i;
 
-    PyEval_RestoreThread(*ctx->py_thread);
+    if ((str = jsonnet_json_extract_string(vm, v)) != NULL) {
+        return PyUnicode_DecodeUTF8(str, strlen(str), NULL);
+    } else if (jsonnet_json_extract_number(vm, v, &number)) {
+        /* Integers are written without a fraction, so json.loads gives an int. */
+        if (number == floor(number))
+            return PyLong_FromDouble(number);
+        return PyFloat_FromDouble(number);
+    } else if (jsonnet_json_extract_bool(vm, v) != 2) {
+        return PyBool_FromLong(jsonnet_json_extract_bool(vm, v));
+    } else if (jsonnet_json_extract_array(vm, v, &len)) {
+        PyObject *list = PyList_New(len);
+        if (list == NULL)
+            return NULL;
+        for (i = 0; i < len; ++i) {
+            PyObject *el = jsonnet_json_to_python(vm, jsonnet_json_array_element(vm, v, i));
+            if (el == NULL) {
+                Py_DECREF(list);
+                return NULL;
+            }
+            PyList_SET_ITEM(list, i, el);
+        }
+        return list;
+    } else if (jsonnet_json_extract_object(vm, v, &len)) {
+        PyObject *dict = PyDict_New();
+        if (dict == NULL)
+            return NULL;
+        for (i = 0; i < len; ++i) {
+            const struct JsonnetJsonValue *field_value;
+            const char *field = jsonnet_json_object_field(vm, v, i, &field_value);
+            PyObject *key = PyUnicode_DecodeUTF8(field, strlen(field), NULL);
+            PyObject *val = key == NULL ? NULL : jsonnet_json_to_python(vm, field_value);
+            if (val == NULL || PyDict_SetItem(dict, key, val) < 0) {
+                Py_XDECREF(key);
+                Py_XDECREF(val);
+                Py_DECREF(dict);
+                return NULL;
+            }
+            Py_DECREF(key);
+            Py_DECREF(val);
+        }
+        return dict;
+    } else {
+        Py_RETURN_NONE;
+    }
+}
 
-    PyObject *arglist;  // Will hold a tuple of strings.
-    PyObject *result;  // Will hold a string.
+/** Convert the arguments of a call of a native callback into a tuple.
+ *
+ * Arrays and objects become lists and dicts, as from json.loads.  Returns NULL with an exception
+ * set on failure.
+ */
+static PyObject *native_args_to_python(struct JsonnetVm *vm,
+                                       const struct JsonnetJsonValue *const *argv, size_t argc)
+{
+    PyObject *arglist = PyTuple_New(argc);
+    size_t i;
 
-    // Populate python function args.
-    arglist = PyTuple_New(ctx->argc);
-    for (i = 0; i < ctx->argc; ++i) {
+    if (arglist == NULL)
+        return NULL;
+    for (i = 0; i < argc; ++i) {
         double d;
-        const char *param_str = jsonnet_json_extract_string(ctx->vm, argv[i]);
-        int param_null = jsonnet_json_extract_null(ctx->vm, argv[i]);
-        int param_bool = jsonnet_json_extract_bool(ctx->vm, argv[i]);
-        int param_num = jsonnet_json_extract_number(ctx->vm, argv[i], &d);
+        const char *param_str = jsonnet_json_extract_string(vm, argv[i]);
+        int param_null = jsonnet_json_extract_null(vm, argv[i]);
+        int param_bool = jsonnet_json_extract_bool(vm, argv[i]);
+        int param_num = jsonnet_json_extract_number(vm, argv[i], &d);
         PyObject *pyobj;
         if (param_str != NULL) {
 #if PY_MAJOR_VERSION >= 3
@@ -161,24 +254,88 @@ static struct JsonnetJsonValue *cpython_native_callback(
             pyobj = PyString_FromString(param_str);
 #endif
         } else if (param_null) {
+            Py_INCREF(Py_None);
             pyobj = Py_None;
         } else if (param_bool != 2) {
             pyobj = PyBool_FromLong(param_bool);
         } else if (param_num) {
             pyobj = PyFloat_FromDouble(d);
         } else {
-            // TODO(dcunnin): Support arrays (to tuples).
-            // TODO(dcunnin): Support objects (to dicts).
+            pyobj = jsonnet_json_to_python(vm, argv[i]);
+        }
+        if (pyobj == NULL) {
             Py_DECREF(arglist);
-            *succ = 0;
-            *ctx->py_thread = PyEval_SaveThread();
-            return jsonnet_json_make_string(ctx->vm, "Non-primitive param.");
+            return NULL;
+        }
+        PyTuple_SET_ITEM(arglist, i, pyobj);
+    }
+    return arglist;
+}
+
+/** Convert the batch given to a vectorized native callback into a list of argument tuples.
+ * Returns NULL with an exception set on failure.
+ */
+static PyObject *native_batch_to_python(struct JsonnetVm *vm, const struct JsonnetJsonValue *calls)
+{
+    size_t num_calls = 0, argc = 0, i, j;
+    const struct JsonnetJsonValue **argv = NULL;
+    PyObject *list;
+
+    jsonnet_json_extract_array(vm, calls, &num_calls);
+    list = PyList_New(num_calls);
+    if (list == NULL)
+        return NULL;
+    for (i = 0; i < num_calls; ++i) {
+        const struct JsonnetJsonValue *call = jsonnet_json_array_element(vm, calls, i);
+        PyObject *arglist;
+        jsonnet_json_extract_array(vm, call, &argc);
+        argv = realloc(argv, sizeof(*argv) * (argc + 1));
+        for (j = 0; j < argc; ++j)
+            argv[j] = jsonnet_json_array_element(vm, call, j);
+        arglist = native_args_to_python(vm, argv, argc);
+        if (arglist == NULL) {
+            free(argv);
+            Py_DECREF(list);
+            return NULL;
         }
-        PyTuple_SetItem(arglist, i, pyobj);
+        PyList_SET_ITEM(list, i, arglist);
+    }
+    free(argv);
+    return list;
+}
+
+/* This function is bound for every native callback, but with a different
+ * context.
+ */
+static struct JsonnetJsonValue *cpython_native_callback(
+    void *ctx_, const struct JsonnetJsonValue * const *argv, int *succ)
+{
+    const struct NativeCtx *ctx = ctx_;
+
+    PyGILState_STATE gil = PyGILState_Ensure();
+
+    PyObject *arglist;  // Will hold a tuple of the arguments.
+    PyObject *result;
+
+    // Populate python function args.  A vectorized callback takes the list of the argument
+    // tuples of each call.
+    if (ctx->vectorized) {
+        PyObject *batch = native_batch_to_python(ctx->vm, argv[0]);
+        arglist = batch == NULL ? NULL : PyTuple_Pack(1, batch);
+        Py_XDECREF(batch);
+    } else {
+        arglist = native_args_to_python(ctx->vm, argv, ctx->argc);
+    }
+    if (arglist == NULL) {
+        struct JsonnetJsonValue *r = jsonnet_json_make_string(ctx->vm, exc_to_str());
+        PyErr_Clear();
+        *succ = 0;
+        PyGILState_Release(gil);
+        return r;
     }
 
     // Call python function.
-    result = PyEval_CallObject(ctx->callback, arglist);
+    result = await_on_loop(ctx->loop, PyEval_CallObject(ctx->callback, arglist));
     Py_DECREF(arglist);
 
     if (result == NULL) {
@@ -186,7 +343,7 @@ static struct JsonnetJsonValue *cpython_native_callback(
         struct JsonnetJsonValue *r = jsonnet_json_make_string(ctx->vm, exc_to_str());
         *succ = 0;
         PyErr_Clear();
-        *ctx->py_thread = PyEval_SaveThread();
+        PyGILState_Release(gil);
         return r;
     }
 
@@ -198,27 +355,115 @@ static struct JsonnetJsonValue *cpython_native_callback(
         *succ = 0;
         r = jsonnet_json_make_string(ctx->vm, err_msg);
     }
-    *ctx->py_thread = PyEval_SaveThread();
+    PyGILState_Release(gil);
     return r;
 }
 
 
 struct ImportCtx {
     struct JsonnetVm *vm;
-    PyThreadState **py_thread;
     PyObject *callback;
+    /* The event loop of an asynchronous evaluation, or NULL. */
+    PyObject *loop;
 };
 
+/* Releases a Python object whose memory the VM kept as the content of an imported file. */
+static void cpython_import_release(void *owner)
+{
+    PyGILState_STATE gil = PyGILState_Ensure();
+    Py_DECREF((PyObject *)owner);
+    PyGILState_Release(gil);
+}
+
+/* Releases a buffer the VM kept as the content of an imported file. */
+static void cpython_import_release_buffer(void *owner)
+{
+    PyGILState_STATE gil = PyGILState_Ensure();
+    PyBuffer_Release((Py_buffer *)owner);
+    PyGILState_Release(gil);
+    free(owner);
+}
+
+/* Hand the content returned by the import callback to the VM, without copying it if possible.
+ *
+ * Bytes and str are NUL-terminated, so their memory is used as it is.  Other buffers are only used
+ * as they are if their last byte is NUL, and copied once otherwise.  None makes the VM load the
+ * file at found_here itself.
+ *
+ * Returns 0 if the content has none of these types.
+ */
+static int import_content(PyObject *content, struct JsonnetImportBuffer *buffer)
+{
+    const char *s;
+    Py_ssize_t length;
+    Py_buffer *view;
+
+    if (content == Py_None) {
+        buffer->content = NULL;
+        return 1;
+    }
+#if PY_MAJOR_VERSION >= 3
+    if (PyUnicode_Check(content)) {
+        s = PyUnicode_AsUTF8AndSize(content, &length);
+        if (s == NULL) {
+            PyErr_Clear();
+            return 0;
+        }
+    } else
+#endif
+    if (PyBytes_Check(content)) {
+        s = PyBytes_AS_STRING(content);
+        length = PyBytes_GET_SIZE(content);
+    } else if (PyObject_CheckBuffer(content)) {
+        view = malloc(sizeof(*view));
+        if (view == NULL || PyObject_GetBuffer(content, view, PyBUF_SIMPLE) != 0) {
+            PyErr_Clear();
+            free(view);
+            return 0;
+        }
+        s = view->buf;
+        length = view->len;
+        if (length > 0 && s[length - 1] == '\0') {
+            buffer->content = s;
+            buffer->length = length - 1;
+            buffer->release = cpython_import_release_buffer;
+            buffer->owner = view;
+            return 1;
+        }
+        content = PyBytes_FromStringAndSize(s, length);
+        PyBuffer_Release(view);
+        free(view);
+        if (content == NULL) {
+            PyErr_Clear();
+            return 0;
+        }
+        buffer->content = PyBytes_AS_STRING(content);
+        buffer->length = length;
+        buffer->release = cpython_import_release;
+        buffer->owner = content;
+        return 1;
+    } else {
+        return 0;
+    }
+    Py_INCREF(content);
+    buffer->content = s;
+    buffer->length = length;
+    buffer->release = cpython_import_release;
+    buffer->owner = content;
+    return 1;
+}
+
 static char *cpython_import_callback(void *ctx_, const char *base, const char *rel,
-                                     char **found_here, int *success)
+                                     char **found_here, struct JsonnetImportBuffer *buffer,
+                                     int *success)
 {
     const struct ImportCtx *ctx = ctx_;
     PyObject *arglist, *result;
-    char *out;
+    char *out = NULL;
 
-    PyEval_RestoreThread(*ctx->py_thread);
+    PyGILState_STATE gil = PyGILState_Ensure();
     arglist = Py_BuildValue("(s, s)", base, rel);
-    result = PyEval_CallObject(ctx->callback, arglist);
+    result = await_on_loop(ctx->loop, PyEval_CallObject(ctx->callback, arglist));
     Py_DECREF(arglist);
 
     if (result == NULL) {
@@ -226,7 +471,7 @@ static char *cpython_import_callback(void *ctx_, const char *base, const char *r
         char *out = jsonnet_str(ctx->vm, exc_to_str());
         *success = 0;
         PyErr_Clear();
-        *ctx->py_thread = PyEval_SaveThread();
+        PyGILState_Release(gil);
         return out;
     }
 
@@ -240,28 +485,27 @@ static char *cpython_import_callback(void *ctx_, const char *base, const char *r
         PyObject *file_name = PyTuple_GetItem(result, 0);
         PyObject *file_content = PyTuple_GetItem(result, 1);
 #if PY_MAJOR_VERSION >= 3
-        if (!PyUnicode_Check(file_name) || !PyUnicode_Check(file_content)) {
+        if (!PyUnicode_Check(file_name) || !import_content(file_content, buffer)) {
 #else
-        if (!PyString_Check(file_name) || !PyString_Check(file_content)) {
+        if (!PyString_Check(file_name) || !import_content(file_content, buffer)) {
 #endif
-            out = jsonnet_str(ctx->vm, "import_callback did not return a pair of strings");
+            out = jsonnet_str(ctx->vm,
+                              "import_callback did not return a string and the content as a "
+                              "string, bytes, buffer or None");
             *success = 0;
         } else {
 #if PY_MAJOR_VERSION >= 3
             const char *found_here_cstr = PyUnicode_AsUTF8(file_name);
-            const char *content_cstr = PyUnicode_AsUTF8(file_content);
 #else
             const char *found_here_cstr = PyString_AsString(file_name);
-            const char *content_cstr = PyString_AsString(file_content);
 #endif
             *found_here = jsonnet_str(ctx->vm, found_here_cstr);
-            out = jsonnet_str(ctx->vm, content_cstr);
             *success = 1;
         }
     }
 
     Py_DECREF(result);
-    *ctx->py_thread = PyEval_SaveThread();
+    PyGILState_Release(gil);
 
     return out;
 }
@@ -271,7 +515,6 @@ static PyObject *handle_result(struct JsonnetVm *vm, char *out, int error)
     if (error) {
         PyErr_SetString(PyExc_RuntimeError, out);
         jsonnet_realloc(vm, out, 0);
-        jsonnet_destroy(vm);
         return NULL;
     } else {
 #if PY_MAJOR_VERSION >= 3
@@ -280,12 +523,258 @@ static PyObject *handle_result(struct JsonnetVm *vm, char *out, int error)
         PyObject *ret = PyString_FromString(out);
 #endif
         jsonnet_realloc(vm, out, 0);
-        jsonnet_destroy(vm);
         return ret;
     }
 }
 
-int handle_vars(struct JsonnetVm *vm, PyObject *map, int code, int tla)
+/* An array or object of which ValueCtx has not yet seen all elements or fields. */
+struct ValueOpen {
+    /* The list or dict. */
+    PyObject *container;
+    /* The number of elements or fields still to come. */
+    size_t left;
+    /* The name of the field whose value comes next, for a dict. */
+    PyObject *key;
+};
+
+/* Builds the Python value from the events of jsonnet_evaluate_*_value. */
+struct ValueCtx {
+    /* The value, once complete. */
+    PyObject *result;
+    /* The lists and dicts being filled, innermost last. */
+    struct ValueOpen *open;
+    size_t depth, capacity;
+    /* Field names seen so far, so that objects with the same fields share the keys, as they do
+     * with json.loads. */
+    PyObject *keys;
+    /* The exception raised while building the value, if any. */
+    PyObject *exc_type, *exc_value, *exc_traceback;
+};
+
+/** Add a complete value (stealing the reference) to the innermost open list or dict, or make it
+ * the result.  Returns -1 with an exception set on failure.
+ */
+static int value_add(struct ValueCtx *ctx, PyObject *v)
+{
+    if (v == NULL)
+        return -1;
+    while (ctx->depth > 0) {
+        struct ValueOpen *top = &ctx->open[ctx->depth - 1];
+        if (PyList_Check(top->container)) {
+            PyList_SET_ITEM(top->container, PyList_GET_SIZE(top->container) - top->left, v);
+        } else {
+            int r = PyDict_SetItem(top->container, top->key, v);
+            Py_DECREF(v);
+            Py_CLEAR(top->key);
+            if (r < 0)
+                return -1;
+        }
+        if (--top->left > 0)
+            return 0;
+        /* The list or dict is complete, so it is now added to the one around it. */
+        v = top->container;
+        ctx->depth--;
+    }
+    ctx->result = v;
+    return 0;
+}
+
+/** Start filling a list or dict (stealing the reference) of size elements or fields. */
+static int value_open(struct ValueCtx *ctx, PyObject *container, size_t size)
+{
+    if (container == NULL)
+        return -1;
+    if (size == 0)
+        return value_add(ctx, container);
+    if (ctx->depth == ctx->capacity) {
+        size_t capacity = ctx->capacity == 0 ? 16 : ctx->capacity * 2;
+        struct ValueOpen *open = PyMem_Realloc(ctx->open, capacity * sizeof(*open));
+        if (open == NULL) {
+            Py_DECREF(container);
+            PyErr_NoMemory();
+            return -1;
+        }
+        ctx->open = open;
+        ctx->capacity = capacity;
+    }
+    ctx->open[ctx->depth].container = container;
+    ctx->open[ctx->depth].left = size;
+    ctx->open[ctx->depth].key = NULL;
+    ctx->depth++;
+    return 0;
+}
+
+/** Take the name of the field whose value comes next. */
+static int value_field(struct ValueCtx *ctx, const char *name, size_t len)
+{
+    PyObject *key = PyUnicode_DecodeUTF8(name, len, NULL);
+    PyObject *shared;
+    if (key == NULL)
+        return -1;
+    shared = PyDict_GetItem(ctx->keys, key);
+    if (shared != NULL) {
+        Py_INCREF(shared);
+        Py_DECREF(key);
+        key = shared;
+    } else if (PyDict_SetItem(ctx->keys, key, key) < 0) {
+        Py_DECREF(key);
+        return -1;
+    }
+    ctx->open[ctx->depth - 1].key = key;
+    return 0;
+}
+
+static int value_event(struct ValueCtx *ctx, const struct JsonnetValueEvent *e)
+{
+    switch (e->kind) {
+        case JSONNET_VALUE_NULL:
+            Py_INCREF(Py_None);
+            return value_add(ctx, Py_None);
+        case JSONNET_VALUE_BOOL: return value_add(ctx, PyBool_FromLong(e->number != 0));
+        case JSONNET_VALUE_NUMBER:
+            /* Integers are written without a fraction, so json.loads gives an int. */
+            if (e->number == floor(e->number))
+                return value_add(ctx, PyLong_FromDouble(e->number));
+            return value_add(ctx, PyFloat_FromDouble(e->number));
+        case JSONNET_VALUE_STRING:
+            return value_add(ctx, PyUnicode_DecodeUTF8(e->string, e->size, NULL));
+        case JSONNET_VALUE_ARRAY: return value_open(ctx, PyList_New(e->size), e->size);
+        case JSONNET_VALUE_OBJECT: return value_open(ctx, PyDict_New(), e->size);
+        default: return value_field(ctx, e->string, e->size);
+    }
+}
+
+/** Add the next parts of the result of jsonnet_evaluate_*_value to the value being built. */
+static int cpython_value_callback(void *ctx_, const struct JsonnetValueEvent *events, size_t n)
+{
+    struct ValueCtx *ctx = ctx_;
+    size_t i;
+    int r = 0;
+    PyGILState_STATE gil = PyGILState_Ensure();
+
+    for (i = 0; i < n && r == 0; ++i)
+        r = value_event(ctx, &events[i]);
+    if (r != 0)
+        PyErr_Fetch(&ctx->exc_type, &ctx->exc_value, &ctx->exc_traceback);
+    PyGILState_Release(gil);
+    return r != 0;
+}
+
+/** Return the value built by cpython_value_callback, or raise the exception it got or else the
+ * evaluation error.
+ */
+static PyObject *handle_value_result(struct JsonnetVm *vm, struct ValueCtx *ctx, int ok,
+                                     char *error)
+{
+    PyObject *ret = ctx->result;
+    while (ctx->depth > 0) {
+        struct ValueOpen *top = &ctx->open[--ctx->depth];
+        Py_DECREF(top->container);
+        Py_XDECREF(top->key);
+    }
+    PyMem_Free(ctx->open);
+    Py_DECREF(ctx->keys);
+    if (ctx->exc_type != NULL || !ok) {
+        Py_XDECREF(ret);
+        ret = NULL;
+    }
+    if (ctx->exc_type != NULL) {
+        if (!ok)
+            jsonnet_realloc(vm, error, 0);
+        PyErr_Restore(ctx->exc_type, ctx->exc_value, ctx->exc_traceback);
+    } else if (!ok) {
+        PyErr_SetString(PyExc_RuntimeError, error);
+        jsonnet_realloc(vm, error, 0);
+    }
+    return ret;
+}
+
+struct SinkCtx {
+    /* The write method of the file-like object given the output. */
+    PyObject *write;
+    /* The exception raised by write, if any. */
+    PyObject *exc_type, *exc_value, *exc_traceback;
+};
+
+/** Pass a chunk of output to the write method of a file-like object. */
+static int cpython_sink_callback(void *ctx_, const char *buf, size_t len)
+{
+    struct SinkCtx *ctx = ctx_;
+    PyObject *chunk, *result;
+    PyGILState_STATE gil = PyGILState_Ensure();
+
+#if PY_MAJOR_VERSION >= 3
+    chunk = PyUnicode_DecodeUTF8(buf, len, NULL);
+#else
+    chunk = PyString_FromStringAndSize(buf, len);
+#endif
+    result = chunk == NULL ? NULL : PyObject_CallFunctionObjArgs(ctx->write, chunk, NULL);
+    Py_XDECREF(chunk);
+    if (result == NULL) {
+        PyErr_Fetch(&ctx->exc_type, &ctx->exc_value, &ctx->exc_traceback);
+    }
+    Py_XDECREF(result);
+    PyGILState_Release(gil);
+    return result == NULL;
+}
+
+/** Raise the exception of the write method if it failed, or else the evaluation error, if any. */
+static PyObject *handle_sink_result(struct JsonnetVm *vm, struct SinkCtx *ctx, int ok, char *error)
+{
+    if (ctx->exc_type != NULL) {
+        if (!ok)
+            jsonnet_realloc(vm, error, 0);
+        PyErr_Restore(ctx->exc_type, ctx->exc_value, ctx->exc_traceback);
+        return NULL;
+    }
+    if (!ok) {
+        PyErr_SetString(PyExc_RuntimeError, error);
+        jsonnet_realloc(vm, error, 0);
+        return NULL;
+    }
+    Py_RETURN_NONE;
+}
+
+/** Convert the \0 separated buffer of jsonnet_evaluate_*_stream into a list of JSON documents.
+ */
+static PyObject *handle_stream_result(struct JsonnetVm *vm, char *out, int error)
+{
+    PyObject *ret;
+    const char *ptr;
+
+    if (error)
+        return handle_result(vm, out, error);
+
+    ret = PyList_New(0);
+    if (ret == NULL) {
+        jsonnet_realloc(vm, out, 0);
+        return NULL;
+    }
+    for (ptr = out; *ptr != '\0'; ptr += strlen(ptr) + 1) {
+#if PY_MAJOR_VERSION >= 3
+        PyObject *json_obj = PyUnicode_FromString(ptr);
+#else
+        PyObject *json_obj = PyString_FromString(ptr);
+#endif
+        if (json_obj == NULL || PyList_Append(ret, json_obj) < 0) {
+            Py_XDECREF(json_obj);
+            Py_DECREF(ret);
+            jsonnet_realloc(vm, out, 0);
+            return NULL;
+        }
+        Py_DECREF(json_obj);
+    }
+    jsonnet_realloc(vm, out, 0);
+    return ret;
+}
+
+/** Bind ext vars or top-level arguments from a dict of strings.
+ *
+ * Values that are not strings are bound as JSON values (unless they are code).
+ *
+ * \returns 1 on success, 0 with exception set upon failure.
+ */
+static int handle_vars(struct JsonnetVm *vm, PyObject *map, int code, int tla)
 {
     if (map == NULL) return 1;
 
@@ -295,20 +784,37 @@ int handle_vars(struct JsonnetVm *vm, PyObject *map, int code, int tla)
     while (PyDict_Next(map, &pos, &key, &val)) {
 #if PY_MAJOR_VERSION >= 3
         const char *key_ = PyUnicode_AsUTF8(key);
+        int is_str = PyUnicode_Check(val);
 #else
         const char *key_ = PyString_AsString(key);
+        int is_str = PyString_Check(val);
 #endif
         if (key_ == NULL) {
-            jsonnet_destroy(vm);
             return 0;
         }
+        if (!code && !is_str) {
+            const char *err_msg;
+            struct JsonnetJsonValue *json = python_to_jsonnet_json(vm, val, &err_msg);
+            if (json == NULL) {
+                PyErr_Format(PyExc_TypeError,
+                             "%s['%s'] must be a str, or be made of dicts, lists, strings, "
+                             "numbers, bools and None",
+                             tla ? "tla_vars" : "ext_vars", key_);
+                return 0;
+            }
+            if (tla) {
+                jsonnet_tla_value(vm, key_, json);
+            } else {
+                jsonnet_ext_value(vm, key_, json);
+            }
+            continue;
+        }
 #if PY_MAJOR_VERSION >= 3
         const char *val_ = PyUnicode_AsUTF8(val);
 #else
         const char *val_ = PyString_AsString(val);
 #endif
         if (val_ == NULL) {
-            jsonnet_destroy(vm);
             return 0;
         }
         if (!tla && !code) {
@@ -324,18 +830,118 @@ int handle_vars(struct JsonnetVm *vm, PyObject *map, int code, int tla)
     return 1;
 }
 
+/** Add the library search paths, given either as a string or a list of strings.
+ */
+static void handle_jpathdir(struct JsonnetVm *vm, PyObject *jpathdir)
+{
+    const char *jpath_str;
+    Py_ssize_t num_jpathdir, i;
+
+    if (jpathdir == NULL) return;
+
+    // Support string for backward compatibility with <= 0.15.0
+#if PY_MAJOR_VERSION >= 3
+    if (PyUnicode_Check(jpathdir)) {
+        jpath_str = PyUnicode_AsUTF8(jpathdir);
+#else
+    if (PyString_Check(jpathdir)) {
+        jpath_str = PyString_AsString(jpathdir);
+#endif
+        jsonnet_jpath_add(vm, jpath_str);
+    } else if (PyList_Check(jpathdir)) {
+        num_jpathdir = PyList_Size(jpathdir);
+        for (i = 0; i < num_jpathdir ; ++i) {
+            PyObject *jpath = PyList_GetItem(jpathdir, i);
+#if PY_MAJOR_VERSION >= 3
+            if (PyUnicode_Check(jpath)) {
+                jpath_str = PyUnicode_AsUTF8(jpath);
+#else
+            if (PyString_Check(jpath)) {
+                jpath_str = PyString_AsString(jpath);
+#endif
+                jsonnet_jpath_add(vm, jpath_str);
+            }
+        }
+    }
+}
+
+/** Give the VM the paths to select, from a string or a list of strings.  Returns 0 with a Python
+ * exception set on failure.
+ */
+static int handle_select(struct JsonnetVm *vm, PyObject *select)
+{
+    PyObject *paths;
+    Py_ssize_t i;
+
+    jsonnet_select_clear(vm);
+    if (select == NULL || select == Py_None) return 1;
+
+#if PY_MAJOR_VERSION >= 3
+    if (PyUnicode_Check(select)) {
+        jsonnet_select_add(vm, PyUnicode_AsUTF8(select));
+#else
+    if (PyString_Check(select)) {
+        jsonnet_select_add(vm, PyString_AsString(select));
+#endif
+        return 1;
+    }
+    paths = PySequence_Fast(select, "select must be a string or a list of strings");
+    if (paths == NULL) return 0;
+    for (i = 0; i < PySequence_Fast_GET_SIZE(paths); ++i) {
+        PyObject *path = PySequence_Fast_GET_ITEM(paths, i);
+#if PY_MAJOR_VERSION >= 3
+        const char *path_str = PyUnicode_Check(path) ? PyUnicode_AsUTF8(path) : NULL;
+#else
+        const char *path_str = PyString_Check(path) ? PyString_AsString(path) : NULL;
+#endif
+        if (path_str == NULL) {
+            if (!PyErr_Occurred())
+                PyErr_SetString(PyExc_TypeError, "select must be a string or a list of strings");
+            jsonnet_select_clear(vm);
+            Py_DECREF(paths);
+            return 0;
+        }
+        jsonnet_select_add(vm, path_str);
+    }
+    Py_DECREF(paths);
+    return 1;
+}
 
-int handle_import_callback(struct ImportCtx *ctx, PyObject *import_callback)
+static int handle_import_callback(struct ImportCtx *ctx, PyObject *import_callback)
 {
     if (import_callback == NULL) return 1;
 
     if (!PyCallable_Check(import_callback)) {
-        jsonnet_destroy(ctx->vm);
         PyErr_SetString(PyExc_TypeError, "import_callback must be callable");
         return 0;
     }
 
-    jsonnet_import_callback(ctx->vm, cpython_import_callback, ctx);
+    jsonnet_import_buffer_callback(ctx->vm, cpython_import_callback, ctx);
+
+    return 1;
+}
+
+/** Give the built-in importer a callable for the files it cannot find, and make it remember which
+ * files it found in each directory if path_cache is set.  The callable is called like an
+ * import_callback.
+ */
+static int handle_import_fallback(struct ImportCtx *ctx, PyObject *import_callback,
+                                  PyObject *import_fallback, int path_cache)
+{
+    jsonnet_import_path_cache(ctx->vm, path_cache);
+
+    if (import_fallback == NULL) return 1;
+
+    if (!PyCallable_Check(import_fallback)) {
+        PyErr_SetString(PyExc_TypeError, "import_fallback must be callable");
+        return 0;
+    }
+    if (import_callback != NULL) {
+        PyErr_SetString(PyExc_TypeError, "import_fallback cannot be used with import_callback");
+        return 0;
+    }
+
+    jsonnet_import_fallback(ctx->vm, cpython_import_callback, ctx);
 
     return 1;
 }
@@ -347,10 +953,12 @@ int handle_import_callback(struct ImportCtx *ctx, PyObject *import_callback)
  *
  * May set *ctxs, in which case it should be free()'d by caller.
  *
+ * loop is the event loop of an asynchronous evaluation, or NULL.
+ *
  * \returns 1 on success, 0 with exception set upon failure.
  */
 static int handle_native_callbacks(struct JsonnetVm *vm, PyObject *native_callbacks,
-                                   struct NativeCtx **ctxs, PyThreadState **py_thread)
+                                   struct NativeCtx **ctxs, PyObject *loop)
 {
     size_t num_natives = 0;
     PyObject *key, *val;
@@ -372,19 +980,19 @@ static int handle_native_callbacks(struct JsonnetVm *vm, PyObject *native_callba
 #endif
         if (key_ == NULL) {
             PyErr_SetString(PyExc_TypeError, "native callback dict keys must be string");
-            goto bad;
+            return 0;
         }
         if (!PyTuple_Check(val)) {
             PyErr_SetString(PyExc_TypeError, "native callback dict values must be tuples");
-            goto bad;
-        } else if (PyTuple_Size(val) != 2) {
-            PyErr_SetString(PyExc_TypeError, "native callback tuples must have size 2");
-            goto bad;
+            return 0;
+        } else if (PyTuple_Size(val) != 2 && PyTuple_Size(val) != 3) {
+            PyErr_SetString(PyExc_TypeError, "native callback tuples must have size 2 or 3");
+            return 0;
         }
         params = PyTuple_GetItem(val, 0);
         if (!PyTuple_Check(params)) {
             PyErr_SetString(PyExc_TypeError, "native callback params must be a tuple");
-            goto bad;
+            return 0;
         }
         /* Check the params are all strings */
         num_params = PyTuple_Size(params);
@@ -396,20 +1004,37 @@ static int handle_native_callbacks(struct JsonnetVm *vm, PyObject *native_callba
             if (!PyString_Check(param)) {
 #endif
                 PyErr_SetString(PyExc_TypeError, "native callback param must be string");
-                goto bad;
+                return 0;
             }
         }
         if (!PyCallable_Check(PyTuple_GetItem(val, 1))) {
             PyErr_SetString(PyExc_TypeError, "native callback must be callable");
-            goto bad;
+            return 0;
+        }
+        if (PyTuple_Size(val) == 3) {
+            PyObject *options = PyTuple_GetItem(val, 2);
+            PyObject *option;
+            Py_ssize_t option_pos = 0;
+            if (!PyDict_Check(options)) {
+                PyErr_SetString(PyExc_TypeError, "native callback options must be a dict");
+                return 0;
+            }
+            while (PyDict_Next(options, &option_pos, &option, NULL)) {
+#if PY_MAJOR_VERSION >= 3
+                const char *option_ = PyUnicode_Check(option) ? PyUnicode_AsUTF8(option) : NULL;
+#else
+                const char *option_ = PyString_Check(option) ? PyString_AsString(option) : NULL;
+#endif
+                if (option_ == NULL
+                    || (strcmp(option_, "pure") != 0 && strcmp(option_, "vectorized") != 0)) {
+                    PyErr_SetString(PyExc_TypeError,
+                                    "native callback options may only be 'pure' and 'vectorized'");
+                    return 0;
+                }
+            }
         }
 
         num_natives++;
-        continue;
-
-        bad:
-        jsonnet_destroy(vm);
-        return 0;
     }
 
     if (num_natives == 0) {
@@ -443,12 +1068,26 @@ static int handle_native_callbacks(struct JsonnetVm *vm, PyObject *native_callba
         }
         params_c[num_params] = NULL;
         (*ctxs)[num_natives].vm = vm;
-        (*ctxs)[num_natives].py_thread = py_thread;
         (*ctxs)[num_natives].callback = PyTuple_GetItem(val, 1);
         (*ctxs)[num_natives].argc = num_params;
-        jsonnet_native_callback(vm, key_, cpython_native_callback, &(*ctxs)[num_natives],
-                                params_c);
+        (*ctxs)[num_natives].vectorized = 0;
+        (*ctxs)[num_natives].loop = loop;
+        if (PyTuple_Size(val) == 3) {
+            PyObject *v = PyDict_GetItemString(PyTuple_GetItem(val, 2), "vectorized");
+            (*ctxs)[num_natives].vectorized = v != NULL && PyObject_IsTrue(v);
+        }
+        if ((*ctxs)[num_natives].vectorized)
+            jsonnet_native_callback_vectorized(vm, key_, cpython_native_callback,
+                                               &(*ctxs)[num_natives], params_c);
+        else
+            jsonnet_native_callback(vm, key_, cpython_native_callback, &(*ctxs)[num_natives],
+                                    params_c);
         free(params_c);
+        if (PyTuple_Size(val) == 3) {
+            PyObject *pure = PyDict_GetItemString(PyTuple_GetItem(val, 2), "pure");
+            if (pure != NULL && PyObject_IsTrue(pure))
+                jsonnet_native_callback_memo(vm, key_, 1);
+        }
         num_natives++;
     }
 
@@ -460,16 +1099,15 @@ static PyObject* evaluate_file(PyObject* self, PyObject* args, PyObject *keywds)
 {
     const char *filename;
     char *out;
-    const char *jpath_str;
     unsigned max_stack = 500, gc_min_objects = 1000, max_trace = 20;
     double gc_growth_trigger = 2;
     int error;
-    Py_ssize_t num_jpathdir, i;
     PyObject *jpathdir = NULL;
     PyObject *ext_vars = NULL, *ext_codes = NULL;
     PyObject *tla_vars = NULL, *tla_codes = NULL;
     PyObject *import_callback = NULL;
     PyObject *native_callbacks = NULL;
+    PyObject *result;
     struct JsonnetVm *vm;
     static char *kwlist[] = {
         "filename", "jpathdir",
@@ -497,69 +1135,47 @@ static PyObject* evaluate_file(PyObject* self, PyObject* args, PyObject *keywds)
     jsonnet_gc_min_objects(vm, gc_min_objects);
     jsonnet_max_trace(vm, max_trace);
     jsonnet_gc_growth_trigger(vm, gc_growth_trigger);
+    handle_jpathdir(vm, jpathdir);
 
-    if (jpathdir != NULL) {
-        // Support string for backward compatibility with <= 0.15.0
-#if PY_MAJOR_VERSION >= 3
-        if (PyUnicode_Check(jpathdir)) {
-            jpath_str = PyUnicode_AsUTF8(jpathdir);
-#else
-        if (PyString_Check(jpathdir)) {
-            jpath_str = PyString_AsString(jpathdir);
-#endif
-            jsonnet_jpath_add(vm, jpath_str);
-        } else if (PyList_Check(jpathdir)) {
-            num_jpathdir = PyList_Size(jpathdir);
-            for (i = 0; i < num_jpathdir ; ++i) {
-                PyObject *jpath = PyList_GetItem(jpathdir, i);
-#if PY_MAJOR_VERSION >= 3
-                if (PyUnicode_Check(jpath)) {
-                    jpath_str = PyUnicode_AsUTF8(jpath);
-#else
-                if (PyString_Check(jpath)) {
-                    jpath_str = PyString_AsString(jpath);
-#endif
-                    jsonnet_jpath_add(vm, jpath_str);
-                }
-            }
-        }
+    if (!handle_vars(vm, ext_vars, 0, 0) || !handle_vars(vm, ext_codes, 1, 0)
+        || !handle_vars(vm, tla_vars, 0, 1) || !handle_vars(vm, tla_codes, 1, 1)) {
+        jsonnet_destroy(vm);
+        return NULL;
     }
 
-    if (!handle_vars(vm, ext_vars, 0, 0)) return NULL;
-    if (!handle_vars(vm, ext_codes, 1, 0)) return NULL;
-    if (!handle_vars(vm, tla_vars, 0, 1)) return NULL;
-    if (!handle_vars(vm, tla_codes, 1, 1)) return NULL;
-
-    struct ImportCtx ctx = { vm, &py_thread, import_callback };
+    struct ImportCtx ctx = { vm, import_callback };
     if (!handle_import_callback(&ctx, import_callback)) {
+        jsonnet_destroy(vm);
         return NULL;
     }
     struct NativeCtx *ctxs = NULL;
-    if (!handle_native_callbacks(vm, native_callbacks, &ctxs, &py_thread)) {
+    if (!handle_native_callbacks(vm, native_callbacks, &ctxs, NULL)) {
         free(ctxs);
+        jsonnet_destroy(vm);
         return NULL;
     }
     py_thread = PyEval_SaveThread();
     out = jsonnet_evaluate_file(vm, filename, &error);
     PyEval_RestoreThread(py_thread);
     free(ctxs);
-    return handle_result(vm, out, error);
+    result = handle_result(vm, out, error);
+    jsonnet_destroy(vm);
+    return result;
 }
 
 static PyObject* evaluate_snippet(PyObject* self, PyObject* args, PyObject *keywds)
 {
     const char *filename, *src;
     char *out;
-    const char *jpath_str;
     unsigned max_stack = 500, gc_min_objects = 1000, max_trace = 20;
     double gc_growth_trigger = 2;
     int error;
-    Py_ssize_t num_jpathdir, i;
     PyObject *jpathdir = NULL;
     PyObject *ext_vars = NULL, *ext_codes = NULL;
     PyObject *tla_vars = NULL, *tla_codes = NULL;
     PyObject *import_callback = NULL;
     PyObject *native_callbacks = NULL;
+    PyObject *result;
     struct JsonnetVm *vm;
     static char *kwlist[] = {
         "filename", "src", "jpathdir",
@@ -587,52 +1203,1706 @@ static PyObject* evaluate_snippet(PyObject* self, PyObject* args, PyObject *keyw
     jsonnet_gc_min_objects(vm, gc_min_objects);
     jsonnet_max_trace(vm, max_trace);
     jsonnet_gc_growth_trigger(vm, gc_growth_trigger);
+    handle_jpathdir(vm, jpathdir);
 
-    if (jpathdir != NULL) {
-        // Support string for backward compatibility with <= 0.15.0
-#if PY_MAJOR_VERSION >= 3
-        if (PyUnicode_Check(jpathdir)) {
-            jpath_str = PyUnicode_AsUTF8(jpathdir);
-#else
-        if (PyString_Check(jpathdir)) {
-            jpath_str = PyString_AsString(jpathdir);
-#endif
-            jsonnet_jpath_add(vm, jpath_str);
-        } else if (PyList_Check(jpathdir)) {
-            num_jpathdir = PyList_Size(jpathdir);
-            for (i = 0; i < num_jpathdir ; ++i) {
-                PyObject *jpath = PyList_GetItem(jpathdir, i);
-#if PY_MAJOR_VERSION >= 3
-                if (PyUnicode_Check(jpath)) {
-                    jpath_str = PyUnicode_AsUTF8(jpath);
-#else
-                if (PyString_Check(jpath)) {
-                    jpath_str = PyString_AsString(jpath);
-#endif
-                    jsonnet_jpath_add(vm, jpath_str);
-                }
+    if (!handle_vars(vm, ext_vars, 0, 0) || !handle_vars(vm, ext_codes, 1, 0)
+        || !handle_vars(vm, tla_vars, 0, 1) || !handle_vars(vm, tla_codes, 1, 1)) {
+        jsonnet_destroy(vm);
+        return NULL;
+    }
+    struct ImportCtx ctx = { vm, import_callback };
+    if (!handle_import_callback(&ctx, import_callback)) {
+        jsonnet_destroy(vm);
+        return NULL;
+    }
+    struct NativeCtx *ctxs = NULL;
+    if (!handle_native_callbacks(vm, native_callbacks, &ctxs, NULL)) {
+        free(ctxs);
+        jsonnet_destroy(vm);
+        return NULL;
+    }
+    py_thread = PyEval_SaveThread();
+    out = jsonnet_evaluate_snippet(vm, filename, src, &error);
+    PyEval_RestoreThread(py_thread);
+    free(ctxs);
+    result = handle_result(vm, out, error);
+    jsonnet_destroy(vm);
+    return result;
+}
+
+
+/** One of the jobs given to evaluate_many. */
+struct ManyJob {
+    /* The dict describing the job, borrowed from the list of jobs. */
+    PyObject *job;
+    /* The JSON output, or else the exception raised by the job. */
+    PyObject *result;
+    PyObject *exc_type, *exc_value, *exc_traceback;
+};
+
+struct ManyPool;
+
+/** A worker thread of evaluate_many and its own VM. */
+struct ManyWorker {
+    struct ManyPool *pool;
+    struct JsonnetVm *vm;
+    struct ImportCtx import_ctx;
+    struct ImportCtx fallback_ctx;
+    struct NativeCtx *native_ctxs;
+};
+
+/** The state shared by the worker threads of evaluate_many.
+ *
+ * The workers only access it while holding the GIL.
+ */
+struct ManyPool {
+    struct ManyJob *jobs;
+    Py_ssize_t num_jobs;
+    /* The next job to be picked up by a worker. */
+    Py_ssize_t next;
+    /* The number of workers still running, the last one to finish releases done. */
+    int running;
+    PyThread_type_lock done;
+};
+
+static char *copy_str(const char *str)
+{
+    char *out;
+    if (str == NULL) return NULL;
+    out = malloc(strlen(str) + 1);
+    memcpy(out, str, strlen(str) + 1);
+    return out;
+}
+
+/** Run one job of evaluate_many, releasing the GIL during the evaluation. */
+static void many_run_job(struct JsonnetVm *vm, struct ManyJob *job)
+{
+    const char *filename, *src = NULL;
+    char *out;
+    int error;
+    PyObject *ext_vars = NULL, *ext_codes = NULL;
+    PyObject *tla_vars = NULL, *tla_codes = NULL;
+    PyObject *no_args = PyTuple_New(0);
+    static char *kwlist[] = {
+        "filename", "src", "ext_vars", "ext_codes", "tla_vars", "tla_codes",
+        NULL
+    };
+    int ok = no_args != NULL && PyArg_ParseTupleAndKeywords(
+        no_args, job->job, "s|zOOOO", kwlist,
+        &filename, &src, &ext_vars, &ext_codes, &tla_vars, &tla_codes);
+    Py_XDECREF(no_args);
+
+    if (ok) {
+        jsonnet_ext_clear(vm);
+        jsonnet_tla_clear(vm);
+        ok = handle_vars(vm, ext_vars, 0, 0) && handle_vars(vm, ext_codes, 1, 0)
+            && handle_vars(vm, tla_vars, 0, 1) && handle_vars(vm, tla_codes, 1, 1);
+    }
+    if (ok) {
+        /* The job dict may be changed by other threads while the GIL is released. */
+        char *filename_ = copy_str(filename), *src_ = copy_str(src);
+        PyThreadState *py_thread = PyEval_SaveThread();
+        out = src_ == NULL ? jsonnet_evaluate_file(vm, filename_, &error)
+                           : jsonnet_evaluate_snippet(vm, filename_, src_, &error);
+        PyEval_RestoreThread(py_thread);
+        free(filename_);
+        free(src_);
+        job->result = handle_result(vm, out, error);
+        ok = job->result != NULL;
+    }
+    if (!ok) {
+        PyErr_Fetch(&job->exc_type, &job->exc_value, &job->exc_traceback);
+    }
+}
+
+/** The body of the worker threads of evaluate_many: run jobs until there are none left. */
+static void many_worker(void *worker_)
+{
+    struct ManyWorker *worker = worker_;
+    struct ManyPool *pool = worker->pool;
+    PyGILState_STATE gil = PyGILState_Ensure();
+
+    while (pool->next < pool->num_jobs) {
+        many_run_job(worker->vm, &pool->jobs[pool->next++]);
+    }
+
+    if (--pool->running == 0) {
+        PyThread_release_lock(pool->done);
+    }
+    PyGILState_Release(gil);
+}
+
+static int default_workers(void)
+{
+    long n = 1;
+    PyObject *module = PyImport_ImportModule("multiprocessing");
+    PyObject *count = module == NULL ? NULL : PyObject_CallMethod(module, "cpu_count", NULL);
+    if (count != NULL) {
+        n = PyLong_AsLong(count);
+    }
+    Py_XDECREF(count);
+    Py_XDECREF(module);
+    PyErr_Clear();
+    return n < 1 ? 1 : (int)n;
+}
+
+static PyObject* evaluate_many(PyObject* self, PyObject* args, PyObject *keywds)
+{
+    PyObject *jobs_arg;
+    int workers = 0, return_exceptions = 0;
+    unsigned max_stack = 500, gc_min_objects = 1000, max_trace = 20;
+    Py_ssize_t import_cache_max = 0;
+    int import_path_cache = 0;
+    double gc_growth_trigger = 2;
+    PyObject *jpathdir = NULL;
+    PyObject *import_callback = NULL;
+    PyObject *import_fallback = NULL;
+    PyObject *native_callbacks = NULL;
+    PyObject *jobs, *result = NULL;
+    struct ManyPool pool;
+    struct ManyWorker *pool_workers;
+    Py_ssize_t i;
+    int num_workers, started = 0;
+    static char *kwlist[] = {
+        "jobs", "workers", "return_exceptions", "jpathdir",
+        "max_stack", "gc_min_objects", "gc_growth_trigger", "max_trace", "import_callback",
+        "native_callbacks", "import_cache_max", "import_fallback", "import_path_cache",
+        NULL
+    };
+
+    (void) self;
+
+    if (!PyArg_ParseTupleAndKeywords(
+        args, keywds, "O|iiOIIdIOOnOi", kwlist,
+        &jobs_arg, &workers, &return_exceptions, &jpathdir,
+        &max_stack, &gc_min_objects, &gc_growth_trigger, &max_trace, &import_callback,
+        &native_callbacks, &import_cache_max, &import_fallback, &import_path_cache)) {
+        return NULL;
+    }
+    if (workers < 0) {
+        PyErr_SetString(PyExc_ValueError, "workers must not be negative");
+        return NULL;
+    }
+    if (import_cache_max < 0) {
+        PyErr_SetString(PyExc_ValueError, "import_cache_max must not be negative");
+        return NULL;
+    }
+    if (native_callbacks != NULL && !PyDict_Check(native_callbacks)) {
+        PyErr_SetString(PyExc_TypeError, "native_callbacks must be a dict");
+        return NULL;
+    }
+
+    /* Our own list, so that the job dicts stay alive whatever the caller does. */
+    jobs = PySequence_List(jobs_arg);
+    if (jobs == NULL) {
+        return NULL;
+    }
+    pool.num_jobs = PyList_Size(jobs);
+    for (i = 0; i < pool.num_jobs; ++i) {
+        if (!PyDict_Check(PyList_GetItem(jobs, i))) {
+            PyErr_SetString(PyExc_TypeError, "evaluate_many jobs must be dicts");
+            Py_DECREF(jobs);
+            return NULL;
+        }
+    }
+
+    if (workers == 0) {
+        workers = default_workers();
+    }
+    num_workers = pool.num_jobs < workers ? (int)pool.num_jobs : workers;
+
+    pool.jobs = calloc(pool.num_jobs, sizeof(struct ManyJob));
+    for (i = 0; i < pool.num_jobs; ++i) {
+        pool.jobs[i].job = PyList_GetItem(jobs, i);
+    }
+    pool.next = 0;
+    pool.running = 0;
+    pool.done = PyThread_allocate_lock();
+    PyThread_acquire_lock(pool.done, WAIT_LOCK);
+
+    /* Configure every VM up front, so that bad arguments are raised here. */
+    pool_workers = calloc(num_workers, sizeof(struct ManyWorker));
+    for (i = 0; i < num_workers; ++i) {
+        struct ManyWorker *worker = &pool_workers[i];
+        worker->pool = &pool;
+        worker->vm = jsonnet_make();
+        jsonnet_max_stack(worker->vm, max_stack);
+        jsonnet_gc_min_objects(worker->vm, gc_min_objects);
+        jsonnet_max_trace(worker->vm, max_trace);
+        jsonnet_gc_growth_trigger(worker->vm, gc_growth_trigger);
+        jsonnet_import_cache_max(worker->vm, (size_t)import_cache_max);
+        handle_jpathdir(worker->vm, jpathdir);
+        worker->import_ctx.vm = worker->vm;
+        worker->import_ctx.callback = import_callback;
+        worker->fallback_ctx.vm = worker->vm;
+        worker->fallback_ctx.callback = import_fallback;
+        if (!handle_import_callback(&worker->import_ctx, import_callback)
+            || !handle_import_fallback(&worker->fallback_ctx, import_callback, import_fallback,
+                                       import_path_cache)
+            || !handle_native_callbacks(worker->vm, native_callbacks, &worker->native_ctxs,
+                                        NULL)) {
+            goto cleanup;
+        }
+    }
+
+#if PY_VERSION_HEX < 0x03070000
+    PyEval_InitThreads();
+#endif
+    /* The workers cannot take jobs before the GIL is released below. */
+    for (i = 0; i < num_workers; ++i) {
+#ifdef PYTHREAD_INVALID_THREAD_ID
+        if (PyThread_start_new_thread(many_worker, &pool_workers[i]) == PYTHREAD_INVALID_THREAD_ID)
+#else
+        if (PyThread_start_new_thread(many_worker, &pool_workers[i]) == -1)
+#endif
+            break;
+        started++;
+    }
+    pool.running = started;
+    if (started == 0 && num_workers > 0) {
+        PyErr_SetString(PyExc_RuntimeError, "can't start new thread");
+        goto cleanup;
+    }
+    if (started > 0) {
+        Py_BEGIN_ALLOW_THREADS
+        PyThread_acquire_lock(pool.done, WAIT_LOCK);
+        Py_END_ALLOW_THREADS
+    }
+
+    result = PyList_New(pool.num_jobs);
+    for (i = 0; i < pool.num_jobs && result != NULL; ++i) {
+        struct ManyJob *job = &pool.jobs[i];
+        if (job->result != NULL) {
+            PyList_SET_ITEM(result, i, job->result);
+            job->result = NULL;
+        } else if (return_exceptions) {
+            PyErr_NormalizeException(&job->exc_type, &job->exc_value, &job->exc_traceback);
+            PyList_SET_ITEM(result, i, job->exc_value);
+            job->exc_value = NULL;
+        } else {
+            PyErr_Restore(job->exc_type, job->exc_value, job->exc_traceback);
+            job->exc_type = job->exc_value = job->exc_traceback = NULL;
+            Py_CLEAR(result);
+        }
+    }
+
+cleanup:
+    for (i = 0; i < pool.num_jobs; ++i) {
+        Py_XDECREF(pool.jobs[i].result);
+        Py_XDECREF(pool.jobs[i].exc_type);
+        Py_XDECREF(pool.jobs[i].exc_value);
+        Py_XDECREF(pool.jobs[i].exc_traceback);
+    }
+    Py_BEGIN_ALLOW_THREADS
+    for (i = 0; i < num_workers; ++i) {
+        if (pool_workers[i].vm != NULL)
+            jsonnet_destroy(pool_workers[i].vm);
+        free(pool_workers[i].native_ctxs);
+    }
+    Py_END_ALLOW_THREADS
+    free(pool_workers);
+    free(pool.jobs);
+    PyThread_free_lock(pool.done);
+    Py_DECREF(jobs);
+    return result;
+}
+
+
+#if PY_MAJOR_VERSION >= 3
+/** An evaluation started by evaluate_file_async or evaluate_snippet_async.
+ *
+ * Queued for the asynchronous worker threads, and completes an asyncio future on the event loop
+ * that started it.
+ */
+typedef struct {
+    PyObject_HEAD
+    char *filename;
+    /* NULL to read filename from disk. */
+    char *src;
+    unsigned max_stack, gc_min_objects, max_trace;
+    double gc_growth_trigger;
+    PyObject *jpathdir, *ext_vars, *ext_codes, *tla_vars, *tla_codes;
+    PyObject *import_callback, *native_callbacks;
+    PyObject *loop, *future;
+    /* The VM, only while the job is evaluating. */
+    struct JsonnetVm *vm;
+    /* The JSON output, or else the exception raised by the job. */
+    PyObject *result;
+    PyObject *exc_type, *exc_value, *exc_traceback;
+} AsyncJobObject;
+
+static PyTypeObject AsyncJobType;
+
+/* Jobs not yet picked up by a worker thread. */
+static PyObject *async_queue = NULL;
+/* The number of worker threads, and the most that may run at once (0 for one per CPU). */
+static int async_running = 0, async_workers_max = 0;
+
+static int AsyncJob_traverse(AsyncJobObject *self, visitproc visit, void *arg)
+{
+    Py_VISIT(self->jpathdir);
+    Py_VISIT(self->ext_vars);
+    Py_VISIT(self->ext_codes);
+    Py_VISIT(self->tla_vars);
+    Py_VISIT(self->tla_codes);
+    Py_VISIT(self->import_callback);
+    Py_VISIT(self->native_callbacks);
+    Py_VISIT(self->loop);
+    Py_VISIT(self->future);
+    Py_VISIT(self->result);
+    Py_VISIT(self->exc_type);
+    Py_VISIT(self->exc_value);
+    Py_VISIT(self->exc_traceback);
+    return 0;
+}
+
+static int AsyncJob_clear(AsyncJobObject *self)
+{
+    Py_CLEAR(self->jpathdir);
+    Py_CLEAR(self->ext_vars);
+    Py_CLEAR(self->ext_codes);
+    Py_CLEAR(self->tla_vars);
+    Py_CLEAR(self->tla_codes);
+    Py_CLEAR(self->import_callback);
+    Py_CLEAR(self->native_callbacks);
+    Py_CLEAR(self->loop);
+    Py_CLEAR(self->future);
+    Py_CLEAR(self->result);
+    Py_CLEAR(self->exc_type);
+    Py_CLEAR(self->exc_value);
+    Py_CLEAR(self->exc_traceback);
+    return 0;
+}
+
+static void AsyncJob_dealloc(AsyncJobObject *self)
+{
+    PyObject_GC_UnTrack(self);
+    AsyncJob_clear(self);
+    free(self->filename);
+    free(self->src);
+    Py_TYPE(self)->tp_free((PyObject *)self);
+}
+
+/** Called on the event loop when the future is done, to stop the evaluation if it was cancelled. */
+static PyObject *AsyncJob_cancel(AsyncJobObject *self, PyObject *future)
+{
+    PyObject *cancelled = PyObject_CallMethod(future, "cancelled", NULL);
+    if (cancelled == NULL) return NULL;
+    if (PyObject_IsTrue(cancelled) && self->vm != NULL)
+        jsonnet_cancel(self->vm, 1);
+    Py_DECREF(cancelled);
+    Py_RETURN_NONE;
+}
+
+/** Called on the event loop when the evaluation is over, to complete the future. */
+static PyObject *AsyncJob_finish(AsyncJobObject *self, PyObject *unused)
+{
+    PyObject *done = PyObject_CallMethod(self->future, "done", NULL);
+    PyObject *r;
+    (void) unused;
+    if (done == NULL) return NULL;
+    if (PyObject_IsTrue(done)) {
+        r = Py_None;
+        Py_INCREF(r);
+    } else if (self->result != NULL) {
+        r = PyObject_CallMethod(self->future, "set_result", "(O)", self->result);
+    } else {
+        PyErr_NormalizeException(&self->exc_type, &self->exc_value, &self->exc_traceback);
+        if (self->exc_traceback != NULL)
+            PyException_SetTraceback(self->exc_value, self->exc_traceback);
+        r = PyObject_CallMethod(self->future, "set_exception", "(O)", self->exc_value);
+    }
+    Py_DECREF(done);
+    return r;
+}
+
+static PyMethodDef AsyncJob_methods[] = {
+    {"_cancel", (PyCFunction)AsyncJob_cancel, METH_O, NULL},
+    {"_finish", (PyCFunction)AsyncJob_finish, METH_NOARGS, NULL},
+    {NULL, NULL, 0, NULL}
+};
+
+static PyTypeObject AsyncJobType = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    "_jsonnet._AsyncJob",                           /* tp_name */
+    sizeof(AsyncJobObject),                         /* tp_basicsize */
+    0,                                              /* tp_itemsize */
+    (destructor)AsyncJob_dealloc,                   /* tp_dealloc */
+    0,                                              /* tp_print */
+    0,                                              /* tp_getattr */
+    0,                                              /* tp_setattr */
+    0,                                              /* tp_compare */
+    0,                                              /* tp_repr */
+    0,                                              /* tp_as_number */
+    0,                                              /* tp_as_sequence */
+    0,                                              /* tp_as_mapping */
+    0,                                              /* tp_hash */
+    0,                                              /* tp_call */
+    0,                                              /* tp_str */
+    0,                                              /* tp_getattro */
+    0,                                              /* tp_setattro */
+    0,                                              /* tp_as_buffer */
+    Py_TPFLAGS_DEFAULT | Py_TPFLAGS_HAVE_GC,        /* tp_flags */
+    "An evaluation started by evaluate_file_async or evaluate_snippet_async.",  /* tp_doc */
+    (traverseproc)AsyncJob_traverse,                /* tp_traverse */
+    (inquiry)AsyncJob_clear,                        /* tp_clear */
+    0,                                              /* tp_richcompare */
+    0,                                              /* tp_weaklistoffset */
+    0,                                              /* tp_iter */
+    0,                                              /* tp_iternext */
+    AsyncJob_methods,                               /* tp_methods */
+};
+
+/** Evaluate a job on a worker thread, releasing the GIL during the evaluation, and schedule the
+ * completion of its future on its event loop.
+ */
+static void async_run_job(AsyncJobObject *job)
+{
+    PyObject *cancelled, *finish, *r;
+    struct JsonnetVm *vm;
+    struct ImportCtx import_ctx;
+    struct NativeCtx *native_ctxs = NULL;
+    PyThreadState *py_thread;
+    char *out;
+    int error, ok;
+
+    /* Cancelled before it was picked up. */
+    cancelled = PyObject_CallMethod(job->future, "cancelled", NULL);
+    ok = cancelled != NULL && !PyObject_IsTrue(cancelled);
+    Py_XDECREF(cancelled);
+    if (!ok) {
+        PyErr_Clear();
+        return;
+    }
+
+    vm = jsonnet_make();
+    jsonnet_max_stack(vm, job->max_stack);
+    jsonnet_gc_min_objects(vm, job->gc_min_objects);
+    jsonnet_max_trace(vm, job->max_trace);
+    jsonnet_gc_growth_trigger(vm, job->gc_growth_trigger);
+    handle_jpathdir(vm, job->jpathdir);
+    import_ctx.vm = vm;
+    import_ctx.callback = job->import_callback;
+    import_ctx.loop = job->loop;
+
+    ok = handle_import_callback(&import_ctx, job->import_callback)
+        && handle_native_callbacks(vm, job->native_callbacks, &native_ctxs, job->loop)
+        && handle_vars(vm, job->ext_vars, 0, 0) && handle_vars(vm, job->ext_codes, 1, 0)
+        && handle_vars(vm, job->tla_vars, 0, 1) && handle_vars(vm, job->tla_codes, 1, 1);
+    if (ok) {
+        job->vm = vm;
+        py_thread = PyEval_SaveThread();
+        out = job->src == NULL ? jsonnet_evaluate_file(vm, job->filename, &error)
+                               : jsonnet_evaluate_snippet(vm, job->filename, job->src, &error);
+        PyEval_RestoreThread(py_thread);
+        job->vm = NULL;
+        job->result = handle_result(vm, out, error);
+        ok = job->result != NULL;
+    }
+    if (!ok) {
+        PyErr_Fetch(&job->exc_type, &job->exc_value, &job->exc_traceback);
+    }
+    free(native_ctxs);
+    jsonnet_destroy(vm);
+
+    finish = PyObject_GetAttrString((PyObject *)job, "_finish");
+    r = finish == NULL ? NULL
+                       : PyObject_CallMethod(job->loop, "call_soon_threadsafe", "(O)", finish);
+    /* Fails if the loop was closed in the meantime, then nobody is waiting for the result. */
+    if (r == NULL)
+        PyErr_Clear();
+    Py_XDECREF(r);
+    Py_XDECREF(finish);
+}
+
+/** The body of the asynchronous worker threads: run queued jobs until there are none left. */
+static void async_worker(void *unused)
+{
+    PyGILState_STATE gil = PyGILState_Ensure();
+    (void) unused;
+
+    while (PyList_Size(async_queue) > 0) {
+        PyObject *job = PyList_GetItem(async_queue, 0);
+        Py_INCREF(job);
+        PySequence_DelItem(async_queue, 0);
+        async_run_job((AsyncJobObject *)job);
+        Py_DECREF(job);
+    }
+    async_running--;
+    PyGILState_Release(gil);
+}
+
+/** Common implementation of evaluate_file_async and evaluate_snippet_async. */
+static PyObject *evaluate_async_aux(PyObject *args, PyObject *keywds, int snippet)
+{
+    const char *filename, *src = NULL;
+    AsyncJobObject *job;
+    PyObject *asyncio, *future, *cancel, *r;
+    static char *file_kwlist[] = {
+        "filename", "jpathdir",
+        "max_stack", "gc_min_objects", "gc_growth_trigger", "ext_vars",
+        "ext_codes", "tla_vars", "tla_codes", "max_trace", "import_callback",
+        "native_callbacks",
+        NULL
+    };
+    static char *snippet_kwlist[] = {
+        "filename", "src", "jpathdir",
+        "max_stack", "gc_min_objects", "gc_growth_trigger", "ext_vars",
+        "ext_codes", "tla_vars", "tla_codes", "max_trace", "import_callback",
+        "native_callbacks",
+        NULL
+    };
+
+    job = (AsyncJobObject *)AsyncJobType.tp_alloc(&AsyncJobType, 0);
+    if (job == NULL) return NULL;
+    job->max_stack = 500;
+    job->gc_min_objects = 1000;
+    job->max_trace = 20;
+    job->gc_growth_trigger = 2;
+
+    if (snippet ? !PyArg_ParseTupleAndKeywords(
+                      args, keywds, "ss|OIIdOOOOIOO", snippet_kwlist,
+                      &filename, &src, &job->jpathdir,
+                      &job->max_stack, &job->gc_min_objects, &job->gc_growth_trigger,
+                      &job->ext_vars, &job->ext_codes, &job->tla_vars, &job->tla_codes,
+                      &job->max_trace, &job->import_callback, &job->native_callbacks)
+                : !PyArg_ParseTupleAndKeywords(
+                      args, keywds, "s|OIIdOOOOIOO", file_kwlist,
+                      &filename, &job->jpathdir,
+                      &job->max_stack, &job->gc_min_objects, &job->gc_growth_trigger,
+                      &job->ext_vars, &job->ext_codes, &job->tla_vars, &job->tla_codes,
+                      &job->max_trace, &job->import_callback, &job->native_callbacks)) {
+        Py_DECREF(job);
+        return NULL;
+    }
+    /* The parsed objects are borrowed. */
+    Py_XINCREF(job->jpathdir);
+    Py_XINCREF(job->ext_vars);
+    Py_XINCREF(job->ext_codes);
+    Py_XINCREF(job->tla_vars);
+    Py_XINCREF(job->tla_codes);
+    Py_XINCREF(job->import_callback);
+    Py_XINCREF(job->native_callbacks);
+    job->filename = copy_str(filename);
+    job->src = copy_str(src);
+
+    if (job->import_callback != NULL && !PyCallable_Check(job->import_callback)) {
+        PyErr_SetString(PyExc_TypeError, "import_callback must be callable");
+        Py_DECREF(job);
+        return NULL;
+    }
+    if (job->native_callbacks != NULL && !PyDict_Check(job->native_callbacks)) {
+        PyErr_SetString(PyExc_TypeError, "native_callbacks must be a dict");
+        Py_DECREF(job);
+        return NULL;
+    }
+
+    asyncio = PyImport_ImportModule("asyncio");
+    if (asyncio == NULL) {
+        Py_DECREF(job);
+        return NULL;
+    }
+#if PY_VERSION_HEX >= 0x03070000
+    job->loop = PyObject_CallMethod(asyncio, "get_running_loop", NULL);
+#else
+    job->loop = PyObject_CallMethod(asyncio, "get_event_loop", NULL);
+#endif
+    Py_DECREF(asyncio);
+    job->future = job->loop == NULL ? NULL : PyObject_CallMethod(job->loop, "create_future", NULL);
+    cancel = job->future == NULL ? NULL : PyObject_GetAttrString((PyObject *)job, "_cancel");
+    r = cancel == NULL ? NULL
+                       : PyObject_CallMethod(job->future, "add_done_callback", "(O)", cancel);
+    Py_XDECREF(cancel);
+    if (r == NULL) {
+        Py_DECREF(job);
+        return NULL;
+    }
+    Py_DECREF(r);
+
+    if (async_queue == NULL) {
+        async_queue = PyList_New(0);
+        if (async_queue == NULL) {
+            Py_DECREF(job);
+            return NULL;
+        }
+    }
+    if (PyList_Append(async_queue, (PyObject *)job) < 0) {
+        Py_DECREF(job);
+        return NULL;
+    }
+    if (async_workers_max == 0) {
+        async_workers_max = default_workers();
+    }
+    /* Otherwise a running worker picks the job up once it is done with its current one. */
+    if (async_running < async_workers_max) {
+#if PY_VERSION_HEX < 0x03070000
+        PyEval_InitThreads();
+#endif
+#ifdef PYTHREAD_INVALID_THREAD_ID
+        if (PyThread_start_new_thread(async_worker, NULL) == PYTHREAD_INVALID_THREAD_ID) {
+#else
+        if (PyThread_start_new_thread(async_worker, NULL) == -1) {
+#endif
+            if (async_running == 0) {
+                PySequence_DelItem(async_queue, PyList_Size(async_queue) - 1);
+                PyErr_SetString(PyExc_RuntimeError, "can't start new thread");
+                Py_DECREF(job);
+                return NULL;
             }
+        } else {
+            async_running++;
+        }
+    }
+
+    future = job->future;
+    Py_INCREF(future);
+    Py_DECREF(job);
+    return future;
+}
+
+static PyObject* evaluate_file_async(PyObject* self, PyObject* args, PyObject *keywds)
+{
+    (void) self;
+    return evaluate_async_aux(args, keywds, 0);
+}
+
+static PyObject* evaluate_snippet_async(PyObject* self, PyObject* args, PyObject *keywds)
+{
+    (void) self;
+    return evaluate_async_aux(args, keywds, 1);
+}
+
+static PyObject* set_async_workers(PyObject* self, PyObject* args)
+{
+    int n;
+    (void) self;
+    if (!PyArg_ParseTuple(args, "i", &n)) {
+        return NULL;
+    }
+    if (n < 0) {
+        PyErr_SetString(PyExc_ValueError, "the number of workers must not be negative");
+        return NULL;
+    }
+    async_workers_max = n;
+    Py_RETURN_NONE;
+}
+#endif
+
+
+/** A long-lived Jsonnet VM.
+ *
+ * The VM is configured once by the constructor (stack and GC limits, library search path, import
+ * and native callbacks) and can then be used for any number of evaluations.  Ext vars and
+ * top-level arguments are given per evaluation.
+ */
+typedef struct {
+    PyObject_HEAD
+    struct JsonnetVm *vm;
+    struct ImportCtx import_ctx;
+    struct ImportCtx fallback_ctx;
+    struct NativeCtx *native_ctxs;
+    /* Strong references to the callbacks, which the contexts above only borrow. */
+    PyObject *import_callback;
+    PyObject *import_fallback;
+    PyObject *native_callbacks;
+    /* Set while the VM is evaluating, to reject concurrent and re-entrant use. */
+    int busy;
+} VmObject;
+
+static int Vm_init(VmObject *self, PyObject *args, PyObject *keywds)
+{
+    unsigned max_stack = 500, gc_min_objects = 1000, max_trace = 20, program_cache_max = 0;
+    Py_ssize_t import_cache_max = 0;
+    int import_path_cache = 0;
+    double gc_growth_trigger = 2;
+    PyObject *jpathdir = NULL;
+    PyObject *import_callback = NULL;
+    PyObject *import_fallback = NULL;
+    PyObject *native_callbacks = NULL;
+    static char *kwlist[] = {
+        "jpathdir", "max_stack", "gc_min_objects", "gc_growth_trigger", "max_trace",
+        "import_callback", "native_callbacks", "program_cache_max", "import_cache_max",
+        "import_fallback", "import_path_cache",
+        NULL
+    };
+
+    if (!PyArg_ParseTupleAndKeywords(
+        args, keywds, "|OIIdIOOInOi", kwlist,
+        &jpathdir, &max_stack, &gc_min_objects, &gc_growth_trigger, &max_trace,
+        &import_callback, &native_callbacks, &program_cache_max, &import_cache_max,
+        &import_fallback, &import_path_cache)) {
+        return -1;
+    }
+    if (import_cache_max < 0) {
+        PyErr_SetString(PyExc_ValueError, "import_cache_max must not be negative");
+        return -1;
+    }
+
+    if (self->vm != NULL) {
+        PyErr_SetString(PyExc_RuntimeError, "Vm is already initialized");
+        return -1;
+    }
+    if (native_callbacks != NULL && !PyDict_Check(native_callbacks)) {
+        PyErr_SetString(PyExc_TypeError, "native_callbacks must be a dict");
+        return -1;
+    }
+
+    self->vm = jsonnet_make();
+    jsonnet_max_stack(self->vm, max_stack);
+    jsonnet_gc_min_objects(self->vm, gc_min_objects);
+    jsonnet_max_trace(self->vm, max_trace);
+    jsonnet_gc_growth_trigger(self->vm, gc_growth_trigger);
+    jsonnet_program_cache_max(self->vm, program_cache_max);
+    jsonnet_import_cache_max(self->vm, (size_t)import_cache_max);
+    handle_jpathdir(self->vm, jpathdir);
+
+    self->import_ctx.vm = self->vm;
+    self->import_ctx.callback = import_callback;
+    if (!handle_import_callback(&self->import_ctx, import_callback)) {
+        return -1;
+    }
+    Py_XINCREF(import_callback);
+    self->import_callback = import_callback;
+    self->fallback_ctx.vm = self->vm;
+    self->fallback_ctx.callback = import_fallback;
+    if (!handle_import_fallback(&self->fallback_ctx, import_callback, import_fallback,
+                                import_path_cache)) {
+        return -1;
+    }
+    Py_XINCREF(import_fallback);
+    self->import_fallback = import_fallback;
+
+    if (native_callbacks != NULL) {
+        /* Take a copy so that later changes to the caller's dict cannot free the callbacks. */
+        self->native_callbacks = PyDict_Copy(native_callbacks);
+        if (self->native_callbacks == NULL) {
+            return -1;
+        }
+    }
+    if (!handle_native_callbacks(self->vm, self->native_callbacks, &self->native_ctxs, NULL)) {
+        return -1;
+    }
+
+    return 0;
+}
+
+static int Vm_traverse(VmObject *self, visitproc visit, void *arg)
+{
+    Py_VISIT(self->import_callback);
+    Py_VISIT(self->import_fallback);
+    Py_VISIT(self->native_callbacks);
+    return 0;
+}
+
+static int Vm_clear(VmObject *self)
+{
+    Py_CLEAR(self->import_callback);
+    Py_CLEAR(self->import_fallback);
+    Py_CLEAR(self->native_callbacks);
+    return 0;
+}
+
+static void Vm_dealloc(VmObject *self)
+{
+    PyObject_GC_UnTrack(self);
+    Vm_clear(self);
+    if (self->vm != NULL)
+        jsonnet_destroy(self->vm);
+    free(self->native_ctxs);
+    Py_TYPE(self)->tp_free((PyObject *)self);
+}
+
+/** The files of an evaluation in multi mode, as a read-only mapping of filename to JSON.
+ *
+ * Each file is only manifested the first time it is looked up, so a caller that needs a few of
+ * the files does not pay for the others.  The VM cannot be used while a file is manifested.
+ */
+typedef struct {
+    PyObject_HEAD
+    VmObject *vm;
+    struct JsonnetMulti *multi;
+    /* Dict of filename to its index in multi, in sorted order. */
+    PyObject *index;
+    /* Dict of filename to JSON, of the files manifested so far. */
+    PyObject *files;
+} MultiObject;
+
+static PyTypeObject MultiType;
+
+/** Wrap the result of jsonnet_*_multi_lazy, or raise its error. */
+static PyObject *Multi_new(VmObject *vm, struct JsonnetMulti *multi, char *error)
+{
+    MultiObject *r;
+    size_t i, n;
+
+    if (multi == NULL) {
+        return handle_result(vm->vm, error, 1);
+    }
+    r = PyObject_New(MultiObject, &MultiType);
+    if (r == NULL) {
+        jsonnet_multi_destroy(vm->vm, multi);
+        return NULL;
+    }
+    Py_INCREF(vm);
+    r->vm = vm;
+    r->multi = multi;
+    r->index = PyDict_New();
+    r->files = PyDict_New();
+    if (r->index == NULL || r->files == NULL) {
+        Py_DECREF(r);
+        return NULL;
+    }
+    n = jsonnet_multi_size(vm->vm, multi);
+    for (i = 0; i < n; ++i) {
+        PyObject *pos = PyLong_FromSize_t(i);
+        if (pos == NULL
+            || PyDict_SetItemString(r->index, jsonnet_multi_name(vm->vm, multi, i), pos) < 0) {
+            Py_XDECREF(pos);
+            Py_DECREF(r);
+            return NULL;
+        }
+        Py_DECREF(pos);
+    }
+    return (PyObject *)r;
+}
+
+static void Multi_dealloc(MultiObject *self)
+{
+    jsonnet_multi_destroy(self->vm->vm, self->multi);
+    Py_XDECREF(self->index);
+    Py_XDECREF(self->files);
+    Py_DECREF(self->vm);
+    PyObject_Del(self);
+}
+
+/** Return a new reference to the JSON of a file, manifesting it if this is the first lookup.
+ *
+ * Returns NULL without an exception set if there is no such file.
+ */
+static PyObject *Multi_lookup(MultiObject *self, PyObject *key)
+{
+    VmObject *vm = self->vm;
+    PyThreadState *py_thread;
+    PyObject *pos, *ret;
+    char *out;
+    int error;
+
+    ret = PyDict_GetItem(self->files, key);
+    if (ret != NULL) {
+        Py_INCREF(ret);
+        return ret;
+    }
+    pos = PyDict_GetItem(self->index, key);
+    if (pos == NULL) {
+        return NULL;
+    }
+    if (vm->busy) {
+        PyErr_SetString(PyExc_RuntimeError, "Vm is already evaluating");
+        return NULL;
+    }
+
+    vm->busy = 1;
+    py_thread = PyEval_SaveThread();
+    out = jsonnet_multi_manifest(vm->vm, self->multi, PyLong_AsSize_t(pos), &error);
+    PyEval_RestoreThread(py_thread);
+    vm->busy = 0;
+
+    ret = handle_result(vm->vm, out, error);
+    if (ret != NULL && PyDict_SetItem(self->files, key, ret) < 0) {
+        Py_DECREF(ret);
+        return NULL;
+    }
+    return ret;
+}
+
+/** Manifest all the files into a new dict. */
+static PyObject *Multi_dict(MultiObject *self)
+{
+    PyObject *key, *pos, *json;
+    Py_ssize_t i = 0;
+    PyObject *ret = PyDict_New();
+
+    if (ret == NULL)
+        return NULL;
+    while (PyDict_Next(self->index, &i, &key, &pos)) {
+        json = Multi_lookup(self, key);
+        if (json == NULL || PyDict_SetItem(ret, key, json) < 0) {
+            Py_XDECREF(json);
+            Py_DECREF(ret);
+            return NULL;
+        }
+        Py_DECREF(json);
+    }
+    return ret;
+}
+
+static Py_ssize_t Multi_length(MultiObject *self)
+{
+    return PyDict_Size(self->index);
+}
+
+static PyObject *Multi_subscript(MultiObject *self, PyObject *key)
+{
+    PyObject *ret = Multi_lookup(self, key);
+    if (ret == NULL && !PyErr_Occurred())
+        PyErr_SetObject(PyExc_KeyError, key);
+    return ret;
+}
+
+static int Multi_contains(MultiObject *self, PyObject *key)
+{
+    return PyDict_Contains(self->index, key);
+}
+
+static PyObject *Multi_iter(MultiObject *self)
+{
+    return PyObject_GetIter(self->index);
+}
+
+static PyObject *Multi_richcompare(MultiObject *self, PyObject *other, int op)
+{
+    PyObject *dict, *ret;
+
+    if ((op != Py_EQ && op != Py_NE)
+        || (!PyDict_Check(other) && !PyObject_TypeCheck(other, &MultiType))) {
+        Py_INCREF(Py_NotImplemented);
+        return Py_NotImplemented;
+    }
+    dict = Multi_dict(self);
+    if (dict == NULL)
+        return NULL;
+    ret = PyObject_RichCompare(dict, other, op);
+    Py_DECREF(dict);
+    return ret;
+}
+
+static PyObject *Multi_keys(MultiObject *self)
+{
+    return PyDict_Keys(self->index);
+}
+
+static PyObject *Multi_values(MultiObject *self)
+{
+    PyObject *dict = Multi_dict(self);
+    PyObject *ret = dict == NULL ? NULL : PyDict_Values(dict);
+    Py_XDECREF(dict);
+    return ret;
+}
+
+static PyObject *Multi_items(MultiObject *self)
+{
+    PyObject *dict = Multi_dict(self);
+    PyObject *ret = dict == NULL ? NULL : PyDict_Items(dict);
+    Py_XDECREF(dict);
+    return ret;
+}
+
+static PyObject *Multi_get(MultiObject *self, PyObject *args)
+{
+    PyObject *key, *ret, *def = Py_None;
+
+    if (!PyArg_ParseTuple(args, "O|O", &key, &def)) {
+        return NULL;
+    }
+    ret = Multi_lookup(self, key);
+    if (ret == NULL && !PyErr_Occurred()) {
+        Py_INCREF(def);
+        return def;
+    }
+    return ret;
+}
+
+static PyMethodDef Multi_methods[] = {
+    {"keys", (PyCFunction)Multi_keys, METH_NOARGS,
+     "Return a list of the filenames, without manifesting the files."},
+    {"values", (PyCFunction)Multi_values, METH_NOARGS,
+     "Return a list of the JSON of all files."},
+    {"items", (PyCFunction)Multi_items, METH_NOARGS,
+     "Return a list of the (filename, JSON) pairs of all files."},
+    {"get", (PyCFunction)Multi_get, METH_VARARGS,
+     "Return the JSON of the given file, or the default if there is no such file."},
+    {NULL, NULL, 0, NULL}
+};
+
+static PyMappingMethods Multi_as_mapping = {
+    (lenfunc)Multi_length,                          /* mp_length */
+    (binaryfunc)Multi_subscript,                    /* mp_subscript */
+    0,                                              /* mp_ass_subscript */
+};
+
+static PySequenceMethods Multi_as_sequence = {
+    0,                                              /* sq_length */
+    0,                                              /* sq_concat */
+    0,                                              /* sq_repeat */
+    0,                                              /* sq_item */
+    0,                                              /* sq_slice */
+    0,                                              /* sq_ass_item */
+    0,                                              /* sq_ass_slice */
+    (objobjproc)Multi_contains,                     /* sq_contains */
+};
+
+static PyTypeObject MultiType = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    "_jsonnet.MultiResult",                         /* tp_name */
+    sizeof(MultiObject),                            /* tp_basicsize */
+    0,                                              /* tp_itemsize */
+    (destructor)Multi_dealloc,                      /* tp_dealloc */
+    0,                                              /* tp_print */
+    0,                                              /* tp_getattr */
+    0,                                              /* tp_setattr */
+    0,                                              /* tp_compare */
+    0,                                              /* tp_repr */
+    0,                                              /* tp_as_number */
+    &Multi_as_sequence,                             /* tp_as_sequence */
+    &Multi_as_mapping,                              /* tp_as_mapping */
+    0,                                              /* tp_hash */
+    0,                                              /* tp_call */
+    0,                                              /* tp_str */
+    0,                                              /* tp_getattro */
+    0,                                              /* tp_setattro */
+    0,                                              /* tp_as_buffer */
+    Py_TPFLAGS_DEFAULT,                             /* tp_flags */
+    "The files of a multi mode evaluation, manifested when they are looked up.",  /* tp_doc */
+    0,                                              /* tp_traverse */
+    0,                                              /* tp_clear */
+    (richcmpfunc)Multi_richcompare,                 /* tp_richcompare */
+    0,                                              /* tp_weaklistoffset */
+    (getiterfunc)Multi_iter,                        /* tp_iter */
+    0,                                              /* tp_iternext */
+    Multi_methods,                                  /* tp_methods */
+};
+
+enum VmEvalKind { VM_EVAL_REGULAR, VM_EVAL_MULTI, VM_EVAL_STREAM, VM_EVAL_VALUE, VM_EVAL_WRITE };
+
+/** Check that the VM can be used now, and give it the ext vars, top-level arguments and selected
+ * paths of the next evaluation.  Returns 0 with a Python exception set on failure.
+ */
+static int Vm_begin(VmObject *self, PyObject *ext_vars, PyObject *ext_codes, PyObject *tla_vars,
+                    PyObject *tla_codes, PyObject *select)
+{
+    if (self->vm == NULL) {
+        PyErr_SetString(PyExc_RuntimeError, "Vm is not initialized");
+        return 0;
+    }
+    if (self->busy) {
+        PyErr_SetString(PyExc_RuntimeError, "Vm is already evaluating");
+        return 0;
+    }
+
+    jsonnet_ext_clear(self->vm);
+    jsonnet_tla_clear(self->vm);
+    return handle_vars(self->vm, ext_vars, 0, 0) && handle_vars(self->vm, ext_codes, 1, 0)
+        && handle_vars(self->vm, tla_vars, 0, 1) && handle_vars(self->vm, tla_codes, 1, 1)
+        && handle_select(self->vm, select);
+}
+
+static PyObject *Vm_result(VmObject *self, char *out, int error, enum VmEvalKind kind)
+{
+    switch (kind) {
+        case VM_EVAL_REGULAR: return handle_result(self->vm, out, error);
+        default: return handle_stream_result(self->vm, out, error);
+    }
+}
+
+/** Common implementation of the Vm.evaluate_* methods.
+ *
+ * If src is NULL, filename is read from disk, otherwise src is evaluated.  For VM_EVAL_WRITE, the
+ * output is written to file.
+ */
+static PyObject *Vm_evaluate_aux(VmObject *self, const char *filename, const char *src,
+                                 PyObject *file, PyObject *ext_vars, PyObject *ext_codes,
+                                 PyObject *tla_vars, PyObject *tla_codes, PyObject *select,
+                                 enum VmEvalKind kind)
+{
+    PyThreadState *py_thread;
+    char *out = NULL;
+    int error;
+    struct ValueCtx value = { NULL, NULL, 0, 0, NULL, NULL, NULL, NULL };
+    struct JsonnetMulti *multi = NULL;
+    struct SinkCtx sink = { NULL, NULL, NULL, NULL };
+
+    if (kind == VM_EVAL_WRITE) {
+        sink.write = PyObject_GetAttrString(file, "write");
+        if (sink.write == NULL) {
+            return NULL;
         }
     }
+    if (!Vm_begin(self, ext_vars, ext_codes, tla_vars, tla_codes, select)) {
+        Py_XDECREF(sink.write);
+        return NULL;
+    }
+    if (kind == VM_EVAL_VALUE && (value.keys = PyDict_New()) == NULL) {
+        return NULL;
+    }
 
-    if (!handle_vars(vm, ext_vars, 0, 0)) return NULL;
-    if (!handle_vars(vm, ext_codes, 1, 0)) return NULL;
-    if (!handle_vars(vm, tla_vars, 0, 1)) return NULL;
-    if (!handle_vars(vm, tla_codes, 1, 1)) return NULL;
-    struct ImportCtx ctx = { vm, &py_thread, import_callback };
-    if (!handle_import_callback(&ctx, import_callback)) {
+    self->busy = 1;
+    py_thread = PyEval_SaveThread();
+    switch (kind) {
+        case VM_EVAL_VALUE:
+            error = src == NULL ? jsonnet_evaluate_file_value(self->vm, filename,
+                                                              cpython_value_callback, &value, &out)
+                                : jsonnet_evaluate_snippet_value(self->vm, filename, src,
+                                                                 cpython_value_callback, &value,
+                                                                 &out);
+            break;
+        case VM_EVAL_WRITE:
+            error = src == NULL ? jsonnet_evaluate_file_sink(self->vm, filename,
+                                                             cpython_sink_callback, &sink, &out)
+                                : jsonnet_evaluate_snippet_sink(self->vm, filename, src,
+                                                                cpython_sink_callback, &sink, &out);
+            break;
+        case VM_EVAL_REGULAR:
+            out = src == NULL ? jsonnet_evaluate_file(self->vm, filename, &error)
+                              : jsonnet_evaluate_snippet(self->vm, filename, src, &error);
+            break;
+        case VM_EVAL_MULTI:
+            multi = src == NULL
+                ? jsonnet_evaluate_file_multi_lazy(self->vm, filename, &out)
+                : jsonnet_evaluate_snippet_multi_lazy(self->vm, filename, src, &out);
+            break;
+        default:
+            out = src == NULL ? jsonnet_evaluate_file_stream(self->vm, filename, &error)
+                              : jsonnet_evaluate_snippet_stream(self->vm, filename, src, &error);
+            break;
+    }
+    PyEval_RestoreThread(py_thread);
+    self->busy = 0;
+
+    if (kind == VM_EVAL_VALUE)
+        return handle_value_result(self->vm, &value, error, out);
+    if (kind == VM_EVAL_MULTI)
+        return Multi_new(self, multi, out);
+    if (kind == VM_EVAL_WRITE) {
+        Py_DECREF(sink.write);
+        return handle_sink_result(self->vm, &sink, error, out);
+    }
+    return Vm_result(self, out, error, kind);
+}
+
+static PyObject *Vm_evaluate_file_aux(VmObject *self, PyObject *args, PyObject *keywds,
+                                      enum VmEvalKind kind)
+{
+    const char *filename;
+    PyObject *ext_vars = NULL, *ext_codes = NULL;
+    PyObject *tla_vars = NULL, *tla_codes = NULL;
+    PyObject *select = NULL;
+    static char *kwlist[] = {
+        "filename", "ext_vars", "ext_codes", "tla_vars", "tla_codes", "select",
+        NULL
+    };
+
+    if (!PyArg_ParseTupleAndKeywords(
+        args, keywds, "s|OOOOO", kwlist,
+        &filename, &ext_vars, &ext_codes, &tla_vars, &tla_codes, &select)) {
         return NULL;
     }
-    struct NativeCtx *ctxs = NULL;
-    if (!handle_native_callbacks(vm, native_callbacks, &ctxs, &py_thread)) {
-        free(ctxs);
+    return Vm_evaluate_aux(self, filename, NULL, NULL, ext_vars, ext_codes, tla_vars, tla_codes,
+                           select, kind);
+}
+
+static PyObject *Vm_evaluate_snippet_aux(VmObject *self, PyObject *args, PyObject *keywds,
+                                         enum VmEvalKind kind)
+{
+    const char *filename, *src;
+    PyObject *ext_vars = NULL, *ext_codes = NULL;
+    PyObject *tla_vars = NULL, *tla_codes = NULL;
+    PyObject *select = NULL;
+    static char *kwlist[] = {
+        "filename", "src", "ext_vars", "ext_codes", "tla_vars", "tla_codes", "select",
+        NULL
+    };
+
+    if (!PyArg_ParseTupleAndKeywords(
+        args, keywds, "ss|OOOOO", kwlist,
+        &filename, &src, &ext_vars, &ext_codes, &tla_vars, &tla_codes, &select)) {
+        return NULL;
+    }
+    return Vm_evaluate_aux(self, filename, src, NULL, ext_vars, ext_codes, tla_vars, tla_codes,
+                           select, kind);
+}
+
+static PyObject *Vm_evaluate_file_to(VmObject *self, PyObject *args, PyObject *keywds)
+{
+    const char *filename;
+    PyObject *file;
+    PyObject *ext_vars = NULL, *ext_codes = NULL;
+    PyObject *tla_vars = NULL, *tla_codes = NULL;
+    PyObject *select = NULL;
+    static char *kwlist[] = {
+        "filename", "file", "ext_vars", "ext_codes", "tla_vars", "tla_codes", "select",
+        NULL
+    };
+
+    if (!PyArg_ParseTupleAndKeywords(
+        args, keywds, "sO|OOOOO", kwlist,
+        &filename, &file, &ext_vars, &ext_codes, &tla_vars, &tla_codes, &select)) {
+        return NULL;
+    }
+    return Vm_evaluate_aux(self, filename, NULL, file, ext_vars, ext_codes, tla_vars, tla_codes,
+                           select, VM_EVAL_WRITE);
+}
+
+static PyObject *Vm_evaluate_snippet_to(VmObject *self, PyObject *args, PyObject *keywds)
+{
+    const char *filename, *src;
+    PyObject *file;
+    PyObject *ext_vars = NULL, *ext_codes = NULL;
+    PyObject *tla_vars = NULL, *tla_codes = NULL;
+    PyObject *select = NULL;
+    static char *kwlist[] = {
+        "filename", "src", "file", "ext_vars", "ext_codes", "tla_vars", "tla_codes", "select",
+        NULL
+    };
+
+    if (!PyArg_ParseTupleAndKeywords(
+        args, keywds, "ssO|OOOOO", kwlist,
+        &filename, &src, &file, &ext_vars, &ext_codes, &tla_vars, &tla_codes, &select)) {
+        return NULL;
+    }
+    return Vm_evaluate_aux(self, filename, src, file, ext_vars, ext_codes, tla_vars, tla_codes,
+                           select, VM_EVAL_WRITE);
+}
+
+static PyObject *Vm_evaluate_file(VmObject *self, PyObject *args, PyObject *keywds)
+{
+    return Vm_evaluate_file_aux(self, args, keywds, VM_EVAL_REGULAR);
+}
+
+static PyObject *Vm_evaluate_snippet(VmObject *self, PyObject *args, PyObject *keywds)
+{
+    return Vm_evaluate_snippet_aux(self, args, keywds, VM_EVAL_REGULAR);
+}
+
+static PyObject *Vm_evaluate_file_value(VmObject *self, PyObject *args, PyObject *keywds)
+{
+    return Vm_evaluate_file_aux(self, args, keywds, VM_EVAL_VALUE);
+}
+
+static PyObject *Vm_evaluate_snippet_value(VmObject *self, PyObject *args, PyObject *keywds)
+{
+    return Vm_evaluate_snippet_aux(self, args, keywds, VM_EVAL_VALUE);
+}
+
+static PyObject *Vm_evaluate_file_multi(VmObject *self, PyObject *args, PyObject *keywds)
+{
+    return Vm_evaluate_file_aux(self, args, keywds, VM_EVAL_MULTI);
+}
+
+static PyObject *Vm_evaluate_snippet_multi(VmObject *self, PyObject *args, PyObject *keywds)
+{
+    return Vm_evaluate_snippet_aux(self, args, keywds, VM_EVAL_MULTI);
+}
+
+static PyObject *Vm_evaluate_file_stream(VmObject *self, PyObject *args, PyObject *keywds)
+{
+    return Vm_evaluate_file_aux(self, args, keywds, VM_EVAL_STREAM);
+}
+
+static PyObject *Vm_evaluate_snippet_stream(VmObject *self, PyObject *args, PyObject *keywds)
+{
+    return Vm_evaluate_snippet_aux(self, args, keywds, VM_EVAL_STREAM);
+}
+
+/** A Jsonnet program compiled by a Vm, which can be evaluated many times. */
+typedef struct {
+    PyObject_HEAD
+    VmObject *vm;
+    struct JsonnetProgram *program;
+} ProgramObject;
+
+static PyTypeObject ProgramType;
+
+/** Common implementation of Vm.compile_file and Vm.compile_snippet.
+ *
+ * If src is NULL, filename is read from disk, otherwise src is compiled.
+ */
+static PyObject *Vm_compile_aux(VmObject *self, const char *filename, const char *src)
+{
+    PyThreadState *py_thread;
+    struct JsonnetProgram *program;
+    ProgramObject *r;
+    char *error = NULL;
+
+    if (!Vm_begin(self, NULL, NULL, NULL, NULL, NULL)) {
         return NULL;
     }
+
+    self->busy = 1;
     py_thread = PyEval_SaveThread();
-    out = jsonnet_evaluate_snippet(vm, filename, src, &error);
+    program = src == NULL ? jsonnet_compile_file(self->vm, filename, &error)
+                          : jsonnet_compile_snippet(self->vm, filename, src, &error);
     PyEval_RestoreThread(py_thread);
-    free(ctxs);
-    return handle_result(vm, out, error);
+    self->busy = 0;
+
+    if (program == NULL) {
+        PyErr_SetString(PyExc_RuntimeError, error);
+        jsonnet_realloc(self->vm, error, 0);
+        return NULL;
+    }
+    r = PyObject_New(ProgramObject, &ProgramType);
+    if (r == NULL) {
+        jsonnet_program_destroy(self->vm, program);
+        return NULL;
+    }
+    Py_INCREF(self);
+    r->vm = self;
+    r->program = program;
+    return (PyObject *)r;
+}
+
+static PyObject *Vm_compile_file(VmObject *self, PyObject *args, PyObject *keywds)
+{
+    const char *filename;
+    static char *kwlist[] = {"filename", NULL};
+
+    if (!PyArg_ParseTupleAndKeywords(args, keywds, "s", kwlist, &filename)) {
+        return NULL;
+    }
+    return Vm_compile_aux(self, filename, NULL);
+}
+
+static PyObject *Vm_compile_snippet(VmObject *self, PyObject *args, PyObject *keywds)
+{
+    const char *filename, *src;
+    static char *kwlist[] = {"filename", "src", NULL};
+
+    if (!PyArg_ParseTupleAndKeywords(args, keywds, "ss", kwlist, &filename, &src)) {
+        return NULL;
+    }
+    return Vm_compile_aux(self, filename, src);
+}
+
+static PyObject *Vm_gc_stats(VmObject *self, PyObject *args, PyObject *keywds)
+{
+    int reset = 0;
+    struct JsonnetGcStats stats;
+    static char *kwlist[] = {"reset", NULL};
+
+    if (!PyArg_ParseTupleAndKeywords(args, keywds, "|i", kwlist, &reset)) {
+        return NULL;
+    }
+    if (self->vm == NULL) {
+        PyErr_SetString(PyExc_RuntimeError, "Vm is not initialized");
+        return NULL;
+    }
+    if (self->busy) {
+        PyErr_SetString(PyExc_RuntimeError, "Vm is already evaluating");
+        return NULL;
+    }
+    jsonnet_gc_stats(self->vm, &stats);
+    if (reset) {
+        jsonnet_gc_stats_reset(self->vm);
+    }
+    return Py_BuildValue("{s:k,s:k,s:k,s:k,s:d,s:d}",
+                         "cycles", stats.cycles,
+                         "steps", stats.steps,
+                         "freed", stats.freed,
+                         "peak_entities", stats.peak_entities,
+                         "pause_ms", stats.pause_ms,
+                         "max_pause_ms", stats.max_pause_ms);
+}
+
+static PyMethodDef Vm_methods[] = {
+    {"evaluate_file", (PyCFunction)Vm_evaluate_file, METH_VARARGS | METH_KEYWORDS,
+     "Interpret the given Jsonnet file."},
+    {"evaluate_snippet", (PyCFunction)Vm_evaluate_snippet, METH_VARARGS | METH_KEYWORDS,
+     "Interpret the given Jsonnet code."},
+    {"evaluate_file_value", (PyCFunction)Vm_evaluate_file_value, METH_VARARGS | METH_KEYWORDS,
+     "Interpret the given Jsonnet file, returning the result as Python objects."},
+    {"evaluate_snippet_value", (PyCFunction)Vm_evaluate_snippet_value,
+     METH_VARARGS | METH_KEYWORDS,
+     "Interpret the given Jsonnet code, returning the result as Python objects."},
+    {"evaluate_file_to", (PyCFunction)Vm_evaluate_file_to, METH_VARARGS | METH_KEYWORDS,
+     "Interpret the given Jsonnet file, writing the JSON to a file as it is produced."},
+    {"evaluate_snippet_to", (PyCFunction)Vm_evaluate_snippet_to, METH_VARARGS | METH_KEYWORDS,
+     "Interpret the given Jsonnet code, writing the JSON to a file as it is produced."},
+    {"evaluate_file_multi", (PyCFunction)Vm_evaluate_file_multi, METH_VARARGS | METH_KEYWORDS,
+     "Interpret the given Jsonnet file, returning a mapping of filename to JSON."},
+    {"evaluate_snippet_multi", (PyCFunction)Vm_evaluate_snippet_multi,
+     METH_VARARGS | METH_KEYWORDS,
+     "Interpret the given Jsonnet code, returning a mapping of filename to JSON."},
+    {"evaluate_file_stream", (PyCFunction)Vm_evaluate_file_stream, METH_VARARGS | METH_KEYWORDS,
+     "Interpret the given Jsonnet file, returning a list of JSON documents."},
+    {"evaluate_snippet_stream", (PyCFunction)Vm_evaluate_snippet_stream,
+     METH_VARARGS | METH_KEYWORDS,
+     "Interpret the given Jsonnet code, returning a list of JSON documents."},
+    {"compile_file", (PyCFunction)Vm_compile_file, METH_VARARGS | METH_KEYWORDS,
+     "Compile the given Jsonnet file into a Program."},
+    {"compile_snippet", (PyCFunction)Vm_compile_snippet, METH_VARARGS | METH_KEYWORDS,
+     "Compile the given Jsonnet code into a Program."},
+    {"gc_stats", (PyCFunction)Vm_gc_stats, METH_VARARGS | METH_KEYWORDS,
+     "Return the garbage collection statistics of the evaluations so far, then maybe reset them."},
+    {NULL, NULL, 0, NULL}
+};
+
+static PyTypeObject VmType = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    "_jsonnet.Vm",                                  /* tp_name */
+    sizeof(VmObject),                               /* tp_basicsize */
+    0,                                              /* tp_itemsize */
+    (destructor)Vm_dealloc,                         /* tp_dealloc */
+    0,                                              /* tp_print */
+    0,                                              /* tp_getattr */
+    0,                                              /* tp_setattr */
+    0,                                              /* tp_compare */
+    0,                                              /* tp_repr */
+    0,                                              /* tp_as_number */
+    0,                                              /* tp_as_sequence */
+    0,                                              /* tp_as_mapping */
+    0,                                              /* tp_hash */
+    0,                                              /* tp_call */
+    0,                                              /* tp_str */
+    0,                                              /* tp_getattro */
+    0,                                              /* tp_setattro */
+    0,                                              /* tp_as_buffer */
+    Py_TPFLAGS_DEFAULT | Py_TPFLAGS_BASETYPE | Py_TPFLAGS_HAVE_GC,  /* tp_flags */
+    "A reusable Jsonnet VM, configured once and used for many evaluations.",  /* tp_doc */
+    (traverseproc)Vm_traverse,                      /* tp_traverse */
+    (inquiry)Vm_clear,                              /* tp_clear */
+    0,                                              /* tp_richcompare */
+    0,                                              /* tp_weaklistoffset */
+    0,                                              /* tp_iter */
+    0,                                              /* tp_iternext */
+    Vm_methods,                                     /* tp_methods */
+    0,                                              /* tp_members */
+    0,                                              /* tp_getset */
+    0,                                              /* tp_base */
+    0,                                              /* tp_dict */
+    0,                                              /* tp_descr_get */
+    0,                                              /* tp_descr_set */
+    0,                                              /* tp_dictoffset */
+    (initproc)Vm_init,                              /* tp_init */
+    0,                                              /* tp_alloc */
+    PyType_GenericNew,                              /* tp_new */
+};
+
+static void Program_dealloc(ProgramObject *self)
+{
+    jsonnet_program_destroy(self->vm->vm, self->program);
+    Py_DECREF(self->vm);
+    PyObject_Del(self);
+}
+
+/** Common implementation of the Program.evaluate* methods. */
+static PyObject *Program_evaluate_aux(ProgramObject *self, PyObject *args, PyObject *keywds,
+                                      enum VmEvalKind kind)
+{
+    VmObject *vm = self->vm;
+    PyThreadState *py_thread;
+    char *out = NULL;
+    int error;
+    struct ValueCtx value = { NULL, NULL, 0, 0, NULL, NULL, NULL, NULL };
+    struct JsonnetMulti *multi = NULL;
+    struct SinkCtx sink = { NULL, NULL, NULL, NULL };
+    PyObject *file = NULL;
+    PyObject *ext_vars = NULL, *ext_codes = NULL;
+    PyObject *tla_vars = NULL, *tla_codes = NULL;
+    PyObject *select = NULL;
+    static char *kwlist[] = {
+        "ext_vars", "ext_codes", "tla_vars", "tla_codes", "select",
+        NULL
+    };
+    static char *write_kwlist[] = {
+        "file", "ext_vars", "ext_codes", "tla_vars", "tla_codes", "select",
+        NULL
+    };
+
+    if (kind == VM_EVAL_WRITE ? !PyArg_ParseTupleAndKeywords(
+                                    args, keywds, "O|OOOOO", write_kwlist,
+                                    &file, &ext_vars, &ext_codes, &tla_vars, &tla_codes, &select)
+                              : !PyArg_ParseTupleAndKeywords(
+                                    args, keywds, "|OOOOO", kwlist,
+                                    &ext_vars, &ext_codes, &tla_vars, &tla_codes, &select)) {
+        return NULL;
+    }
+    if (kind == VM_EVAL_WRITE) {
+        sink.write = PyObject_GetAttrString(file, "write");
+        if (sink.write == NULL) {
+            return NULL;
+        }
+    }
+    if (!Vm_begin(vm, ext_vars, ext_codes, tla_vars, tla_codes, select)) {
+        Py_XDECREF(sink.write);
+        return NULL;
+    }
+    if (kind == VM_EVAL_VALUE && (value.keys = PyDict_New()) == NULL) {
+        return NULL;
+    }
+
+    vm->busy = 1;
+    py_thread = PyEval_SaveThread();
+    switch (kind) {
+        case VM_EVAL_VALUE:
+            error = jsonnet_program_evaluate_value(vm->vm, self->program, cpython_value_callback,
+                                                   &value, &out);
+            break;
+        case VM_EVAL_WRITE:
+            error = jsonnet_program_evaluate_sink(vm->vm, self->program, cpython_sink_callback,
+                                                  &sink, &out);
+            break;
+        case VM_EVAL_REGULAR:
+            out = jsonnet_program_evaluate(vm->vm, self->program, &error);
+            break;
+        case VM_EVAL_MULTI:
+            multi = jsonnet_program_evaluate_multi_lazy(vm->vm, self->program, &out);
+            break;
+        default:
+            out = jsonnet_program_evaluate_stream(vm->vm, self->program, &error);
+            break;
+    }
+    PyEval_RestoreThread(py_thread);
+    vm->busy = 0;
+
+    if (kind == VM_EVAL_VALUE)
+        return handle_value_result(vm->vm, &value, error, out);
+    if (kind == VM_EVAL_MULTI)
+        return Multi_new(vm, multi, out);
+    if (kind == VM_EVAL_WRITE) {
+        Py_DECREF(sink.write);
+        return handle_sink_result(vm->vm, &sink, error, out);
+    }
+    return Vm_result(vm, out, error, kind);
+}
+
+static PyObject *Program_evaluate(ProgramObject *self, PyObject *args, PyObject *keywds)
+{
+    return Program_evaluate_aux(self, args, keywds, VM_EVAL_REGULAR);
+}
+
+static PyObject *Program_evaluate_value(ProgramObject *self, PyObject *args, PyObject *keywds)
+{
+    return Program_evaluate_aux(self, args, keywds, VM_EVAL_VALUE);
+}
+
+static PyObject *Program_evaluate_to(ProgramObject *self, PyObject *args, PyObject *keywds)
+{
+    return Program_evaluate_aux(self, args, keywds, VM_EVAL_WRITE);
+}
+
+static PyObject *Program_evaluate_multi(ProgramObject *self, PyObject *args, PyObject *keywds)
+{
+    return Program_evaluate_aux(self, args, keywds, VM_EVAL_MULTI);
+}
+
+static PyObject *Program_evaluate_stream(ProgramObject *self, PyObject *args, PyObject *keywds)
+{
+    return Program_evaluate_aux(self, args, keywds, VM_EVAL_STREAM);
+}
+
+static PyMethodDef Program_methods[] = {
+    {"evaluate", (PyCFunction)Program_evaluate, METH_VARARGS | METH_KEYWORDS,
+     "Interpret the program."},
+    {"evaluate_value", (PyCFunction)Program_evaluate_value, METH_VARARGS | METH_KEYWORDS,
+     "Interpret the program, returning the result as Python objects."},
+    {"evaluate_to", (PyCFunction)Program_evaluate_to, METH_VARARGS | METH_KEYWORDS,
+     "Interpret the program, writing the JSON to a file as it is produced."},
+    {"evaluate_multi", (PyCFunction)Program_evaluate_multi, METH_VARARGS | METH_KEYWORDS,
+     "Interpret the program, returning a mapping of filename to JSON."},
+    {"evaluate_stream", (PyCFunction)Program_evaluate_stream, METH_VARARGS | METH_KEYWORDS,
+     "Interpret the program, returning a list of JSON documents."},
+    {NULL, NULL, 0, NULL}
+};
+
+static PyTypeObject ProgramType = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    "_jsonnet.Program",                             /* tp_name */
+    sizeof(ProgramObject),                          /* tp_basicsize */
+    0,                                              /* tp_itemsize */
+    (destructor)Program_dealloc,                    /* tp_dealloc */
+    0,                                              /* tp_print */
+    0,                                              /* tp_getattr */
+    0,                                              /* tp_setattr */
+    0,                                              /* tp_compare */
+    0,                                              /* tp_repr */
+    0,                                              /* tp_as_number */
+    0,                                              /* tp_as_sequence */
+    0,                                              /* tp_as_mapping */
+    0,                                              /* tp_hash */
+    0,                                              /* tp_call */
+    0,                                              /* tp_str */
+    0,                                              /* tp_getattro */
+    0,                                              /* tp_setattro */
+    0,                                              /* tp_as_buffer */
+    Py_TPFLAGS_DEFAULT,                             /* tp_flags */
+    "A Jsonnet program compiled by a Vm, see Vm.compile_file.",  /* tp_doc */
+    0,                                              /* tp_traverse */
+    0,                                              /* tp_clear */
+    0,                                              /* tp_richcompare */
+    0,                                              /* tp_weaklistoffset */
+    0,                                              /* tp_iter */
+    0,                                              /* tp_iternext */
+    Program_methods,                                /* tp_methods */
+};
+
+/** Common implementation of evaluate_file_multi and evaluate_snippet_multi.
+ *
+ * The keyword arguments that are not about this evaluation configure a new Vm, which the result
+ * keeps alive to manifest the files.
+ */
+static PyObject *evaluate_multi_aux(PyObject *args, PyObject *keywds, int snippet)
+{
+    const char *filename, *src = NULL;
+    PyObject *ext_vars = NULL, *ext_codes = NULL;
+    PyObject *tla_vars = NULL, *tla_codes = NULL;
+    PyObject *config, *eval_keywds, *empty, *vm;
+    PyObject *result = NULL;
+    char **name;
+    static char *file_kwlist[] = {
+        "filename", "ext_vars", "ext_codes", "tla_vars", "tla_codes",
+        NULL
+    };
+    static char *snippet_kwlist[] = {
+        "filename", "src", "ext_vars", "ext_codes", "tla_vars", "tla_codes",
+        NULL
+    };
+
+    config = keywds == NULL ? PyDict_New() : PyDict_Copy(keywds);
+    eval_keywds = PyDict_New();
+    if (config == NULL || eval_keywds == NULL)
+        goto out;
+    for (name = snippet_kwlist; *name != NULL; ++name) {
+        PyObject *v = PyDict_GetItemString(config, *name);
+        if (v == NULL)
+            continue;
+        if (PyDict_SetItemString(eval_keywds, *name, v) < 0
+            || PyDict_DelItemString(config, *name) < 0)
+            goto out;
+    }
+
+    if (snippet ? !PyArg_ParseTupleAndKeywords(
+                      args, eval_keywds, "ss|OOOO", snippet_kwlist,
+                      &filename, &src, &ext_vars, &ext_codes, &tla_vars, &tla_codes)
+                : !PyArg_ParseTupleAndKeywords(
+                      args, eval_keywds, "s|OOOO", file_kwlist,
+                      &filename, &ext_vars, &ext_codes, &tla_vars, &tla_codes)) {
+        goto out;
+    }
+
+    empty = PyTuple_New(0);
+    vm = empty == NULL ? NULL : PyObject_Call((PyObject *)&VmType, empty, config);
+    Py_XDECREF(empty);
+    if (vm != NULL) {
+        result = Vm_evaluate_aux((VmObject *)vm, filename, src, NULL, ext_vars, ext_codes,
+                                 tla_vars, tla_codes, NULL, VM_EVAL_MULTI);
+        Py_DECREF(vm);
+    }
+
+out:
+    Py_XDECREF(config);
+    Py_XDECREF(eval_keywds);
+    return result;
+}
+
+static PyObject *evaluate_file_multi(PyObject *self, PyObject *args, PyObject *keywds)
+{
+    (void) self;
+    return evaluate_multi_aux(args, keywds, 0);
+}
+
+static PyObject *evaluate_snippet_multi(PyObject *self, PyObject *args, PyObject *keywds)
+{
+    (void) self;
+    return evaluate_multi_aux(args, keywds, 1);
 }
 
 static PyMethodDef module_methods[] = {
@@ -640,6 +2910,20 @@ static PyMethodDef module_methods[] = {
      "Interpret the given Jsonnet file."},
     {"evaluate_snippet", (PyCFunction)evaluate_snippet, METH_VARARGS | METH_KEYWORDS,
      "Interpret the given Jsonnet code."},
+    {"evaluate_many", (PyCFunction)evaluate_many, METH_VARARGS | METH_KEYWORDS,
+     "Interpret many Jsonnet files or snippets in parallel, returning a list of JSON."},
+    {"evaluate_file_multi", (PyCFunction)evaluate_file_multi, METH_VARARGS | METH_KEYWORDS,
+     "Interpret the given Jsonnet file, returning a mapping of filename to JSON."},
+    {"evaluate_snippet_multi", (PyCFunction)evaluate_snippet_multi, METH_VARARGS | METH_KEYWORDS,
+     "Interpret the given Jsonnet code, returning a mapping of filename to JSON."},
+#if PY_MAJOR_VERSION >= 3
+    {"evaluate_file_async", (PyCFunction)evaluate_file_async, METH_VARARGS | METH_KEYWORDS,
+     "Interpret the given Jsonnet file on a worker thread, returning an asyncio future."},
+    {"evaluate_snippet_async", (PyCFunction)evaluate_snippet_async, METH_VARARGS | METH_KEYWORDS,
+     "Interpret the given Jsonnet code on a worker thread, returning an asyncio future."},
+    {"set_async_workers", (PyCFunction)set_async_workers, METH_VARARGS,
+     "Set the most worker threads used by asynchronous evaluations (0 for one per CPU)."},
+#endif
     {NULL, NULL, 0, NULL}
 };
 
@@ -655,11 +2939,36 @@ static struct PyModuleDef _jsonnet =
 
 PyMODINIT_FUNC PyInit__jsonnet(void)
 {
-    return PyModule_Create(&_jsonnet);
+    PyObject *module;
+    if (PyType_Ready(&VmType) < 0 || PyType_Ready(&ProgramType) < 0
+        || PyType_Ready(&MultiType) < 0 || PyType_Ready(&AsyncJobType) < 0)
+        return NULL;
+    module = PyModule_Create(&_jsonnet);
+    if (module == NULL)
+        return NULL;
+    Py_INCREF(&VmType);
+    PyModule_AddObject(module, "Vm", (PyObject *)&VmType);
+    Py_INCREF(&ProgramType);
+    PyModule_AddObject(module, "Program", (PyObject *)&ProgramType);
+    Py_INCREF(&MultiType);
+    PyModule_AddObject(module, "MultiResult", (PyObject *)&MultiType);
+    return module;
 }
 #else
 PyMODINIT_FUNC init_jsonnet(void)
 {
-    Py_InitModule3("_jsonnet", module_methods, "A Python interface to Jsonnet.");
+    PyObject *module;
+    if (PyType_Ready(&VmType) < 0 || PyType_Ready(&ProgramType) < 0
+        || PyType_Ready(&MultiType) < 0)
+        return;
+    module = Py_InitModule3("_jsonnet", module_methods, "A Python interface to Jsonnet.");
+    if (module == NULL)
+        return;
+    Py_INCREF(&VmType);
+    PyModule_AddObject(module, "Vm", (PyObject *)&VmType);
+    Py_INCREF(&ProgramType);
+    PyModule_AddObject(module, "Program", (PyObject *)&ProgramType);
+    Py_INCREF(&MultiType);
+    PyModule_AddObject(module, "MultiResult", (PyObject *)&MultiType);
 }
 #endif
@@ -12,7 +12,11 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import asyncio
+import io
+import json
 import os
+import tempfile
 import unittest
 
 import _jsonnet
@@ -93,5 +97,412 @@ class JsonnetTests(unittest.TestCase):
         )
         self.assertEqual(json_str, self.expected_str)
 
+    def test_vm_evaluate_file(self):
+        vm = _jsonnet.Vm(
+            import_callback=import_callback,
+            native_callbacks=native_callbacks,
+        )
+        for _ in range(3):
+            json_str = vm.evaluate_file(self.input_filename)
+            self.assertEqual(json_str, self.expected_str)
+
+    def test_vm_evaluate_snippet(self):
+        vm = _jsonnet.Vm(native_callbacks=native_callbacks)
+        json_str = vm.evaluate_snippet("snippet", self.input_snippet)
+        self.assertEqual(json_str, self.expected_str)
+
+    def test_vm_vars_are_per_call(self):
+        vm = _jsonnet.Vm()
+        json_str = vm.evaluate_snippet(
+            "snippet",
+            "function(x) [x, std.extVar('y')]",
+            ext_vars={'y': 'a'},
+            tla_codes={'x': '1 + 1'},
+        )
+        self.assertEqual(json_str, '[\n   2,\n   "a"\n]\n')
+        with self.assertRaises(RuntimeError):
+            vm.evaluate_snippet("snippet", "std.extVar('y')")
+        self.assertEqual(vm.evaluate_snippet("snippet", "function(x=3) x"), "3\n")
+
+    def test_vm_multi_and_stream(self):
+        vm = _jsonnet.Vm()
+        files = vm.evaluate_snippet_multi("snippet", "{ 'a.json': 1, 'b.json': [] }")
+        self.assertEqual(files, {'a.json': '1\n', 'b.json': '[ ]\n'})
+        docs = vm.evaluate_snippet_stream("snippet", "[1, 'x']")
+        self.assertEqual(docs, ['1\n', '"x"\n'])
+
+    def test_multi_is_lazy(self):
+        files = _jsonnet.evaluate_snippet_multi(
+            "snippet",
+            "{ 'a.json': std.extVar('x'), 'b.json': error 'no b' }",
+            ext_vars={'x': 'a'},
+            max_stack=100,
+        )
+        self.assertEqual(len(files), 2)
+        self.assertEqual(list(files), ['a.json', 'b.json'])
+        self.assertIn('b.json', files)
+        self.assertEqual(files['a.json'], '"a"\n')
+        with self.assertRaises(RuntimeError):
+            files['b.json']
+        with self.assertRaises(KeyError):
+            files['c.json']
+        self.assertEqual(files.get('c.json', 0), 0)
+        self.assertEqual(files['a.json'], '"a"\n')
+        program = _jsonnet.Vm().compile_snippet("snippet", "{ 'a.json': 1 }")
+        self.assertEqual(dict(program.evaluate_multi().items()), {'a.json': '1\n'})
+
+    def test_vm_error(self):
+        vm = _jsonnet.Vm()
+        with self.assertRaises(RuntimeError):
+            vm.evaluate_snippet("snippet", "error 'foo'")
+        self.assertEqual(vm.evaluate_snippet("snippet", "1"), "1\n")
+
+    def test_vm_rejects_reentrant_use(self):
+        def reenter():
+            return vm.evaluate_snippet("snippet", "1")
+        vm = _jsonnet.Vm(native_callbacks={'reenter': ((), reenter)})
+        with self.assertRaises(RuntimeError) as cm:
+            vm.evaluate_snippet("snippet", "std.native('reenter')()")
+        self.assertIn('already evaluating', str(cm.exception))
+
+    def test_vm_gc_stats(self):
+        vm = _jsonnet.Vm()
+        self.assertEqual(vm.gc_stats()['cycles'], 0)
+        vm.evaluate_snippet(
+            "snippet", "std.length([{ x: [i] } for i in std.range(1, 10000)])")
+        stats = vm.gc_stats(reset=True)
+        self.assertGreater(stats['cycles'], 0)
+        self.assertGreater(stats['steps'], stats['cycles'])
+        self.assertGreater(stats['freed'], 0)
+        self.assertGreaterEqual(stats['pause_ms'], stats['max_pause_ms'])
+        self.assertEqual(vm.gc_stats()['cycles'], 0)
+
+    def test_vm_select(self):
+        vm = _jsonnet.Vm()
+        src = "{ a: { b: [1, { c: 'x' }] }, d: error 'not selected' }"
+        self.assertEqual(
+            vm.evaluate_snippet("snippet", src, select="a.b.1.c"), '"x"\n')
+        self.assertEqual(
+            vm.evaluate_snippet_value("snippet", src, select=["a.b.0", "a.b.1"]),
+            {"a.b.0": 1, "a.b.1": {"c": "x"}})
+        with self.assertRaises(RuntimeError):
+            vm.evaluate_snippet("snippet", src, select="a.e")
+        with self.assertRaises(TypeError):
+            vm.evaluate_snippet("snippet", src, select=[1])
+        with self.assertRaises(RuntimeError):
+            vm.evaluate_snippet("snippet", src)
+
+    def test_vm_native_structured_args(self):
+        calls = []
+
+        def lookup(table, key):
+            calls.append(key)
+            return table[key]
+
+        vm = _jsonnet.Vm(native_callbacks={
+            'lookup': (('table', 'key'), lookup, {'pure': True}),
+            'first': (('arr',), lambda arr: arr[0]),
+        })
+        src = """
+            local table = { a: [1, { b: null }], c: 2 };
+            [std.native('lookup')(table, k) for k in ['a', 'c', 'a', 'a']]
+            + [std.native('first')([[3.5], 'x'])]
+        """
+        for _ in range(2):
+            self.assertEqual(
+                vm.evaluate_snippet_value("snippet", src),
+                [[1, {'b': None}], 2, [1, {'b': None}], [1, {'b': None}], [3.5]])
+        self.assertEqual(calls, ['a', 'c'])
+        with self.assertRaises(RuntimeError):
+            vm.evaluate_snippet("snippet", "std.native('first')([function(x) x])")
+        with self.assertRaises(TypeError):
+            _jsonnet.Vm(native_callbacks={'f': ((), concat, {'memo': True})})
+
+    def test_vm_native_vectorized(self):
+        batches = []
+
+        def double(calls):
+            batches.append(len(calls))
+            return [x * 2 for (x,) in calls]
+
+        vm = _jsonnet.Vm(native_callbacks={
+            'double': (('x',), double, {'vectorized': True}),
+            'bad': (('x',), lambda calls: [], {'vectorized': True}),
+        })
+        self.assertEqual(
+            vm.evaluate_snippet_value(
+                "snippet",
+                "local d = std.native('double'); [d(1), std.map(d, std.range(1, 100))[99]]"),
+            [2, 200])
+        self.assertEqual(batches, [1, 100])
+        with self.assertRaises(RuntimeError):
+            vm.evaluate_snippet("snippet", "std.native('bad')(1)")
+
+    def test_vm_compiled_program(self):
+        vm = _jsonnet.Vm()
+        program = vm.compile_snippet(
+            "snippet", "function(x) [x, std.extVar('y')]")
+        del vm
+        for i in range(3):
+            json_str = program.evaluate(
+                ext_vars={'y': str(i)},
+                tla_codes={'x': str(i)},
+            )
+            self.assertEqual(json_str, '[\n   %d,\n   "%d"\n]\n' % (i, i))
+        with self.assertRaises(RuntimeError):
+            program.evaluate()
+
+    def test_vm_compile_file(self):
+        vm = _jsonnet.Vm(
+            import_callback=import_callback,
+            native_callbacks=native_callbacks,
+        )
+        program = vm.compile_file(self.input_filename)
+        self.assertEqual(program.evaluate(), self.expected_str)
+        self.assertEqual(program.evaluate(), self.expected_str)
+
+    def test_vm_compile_error(self):
+        vm = _jsonnet.Vm()
+        with self.assertRaises(RuntimeError) as cm:
+            vm.compile_snippet("snippet", "{")
+        self.assertIn('STATIC ERROR', str(cm.exception))
+
+    def test_vm_program_cache(self):
+        vm = _jsonnet.Vm(program_cache_max=2)
+        for i in range(3):
+            for src in ["{ a: 1 }", "local x = 2; { b: x }", "{ a: 1 }"]:
+                vm.evaluate_snippet("snippet", src)
+        self.assertEqual(vm.evaluate_snippet("snippet", "{ a: 1 }"),
+                         '{\n   "a": 1\n}\n')
+
+    def test_vm_import_cache(self):
+        files = {'lib.libsonnet': '{ x: 1 }'}
+        calls = []
+
+        def callback(dir, rel):
+            calls.append(rel)
+            return rel, files[rel]
+
+        vm = _jsonnet.Vm(import_callback=callback, import_cache_max=1 << 20)
+        src = "(import 'lib.libsonnet').x"
+        self.assertEqual(vm.evaluate_snippet("snippet", src), "1\n")
+        self.assertEqual(vm.evaluate_snippet("snippet", src), "1\n")
+        files['lib.libsonnet'] = '{ x: 2 }'
+        self.assertEqual(vm.evaluate_snippet("snippet", src), "2\n")
+        self.assertEqual(len(calls), 3)
+
+    def test_vm_import_cache_rewritten_file(self):
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 's2.libsonnet')
+            with open(path, 'w') as f:
+                f.write('{ x: 1 }')
+            vm = _jsonnet.Vm(jpathdir=d, import_cache_max=1 << 30)
+            src = "(import 's2.libsonnet').x"
+            self.assertEqual(vm.evaluate_snippet("snippet", src), "1\n")
+            # The same size, within the resolution of the timestamps.
+            mtime = os.stat(path).st_mtime_ns
+            with open(path, 'w') as f:
+                f.write('{ x: 2 }')
+            os.utime(path, ns=(mtime, mtime))
+            self.assertEqual(vm.evaluate_snippet("snippet", src), "2\n")
+            self.assertEqual(vm.evaluate_snippet("snippet", src), "2\n")
+
+    def test_vm_import_buffers(self):
+        files = {
+            'bytes.libsonnet': b'{ x: 1 }',
+            'view.libsonnet': memoryview(b'{ x: 2 }\0'),
+            'copied.libsonnet': bytearray(b'{ x: 3 }'),
+        }
+
+        def callback(dir, rel):
+            if rel in files:
+                return rel, files[rel]
+            # Left to the VM, which loads the file itself.
+            return os.path.join(os.path.dirname(__file__), rel), None
+
+        vm = _jsonnet.Vm(import_callback=callback)
+        src = """[
+            (import 'bytes.libsonnet').x,
+            (import 'view.libsonnet').x,
+            (import 'copied.libsonnet').x,
+            std.length(importstr 'test.jsonnet') > 0,
+        ]"""
+        self.assertEqual(json.loads(vm.evaluate_snippet("snippet", src)), [1, 2, 3, True])
+        with self.assertRaises(RuntimeError):
+            vm.evaluate_snippet("snippet", "import 'x.libsonnet'")
+
+    def test_vm_import_mapped_file_rewritten(self):
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'big.txt')
+            size = 100 * 1000
+            with open(path, 'wb') as f:
+                f.write(b'a' * size)
+
+            def callback(dir, rel):
+                # Left to the VM, which maps a file this large into memory.
+                return path, None
+
+            vm = _jsonnet.Vm(import_callback=callback, import_cache_max=1 << 30)
+            src = "(importstr 'big.txt')[0:3]"
+            self.assertEqual(vm.evaluate_snippet("snippet", src), '"aaa"\n')
+            with open(path, 'r+b') as f:
+                f.write(b'b' * size)
+            self.assertEqual(vm.evaluate_snippet("snippet", src), '"bbb"\n')
+
+    def test_vm_import_fallback(self):
+        jpath = os.path.dirname(os.path.abspath(__file__))
+        calls = []
+
+        def fallback(dir, rel):
+            calls.append(rel)
+            if rel != 'generated.libsonnet':
+                raise RuntimeError('no such file')
+            return rel, '{ x: 1 }'
+
+        vm = _jsonnet.Vm(jpathdir=jpath, import_fallback=fallback, import_path_cache=True)
+        src = "[(import 'generated.libsonnet').x, std.length(importstr 'test.jsonnet') > 0]"
+        for _ in range(2):
+            self.assertEqual(json.loads(vm.evaluate_snippet("snippet", src)), [1, True])
+        self.assertEqual(calls, ['generated.libsonnet'] * 2)
+        with self.assertRaises(RuntimeError):
+            vm.evaluate_snippet("snippet", "import 'missing.libsonnet'")
+        with self.assertRaises(TypeError):
+            _jsonnet.Vm(import_callback=fallback, import_fallback=fallback)
+
+    def test_vm_evaluate_value(self):
+        vm = _jsonnet.Vm()
+        src = """{
+            a: [1, 2.5, 'x', null, true, false, [], {}],
+            b: { c: std.pow(2, 60), 'é': '\\u00e9' },
+        }"""
+        value = vm.evaluate_snippet_value("snippet", src)
+        self.assertEqual(value, json.loads(vm.evaluate_snippet("snippet", src)))
+        self.assertEqual(list(value.keys()), ['a', 'b'])
+        self.assertIsInstance(value['a'][0], int)
+        self.assertEqual(vm.compile_snippet("snippet", "[1]").evaluate_value(), [1])
+        with self.assertRaises(RuntimeError):
+            vm.evaluate_snippet_value("snippet", "[function(x) x]")
+
+    def test_vm_evaluate_value_large(self):
+        vm = _jsonnet.Vm()
+        src = "[{ name: 'item%d' % i, o: { a: [i], b: { c: null } } } for i in std.range(1, 5000)]"
+        value = vm.evaluate_snippet_value("snippet", src)
+        self.assertEqual(value, json.loads(vm.evaluate_snippet("snippet", src)))
+        # Field names are shared between objects, as with json.loads.
+        self.assertIs(list(value[0].keys())[0], list(value[1].keys())[0])
+        with self.assertRaisesRegex(RuntimeError, 'boom'):
+            vm.evaluate_snippet_value(
+                "snippet",
+                "std.makeArray(5000, function(i) if i == 4999 then error 'boom' else { a: i })")
+
+    def test_vm_vars_as_values(self):
+        vm = _jsonnet.Vm()
+        inventory = {'hosts': [{'name': 'a', 'port': 80}, None, True, 1.5]}
+        value = vm.evaluate_snippet_value(
+            "snippet",
+            "function(inv, n) [std.extVar('inv'), inv.hosts[0].port + n, std.extVar('s')]",
+            ext_vars={'inv': inventory, 's': 'str'},
+            tla_vars={'inv': inventory, 'n': 1},
+        )
+        self.assertEqual(value, [inventory, 81, 'str'])
+        program = vm.compile_snippet("snippet", "function(x) x")
+        self.assertEqual(program.evaluate_value(tla_vars={'x': [1, {}]}), [1, {}])
+        with self.assertRaises(TypeError):
+            vm.evaluate_snippet("snippet", "1", ext_vars={'x': object()})
+
+    def test_vm_evaluate_to(self):
+        vm = _jsonnet.Vm()
+        src = "{ ['f' + i]: [i, 'caf\u00e9'] for i in std.range(1, 5000) }"
+        out = io.StringIO()
+        self.assertIsNone(vm.evaluate_snippet_to("snippet", src, out))
+        self.assertEqual(out.getvalue(), vm.evaluate_snippet("snippet", src))
+        program = vm.compile_snippet("snippet", "function(x) [x]")
+        out = io.StringIO()
+        program.evaluate_to(out, tla_vars={'x': 'y'})
+        self.assertEqual(out.getvalue(), '[\n   "y"\n]\n')
+
+        class Full(object):
+            def write(self, chunk):
+                raise IOError('disk full')
+        with self.assertRaisesRegex(IOError, 'disk full'):
+            vm.evaluate_snippet_to("snippet", src, Full())
+        with self.assertRaisesRegex(RuntimeError, 'RUNTIME ERROR: e'):
+            vm.evaluate_snippet_to("snippet", 'error "e"', io.StringIO())
+
+    def test_evaluate_many(self):
+        jobs = [{'filename': self.input_filename}]
+        jobs += [
+            {'filename': 'snippet', 'src': "std.extVar('i') * 2", 'ext_vars': {'i': i}}
+            for i in range(20)
+        ]
+        results = _jsonnet.evaluate_many(
+            jobs,
+            workers=4,
+            import_callback=import_callback,
+            native_callbacks=native_callbacks,
+        )
+        self.assertEqual(results, [self.expected_str] + ['%d\n' % (i * 2) for i in range(20)])
+        self.assertEqual(_jsonnet.evaluate_many([]), [])
+
+    def test_evaluate_many_errors(self):
+        jobs = [
+            {'filename': 'a', 'src': '1'},
+            {'filename': 'b', 'src': 'error "b"'},
+            {'filename': 'c', 'src': 'error "c"'},
+        ]
+        with self.assertRaisesRegex(RuntimeError, 'RUNTIME ERROR: b'):
+            _jsonnet.evaluate_many(jobs, workers=2)
+        results = _jsonnet.evaluate_many(jobs, return_exceptions=True)
+        self.assertEqual(results[0], '1\n')
+        self.assertIsInstance(results[1], RuntimeError)
+        self.assertIn('RUNTIME ERROR: c', str(results[2]))
+        with self.assertRaises(TypeError):
+            _jsonnet.evaluate_many(['1'])
+
+    def test_evaluate_async(self):
+        async def async_import_callback(dir, rel):
+            await asyncio.sleep(0)
+            return import_callback(dir, rel)
+
+        async def main():
+            return await asyncio.gather(
+                _jsonnet.evaluate_file_async(
+                    self.input_filename,
+                    import_callback=async_import_callback,
+                    native_callbacks=native_callbacks,
+                ),
+                *[
+                    _jsonnet.evaluate_snippet_async("snippet", "std.extVar('i')",
+                                                    ext_vars={'i': i})
+                    for i in range(10)
+                ]
+            )
+
+        results = asyncio.run(main())
+        self.assertEqual(results, [self.expected_str] + ['%d\n' % i for i in range(10)])
+
+    def test_evaluate_async_error(self):
+        async def main():
+            await _jsonnet.evaluate_snippet_async("snippet", 'error "e"')
+
+        with self.assertRaisesRegex(RuntimeError, 'RUNTIME ERROR: e'):
+            asyncio.run(main())
+
+    def test_evaluate_async_cancel(self):
+        async def main():
+            with self.assertRaises(asyncio.TimeoutError):
+                await asyncio.wait_for(
+                    _jsonnet.evaluate_snippet_async(
+                        "snippet", "local loop(i) = loop(i + 1) tailstrict; loop(0)"),
+                    0.1)
+            # With a single worker, this only runs once the loop above has stopped.
+            return await _jsonnet.evaluate_snippet_async("snippet", "1")
+
+        _jsonnet.set_async_workers(1)
+        try:
+            self.assertEqual(asyncio.run(main()), '1\n')
+        finally:
+            _jsonnet.set_async_workers(0)
+
 if __name__ == '__main__':
     unittest.main()
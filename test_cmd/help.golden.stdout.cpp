@@ -10,10 +10,13 @@ Available options:
   -m / --multi <dir>      Write multiple files to the directory, list files on stdout
   -y / --yaml-stream      Write output as a YAML stream of JSON documents
   -S / --string           Expect a string, manifest as plain text
+  --select <path>         Evaluate only the value at a path such as a.b.0 (repeatable)
   -s / --max-stack <n>    Number of allowed stack frames
   -t / --max-trace <n>    Max length of stack trace before cropping
   --gc-min-objects <n>    Do not run garbage collector until this many
   --gc-growth-trigger <n> Run garbage collector after this amount of object growth
+  --gc-stats              Print garbage collector statistics to stderr
+  --timings               Print the time taken to evaluate and to write to stderr
   --version               Print version
 Available options for specifying values of 'external' variables:
 Provide the value as a string:
@@ -96,6 +96,26 @@ if do_test "multi3" 0 -m "out/multi3" -o "out/multi3/list" -e '{ file1: "file1",
     check_file "multi3" "out/multi3/list" "multi3.golden.list"
 fi
 do_test "multi4" 1 -m -- -e 'null'
+if mkdir -p "out/multi5" && echo '"same"' > "out/multi5/same" && echo '"old"' > "out/multi5/changed" \
+    && echo '"abc"' > "out/multi5/same_size" && echo '"old"' > "out/multi5/link_target" \
+    && ln -s "link_target" "out/multi5/link" && echo '"old"' > "out/multi5/hard" \
+    && ln "out/multi5/hard" "out/multi5/hard_link"; then
+    # Verify that only the files whose content changed are written
+    touch -m -t 199108252057.08 "out/multi5/same"
+    stat -c '%y' "out/multi5/same" > "out/multi5/stat_mod_time_before.txt"
+    if do_test "multi5" 0 -m "out/multi5" \
+        -e '{ same: "same", changed: "changed", same_size: "xyz", link: "link", hard: "hard" }'; then
+        stat -c '%y' "out/multi5/same" > "out/multi5/stat_mod_time_after.txt"
+        check_file "multi5" "out/multi5/stat_mod_time_before.txt" "out/multi5/stat_mod_time_after.txt"
+        check_file "multi5" "out/multi5/changed" "multi5.golden.changed"
+        check_file "multi5" "out/multi5/same_size" "multi5.golden.same_size"
+        # Links are written through, not replaced.
+        check_file "multi5" "out/multi5/link_target" "multi5.golden.link"
+        check_file "multi5" "out/multi5/hard_link" "multi5.golden.hard"
+        stat -c '%n: %F, %h' "out/multi5/link" "out/multi5/hard" > "out/multi5/stat_links.txt"
+        check_file "multi5" "out/multi5/stat_links.txt" "multi5.golden.stat_links"
+    fi
+fi
 do_test "yaml1" 0 -y -e '[1,2,3]'
 do_test "yaml2" 1 -y -e 'null'
 if do_test "yaml3" 0 -y -o "out/yaml3/stream" -e '[1,2,3]'; then